@@ -1,5 +1,6 @@
 from __future__ import with_statement
 
+import re
 import sys
 
 from alembic import context
@@ -25,6 +26,14 @@ if 'pytest' not in sys.modules:
 # target_metadata = mymodel.Base.metadata
 target_metadata = metadata
 
+USER_ACTION_PARTITION = re.compile(r'^user_action_(y\d{4}m\d{2}|default)$')
+
+
+def include_object(object, name, type_, reflected, compare_to):
+    """Skip the partitions of user_action and their indexes, they are created by the bot."""
+    table_name = object.table.name if type_ == 'index' else name
+    return not (type_ in ('table', 'index') and USER_ACTION_PARTITION.match(table_name))
+
 
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
@@ -46,7 +55,7 @@ def run_migrations_offline():
     """
     url = mosbot_config.DATABASE_URL
     context.configure(
-        url=url, target_metadata=target_metadata, literal_binds=True)
+        url=url, target_metadata=target_metadata, literal_binds=True, include_object=include_object)
 
     with context.begin_transaction():
         context.run_migrations()
@@ -67,7 +76,8 @@ def run_migrations_online():
     with connectable.connect() as connection:
         context.configure(
             connection=connection,
-            target_metadata=target_metadata
+            target_metadata=target_metadata,
+            include_object=include_object,
         )
 
         with context.begin_transaction():
@@ -0,0 +1,115 @@
+"""Partition user_action by month.
+
+The data is copied online: the new partitioned table is filled in batches, each one committed on its own, while a
+trigger mirrors the writes done meanwhile. The table is only locked to swap them at the end.
+
+Revision ID: 216f139d9fe6
+Revises: 26177272785e
+Create Date: 2026-10-19 19:20:37.480112+00:00
+
+"""
+import datetime
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '216f139d9fe6'
+down_revision = '26177272785e'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 10000
+MONTHS_AHEAD = 3
+MAX_MONTHS_BEHIND = 240
+"""Older actions go to the default partition, so wrong timestamps don't create thousands of partitions"""
+
+COLUMNS = 'id, ts, playback_id, user_id, action'
+
+
+def add_months(month, months):  # noqa D103
+    month_index = month.year * 12 + month.month - 1 + months
+    return datetime.datetime(month_index // 12, month_index % 12 + 1, 1)
+
+
+def upgrade():  # noqa D103
+    bind = op.get_bind()
+    op.execute("""
+        CREATE TABLE user_action_partitioned (
+            id integer NOT NULL DEFAULT nextval('user_action_id_seq'::regclass),
+            ts timestamp without time zone NOT NULL,
+            playback_id integer NOT NULL,
+            user_id integer,
+            action action NOT NULL,
+            CONSTRAINT user_action_partitioned_pkey PRIMARY KEY (id, ts),
+            CONSTRAINT user_action_partitioned_playback_id_fkey FOREIGN KEY (playback_id) REFERENCES playback (id),
+            CONSTRAINT user_action_partitioned_user_id_fkey FOREIGN KEY (user_id) REFERENCES "user" (id)
+        ) PARTITION BY RANGE (ts)
+    """)
+    op.execute('CREATE INDEX ix_user_action_partitioned_playback_id ON user_action_partitioned (playback_id)')
+    op.execute('CREATE INDEX ix_user_action_partitioned_ts ON user_action_partitioned (ts)')
+
+    now = datetime.datetime.utcnow()
+    current_month = add_months(now, 0)
+    first_ts = bind.execute('SELECT min(ts) FROM user_action').scalar() or now
+    month = max(add_months(first_ts, 0), add_months(current_month, -MAX_MONTHS_BEHIND))
+    while month <= add_months(current_month, MONTHS_AHEAD):
+        next_month = add_months(month, 1)
+        op.execute(f"CREATE TABLE user_action_y{month.year:04d}m{month.month:02d} PARTITION OF user_action_partitioned "
+                   f"FOR VALUES FROM ('{month.isoformat()}') TO ('{next_month.isoformat()}')")
+        month = next_month
+    op.execute('CREATE TABLE user_action_default PARTITION OF user_action_partitioned DEFAULT')
+
+    # Mirror the writes that happen while copying
+    op.execute(f"""
+        CREATE FUNCTION user_action_mirror() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                DELETE FROM user_action_partitioned WHERE id = OLD.id AND ts = OLD.ts;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                INSERT INTO user_action_partitioned ({COLUMNS})
+                VALUES (NEW.id, NEW.ts, NEW.playback_id, NEW.user_id, NEW.action)
+                ON CONFLICT DO NOTHING;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute('CREATE TRIGGER user_action_mirror AFTER INSERT OR UPDATE OR DELETE ON user_action '
+               'FOR EACH ROW EXECUTE FUNCTION user_action_mirror()')
+    # Creating the trigger locks the table, all the rows committed before have an id up to this one
+    last_id = bind.execute('SELECT max(id) FROM user_action').scalar() or 0
+
+    with op.get_context().autocommit_block():
+        for from_id in range(0, last_id + 1, BATCH_SIZE):
+            op.execute(f'INSERT INTO user_action_partitioned ({COLUMNS}) '
+                       f'SELECT {COLUMNS} FROM user_action WHERE id >= {from_id} AND id < {from_id + BATCH_SIZE} '
+                       f'ON CONFLICT DO NOTHING')
+
+    op.execute('LOCK TABLE user_action IN ACCESS EXCLUSIVE MODE')
+    op.execute('DROP TRIGGER user_action_mirror ON user_action')
+    op.execute('DROP FUNCTION user_action_mirror()')
+    op.execute('ALTER SEQUENCE user_action_id_seq OWNED BY user_action_partitioned.id')
+    op.execute('DROP TABLE user_action')
+    op.execute('ALTER TABLE user_action_partitioned RENAME TO user_action')
+    for suffix in ('pkey', 'playback_id_fkey', 'user_id_fkey'):
+        op.execute(f'ALTER TABLE user_action '
+                   f'RENAME CONSTRAINT user_action_partitioned_{suffix} TO user_action_{suffix}')
+    for column in ('playback_id', 'ts'):
+        op.execute(f'ALTER INDEX ix_user_action_partitioned_{column} RENAME TO ix_user_action_{column}')
+
+
+def downgrade():  # noqa D103
+    op.execute('LOCK TABLE user_action IN ACCESS EXCLUSIVE MODE')
+    op.execute('CREATE TABLE user_action_unpartitioned (LIKE user_action INCLUDING DEFAULTS)')
+    op.execute(f'INSERT INTO user_action_unpartitioned ({COLUMNS}) SELECT {COLUMNS} FROM user_action')
+    op.execute('ALTER SEQUENCE user_action_id_seq OWNED BY user_action_unpartitioned.id')
+    op.execute('DROP TABLE user_action')
+    op.execute('ALTER TABLE user_action_unpartitioned RENAME TO user_action')
+    op.execute('ALTER TABLE user_action ADD CONSTRAINT user_action_pkey PRIMARY KEY (id)')
+    op.execute('ALTER TABLE user_action ADD CONSTRAINT user_action_playback_id_fkey '
+               'FOREIGN KEY (playback_id) REFERENCES playback (id)')
+    op.execute('ALTER TABLE user_action ADD CONSTRAINT user_action_user_id_fkey '
+               'FOREIGN KEY (user_id) REFERENCES "user" (id)')
+    op.execute('CREATE INDEX ix_user_action_playback_id ON user_action (playback_id)')
+    op.execute('CREATE INDEX ix_user_action_ts ON user_action (ts)')
@@ -0,0 +1,42 @@
+"""Add activity rollup tables.
+
+Revision ID: 26177272785e
+Revises: 602043520b9d
+Create Date: 2026-10-19 18:41:12.372615+00:00
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '26177272785e'
+down_revision = '602043520b9d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():  # noqa D103
+    # No backfill, without a watermark the first refresh rolls up the whole history
+    for table in ('activity_hourly', 'activity_daily'):
+        op.create_table(table,
+                        sa.Column('bucket', sa.DateTime(), nullable=False),
+                        sa.Column('plays', sa.Integer(), nullable=False),
+                        sa.Column('djs', sa.Integer(), nullable=False),
+                        sa.Column('upvotes', sa.Integer(), nullable=False),
+                        sa.Column('downvotes', sa.Integer(), nullable=False),
+                        sa.Column('skips', sa.Integer(), nullable=False),
+                        sa.PrimaryKeyConstraint('bucket')
+                        )
+    op.create_table('activity_dirty',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('hour', sa.DateTime(), nullable=False),
+                    sa.PrimaryKeyConstraint('id')
+                    )
+    op.create_index(op.f('ix_user_action_ts'), 'user_action', ['ts'], unique=False)
+
+
+def downgrade():  # noqa D103
+    op.drop_index(op.f('ix_user_action_ts'), table_name='user_action')
+    op.drop_table('activity_dirty')
+    op.drop_table('activity_daily')
+    op.drop_table('activity_hourly')
@@ -0,0 +1,103 @@
+"""Add user and track stats tables.
+
+Revision ID: 602043520b9d
+Revises: 7fdfd9e2fd80
+Create Date: 2026-10-19 18:02:41.514207+00:00
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '602043520b9d'
+down_revision = '7fdfd9e2fd80'
+branch_labels = None
+depends_on = None
+
+PLAYED = """
+    SELECT playback.{key} AS key,
+           count(*) AS plays,
+           sum(CASE WHEN playback_summary.skipped
+                    THEN least(track.length,
+                               greatest(0, floor(extract(epoch FROM playback_summary.skip_ts - playback.start))))
+                    ELSE track.length END) AS listened_seconds,
+           sum(playback_summary.upvotes) AS updubs,
+           sum(playback_summary.downvotes) AS downdubs,
+           count(*) FILTER (WHERE playback_summary.skipped) AS skips,
+           max(playback.start) AS last_played
+    FROM playback
+    JOIN track ON track.id = playback.track_id
+    JOIN playback_summary ON playback_summary.playback_id = playback.id
+    GROUP BY playback.{key}
+"""
+
+STATS = """
+    coalesce(played.plays, 0),
+    coalesce(played.listened_seconds, 0),
+    coalesce(played.updubs, 0),
+    coalesce(played.downdubs, 0),
+    coalesce(played.skips, 0),
+    played.last_played
+"""
+
+
+def upgrade():  # noqa D103
+    op.create_table('user_stats',
+                    sa.Column('user_id', sa.Integer(), nullable=False),
+                    sa.Column('plays', sa.Integer(), nullable=False),
+                    sa.Column('listened_seconds', sa.Integer(), nullable=False),
+                    sa.Column('updubs', sa.Integer(), nullable=False),
+                    sa.Column('downdubs', sa.Integer(), nullable=False),
+                    sa.Column('skips', sa.Integer(), nullable=False),
+                    sa.Column('updubs_given', sa.Integer(), nullable=False),
+                    sa.Column('downdubs_given', sa.Integer(), nullable=False),
+                    sa.Column('last_played', sa.DateTime(), nullable=True),
+                    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+                    sa.PrimaryKeyConstraint('user_id')
+                    )
+    op.create_table('track_stats',
+                    sa.Column('track_id', sa.Integer(), nullable=False),
+                    sa.Column('plays', sa.Integer(), nullable=False),
+                    sa.Column('listened_seconds', sa.Integer(), nullable=False),
+                    sa.Column('updubs', sa.Integer(), nullable=False),
+                    sa.Column('downdubs', sa.Integer(), nullable=False),
+                    sa.Column('skips', sa.Integer(), nullable=False),
+                    sa.Column('last_played', sa.DateTime(), nullable=True),
+                    sa.ForeignKeyConstraint(['track_id'], ['track.id'], ),
+                    sa.PrimaryKeyConstraint('track_id')
+                    )
+    # Backfill, the same as `mosbot stats_rebuild` does
+    op.execute(f"""
+        INSERT INTO user_stats (user_id, plays, listened_seconds, updubs, downdubs, skips, last_played, updubs_given,
+                                downdubs_given)
+        SELECT "user".id,
+               {STATS},
+               coalesce(given.updubs_given, 0),
+               coalesce(given.downdubs_given, 0)
+        FROM "user"
+        LEFT OUTER JOIN ({PLAYED.format(key='user_id')}) AS played ON played.key = "user".id
+        LEFT OUTER JOIN (
+            SELECT user_id,
+                   count(*) FILTER (WHERE action = 'upvote') AS updubs_given,
+                   count(*) FILTER (WHERE action = 'downvote') AS downdubs_given
+            FROM (
+                SELECT DISTINCT ON (playback_id, user_id) user_id, action
+                FROM user_action
+                WHERE action IN ('upvote', 'downvote') AND user_id IS NOT NULL
+                ORDER BY playback_id, user_id, ts DESC, id DESC
+            ) AS last_votes
+            GROUP BY user_id
+        ) AS given ON given.user_id = "user".id
+    """)
+    op.execute(f"""
+        INSERT INTO track_stats (track_id, plays, listened_seconds, updubs, downdubs, skips, last_played)
+        SELECT track.id,
+               {STATS}
+        FROM track
+        LEFT OUTER JOIN ({PLAYED.format(key='track_id')}) AS played ON played.key = track.id
+    """)
+
+
+def downgrade():  # noqa D103
+    op.drop_table('track_stats')
+    op.drop_table('user_stats')
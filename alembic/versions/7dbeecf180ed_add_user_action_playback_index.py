@@ -0,0 +1,22 @@
+"""Add user_action playback_id index.
+
+Revision ID: 7dbeecf180ed
+Revises: 343c78c7a0b8
+Create Date: 2026-10-19 16:52:41.318204+00:00
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '7dbeecf180ed'
+down_revision = '343c78c7a0b8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():  # noqa D103
+    op.create_index('ix_user_action_playback_id', 'user_action', ['playback_id'])
+
+
+def downgrade():  # noqa D103
+    op.drop_index('ix_user_action_playback_id', 'user_action')
@@ -0,0 +1,62 @@
+"""Add playback summary table.
+
+Revision ID: 7fdfd9e2fd80
+Revises: 7dbeecf180ed
+Create Date: 2026-10-19 17:21:06.104381+00:00
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '7fdfd9e2fd80'
+down_revision = '7dbeecf180ed'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():  # noqa D103
+    op.create_table('playback_summary',
+                    sa.Column('playback_id', sa.Integer(), nullable=False),
+                    sa.Column('upvotes', sa.Integer(), nullable=False),
+                    sa.Column('downvotes', sa.Integer(), nullable=False),
+                    sa.Column('voters', sa.Integer(), nullable=False),
+                    sa.Column('skipped', sa.Boolean(), nullable=False),
+                    sa.Column('skip_ts', sa.DateTime(), nullable=True),
+                    sa.ForeignKeyConstraint(['playback_id'], ['playback.id'], ),
+                    sa.PrimaryKeyConstraint('playback_id')
+                    )
+    # Backfill, the same as `mosbot summary_rebuild` does
+    op.execute("""
+        INSERT INTO playback_summary (playback_id, upvotes, downvotes, voters, skipped, skip_ts)
+        SELECT playback.id,
+               coalesce(votes.upvotes, 0),
+               coalesce(votes.downvotes, 0),
+               coalesce(votes.voters, 0),
+               skips.skip_ts IS NOT NULL,
+               skips.skip_ts
+        FROM playback
+        LEFT OUTER JOIN (
+            SELECT playback_id,
+                   count(*) FILTER (WHERE action = 'upvote') AS upvotes,
+                   count(*) FILTER (WHERE action = 'downvote') AS downvotes,
+                   count(*) AS voters
+            FROM (
+                SELECT DISTINCT ON (playback_id, coalesce(user_id, -id)) playback_id, action
+                FROM user_action
+                WHERE action IN ('upvote', 'downvote')
+                ORDER BY playback_id, coalesce(user_id, -id), ts DESC, id DESC
+            ) AS last_votes
+            GROUP BY playback_id
+        ) AS votes ON votes.playback_id = playback.id
+        LEFT OUTER JOIN (
+            SELECT playback_id, min(ts) AS skip_ts
+            FROM user_action
+            WHERE action = 'skip'
+            GROUP BY playback_id
+        ) AS skips ON skips.playback_id = playback.id
+    """)
+
+
+def downgrade():  # noqa D103
+    op.drop_table('playback_summary')
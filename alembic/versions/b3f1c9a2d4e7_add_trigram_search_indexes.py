@@ -0,0 +1,45 @@
+"""Add trigram search indexes.
+
+The GIN trigram indexes make partial and fuzzy matches of track names and usernames an index scan. They are built
+concurrently, so the tables are not locked meanwhile. They need the pg_trgm extension, if the server doesn't have it,
+they are not created and the search falls back to a scan. As they may not exist, they are not declared in
+:ref:`mosbot.db`.
+
+Revision ID: b3f1c9a2d4e7
+Revises: 216f139d9fe6
+Create Date: 2026-10-19 20:41:12.538190+00:00
+
+"""
+import logging
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'b3f1c9a2d4e7'
+down_revision = '216f139d9fe6'
+branch_labels = None
+depends_on = None
+
+logger = logging.getLogger(__name__)
+
+INDEXES = {
+    'ix_track_name_trgm': ('track', 'name'),
+    'ix_user_username_trgm': ('"user"', 'username'),
+}
+
+
+def upgrade():  # noqa D103
+    bind = op.get_bind()
+    if not bind.execute("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'").scalar():
+        logger.warning('The pg_trgm extension is not available, the search indexes are not created')
+        return
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    with op.get_context().autocommit_block():
+        for name, (table, column) in INDEXES.items():
+            op.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} USING gin ({column} gin_trgm_ops)')
+
+
+def downgrade():  # noqa D103
+    # The extension is left, other objects may use it
+    for name in INDEXES:
+        op.execute(f'DROP INDEX IF EXISTS {name}')
@@ -0,0 +1,34 @@
+"""Add track canonical table.
+
+Revision ID: c4d2e8f1a6b3
+Revises: b3f1c9a2d4e7
+Create Date: 2026-10-19 21:32:07.104853+00:00
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'c4d2e8f1a6b3'
+down_revision = 'b3f1c9a2d4e7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():  # noqa D103
+    # It's filled by the bot, or `mosbot tracks_dedupe`
+    op.create_table('track_canonical',
+                    sa.Column('track_id', sa.Integer(), nullable=False),
+                    sa.Column('canonical_track_id', sa.Integer(), nullable=False),
+                    sa.Column('similarity', sa.Float(), nullable=False),
+                    sa.ForeignKeyConstraint(['canonical_track_id'], ['track.id'], ),
+                    sa.ForeignKeyConstraint(['track_id'], ['track.id'], ),
+                    sa.PrimaryKeyConstraint('track_id')
+                    )
+    op.create_index(op.f('ix_track_canonical_canonical_track_id'), 'track_canonical', ['canonical_track_id'],
+                    unique=False)
+
+
+def downgrade():  # noqa D103
+    op.drop_index(op.f('ix_track_canonical_canonical_track_id'), table_name='track_canonical')
+    op.drop_table('track_canonical')
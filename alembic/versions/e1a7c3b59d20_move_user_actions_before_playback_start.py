@@ -0,0 +1,33 @@
+"""Move the user actions stored before their playback started.
+
+The queries on the actions of some playbacks only read the partitions since their start, less the clock skew, so the
+actions stored earlier are moved up to it, as :ref:`mosbot.query.save_user_action` does from now on.
+
+Revision ID: e1a7c3b59d20
+Revises: c4d2e8f1a6b3
+Create Date: 2026-10-19 23:12:41.530271+00:00
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'e1a7c3b59d20'
+down_revision = 'c4d2e8f1a6b3'
+branch_labels = None
+depends_on = None
+
+ACTION_CLOCK_SKEW = '1 hour'
+"""As :ref:`mosbot.query.ACTION_CLOCK_SKEW`, not imported so the migration doesn't change with it"""
+
+
+def upgrade():  # noqa D103
+    # The rows are moved to the partition of the new ts
+    op.execute(f"""
+        UPDATE user_action SET ts = playback.start - interval '{ACTION_CLOCK_SKEW}'
+        FROM playback
+        WHERE playback.id = user_action.playback_id AND user_action.ts < playback.start - interval '{ACTION_CLOCK_SKEW}'
+    """)
+
+
+def downgrade():  # noqa D103
+    pass  # The ts they had is not kept, and they are right as they are
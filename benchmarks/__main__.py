@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+
+"""Benchmark runner, run it as `python -m benchmarks` from the repository root.
+
+It needs a database it can wipe, it uses the same `DATABASE_URL` configuration as the bot. Results are written as JSON
+so that different commits can be compared.
+"""
+
+import asyncio
+import datetime
+import json
+import platform
+import subprocess
+import sys
+
+import click
+import sqlalchemy as sa
+from alembic.command import downgrade, upgrade
+from alembic.config import Config
+
+from benchmarks import analytics, persistence
+from benchmarks.generator import DubtrackGenerator
+from mosbot import config as mos_config
+from mosbot.db import close_engine
+from mosbot.query import execute_and_first, get_last_playback
+
+SUITES = {
+    'persistence': persistence.run,
+    'analytics': analytics.run,
+}
+"""Suites in the order they run, the later ones use the data stored by the earlier ones"""
+
+
+def git_revision():  # noqa D103
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def database_is_empty():  # noqa D103
+    # A new database doesn't have the tables yet, the suite creates them
+    tables = await execute_and_first(query=sa.select([sa.func.to_regclass('playback').label('playback')]))
+    return tables['playback'] is None or not await get_last_playback()
+
+
+@click.command()
+@click.option('--suite', '-s', 'suites', multiple=True, type=click.Choice(sorted(SUITES)),
+              help='Suites to run, all of them by default')
+@click.option('--songs', default=2000, help='Songs to generate for each of the history and live benchmarks')
+@click.option('--iterations', default=200, help='Iterations for each of the latency benchmarks')
+@click.option('--seed', default=0, help='Seed of the data generator')
+@click.option('--output', '-o', type=click.File('w'), default='-', help='File to write the JSON results to')
+@click.option('--force/--no-force', default=False, help='Wipe the database even if it has data')
+def main(suites, songs, iterations, seed, output, force):
+    """Run the benchmarks on a clean database and write the results as JSON."""
+    loop = asyncio.get_event_loop()
+    if not force and not loop.run_until_complete(database_is_empty()):
+        raise click.UsageError(f'Database {mos_config.DATABASE_URL} has data, use --force to wipe it')
+
+    alembic_config = Config('alembic.ini')
+    downgrade(alembic_config, 'base')
+    upgrade(alembic_config, 'head')
+
+    generator = DubtrackGenerator(seed=seed)
+    results = {}
+    for suite in [suite for suite in SUITES if suite in suites] or SUITES:
+        click.echo(f'Running {suite} suite', err=True)
+        results[suite] = loop.run_until_complete(SUITES[suite](generator, songs=songs, iterations=iterations))
+    loop.run_until_complete(close_engine())
+
+    json.dump({
+        'meta': {
+            'revision': git_revision(),
+            'date': datetime.datetime.utcnow().isoformat(),
+            'python': sys.version,
+            'platform': platform.platform(),
+            'seed': seed,
+            'songs': songs,
+            'iterations': iterations,
+        },
+        'results': results,
+    }, output, indent=2, sort_keys=True)
+    output.write('\n')
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
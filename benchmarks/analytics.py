@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+
+"""Benchmarks of the NumPy room analytics against the same metrics computed in SQL."""
+
+import time
+
+import sqlalchemy as sa
+import sqlalchemy.sql.functions as saf
+
+from mosbot import analytics, query
+from mosbot.db import Playback, Track, get_engine
+from mosbot.usecase.history_sync import bulk_persist_history
+
+
+def sql_metrics_query(key, from_id, to_id):
+    """Compute the metrics of :ref:`analytics.track_metrics` grouped by a playback column, from the user actions."""
+    summary = query._playback_summary_query(from_id, to_id).alias('summary')
+    skipped_after = sa.func.floor(sa.extract('epoch', summary.c.skip_ts - Playback.c.start))
+    listened = sa.case([
+        (summary.c.skipped, sa.func.least(Track.c.length, sa.func.greatest(0, skipped_after))),
+    ], else_=Track.c.length)
+    upvotes, downvotes = saf.sum(summary.c.upvotes), saf.sum(summary.c.downvotes)
+    return sa.select([
+        key,
+        saf.count().label('plays'),
+        saf.count().filter(summary.c.skipped).label('skips'),
+        sa.func.avg(sa.cast(listened, sa.Float) / sa.func.nullif(Track.c.length, 0)).label('listened_fraction'),
+        upvotes.label('upvotes'),
+        downvotes.label('downvotes'),
+        (sa.cast(upvotes, sa.Float) / sa.func.nullif(upvotes + downvotes, 0)).label('vote_ratio'),
+    ]).select_from(
+        summary.join(Playback, Playback.c.id == summary.c.playback_id).join(Track, Track.c.id == Playback.c.track_id)
+    ).where(key.isnot(None)).group_by(key).order_by(key)
+
+
+async def bench_numpy(repeat):
+    """Measure loading the arrays and computing the track metrics and DJ rankings from them."""
+    load, compute = [], []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        playbacks = await analytics.load_playbacks()
+        user_actions = await analytics.load_user_actions()
+        loaded = time.perf_counter()
+        outcomes = analytics.playback_outcomes(playbacks, user_actions)
+        tracks = analytics.track_metrics(playbacks, outcomes)
+        djs = analytics.dj_rankings(playbacks, outcomes)
+        load.append(loaded - started)
+        compute.append(time.perf_counter() - loaded)
+    return {
+        'playbacks': len(playbacks['id']),
+        'user_actions': len(user_actions['id']),
+        'load_seconds': min(load),
+        'compute_seconds': min(compute),
+        'seconds': min(load) + min(compute),
+    }, tracks, djs
+
+
+async def bench_sql(repeat, from_id, to_id):
+    """Measure computing the track metrics and DJ rankings in SQL."""
+    elapsed = []
+    engine = await get_engine()
+    async with engine.acquire() as conn:
+        for _ in range(repeat):
+            started = time.perf_counter()
+            tracks = await (await conn.execute(sql_metrics_query(Playback.c.track_id, from_id, to_id))).fetchall()
+            djs = await (await conn.execute(sql_metrics_query(Playback.c.user_id, from_id, to_id))).fetchall()
+            elapsed.append(time.perf_counter() - started)
+    return {'seconds': min(elapsed)}, tracks, djs
+
+
+async def run(generator, *, songs, iterations):
+    """Run the analytics suite on the data already in the database, generating `songs` if there is none."""
+    first_id, last_id = await query.get_playback_id_range()
+    if first_id is None:
+        await bulk_persist_history(generator.history(songs))
+        first_id, last_id = await query.get_playback_id_range()
+    repeat = max(1, min(iterations, 5))
+    numpy_result, tracks, djs = await bench_numpy(repeat)
+    sql_result, sql_tracks, sql_djs = await bench_sql(repeat, first_id, last_id + 1)
+    same = tracks['track_id'].tolist() == [row['track_id'] for row in sql_tracks] \
+        and tracks['plays'].tolist() == [row['plays'] for row in sql_tracks] \
+        and sorted(djs['user_id'].tolist()) == [row['user_id'] for row in sql_djs]
+    return {
+        'numpy': numpy_result,
+        'sql': sql_result,
+        'speedup': sql_result['seconds'] / numpy_result['seconds'],
+        # Once loaded, the arrays can be sliced and aggregated again without going to the database
+        'compute_speedup': sql_result['seconds'] / numpy_result['compute_seconds'],
+        'same_results': same,
+    }
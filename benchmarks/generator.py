@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+
+"""Deterministic generator of dubtrack-like data, both history pages and live (websocket) events.
+
+The same seed always generates the same data, so benchmark runs are comparable across commits. The distributions try
+to look like the ones of a real room: a few DJs play most of the songs, some tracks are played over and over, around a
+sixth of the songs are skipped and most of the votes are updubs.
+"""
+
+import datetime
+import random
+
+from abot.dubtrack import DubtrackDub, DubtrackPlaying, DubtrackSkip
+
+from mosbot.event_log import ReplayBackend
+
+ROOM_ID = '561b1e59c90a9c0e00df610b'
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def to_ms(dt):
+    """Convert a naive UTC datetime to a dubtrack timestamp (milliseconds since epoch)."""
+    return int((dt - EPOCH).total_seconds() * 1000)
+
+
+def object_id(rnd):
+    """Generate a mongo-like object id, as dubtrack uses."""
+    return '%024x' % rnd.getrandbits(96)
+
+
+class DubtrackGenerator:
+    """Generates users, tracks and the songs played with them.
+
+    :param int seed: Seed for the random generator, same seed means same data
+    :param int users: Number of users in the room
+    :param int tracks: Number of different tracks
+    :param float skip_ratio: Ratio of songs that are skipped
+    :param datetime.datetime start: When the first song is played, following calls continue from the last song
+    """
+
+    def __init__(self, *, seed=0, users=50, tracks=500, skip_ratio=0.15,  # noqa D107
+                 start=datetime.datetime(2018, 1, 1)):
+        self.random = random.Random(seed)
+        self.skip_ratio = skip_ratio
+        self.played = start
+        self.users = [{
+            '_id': object_id(self.random),
+            'username': f'user{num}',
+        } for num in range(users)]
+        self.tracks = [{
+            '_id': object_id(self.random),
+            'fkid': object_id(self.random)[:11],
+            'name': f'Artist {num % 97} - Song {num}',
+            'songLength': self.random.randint(90, 420) * 1000,
+            'type': 'youtube' if self.random.random() < 0.9 else 'soundcloud',
+        } for num in range(tracks)]
+        # Zipf-like weights, few DJs/tracks concentrate most of the playbacks
+        self.user_weights = [1 / (rank + 1) for rank in range(users)]
+        self.track_weights = [1 / (rank + 1) ** 0.8 for rank in range(tracks)]
+
+    def songs(self, count):
+        """Generate `count` consecutive songs, oldest first, in the format of the history API.
+
+        Each song is yielded along with the list of voters (user dicts) and their vote, which the history API doesn't
+        provide but the live events need.
+        """
+        for _ in range(count):
+            played = self.played
+            user = self.random.choices(self.users, self.user_weights)[0]
+            track = self.random.choices(self.tracks, self.track_weights)[0]
+            skipped = self.random.random() < self.skip_ratio
+            listeners = [u for u in self.users if u is not user and self.random.random() < 0.3]
+            votes = [(voter, 'updub' if self.random.random() < 0.85 else 'downdub')
+                     for voter in listeners if self.random.random() < 0.4]
+            length = track['songLength']
+            duration = self.random.randint(5000, length // 2) if skipped else length
+            song = {
+                '_id': object_id(self.random),
+                '_song': dict(track),
+                '_user': dict(user),
+                'created': to_ms(played) - 60000,
+                'downdubs': sum(1 for _, dubtype in votes if dubtype == 'downdub'),
+                'isActive': True,
+                'isPlayed': True,
+                'order': 0,
+                'played': to_ms(played),
+                'roomid': ROOM_ID,
+                'skipped': skipped,
+                'songLength': length,
+                'songid': track['_id'],
+                'updubs': sum(1 for _, dubtype in votes if dubtype == 'updub'),
+                'userid': user['_id'],
+            }
+            self.played = played + datetime.timedelta(milliseconds=duration + self.random.randint(500, 3000))
+            yield song, votes
+
+    def history(self, count):
+        """Generate `count` songs as `persist_history` receives them, a dict of played timestamp to song."""
+        return {song['played'] / 1000: song for song, _ in self.songs(count)}
+
+    def history_pages(self, count, page_size=20):
+        """Generate `count` songs as the history API pages, most recent first."""
+        songs = sorted((song for song, _ in self.songs(count)), key=lambda s: -s['played'])
+        return [songs[i:i + page_size] for i in range(0, len(songs), page_size)]
+
+    def live_data(self, count):
+        """Generate the raw websocket data of `count` songs being played live.
+
+        Each song produces a playing event followed by the burst of votes, and a skip chat event if it was skipped.
+        """
+        for song, votes in self.songs(count):
+            yield {
+                'type': 'room_playlist-update',
+                'song': {key: song[key] for key in ('_id', 'played', 'songid', 'userid', 'skipped', 'updubs',
+                                                    'downdubs', 'songLength')},
+                'songInfo': {
+                    'songid': song['songid'],
+                    'name': song['_song']['name'],
+                    'type': song['_song']['type'],
+                    'fkid': song['_song']['fkid'],
+                    'songLength': song['songLength'],
+                },
+            }
+            updubs = downdubs = 0
+            for voter, dubtype in votes:
+                updubs += dubtype == 'updub'
+                downdubs += dubtype == 'downdub'
+                yield {
+                    'type': 'room_playlist-dub',
+                    'dubtype': dubtype,
+                    'user': dict(voter),
+                    'playlist': {
+                        'played': song['played'],
+                        'songLength': song['songLength'],
+                        'updubs': updubs,
+                        'downdubs': downdubs,
+                    },
+                }
+            if song['skipped']:
+                skipper = self.random.choice(self.users)
+                yield {
+                    'type': 'chat-skip',
+                    'username': skipper['username'],
+                }
+
+    def live_events(self, count):
+        """Generate the events the bot would receive while `count` songs are played live."""
+        backend = ReplayBackend()
+        for user in self.users:
+            backend.register_entity({'id': user['_id'], 'username': user['username']})
+        event_classes = {cls._data_type: cls for cls in (DubtrackPlaying, DubtrackDub, DubtrackSkip)}
+        for data in self.live_data(count):
+            yield event_classes[data['type']](data, backend)
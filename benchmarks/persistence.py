@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+
+"""Benchmarks of the persistence hot paths: history sync, live events handling and the query helpers."""
+
+import time
+
+import sqlalchemy as sa
+
+from mosbot import query
+from mosbot.db import Playback, Track, User, get_engine
+from mosbot.handler import history_handler
+from mosbot.usecase.history_sync import bulk_persist_history, persist_history
+from mosbot.util import latency_summary
+
+
+async def bench_persist_history(generator, songs):
+    """Measure how many history songs per second `persist_history` stores."""
+    history = generator.history(songs)
+    started = time.perf_counter()
+    await persist_history(history)
+    elapsed = time.perf_counter() - started
+    return {
+        'songs': songs,
+        'seconds': elapsed,
+        'songs_per_second': songs / elapsed,
+    }
+
+
+async def bench_bulk_persist_history(generator, songs):
+    """Measure how many history songs per second `bulk_persist_history` stores."""
+    history = generator.history(songs)
+    started = time.perf_counter()
+    await bulk_persist_history(history)
+    elapsed = time.perf_counter() - started
+    return {
+        'songs': songs,
+        'seconds': elapsed,
+        'songs_per_second': songs / elapsed,
+    }
+
+
+async def bench_history_handler(generator, songs):
+    """Measure how many live events per second `history_handler` handles, one after the other."""
+    events = list(generator.live_events(songs))
+    latencies = []
+    started = time.perf_counter()
+    for event in events:
+        event_started = time.perf_counter()
+        await history_handler(event)
+        latencies.append(time.perf_counter() - event_started)
+    elapsed = time.perf_counter() - started
+    return {
+        'songs': songs,
+        'events': len(events),
+        'seconds': elapsed,
+        'events_per_second': len(events) / elapsed,
+        'latency': latency_summary(latencies),
+    }
+
+
+async def bench_query_helpers(iterations):
+    """Measure the latency of the query helpers, over an already open connection."""
+    engine = await get_engine()
+    async with engine.acquire() as conn:
+        users = await (await conn.execute(sa.select([User]).order_by(User.c.id).limit(iterations))).fetchall()
+        tracks = await (await conn.execute(sa.select([Track]).order_by(Track.c.id).limit(iterations))).fetchall()
+        playbacks = await (await conn.execute(
+            sa.select([Playback]).order_by(Playback.c.id).limit(iterations))).fetchall()
+        if not (users and tracks and playbacks):
+            raise ValueError('There is no data to benchmark the query helpers with')
+        users, tracks, playbacks = [dict(u) for u in users], [dict(t) for t in tracks], [dict(p) for p in playbacks]
+
+        helpers = {
+            'get_user': lambda n: query.get_user(user_dict={'dtid': users[n % len(users)]['dtid']}, conn=conn),
+            'get_or_save_user': lambda n: query.get_or_save_user(user_dict={
+                'dtid': users[n % len(users)]['dtid'],
+                'username': users[n % len(users)]['username'],
+            }, conn=conn),
+            'get_track': lambda n: query.get_track(track_dict={
+                'extid': tracks[n % len(tracks)]['extid'],
+                'origin': tracks[n % len(tracks)]['origin'],
+            }, conn=conn),
+            'get_or_save_track': lambda n: query.get_or_save_track(track_dict={
+                key: tracks[n % len(tracks)][key] for key in ('length', 'origin', 'extid', 'name')
+            }, conn=conn),
+            'get_playback': lambda n: query.get_playback(playback_dict={
+                'start': playbacks[n % len(playbacks)]['start'],
+            }, conn=conn),
+            'get_last_playback': lambda n: query.get_last_playback(conn=conn),
+            'query_simplified_user_actions': lambda n: query.query_simplified_user_actions(
+                playbacks[n % len(playbacks)]['id'], conn=conn),
+            'get_user_user_actions': lambda n: query.get_user_user_actions(users[n % len(users)]['id'], conn=conn),
+            'get_user_dub_user_actions': lambda n: query.get_user_dub_user_actions(
+                users[n % len(users)]['id'], conn=conn),
+            'load_bot_data': lambda n: query.load_bot_data('last_saved_history', conn=conn),
+        }
+        results = {}
+        for name, helper in helpers.items():
+            latencies = []
+            for n in range(iterations):
+                started = time.perf_counter()
+                await helper(n)
+                latencies.append(time.perf_counter() - started)
+            results[name] = latency_summary(latencies)
+        return results
+
+
+async def run(generator, *, songs, iterations):
+    """Run the persistence suite, history first so that the live events continue from there."""
+    return {
+        'persist_history': await bench_persist_history(generator, songs),
+        'bulk_persist_history': await bench_bulk_persist_history(generator, songs),
+        'history_handler': await bench_history_handler(generator, songs),
+        'query_helpers': await bench_query_helpers(iterations),
+        'single_flight': query.single_flight_metrics(),
+    }
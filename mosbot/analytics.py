@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""Room analytics computed over whole columns with NumPy, instead of row by row over the query records.
+
+The playbacks and the user actions are loaded as a compact array per field (int32 ids, int64 microseconds since the
+epoch and uint8 action codes), and every metric is a handful of vectorized operations over them.
+"""
+
+import logging
+from typing import Dict
+
+from mosbot.db import Action
+from mosbot.query import NO_USER_ID, iter_playback_rows, iter_user_action_rows
+from mosbot.util import aclosing
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+PLAYBACK_FIELDS = (
+    ('id', 'int32'),
+    ('start', 'int64'),
+    ('track_id', 'int32'),
+    ('user_id', 'int32'),
+    ('length', 'int32'),
+)
+"""Arrays of the playbacks, in the order of :ref:`iter_playback_rows`"""
+USER_ACTION_FIELDS = (
+    ('id', 'int32'),
+    ('playback_id', 'int32'),
+    ('user_id', 'int32'),
+    ('ts', 'int64'),
+    ('action', 'uint8'),
+)
+"""Arrays of the user actions, in the order of :ref:`iter_user_action_rows`"""
+US_PER_SECOND = 1000000
+
+
+def _require_numpy():
+    if np is None:
+        raise RuntimeError('The analytics need numpy, install it with `pip install mosbot[analytics]`')
+
+
+async def _load_arrays(chunks, fields) -> Dict[str, 'np.ndarray']:
+    dtype = np.dtype(list(fields))
+    parts = []
+    async with aclosing(chunks):
+        async for rows in chunks:
+            parts.append(np.array(rows, dtype=dtype))
+    table = np.concatenate(parts) if parts else np.empty(0, dtype=dtype)
+    return {name: np.ascontiguousarray(table[name]) for name, _ in fields}
+
+
+async def load_playbacks(since=None, until=None, *, fetch_size=10000, conn=None) -> Dict[str, 'np.ndarray']:
+    """Load the playbacks started in [since, until) as an array per field, sorted by id.
+
+    They are fetched `fetch_size` rows at a time, and each fetch is converted to arrays right away, so the rows are
+    never all in memory as Python objects.
+
+    :param datetime.datetime since: Only playbacks started at or after this, None to not limit
+    :param datetime.datetime until: Only playbacks started before this, None to not limit
+    :param int fetch_size: Number of rows fetched from the database at a time
+    :param conn: A connection if any open, otherwise the read replica may be used
+    :return: Dict with the arrays of :ref:`PLAYBACK_FIELDS`, the user id is :ref:`NO_USER_ID` if there is none
+    """
+    _require_numpy()
+    return await _load_arrays(iter_playback_rows(since, until, fetch_size=fetch_size, conn=conn), PLAYBACK_FIELDS)
+
+
+async def load_user_actions(since=None, until=None, *, fetch_size=10000, conn=None) -> Dict[str, 'np.ndarray']:
+    """Load the user actions of the playbacks started in [since, until) as an array per field, in no given order.
+
+    Check :ref:`load_playbacks` for the parameters.
+
+    :return: Dict with the arrays of :ref:`USER_ACTION_FIELDS`, the action is the :ref:`Action` value
+    """
+    _require_numpy()
+    return await _load_arrays(iter_user_action_rows(since, until, fetch_size=fetch_size, conn=conn),
+                              USER_ACTION_FIELDS)
+
+
+def _ratio(numerator, denominator):
+    """Divide element-wise, NaN where the denominator is 0."""
+    result = np.full(len(numerator), np.nan)
+    return np.divide(numerator, denominator, out=result, where=denominator > 0)
+
+
+def playback_outcomes(playbacks, user_actions) -> Dict[str, 'np.ndarray']:
+    """Compute the outcome of each playback from its user actions, the same as :ref:`PlaybackSummary`.
+
+    Votes count the last up/down vote of each voter, each vote without user counts as a different voter, and the
+    playback was skipped at its first skip. The actions of playbacks that are not loaded are ignored.
+
+    :param dict playbacks: Arrays of :ref:`load_playbacks`, sorted by id
+    :param dict user_actions: Arrays of :ref:`load_user_actions`
+    :return: Dict of arrays aligned with the playbacks: `upvotes`, `downvotes`, `skipped`, `listened_seconds`, as in
+    :ref:`listened_seconds`, and `listened_fraction`, that over the track length, NaN if it has no length
+    """
+    count = len(playbacks['id'])
+    index = np.searchsorted(playbacks['id'], user_actions['playback_id'])
+    known = index < count
+    known[known] = playbacks['id'][index[known]] == user_actions['playback_id'][known]
+    action = user_actions['action']
+
+    is_vote = known & ((action == Action.upvote.value) | (action == Action.downvote.value))
+    voter = np.where(user_actions['user_id'] != NO_USER_ID, user_actions['user_id'], -user_actions['id'])[is_vote]
+    vote_index, vote_action = index[is_vote], action[is_vote]
+    order = np.lexsort((user_actions['id'][is_vote], user_actions['ts'][is_vote], voter, vote_index))
+    vote_index, voter, vote_action = vote_index[order], voter[order], vote_action[order]
+    last = np.ones(len(order), dtype=bool)
+    last[:-1] = (vote_index[1:] != vote_index[:-1]) | (voter[1:] != voter[:-1])
+    upvotes = np.bincount(vote_index[last & (vote_action == Action.upvote.value)], minlength=count)
+    downvotes = np.bincount(vote_index[last & (vote_action == Action.downvote.value)], minlength=count)
+
+    is_skip = known & (action == Action.skip.value)
+    skip_ts = np.full(count, np.iinfo(np.int64).max)
+    np.minimum.at(skip_ts, index[is_skip], user_actions['ts'][is_skip])
+    skipped = skip_ts != np.iinfo(np.int64).max
+
+    length = playbacks['length'].astype(np.int64)
+    listened = length.copy()
+    skipped_after = (skip_ts[skipped] - playbacks['start'][skipped]) // US_PER_SECOND
+    listened[skipped] = np.minimum(length[skipped], np.maximum(0, skipped_after))
+    return {
+        'upvotes': upvotes,
+        'downvotes': downvotes,
+        'skipped': skipped,
+        'listened_seconds': listened,
+        'listened_fraction': _ratio(listened, length),
+    }
+
+
+def _grouped_metrics(key, keys, inverse, outcomes) -> Dict[str, 'np.ndarray']:
+    count = len(keys)
+    plays = np.bincount(inverse, minlength=count)
+    skips = np.bincount(inverse, weights=outcomes['skipped'], minlength=count).astype(np.int64)
+    upvotes = np.bincount(inverse, weights=outcomes['upvotes'], minlength=count).astype(np.int64)
+    downvotes = np.bincount(inverse, weights=outcomes['downvotes'], minlength=count).astype(np.int64)
+    fraction = outcomes['listened_fraction']
+    with_length = ~np.isnan(fraction)
+    fraction_sum = np.bincount(inverse[with_length], weights=fraction[with_length], minlength=count)
+    return {
+        key: keys,
+        'plays': plays,
+        'skips': skips,
+        'skip_rate': _ratio(skips, plays),
+        'listened_fraction': _ratio(fraction_sum, np.bincount(inverse[with_length], minlength=count)),
+        'upvotes': upvotes,
+        'downvotes': downvotes,
+        'vote_ratio': _ratio(upvotes, upvotes + downvotes),
+    }
+
+
+def track_metrics(playbacks, outcomes) -> Dict[str, 'np.ndarray']:
+    """Compute the metrics of each track played, sorted by track id.
+
+    :param dict playbacks: Arrays of :ref:`load_playbacks`
+    :param dict outcomes: Arrays of :ref:`playback_outcomes` of those playbacks
+    :return: Dict of arrays: `track_id`, `plays`, `skips`, `skip_rate`, mean `listened_fraction`, `upvotes`,
+    `downvotes` and `vote_ratio`, the fraction of the votes that are upvotes. Ratios without any case are NaN
+    """
+    keys, inverse = np.unique(playbacks['track_id'], return_inverse=True)
+    return _grouped_metrics('track_id', keys, inverse, outcomes)
+
+
+def dj_rankings(playbacks, outcomes) -> Dict[str, 'np.ndarray']:
+    """Compute the same metrics as :ref:`track_metrics` for each DJ, best first.
+
+    DJs are ranked by net votes (upvotes minus downvotes), then by plays. Playbacks without DJ are left out.
+
+    :return: Dict of arrays, as in :ref:`track_metrics` but with `user_id` instead of `track_id`
+    """
+    with_dj = playbacks['user_id'] != NO_USER_ID
+    keys, inverse = np.unique(playbacks['user_id'][with_dj], return_inverse=True)
+    metrics = _grouped_metrics('user_id', keys, inverse, {name: array[with_dj] for name, array in outcomes.items()})
+    order = np.lexsort((metrics['user_id'], -metrics['plays'], metrics['downvotes'] - metrics['upvotes']))
+    return {name: array[order] for name, array in metrics.items()}
+
+
+def room_metrics(outcomes) -> dict:
+    """Compute the metrics of the whole room, as plain numbers, NaN for ratios without any case."""
+    plays = len(outcomes['skipped'])
+    upvotes, downvotes = int(outcomes['upvotes'].sum()), int(outcomes['downvotes'].sum())
+    fraction = outcomes['listened_fraction']
+    return {
+        'plays': plays,
+        'skips': int(outcomes['skipped'].sum()),
+        'skip_rate': float(outcomes['skipped'].mean()) if plays else float('nan'),
+        'listened_fraction': float(np.nanmean(fraction)) if (~np.isnan(fraction)).any() else float('nan'),
+        'upvotes': upvotes,
+        'downvotes': downvotes,
+        'vote_ratio': upvotes / (upvotes + downvotes) if upvotes + downvotes else float('nan'),
+    }
+
+
+async def compute_room_analytics(since=None, until=None, *, fetch_size=10000, conn=None) -> dict:
+    """Load the playbacks started in [since, until) with their user actions and compute all the metrics.
+
+    Check :ref:`load_playbacks` for the parameters.
+
+    :return: Dict with the `room` metrics, and the arrays of the `tracks` metrics and the `djs` rankings
+    """
+    playbacks = await load_playbacks(since, until, fetch_size=fetch_size, conn=conn)
+    user_actions = await load_user_actions(since, until, fetch_size=fetch_size, conn=conn)
+    logger.debug(f'Loaded {len(playbacks["id"])} playbacks and {len(user_actions["id"])} user actions')
+    outcomes = playback_outcomes(playbacks, user_actions)
+    return {
+        'room': room_metrics(outcomes),
+        'tracks': track_metrics(playbacks, outcomes),
+        'djs': dj_rankings(playbacks, outcomes),
+    }
@@ -4,24 +4,37 @@ from __future__ import absolute_import, print_function, unicode_literals
 from abot.dubtrack import DubtrackBotBackend
 from json import JSONDecodeError
 
-from mosbot.db import BotConfig
+from mosbot.db import BotConfig, close_engine, warm_up_engine
 
 """This file contains"""
 
 import asyncio
+import datetime
+import functools
 import json
+import math
 import pprint
 import typing
 
 import click
 
 import abot.cli as cli
-from abot.bot import Bot, current_event, MessageEvent
-from mosbot import config as mos_config
-from mosbot.handler import availability_handler, history_handler
-from mosbot.query import load_bot_data, save_bot_data
-from mosbot.usecase import save_history_songs
-from mosbot.util import setup_logging, check_alembic_in_latest_version
+from abot.bot import Bot, current_event, extract_possible_argument_types, MessageEvent
+from mosbot import config as mos_config, profiling
+from mosbot.event_log import EventRecorder, read_records, replay_records
+from mosbot.handler import availability_handler, backend_connected, fetch_room_queue, history_handler, \
+    repeat_handler, room_listeners, set_journal, set_repeat_policy
+from mosbot.query import has_user_countries, load_bot_data, save_bot_data
+from mosbot.usecase import AvailabilityChecker, RepeatPolicy, YoutubeAvailabilityProvider, cached_search, \
+    check_playback_summaries, check_upcoming_availability_forever, drain_journal, ensure_user_action_partitions, \
+    ensure_user_action_partitions_forever, export_parquet, export_snapshot, find_recent_playback, import_snapshot, \
+    latest_playbacks, leaderboard_wait, minutes_ago, open_journal, rebuild_activity_rollups, \
+    rebuild_playback_summaries, rebuild_stats, reconcile_room_queue_forever, refresh_activity_rollups, \
+    refresh_activity_rollups_forever, refresh_duplicate_tracks, refresh_duplicate_tracks_forever, \
+    refresh_leaderboards_forever, refresh_recommendations_forever, room_queue_fresh, save_history_songs, \
+    set_availability_checker, suggest_tracks, top_djs, top_tracks, upcoming_tracks, user_stats, \
+    warm_up_recent_playbacks, warm_up_recent_plays
+from mosbot.util import setup_logging, check_alembic_in_latest_version, format_duration, parse_duration
 
 
 class BotConfigValueType(click.ParamType):
@@ -42,6 +55,20 @@ class BotConfigValueType(click.ParamType):
             return False, None
 
 
+class DurationType(click.ParamType):
+    """Duration as a number and a unit, like 7d, 12h or 30m, converted to a timedelta."""
+
+    name = 'duration'
+
+    def convert(self, value, param, ctx):  # noqa D102
+        if isinstance(value, datetime.timedelta):
+            return value
+        try:
+            return parse_duration(value)
+        except ValueError as e:
+            self.fail(str(e), param, ctx)
+
+
 @cli.group(invoke_without_command=True)
 async def botcmd():
     """Group in which the commands available only through the bot are."""
@@ -83,6 +110,171 @@ async def config(key, value):
         await event.reply(f'Value for key {key} is `{json.dumps(value)}`')
 
 
+@botcmd.command()
+@click.option('--seconds', '-s', type=click.IntRange(1, 600), default=30)
+@click.option('--memory/--cpu', '-m/-c', default=False)
+async def profile(seconds, memory):
+    """Profile the running bot for some seconds, writing the result in the profile directory.
+
+    CPU profiles are flamegraph collapsed stacks, memory ones are tracemalloc snapshots. It needs the bot to be run with
+    `--profile-dir`, and it should be controlled as it adds some overhead while it runs.
+    """
+    event: MessageEvent = current_event.get()
+    if not profiling.PROFILE_DIR:
+        await event.reply('Profiling is disabled, run the bot with --profile-dir')
+        return
+    kind = 'memory' if memory else 'CPU'
+    await event.reply(f'Starting {kind} profile for {seconds}s')
+    try:
+        if memory:
+            path = await profiling.profile_memory(seconds)
+        else:
+            path = await profiling.profile_cpu(seconds)
+    except RuntimeError as e:
+        await event.reply(str(e))
+        return
+    await event.reply(f'Profile written to {path}')
+
+
+@botcmd.command()
+@click.option('--limit', '-l', type=click.IntRange(1, 10), default=5)
+async def suggest(limit):
+    """Suggest tracks similar to the one playing, the ones played the most around it."""
+    event: MessageEvent = current_event.get()
+    playing, suggestions = suggest_tracks(limit)
+    if playing is None:
+        await event.reply('There are no suggestions yet')
+    elif not suggestions:
+        await event.reply(f'There are no suggestions for {playing} yet')
+    else:
+        await event.reply(f'Similar to {playing}: {", ".join(suggestions)}')
+
+
+@botcmd.command()
+@click.option('--limit', '-l', type=click.IntRange(1, 20), default=1)
+async def last(limit):
+    """Show the last tracks played, the one playing first."""
+    event: MessageEvent = current_event.get()
+    playbacks = latest_playbacks(limit)
+    if not playbacks:
+        await event.reply('Nothing was played yet')
+        return
+    await event.reply('\n'.join(
+        f'{playback.track_name} by {playback.username} (+{playback.updubs}/-{playback.downdubs})'
+        for playback in playbacks
+    ))
+
+
+@botcmd.command()
+@click.argument('text', nargs=-1, required=True)
+async def whoplayed(text):
+    """Show who played the last track whose name contains the text."""
+    event: MessageEvent = current_event.get()
+    text = ' '.join(text)
+    playback = find_recent_playback(text)
+    if playback is None:
+        await event.reply(f'{text} was not played recently')
+    else:
+        await event.reply(f'{playback.track_name} was played by {playback.username} '
+                          f'{minutes_ago(playback)} minutes ago')
+
+
+async def _leaderboard_allowed(event: MessageEvent) -> bool:
+    """Check whether the user can run a leaderboard command now, telling them how long to wait if not."""
+    wait = leaderboard_wait(event.sender.id)
+    if wait:
+        await event.reply(f'Too many requests, try again in {math.ceil(wait)} seconds')
+    return not wait
+
+
+def _since_text(since: typing.Optional[datetime.timedelta]) -> str:
+    return f' of the last {format_duration(since)}' if since else ''
+
+
+@botcmd.command()
+@click.argument('kind', type=click.Choice(['djs', 'tracks']))
+@click.option('--since', '-s', type=DurationType(), default=None, help='Only the last 7d, 12h... instead of all time')
+@click.option('--limit', '-l', type=click.IntRange(1, mos_config.LEADERBOARD_SIZE), default=5)
+async def top(kind, since, limit):
+    """Show the DJs that played the most, or the tracks played the most."""
+    event: MessageEvent = current_event.get()
+    if not await _leaderboard_allowed(event):
+        return
+    if kind == 'djs':
+        entries = [f'{dj["username"]} ({dj["plays"]})' for dj in await top_djs(limit, since=since)]
+    else:
+        entries = [f'{track["name"]} ({track["plays"]})' for track in await top_tracks(limit, since=since)]
+    if not entries:
+        await event.reply(f'Nothing was played{_since_text(since)}')
+    else:
+        await event.reply(f'Top {kind}{_since_text(since)}: {", ".join(entries)}')
+
+
+@botcmd.command()
+@click.option('--since', '-s', type=DurationType(), default='7d', help='Only the last 7d, 12h...')
+@click.option('--limit', '-l', type=click.IntRange(1, mos_config.LEADERBOARD_SIZE), default=5)
+async def leaderboard(since, limit):
+    """Show the DJs that got the most updubs lately."""
+    event: MessageEvent = current_event.get()
+    if not await _leaderboard_allowed(event):
+        return
+    djs = await top_djs(limit, since=since, order_by='updubs')
+    if not djs:
+        await event.reply(f'Nothing was played{_since_text(since)}')
+    else:
+        entries = ', '.join(f'{dj["username"]} +{dj["updubs"]}' for dj in djs)
+        await event.reply(f'Leaderboard{_since_text(since)}: {entries}')
+
+
+@botcmd.command()
+async def mystats():
+    """Show your stats as a DJ and as a listener."""
+    event: MessageEvent = current_event.get()
+    if not await _leaderboard_allowed(event):
+        return
+    stats = await user_stats(event.sender.id)
+    if not stats or not stats.get('plays') and not stats.get('updubs_given') and not stats.get('downdubs_given'):
+        await event.reply('There are no stats of you yet')
+        return
+    await event.reply(
+        f'{stats["username"]}: {stats["plays"]} plays, +{stats["updubs"]}/-{stats["downdubs"]} received, '
+        f'{stats["skips"]} skipped, +{stats["updubs_given"]}/-{stats["downdubs_given"]} given'
+    )
+
+
+@botcmd.command()
+@click.option('--limit', '-l', type=click.IntRange(1, 10), default=5)
+async def queue(limit):
+    """Show the next tracks in the room queue."""
+    event: MessageEvent = current_event.get()
+    fresh = room_queue_fresh()
+    if fresh is None:
+        await event.reply('The queue is not known yet')
+        return
+    items = upcoming_tracks(limit)
+    reply = f'Next: {", ".join(item.name for item in items)}' if items else 'The queue is empty'
+    if not fresh:
+        reply += ', it may have changed since it was last checked'
+    await event.reply(reply)
+
+
+@botcmd.command()
+@click.option('--limit', '-l', type=click.IntRange(1, 20), default=5)
+@click.option('--users/--tracks', '-u/-t', default=False, help='Search users instead of tracks')
+@click.argument('text', nargs=-1, required=True)
+async def search(limit, users, text):
+    """Search tracks by name, or users by username, even with typos."""
+    event: MessageEvent = current_event.get()
+    text = ' '.join(text)
+    results = await cached_search(text, users=users, limit=limit)
+    if not results:
+        await event.reply(f'Nothing found for {text}')
+    elif users:
+        await event.reply(f'Users: {", ".join(user["username"] for user in results)}')
+    else:
+        await event.reply(f'Tracks: {", ".join(track["name"] for track in results)}')
+
+
 @click.group(invoke_without_command=True)
 def botcli():
     """Group of commands that can only be executed from the command line."""
@@ -99,20 +291,284 @@ def test():
 @botcli.command()
 @click.option('--debug/--no-debug', '-d/ ', default=False)
 @click.option('--room', '-r', nargs=1, default='master-of-soundtrack')
-def run(debug, room):
+@click.option('--profile-dir', type=click.Path(file_okay=False), default=None,
+              help='Enables the profile command, writing the profiles in this directory')
+@click.option('--record-events', type=click.Path(dir_okay=False), default=None,
+              help='Append every event received to this file, to replay it later')
+@click.option('--journal-dir', type=click.Path(file_okay=False), default=None,
+              help='Write history events to a local journal first, so they are not lost if the database is down')
+@click.option('--activity-refresh-interval', type=int, default=mos_config.ACTIVITY_REFRESH_INTERVAL,
+              help='Seconds between refreshes of the activity rollups, 0 to not refresh them')
+@click.option('--recommendations-refresh-interval', type=int, default=mos_config.RECOMMENDATIONS_REFRESH_INTERVAL,
+              help='Seconds between refreshes of the track recommendations, 0 to not recommend tracks')
+@click.option('--duplicate-tracks-refresh-interval', type=int,
+              default=mos_config.DUPLICATE_TRACKS_REFRESH_INTERVAL,
+              help='Seconds between checks of the new tracks for duplicates, 0 to not check them')
+@click.option('--repeat-policy', type=click.Choice([policy.value for policy in RepeatPolicy]),
+              default=mos_config.REPEAT_POLICY, help='What to do when a track played recently is played again')
+@click.option('--queue-reconcile-interval', type=int, default=mos_config.ROOM_QUEUE_RECONCILE_INTERVAL,
+              help='Seconds between reconciliations of the room queue model, 0 to not reconcile it')
+@click.option('--availability-check-interval', type=int, default=mos_config.AVAILABILITY_CHECK_INTERVAL,
+              help='Seconds between checks of the availability of the upcoming tracks, 0 to not check it. Only '
+                   'checked if some user has a country, which must be set by hand')
+@click.option('--leaderboards-refresh-interval', type=int, default=mos_config.LEADERBOARD_REFRESH_INTERVAL,
+              help='Seconds between refreshes of the leaderboards asked for, 0 to not refresh them')
+def run(debug, room, profile_dir, record_events, journal_dir, activity_refresh_interval,
+        recommendations_refresh_interval, duplicate_tracks_refresh_interval, repeat_policy, queue_reconcile_interval,
+        availability_check_interval, leaderboards_refresh_interval):
     """Run the bot, this is the main command that is usually run in the server."""
     check_alembic_in_latest_version()
     setup_logging(debug)
+    profiling.set_profile_dir(profile_dir)
     # Setup
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(warm_up_engine())
+    loop.run_until_complete(warm_up_recent_playbacks())
+    if journal_dir:
+        journal = open_journal(journal_dir)
+        set_journal(journal)
+        loop.create_task(drain_journal(journal))
+    repeat_policy = RepeatPolicy(repeat_policy)
+    set_repeat_policy(repeat_policy)
+    if repeat_policy is not RepeatPolicy.off:
+        loop.run_until_complete(warm_up_recent_plays())
+    loop.create_task(ensure_user_action_partitions_forever(
+        mos_config.USER_ACTION_PARTITION_CHECK_INTERVAL,
+        months_ahead=mos_config.USER_ACTION_PARTITION_MONTHS_AHEAD,
+    ))
+    if activity_refresh_interval:
+        loop.create_task(refresh_activity_rollups_forever(activity_refresh_interval))
+    if recommendations_refresh_interval:
+        loop.create_task(refresh_recommendations_forever(recommendations_refresh_interval))
+    if duplicate_tracks_refresh_interval:
+        loop.create_task(refresh_duplicate_tracks_forever(duplicate_tracks_refresh_interval))
+    if leaderboards_refresh_interval:
+        loop.create_task(refresh_leaderboards_forever(leaderboards_refresh_interval))
     bot = Bot()
     dubtrack_backend = DubtrackBotBackend(room=room)
     dubtrack_backend.configure(username=mos_config.DUBTRACK_USERNAME, password=mos_config.DUBTRACK_PASSWORD)
     bot.attach_backend(backend=dubtrack_backend)
     bot.attach_command_group(botcmd)  #: Disabled until permissions are implemented
+    if queue_reconcile_interval:
+        loop.create_task(reconcile_room_queue_forever(functools.partial(fetch_room_queue, dubtrack_backend),
+                                                      queue_reconcile_interval,
+                                                      connected=functools.partial(backend_connected, dubtrack_backend)))
+    if availability_check_interval and mos_config.YOUTUBE_API_KEY:
+        if loop.run_until_complete(has_user_countries()):
+            set_availability_checker(AvailabilityChecker(YoutubeAvailabilityProvider(mos_config.YOUTUBE_API_KEY)))
+            loop.create_task(check_upcoming_availability_forever(functools.partial(room_listeners, dubtrack_backend),
+                                                                 availability_check_interval))
+        else:
+            click.echo('Not checking the availability of the tracks, no user has a country', err=True)
 
+    recorder = None
+    if record_events:
+        recorder = EventRecorder(record_events)
+        bot.add_event_handler(func=recorder.record_event)
     bot.add_event_handler(func=history_handler)
     bot.add_event_handler(func=availability_handler)
+    if repeat_policy is not RepeatPolicy.off:
+        bot.add_event_handler(func=repeat_handler)
 
     # Run
+    try:
+        loop.run_until_complete(bot.run_forever())
+    finally:
+        if recorder:
+            recorder.close()
+        loop.run_until_complete(close_engine())
+
+
+@botcli.command()
+@click.option('--debug/--no-debug', '-d/ ', default=False)
+@click.option('--speed', '-s', type=float, default=1.0, help='Replay speed multiplier, 0 for as fast as possible')
+@click.option('--max-in-flight', type=int, default=100, help='Maximum handler calls running at the same time')
+@click.option('--output', '-o', type=click.File('w'), default=None, help='Write the JSON report to this file')
+@click.argument('event_log', type=click.Path(exists=True, dir_okay=False))
+def replay(debug, speed, max_in_flight, output, event_log):
+    """Replay an event log recorded with `run --record-events` into the handlers, and report how they performed.
+
+    The events are persisted in the configured database, so it's better to use a test one.
+    """
+    check_alembic_in_latest_version()
+    setup_logging(debug)
+    handlers = {
+        handler.__name__: (handler, tuple(extract_possible_argument_types(handler)))
+        for handler in (history_handler, availability_handler)
+    }
+    loop = asyncio.get_event_loop()
+    report = loop.run_until_complete(replay_records(
+        read_records(event_log), handlers, speed=speed, max_in_flight=max_in_flight,
+    ))
+    loop.run_until_complete(close_engine())
+
+    click.echo(f'Replayed {report["events"]} events in {report["seconds"]:.2f}s '
+               f'({report["events_per_second"] or 0:.1f} events/s)')
+    for name, handler_report in report['handlers'].items():
+        latency = handler_report['latency']
+        click.echo(f'{name}: {handler_report["calls"]} calls, errors {handler_report["errors"] or "none"}, '
+                   f'p50 {latency.get("p50_ms", 0):.1f}ms p95 {latency.get("p95_ms", 0):.1f}ms '
+                   f'p99 {latency.get("p99_ms", 0):.1f}ms')
+    if output:
+        json.dump(report, output, indent=2, sort_keys=True)
+
+
+@botcli.command()
+@click.option('--debug/--no-debug', '-d/ ', default=False)
+@click.option('--bulk/--no-bulk', default=False, help='Load all the songs at once with COPY, for big backfills')
+@click.option('--since', type=float, default=None, help='Timestamp to import from, instead of the last one saved')
+def history_import(debug, bulk, since):
+    """Import the dubtrack history since the last song saved, or since a timestamp to fill a new database."""
+    check_alembic_in_latest_version()
+    setup_logging(debug)
+    loop = asyncio.get_event_loop()
+    last_song = loop.run_until_complete(save_history_songs(since=since, bulk=bulk))
+    loop.run_until_complete(close_engine())
+    if last_song is None:
+        raise click.ClickException('No history was saved')
+    click.echo(f'Saved the history until {last_song}')
+
+
+@botcli.command()
+@click.option('--debug/--no-debug', '-d/ ', default=False)
+@click.option('--batch-size', type=int, default=1000, help='Playbacks recomputed per statement')
+def summary_rebuild(debug, batch_size):
+    """Recompute the playback summaries from the user actions, to backfill or fix them."""
+    check_alembic_in_latest_version()
+    setup_logging(debug)
+    loop = asyncio.get_event_loop()
+    rebuilt = loop.run_until_complete(rebuild_playback_summaries(batch_size=batch_size))
+    loop.run_until_complete(close_engine())
+    click.echo(f'Rebuilt {rebuilt} playback summaries')
+
+
+@botcli.command()
+@click.option('--debug/--no-debug', '-d/ ', default=False)
+@click.option('--batch-size', type=int, default=1000, help='Playbacks checked per statement')
+@click.option('--show', type=int, default=20, help='Mismatches to show')
+def summary_check(debug, batch_size, show):
+    """Check the playback summaries against the user actions, failing if any of them is wrong."""
+    check_alembic_in_latest_version()
+    setup_logging(debug)
+    loop = asyncio.get_event_loop()
+    checked, mismatches = loop.run_until_complete(check_playback_summaries(batch_size=batch_size))
+    loop.run_until_complete(close_engine())
+    for mismatch in mismatches[:show]:
+        click.echo(f'Playback {mismatch["playback_id"]}: stored {mismatch["stored"]}, expected {mismatch["expected"]}')
+    click.echo(f'Checked {checked} playbacks, {len(mismatches)} mismatches')
+    if mismatches:
+        raise click.ClickException('Playback summaries are not consistent, run summary_rebuild')
+
+
+@botcli.command()
+@click.option('--debug/--no-debug', '-d/ ', default=False)
+@click.option('--batch-size', type=int, default=1000, help='Users/tracks recomputed per statement')
+@click.option('--workers', type=int, default=4, help='Statements running at the same time')
+def stats_rebuild(debug, batch_size, workers):
+    """Recompute the user and track stats from the playbacks, to backfill or fix them.
+
+    The playback summaries are the source, run summary_rebuild first if they are not consistent.
+    """
+    check_alembic_in_latest_version()
+    setup_logging(debug)
+    loop = asyncio.get_event_loop()
+    batches = loop.run_until_complete(rebuild_stats(workers=workers, batch_size=batch_size))
+    loop.run_until_complete(close_engine())
+    click.echo(f'Rebuilt stats in {batches} batches')
+
+
+@botcli.command()
+@click.option('--debug/--no-debug', '-d/ ', default=False)
+@click.option('--rebuild/--incremental', default=False, help='Recompute everything instead of only what changed')
+def activity_refresh(debug, rebuild):
+    """Refresh the hourly and daily activity rollups."""
+    check_alembic_in_latest_version()
+    setup_logging(debug)
+    loop = asyncio.get_event_loop()
+    if rebuild:
+        loop.run_until_complete(rebuild_activity_rollups())
+        click.echo('Rebuilt the activity rollups')
+    else:
+        days = loop.run_until_complete(refresh_activity_rollups())
+        click.echo(f'Refreshed the activity rollups of {days} days')
+    loop.run_until_complete(close_engine())
+
+
+@botcli.command()
+@click.option('--debug/--no-debug', '-d/ ', default=False)
+@click.option('--batch-size', type=int, default=1000, help='Tracks checked at a time')
+def tracks_dedupe(debug, batch_size):
+    """Check all the tracks for duplicated uploads of the same song, the bot checks the new ones while it runs."""
+    check_alembic_in_latest_version()
+    setup_logging(debug)
+    loop = asyncio.get_event_loop()
+    found = loop.run_until_complete(refresh_duplicate_tracks(fetch_size=batch_size))
+    loop.run_until_complete(close_engine())
+    click.echo(f'Found {found} duplicated tracks')
+
+
+@botcli.command()
+@click.option('--debug/--no-debug', '-d/ ', default=False)
+@click.option('--months-ahead', type=int, default=mos_config.USER_ACTION_PARTITION_MONTHS_AHEAD,
+              help='Months after the current one that should have a partition')
+def partitions_ensure(debug, months_ahead):
+    """Create the missing monthly partitions of the user actions, the bot does it while it runs too."""
+    check_alembic_in_latest_version()
+    setup_logging(debug)
+    loop = asyncio.get_event_loop()
+    created = loop.run_until_complete(ensure_user_action_partitions(months_ahead=months_ahead))
+    loop.run_until_complete(close_engine())
+    click.echo(f'Created {len(created)} partitions{": " if created else ""}{", ".join(created)}')
+
+
+@botcli.command()
+@click.option('--debug/--no-debug', '-d/ ', default=False)
+@click.option('--workers', type=int, default=4, help='Tables exported at the same time')
+@click.argument('path', type=click.Path(dir_okay=False, writable=True))
+def snapshot_export(debug, workers, path):
+    """Export all the data to a snapshot archive, to restore it in another database with snapshot_import."""
+    check_alembic_in_latest_version()
+    setup_logging(debug)
+    loop = asyncio.get_event_loop()
+    manifest = loop.run_until_complete(export_snapshot(path, workers=workers))
+    rows = sum(table['rows'] for table in manifest['tables'].values())
+    click.echo(f'Exported {rows} rows of {len(manifest["tables"])} tables at revision {manifest["revision"]}')
+
+
+@botcli.command()
+@click.option('--debug/--no-debug', '-d/ ', default=False)
+@click.option('--workers', type=int, default=4, help='Tables imported at the same time')
+@click.option('--force/--no-force', default=False, help='Import it even if the database has data, removing it')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+def snapshot_import(debug, workers, force, path):
+    """Replace all the data with a snapshot archive, the database has to be in the same revision as the snapshot."""
+    check_alembic_in_latest_version()
+    setup_logging(debug)
+    loop = asyncio.get_event_loop()
+    try:
+        rows = loop.run_until_complete(import_snapshot(path, workers=workers, force=force))
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    finally:
+        loop.run_until_complete(close_engine())
+    click.echo(f'Imported {sum(rows.values())} rows of {len(rows)} tables')
+
+
+@botcli.command()
+@click.option('--debug/--no-debug', '-d/ ', default=False)
+@click.option('--format', 'export_format', type=click.Choice(['parquet']), default='parquet', help='File format')
+@click.option('--batch-size', type=int, default=10000, help='Rows held in memory and written at a time')
+@click.argument('directory', type=click.Path(file_okay=False, writable=True))
+def analytics_export(debug, export_format, batch_size, directory):
+    """Export the playbacks and user actions to files partitioned by month, for offline analytics."""
+    check_alembic_in_latest_version()
+    setup_logging(debug)
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(bot.run_forever())
+    try:
+        result = loop.run_until_complete(export_parquet(directory, batch_size=batch_size))
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    finally:
+        loop.run_until_complete(close_engine())
+    click.echo(f'Exported {result["playbacks"]} playbacks and {result["user_actions"]} user actions of '
+               f'{result["months"]} months to {directory}')
@@ -42,6 +42,76 @@ def get_config(env_var: str, *args):
 
 
 DATABASE_URL = get_config('DATABASE_URL', 'postgresql://postgres@localhost/postgres')
+DATABASE_POOL_MINSIZE = get_config('DATABASE_POOL_MINSIZE', 1)
+"""Connections opened when the engine is created, and kept open"""
+DATABASE_POOL_MAXSIZE = get_config('DATABASE_POOL_MAXSIZE', 10)
+DATABASE_POOL_TIMEOUT = get_config('DATABASE_POOL_TIMEOUT', 60)
+"""Seconds a query can take before it's cancelled"""
+DATABASE_POOL_RECYCLE = get_config('DATABASE_POOL_RECYCLE', 3600)
+"""Seconds after which a connection is closed and reopened instead of reused, -1 to disable"""
+DATABASE_REPLICA_URL = get_config('DATABASE_REPLICA_URL', None)
+"""Read replica for the read only queries that can be served a bit stale, if None, the primary is used"""
+DATABASE_REPLICA_MAX_LAG = get_config('DATABASE_REPLICA_MAX_LAG', 5)
+"""Seconds behind the primary after which the replica is not used"""
+DATABASE_REPLICA_LAG_CHECK_INTERVAL = get_config('DATABASE_REPLICA_LAG_CHECK_INTERVAL', 1)
+DATABASE_REPLICA_RETRY_INTERVAL = get_config('DATABASE_REPLICA_RETRY_INTERVAL', 30)
+"""Seconds after failing to connect to the replica before trying again, the primary is used meanwhile"""
+ACTIVITY_REFRESH_INTERVAL = get_config('ACTIVITY_REFRESH_INTERVAL', 300)
+"""Seconds between refreshes of the activity rollups while the bot runs, 0 to not refresh them"""
+USER_ACTION_PARTITION_MONTHS_AHEAD = get_config('USER_ACTION_PARTITION_MONTHS_AHEAD', 3)
+"""Months after the current one whose user action partitions are created in advance"""
+USER_ACTION_PARTITION_CHECK_INTERVAL = get_config('USER_ACTION_PARTITION_CHECK_INTERVAL', 86400)
+"""Seconds between checks of the user action partitions while the bot runs"""
+RECOMMENDATIONS_REFRESH_INTERVAL = get_config('RECOMMENDATIONS_REFRESH_INTERVAL', 60)
+"""Seconds between refreshes of the track recommendations while the bot runs, 0 to not recommend tracks"""
+INCREMENTAL_REFRESH_ID_OVERLAP = get_config('INCREMENTAL_REFRESH_ID_OVERLAP', 1000)
+"""Ids read again on each refresh of the recommendations and duplicates, to see the rows committed out of order"""
+RECOMMENDATION_WINDOW = get_config('RECOMMENDATION_WINDOW', 3600)
+"""Seconds between the start of two playbacks for their tracks to be considered played together"""
+RECOMMENDATION_TOP_K = get_config('RECOMMENDATION_TOP_K', 10)
+"""Recommendations kept for each track"""
+DUPLICATE_TRACKS_REFRESH_INTERVAL = get_config('DUPLICATE_TRACKS_REFRESH_INTERVAL', 3600)
+"""Seconds between checks of the new tracks for duplicates while the bot runs, 0 to not check them"""
+DUPLICATE_TRACK_SIMILARITY = get_config('DUPLICATE_TRACK_SIMILARITY', 0.8)
+"""Similarity of the normalized names, from 0 to 1, from which two tracks are considered the same song"""
+DUPLICATE_TRACK_LENGTH_TOLERANCE = get_config('DUPLICATE_TRACK_LENGTH_TOLERANCE', 15)
+"""Seconds two tracks can differ in length and still be considered the same song"""
+REPEAT_WINDOW = get_config('REPEAT_WINDOW', 14400)
+"""Seconds after a track is played in which playing it again is a repeat"""
+REPEAT_POLICY = get_config('REPEAT_POLICY', 'warn')
+"""What the bot does when a track is repeated, 'off' to nothing, 'warn' in the chat or 'skip' it too"""
+ROOM_QUEUE_RECONCILE_INTERVAL = get_config('ROOM_QUEUE_RECONCILE_INTERVAL', 300)
+"""Seconds between reconciliations of the room queue model with the room queue, 0 to not reconcile it"""
+AVAILABILITY_CHECK_INTERVAL = get_config('AVAILABILITY_CHECK_INTERVAL', 30)
+"""Seconds between checks of the availability of the upcoming tracks, 0 to not check it"""
+AVAILABILITY_UPCOMING = get_config('AVAILABILITY_UPCOMING', 10)
+"""Upcoming tracks of the room queue whose availability is checked"""
+AVAILABILITY_TTL = get_config('AVAILABILITY_TTL', 86400)
+"""Seconds the availability of a track in a country is cached"""
+AVAILABILITY_NEGATIVE_TTL = get_config('AVAILABILITY_NEGATIVE_TTL', 3600)
+"""Seconds that a track is cached as not available in a country"""
+AVAILABILITY_CACHE_SIZE = get_config('AVAILABILITY_CACHE_SIZE', 10000)
+"""Track and country pairs whose availability is cached"""
+YOUTUBE_API_KEY = get_config('YOUTUBE_API_KEY', None)
+"""Key of the YouTube Data API, to check the availability of the tracks, not checked if not set"""
+RECENT_PLAYBACKS_SIZE = get_config('RECENT_PLAYBACKS_SIZE', 100)
+"""Last playbacks kept in memory to answer the chat commands about them"""
+LEADERBOARD_TTL = get_config('LEADERBOARD_TTL', 600)
+"""Seconds a leaderboard is kept, it's refreshed before while it keeps being asked for"""
+LEADERBOARD_REFRESH_INTERVAL = get_config('LEADERBOARD_REFRESH_INTERVAL', 300)
+"""Seconds between refreshes of the leaderboards asked for while the bot runs, 0 to not refresh them"""
+LEADERBOARD_SIZE = get_config('LEADERBOARD_SIZE', 10)
+"""Entries kept of each leaderboard"""
+LEADERBOARD_CACHE_SIZE = get_config('LEADERBOARD_CACHE_SIZE', 256)
+"""Leaderboards and user stats kept"""
+LEADERBOARD_RATE = get_config('LEADERBOARD_RATE', 3)
+"""Leaderboard commands each user can run in LEADERBOARD_RATE_PERIOD"""
+LEADERBOARD_RATE_PERIOD = get_config('LEADERBOARD_RATE_PERIOD', 60)
+"""Seconds in which each user can run LEADERBOARD_RATE leaderboard commands"""
+SEARCH_CACHE_SIZE = get_config('SEARCH_CACHE_SIZE', 256)
+"""Recent searches whose results are kept"""
+SEARCH_CACHE_TTL = get_config('SEARCH_CACHE_TTL', 300)
+"""Seconds the results of a search are kept"""
 
 DUBTRACK_USERNAME = get_config('DUBTRACK_USERNAME', None)
 DUBTRACK_PASSWORD = get_config('DUBTRACK_PASSWORD', None)
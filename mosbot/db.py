@@ -9,15 +9,19 @@ the entities that the datamodel has. It should not import anything from the rest
 to be able to connect to the database"""
 
 import enum
+import logging
 
 import aiopg.sa as asa
 import sqlalchemy as sa
 import sqlalchemy.dialects.postgresql as psa
 from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.pool import NullPool
 from sqlalchemy.sql import functions
 
 from mosbot import config
 
+logger = logging.getLogger(__name__)
+
 
 class utcnow(functions.FunctionElement):  # noqa
     key = 'utcnow'
@@ -30,15 +34,144 @@ def _pg_utcnow(element, compiler, **kwargs):  # pragma: no cover
 
 
 ENGINE = weakref.WeakKeyDictionary()
+REPLICA_ENGINE = weakref.WeakKeyDictionary()
+_ENGINE_LOCK = weakref.WeakKeyDictionary()
+_REPLICA_LAG = weakref.WeakKeyDictionary()
+_REPLICA_FAILED = weakref.WeakKeyDictionary()
+
+REPLICA_LAG_QUERY = """
+SELECT CASE
+    WHEN NOT pg_is_in_recovery() THEN 0
+    ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+END
+"""
+"""Seconds since the replica replayed the last transaction, NULL if it didn't replay any
+
+A replica that stopped receiving looks as up to date as what it received, so it's not trusted even if it replayed all of
+it. While the primary is idle it grows too, and the primary is used, which is fine as there is no load then.
+"""
+
+
+def pool_settings() -> dict:
+    """Return the connection pool arguments for `aiopg.sa.create_engine`, from the configuration."""
+    return {
+        'minsize': config.DATABASE_POOL_MINSIZE,
+        'maxsize': config.DATABASE_POOL_MAXSIZE,
+        'timeout': config.DATABASE_POOL_TIMEOUT,
+        'pool_recycle': config.DATABASE_POOL_RECYCLE,
+    }
+
+
+async def _get_or_create_engine(engines, dsn, debug):
+    loop = asyncio.get_event_loop()
+    if loop in engines:
+        return engines[loop]
+    lock = _ENGINE_LOCK.setdefault(loop, asyncio.Lock())
+    async with lock:
+        if loop not in engines:
+            engines[loop] = await asa.create_engine(dsn, echo=debug, **pool_settings())
+    return engines[loop]
+
+
+async def get_engine(debug=False):
+    """Return the engine of the current event loop, creating it the first time.
+
+    The engine is created only once per loop, even if several coroutines ask for it at the same time. Creating it opens
+    the minimum connections of the pool.
+    """
+    return await _get_or_create_engine(ENGINE, config.DATABASE_URL, debug)
+
+
+async def get_replica_engine(debug=False):
+    """Return the engine of the read replica, if it can be used.
+
+    A failed connection is not tried again for `DATABASE_REPLICA_RETRY_INTERVAL` seconds, so the reads meanwhile don't
+    wait for the connection timeout.
+
+    :return: The engine, or None if there is no replica configured, it can't be reached or it lags behind more than
+    `DATABASE_REPLICA_MAX_LAG` seconds, in which case the primary should be used
+    """
+    if not config.DATABASE_REPLICA_URL:
+        return None
+    loop = asyncio.get_event_loop()
+    failed_at = _REPLICA_FAILED.get(loop)
+    if failed_at is not None and loop.time() - failed_at < config.DATABASE_REPLICA_RETRY_INTERVAL:
+        return None
+    try:
+        engine = await _get_or_create_engine(REPLICA_ENGINE, config.DATABASE_REPLICA_URL, debug)
+    except Exception:
+        logger.warning(f'Could not connect to the read replica, trying again in '
+                       f'{config.DATABASE_REPLICA_RETRY_INTERVAL}s', exc_info=True)
+        _REPLICA_FAILED[loop] = loop.time()
+        return None
+    _REPLICA_FAILED.pop(loop, None)
+    lag = await replica_lag(engine)
+    if lag is None or lag > config.DATABASE_REPLICA_MAX_LAG:
+        return None
+    return engine
+
+
+async def replica_lag(engine):
+    """Seconds the replica is behind the primary, checked at most every `DATABASE_REPLICA_LAG_CHECK_INTERVAL` seconds.
+
+    :return: The lag, or None if it's unknown
+    """
+    loop = asyncio.get_event_loop()
+    checked_at, lag = _REPLICA_LAG.get(loop, (None, None))
+    if checked_at is not None and loop.time() - checked_at < config.DATABASE_REPLICA_LAG_CHECK_INTERVAL:
+        return lag
+    try:
+        async with engine.acquire() as conn:
+            lag = await conn.scalar(REPLICA_LAG_QUERY)
+        lag = None if lag is None else float(lag)
+    except Exception:
+        logger.warning('Could not check the read replica lag', exc_info=True)
+        lag = None
+    if lag is None or lag > config.DATABASE_REPLICA_MAX_LAG:
+        logger.info(f'Read replica lag is {lag}, reading from the primary')
+    _REPLICA_LAG[loop] = (loop.time(), lag)
+    return lag
+
+
+async def warm_up_engine(debug=False):
+    """Create the engine and check the pool connections are usable, so the first queries don't pay for it.
+
+    Each idle connection is pinged, the ones that fail are closed and replaced by the pool.
+
+    :return: The engine
+    """
+    engine = await get_engine(debug)
+    connections = [await engine.acquire() for _ in range(max(engine.minsize, 1))]
+    for conn in connections:
+        try:
+            await conn.scalar('SELECT 1')
+        except Exception:
+            logger.warning('Discarding broken database connection', exc_info=True)
+            conn.connection.close()
+        finally:
+            await conn.close()
+    return engine
+
+
+def create_blocking_engine(debug=False):
+    """Create a blocking SQLAlchemy engine, for what can't be done through aiopg, like `COPY`.
+
+    It must only be used from a thread of an executor, never from the event loop. Connections are not pooled, as it's
+    for long one-off jobs.
+    """
+    return sa.create_engine(config.DATABASE_URL, echo=debug, poolclass=NullPool)
 
 
-async def get_engine(debug=False):  # noqa D103  TODO
-    global ENGINE
+async def close_engine():
+    """Close the engines of the current event loop, if any, waiting for the connections to be released."""
     loop = asyncio.get_event_loop()
-    if loop in ENGINE:
-        return ENGINE[loop]
-    eng = ENGINE[loop] = await asa.create_engine(config.DATABASE_URL, echo=debug)
-    return eng
+    _REPLICA_LAG.pop(loop, None)
+    _REPLICA_FAILED.pop(loop, None)
+    for engines in (ENGINE, REPLICA_ENGINE):
+        engine = engines.pop(loop, None)
+        if engine is not None:
+            engine.close()
+            await engine.wait_closed()
 
 
 metadata = sa.MetaData()
@@ -54,8 +187,10 @@ User = sa.Table('user', metadata,
 
   :param int id: User id, unique in the DB, not externally retrieved
   :param str dtid: User id, from dubtrack, used to know users that changed their usernames
-  :param str username: User name from dubtrack, it may be changed, so dtid is used to identify users
-  :param str country: Country of the user, TBD (ideally will enable blocked videos autoskip)
+  :param str username: User name from dubtrack, it may be changed, so dtid is used to identify users. It has the
+  ix_user_username_trgm search index if the server has pg_trgm, it's not declared here because it may not exist
+  :param str country: Country code of the user, to check if the tracks are available to the listeners. Dubtrack
+  doesn't give it, so it's only set by hand
 """
 
 
@@ -72,7 +207,7 @@ Track = sa.Table('track', metadata,
                  sa.Column('origin', psa.ENUM(Origin), nullable=False),
                  sa.Column('extid', sa.Text, nullable=False),
                  sa.Column('name', sa.Text, nullable=False),
-                 sa.UniqueConstraint('origin', 'extid')
+                 sa.UniqueConstraint('origin', 'extid'),
                  )
 """Track table contains references to videos(youtube)/songs(soundcloud)
 
@@ -84,7 +219,8 @@ Track = sa.Table('track', metadata,
     :param Origin origin: Source of the track (usually YouTube)
     :param str extid: The id of the track had in the source (usually the track id in YouTube)
     :param str name: The name of the track in the source (usually the track name in YouTube). It's not always useful,
-    but it's convenient when speaking to humans
+    but it's convenient when speaking to humans. It has the ix_track_name_trgm search index if the server has pg_trgm,
+    it's not declared here because it may not exist
 """
 
 Playback = sa.Table('playback', metadata,
@@ -116,18 +252,24 @@ class Action(enum.Enum):
 
 
 UserAction = sa.Table('user_action', metadata,
-                      sa.Column('id', sa.Integer, primary_key=True, nullable=False),
-                      sa.Column('ts', sa.DateTime, nullable=False),
-                      sa.Column('playback_id', sa.ForeignKey('playback.id'), nullable=False),
+                      sa.Column('id', sa.Integer, primary_key=True, autoincrement=True, nullable=False),
+                      sa.Column('ts', sa.DateTime, primary_key=True, nullable=False, index=True),
+                      sa.Column('playback_id', sa.ForeignKey('playback.id'), nullable=False, index=True),
                       sa.Column('user_id', sa.ForeignKey('user.id'), nullable=True),
                       sa.Column('action', psa.ENUM(Action), nullable=False),
+                      postgresql_partition_by='RANGE (ts)',
                       )
 """UserAction table contains the actions made by a user.
 
     It has an optional :ref:`user_id` because when retrieving actions from the history channel (once we have missed
     it live), we don't have data telling us who did what, but only if skipped or not and if downvoted or not.
 
-    :param int id: Id of a UserAction, not externally generated
+    It's partitioned by month of `ts`, with a default partition for the months without one, so the primary key has to
+    include `ts`. Check :ref:`mosbot.usecase.partitions` for the creation of the partitions. The `ts` of an action is
+    never before the start of its playback less :ref:`mosbot.query.ACTION_CLOCK_SKEW`, the queries on the actions of
+    some playbacks rely on it to read only the partitions since then.
+
+    :param int id: Id of a UserAction, not externally generated. Unique because it comes from a sequence
     :param datetime.Datetime ts: This is a datetime entry on when the action happened. Upvotes/Downvotes are usually
     during, and I think they can also be afterwards, and skips are generated when the message of a user skipping
     arrives. Also, skips gathered from history have the date when the next song started, so even if we don't know
@@ -139,6 +281,159 @@ UserAction = sa.Table('user_action', metadata,
     key to know if the bot was on already or not, because the only way to know who did what is by being in the channel.
 """
 
+PlaybackSummary = sa.Table('playback_summary', metadata,
+                           sa.Column('playback_id', sa.ForeignKey('playback.id'), primary_key=True, nullable=False),
+                           sa.Column('upvotes', sa.Integer, nullable=False),
+                           sa.Column('downvotes', sa.Integer, nullable=False),
+                           sa.Column('voters', sa.Integer, nullable=False),
+                           sa.Column('skipped', sa.Boolean, nullable=False),
+                           sa.Column('skip_ts', sa.DateTime, nullable=True),
+                           )
+"""PlaybackSummary contains the outcome of the :ref:`UserAction` of each playback, so it doesn't need to be computed
+every time.
+
+    It's derived data, it's refreshed every time an action is saved, and it can be rebuilt from :ref:`UserAction`.
+
+    :param int playback_id: The :ref:`Playback.id` it summarizes
+    :param int upvotes: Voters whose last vote was an upvote
+    :param int downvotes: Voters whose last vote was a downvote
+    :param int voters: Distinct voters. Votes from history have no user, so each of them counts as a voter
+    :param bool skipped: If the playback was skipped
+    :param datetime.datetime skip_ts: When it was skipped, the first skip if there are many
+"""
+
+UserStats = sa.Table('user_stats', metadata,
+                     sa.Column('user_id', sa.ForeignKey('user.id'), primary_key=True, nullable=False),
+                     sa.Column('plays', sa.Integer, nullable=False),
+                     sa.Column('listened_seconds', sa.Integer, nullable=False),
+                     sa.Column('updubs', sa.Integer, nullable=False),
+                     sa.Column('downdubs', sa.Integer, nullable=False),
+                     sa.Column('skips', sa.Integer, nullable=False),
+                     sa.Column('updubs_given', sa.Integer, nullable=False),
+                     sa.Column('downdubs_given', sa.Integer, nullable=False),
+                     sa.Column('last_played', sa.DateTime, nullable=True),
+                     )
+"""UserStats contains counters about each user, so they don't need to be computed every time.
+
+    It's derived data, updated with the difference every time a :ref:`PlaybackSummary` changes or the user votes, and
+    it can be rebuilt from the rest of the tables.
+
+    :param int user_id: The :ref:`User.id` the counters are about
+    :param int plays: Playbacks played by the user
+    :param int listened_seconds: Seconds the playbacks of the user were listened, until skipped or finished
+    :param int updubs: Upvotes received in the playbacks of the user, as in :ref:`PlaybackSummary`
+    :param int downdubs: Downvotes received in the playbacks of the user, as in :ref:`PlaybackSummary`
+    :param int skips: Playbacks of the user that were skipped
+    :param int updubs_given: Playbacks in which the last vote of the user was an upvote
+    :param int downdubs_given: Playbacks in which the last vote of the user was a downvote
+    :param datetime.datetime last_played: Start of the last playback of the user
+"""
+
+TrackStats = sa.Table('track_stats', metadata,
+                      sa.Column('track_id', sa.ForeignKey('track.id'), primary_key=True, nullable=False),
+                      sa.Column('plays', sa.Integer, nullable=False),
+                      sa.Column('listened_seconds', sa.Integer, nullable=False),
+                      sa.Column('updubs', sa.Integer, nullable=False),
+                      sa.Column('downdubs', sa.Integer, nullable=False),
+                      sa.Column('skips', sa.Integer, nullable=False),
+                      sa.Column('last_played', sa.DateTime, nullable=True),
+                      )
+"""TrackStats contains counters about each track, same as :ref:`UserStats` but without the given votes."""
+
+TrackCanonical = sa.Table('track_canonical', metadata,
+                          sa.Column('track_id', sa.ForeignKey('track.id'), primary_key=True, nullable=False),
+                          sa.Column('canonical_track_id', sa.ForeignKey('track.id'), nullable=False, index=True),
+                          sa.Column('similarity', sa.Float, nullable=False),
+                          )
+"""TrackCanonical maps the tracks detected as duplicates of another upload of the same song to the canonical one.
+
+    It's filled by :ref:`refresh_duplicate_tracks`. Tracks without a row are their own canonical track, and canonical
+    tracks never have a row, so the mapping is never chained.
+
+    :param int track_id: The :ref:`Track.id` of the duplicate
+    :param int canonical_track_id: The :ref:`Track.id` of the first track saved of the song
+    :param float similarity: How similar the normalized names of the duplicate and its closest match are, from 0 to 1
+"""
+
+ActivityHourly = sa.Table('activity_hourly', metadata,
+                          sa.Column('bucket', sa.DateTime, primary_key=True, nullable=False),
+                          sa.Column('plays', sa.Integer, nullable=False),
+                          sa.Column('djs', sa.Integer, nullable=False),
+                          sa.Column('upvotes', sa.Integer, nullable=False),
+                          sa.Column('downvotes', sa.Integer, nullable=False),
+                          sa.Column('skips', sa.Integer, nullable=False),
+                          )
+"""ActivityHourly contains how active the room was each hour, to draw charts without going through all the history.
+
+    It's derived data, refreshed for the hours marked in :ref:`ActivityDirty` and the ones with new rows, and it can be
+    rebuilt from :ref:`Playback` and :ref:`UserAction`. Hours without any activity have no row.
+
+    :param datetime.datetime bucket: Start of the hour, UTC
+    :param int plays: Playbacks started in the hour
+    :param int djs: Distinct users that played in the hour
+    :param int upvotes: Upvote actions done in the hour, changing a vote counts again
+    :param int downvotes: Downvote actions done in the hour, changing a vote counts again
+    :param int skips: Skip actions done in the hour
+"""
+
+ActivityDaily = sa.Table('activity_daily', metadata,
+                         sa.Column('bucket', sa.DateTime, primary_key=True, nullable=False),
+                         sa.Column('plays', sa.Integer, nullable=False),
+                         sa.Column('djs', sa.Integer, nullable=False),
+                         sa.Column('upvotes', sa.Integer, nullable=False),
+                         sa.Column('downvotes', sa.Integer, nullable=False),
+                         sa.Column('skips', sa.Integer, nullable=False),
+                         )
+"""ActivityDaily is the same as :ref:`ActivityHourly` for each day. It's not the sum of the hours, as `djs` are
+distinct in the whole day.
+"""
+
+ActivityDirty = sa.Table('activity_dirty', metadata,
+                         sa.Column('id', sa.Integer, primary_key=True, nullable=False),
+                         sa.Column('hour', sa.DateTime, nullable=False),
+                         )
+"""ActivityDirty contains the hours whose activity rollups need to be refreshed, the same hour can be many times.
+
+    Rows are removed when the rollups are refreshed.
+
+    :param int id: Row id
+    :param datetime.datetime hour: Start of the hour, UTC
+"""
+
+staging_metadata = sa.MetaData()
+"""Temporary tables used while loading data, they are not part of the schema so the migrations don't manage them"""
+
+HistoryStaging = sa.Table('history_staging', staging_metadata,
+                          sa.Column('played', sa.DateTime, nullable=False),
+                          sa.Column('next_played', sa.DateTime, nullable=True),
+                          sa.Column('skipped', sa.Boolean, nullable=False),
+                          sa.Column('dtid', sa.Text, nullable=False),
+                          sa.Column('username', sa.Text, nullable=False),
+                          sa.Column('origin', psa.ENUM(Origin, create_type=False), nullable=False),
+                          sa.Column('extid', sa.Text, nullable=False),
+                          sa.Column('name', sa.Text, nullable=False),
+                          sa.Column('length', sa.Float, nullable=False),
+                          sa.Column('updubs', sa.Integer, nullable=False),
+                          sa.Column('downdubs', sa.Integer, nullable=False),
+                          prefixes=['TEMPORARY'],
+                          )
+"""HistoryStaging holds the songs of the dubtrack history while they are bulk loaded, one row per song.
+
+    It's created in the transaction of the load, filled with `COPY` and dropped once merged.
+
+    :param datetime.datetime played: When the song started, the :ref:`Playback.start`
+    :param datetime.datetime next_played: When the next song started, the time of the skip if it was skipped
+    :param bool skipped: If the song was skipped
+    :param str dtid: Dubtrack id of the user that played it
+    :param str username: Name of the user that played it
+    :param Origin origin: Source of the track
+    :param str extid: Id of the track in the source
+    :param str name: Name of the track in the source
+    :param float length: Track duration in seconds
+    :param int updubs: Upvotes of the song
+    :param int downdubs: Downvotes of the song
+"""
+
 BotData = sa.Table('bot_data', metadata,
                    sa.Column('id', sa.Integer, primary_key=True, nullable=False),
                    sa.Column('key', sa.Text, unique=True, nullable=False),
@@ -153,6 +448,9 @@ class BotConfig:
     """This are the keys used in :ref:`BotData`."""
 
     last_saved_history = 'last_saved_history'  #: Last timestamp history was gathered
+    journal_id = 'journal_id'  #: Id of the journal directory whose sequence number is stored
+    journal_drained_seq = 'journal_drained_seq'  #: Sequence number of the last journal record stored
+    activity_rollup_watermark = 'activity_rollup_watermark'  #: Last playback/user action ids in the activity rollups
 
 
 BotConfig.configs = tuple(v for v in vars(BotConfig) if not v.startswith('__'))
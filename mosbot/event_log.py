@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+
+"""Recording of the events the bot receives, and replaying them later to reproduce production load.
+
+The log is an append-only file with one compact JSON record per line, gzipped if the file name ends in `.gz`. Each
+record has the time the event was received, the abot event class, the raw data dubtrack sent and the data of the sender
+entity, which is resolved by the backend and wouldn't be available when replaying otherwise.
+
+This is transversal, it only knows about abot events, the handlers to replay into are given by the caller.
+"""
+
+import asyncio
+import collections
+import gzip
+import json
+import logging
+import time
+
+import abot.dubtrack
+from abot.dubtrack import DubtrackEntity, DubtrackEvent
+
+from mosbot.util import latency_summary
+
+logger = logging.getLogger(__name__)
+
+
+def open_log(path, mode):
+    """Open an event log, gzipped if the file name ends with `.gz`."""
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+def event_to_record(event: DubtrackEvent, ts=None) -> dict:
+    """Transform an event into a json serializable record.
+
+    :param event: The event to be transformed
+    :param float ts: When the event was received, now if not given
+    :return: The record
+    """
+    sender = event.sender
+    return {
+        'ts': time.time() if ts is None else ts,
+        'type': event.__class__.__name__,
+        'data': event._data,
+        'sender': sender._data if sender else None,
+    }
+
+
+class ReplayBackend:
+    """Stand-in for :ref:`abot.dubtrack.DubtrackBotBackend` that resolves entities from recorded sender data.
+
+    It implements only what the events need to resolve their sender.
+    """
+
+    def __init__(self):  # noqa D107
+        self.entities = {}
+
+    def register_entity(self, entity_data):
+        """Make an entity available by id and username."""
+        entity = DubtrackEntity(dict(entity_data), self)
+        for key in (entity.id, entity.username):
+            if key:
+                self.entities[key] = entity
+        return entity
+
+    def _register_user(self, user_data):
+        pass
+
+    def _get_entity(self, id_or_name):
+        return self.entities.get(id_or_name)
+
+
+def record_to_event(record: dict, backend: ReplayBackend) -> DubtrackEvent:
+    """Recreate the event from a record, registering its sender in the backend."""
+    event_class = getattr(abot.dubtrack, record['type'], None)
+    if not (isinstance(event_class, type) and issubclass(event_class, DubtrackEvent)):
+        raise ValueError(f'Record type {record["type"]} is not a dubtrack event')
+    if record.get('sender'):
+        backend.register_entity(record['sender'])
+    return event_class(record['data'], backend)
+
+
+class EventRecorder:
+    """Append every event received to an event log.
+
+    Records are written when received, in order, so this needs to be attached to the bot as an event handler, check
+    :ref:`EventRecorder.record_event`. They are flushed at most every `flush_interval` seconds, flushing a gzip file
+    ends its compression block, so doing it for each record would barely compress them. Close it to flush the last ones.
+
+    :param str path: File to append to, gzipped if it ends in `.gz`
+    :param float flush_interval: Seconds after a flush before flushing again on the next record
+    :param clock: Function returning the current time in seconds
+    """
+
+    def __init__(self, path, *, flush_interval=1, clock=time.monotonic):  # noqa D107
+        self.path = path
+        self.fd = open_log(path, 'a')
+        self.recorded = 0
+        self.flush_interval = flush_interval
+        self.clock = clock
+        self.flushed_at = clock()
+
+    async def record_event(self, event: DubtrackEvent):
+        """Event handler that records the event."""
+        self.write(event_to_record(event))
+
+    def write(self, record):  # noqa D102
+        self.fd.write(json.dumps(record, separators=(',', ':'), default=str) + '\n')
+        self.recorded += 1
+        if self.clock() - self.flushed_at >= self.flush_interval:
+            self.fd.flush()
+            self.flushed_at = self.clock()
+
+    def close(self):  # noqa D102
+        self.fd.close()
+
+
+def read_records(path):
+    """Iterate over the records of an event log, skipping a trailing partially written line if any."""
+    with open_log(path, 'r') as fd:
+        for line_number, line in enumerate(fd, start=1):
+            try:
+                yield json.loads(line)
+            except ValueError:
+                logger.error(f'Skipping corrupted record at {path}:{line_number}')
+
+
+async def replay_records(records, handlers, *, speed=1.0, max_in_flight=100):
+    """Feed the recorded events into the handlers, as the bot would, and measure how they perform.
+
+    Every event is given to every handler accepting it concurrently, like abot does. The time between events is kept,
+    divided by `speed`.
+
+    :param records: Iterable of records, as read by :ref:`read_records`
+    :param handlers: Dict of name to handler coroutine function, and the event classes it handles
+    :param float speed: Replay speed, 1 is real time, 0 means as fast as possible
+    :param int max_in_flight: Maximum number of handler calls running at the same time
+    :return: A json serializable report
+    """
+    loop = asyncio.get_event_loop()
+    backend = ReplayBackend()
+    semaphore = asyncio.Semaphore(max_in_flight)
+    latencies = collections.defaultdict(list)
+    errors = collections.defaultdict(collections.Counter)
+    pending = set()
+    events = 0
+
+    async def run_handler(name, handler, event, scheduled):
+        try:
+            async with semaphore:
+                await handler(event)
+        except Exception as e:
+            errors[name][e.__class__.__name__] += 1
+            logger.debug(f'Handler {name} failed with {event}', exc_info=True)
+        latencies[name].append(loop.time() - scheduled)
+
+    started = loop.time()
+    first_ts = None
+    for record in records:
+        if first_ts is None:
+            first_ts = record['ts']
+        if speed:
+            delay = started + (record['ts'] - first_ts) / speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        try:
+            event = record_to_event(record, backend)
+        except Exception as e:
+            errors['decode'][e.__class__.__name__] += 1
+            continue
+        events += 1
+        scheduled = loop.time()
+        for name, (handler, event_classes) in handlers.items():
+            if isinstance(event, event_classes):
+                pending.add(asyncio.ensure_future(run_handler(name, handler, event, scheduled)))
+        if len(pending) >= max_in_flight:
+            _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+    if pending:
+        await asyncio.wait(pending)
+    elapsed = loop.time() - started
+
+    return {
+        'events': events,
+        'seconds': elapsed,
+        'events_per_second': events / elapsed if elapsed else None,
+        'speed': speed or 'max',
+        'handlers': {
+            name: {
+                'calls': len(latencies[name]),
+                'errors': dict(errors[name]),
+                'latency': latency_summary(latencies[name]),
+            } for name in handlers
+        },
+        'decode_errors': dict(errors['decode']),
+    }
@@ -1,20 +1,50 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, print_function, unicode_literals
 
+import datetime
 import logging
-from abot.dubtrack import DubtrackDub, DubtrackPlaying, DubtrackRoomQueueReorder, DubtrackSkip, \
+from abot.dubtrack import DubtrackBotBackend, DubtrackDub, DubtrackPlaying, DubtrackRoomQueueReorder, DubtrackSkip, \
     DubtrackUserPauseQueue, \
     DubtrackUserQueueUpdate, DubtrackUserUpdate
-from typing import Union
+from typing import Optional, Union
 
 from mosbot import query
-from mosbot.usecase import ensure_dubtrack_dub, ensure_dubtrack_playing, ensure_dubtrack_skip
+from mosbot.event_log import event_to_record
+from mosbot.journal import Journal
+from mosbot.usecase import RepeatPolicy, apply_queue_event, blocked_countries, ensure_dubtrack_dub, \
+    ensure_dubtrack_playing, ensure_dubtrack_skip, record_playing, set_playing_track
 
 logger = logging.getLogger(__name__)
 
+JOURNAL: Optional[Journal] = None
+"""When set, history events are written to the journal and stored in the database asynchronously by the drainer"""
+REPEAT_POLICY = RepeatPolicy.off
+"""What :ref:`repeat_handler` does with the tracks repeated"""
+
+
+def set_journal(journal: Optional[Journal]):
+    """Make the history handler write to the journal instead of directly to the database."""
+    global JOURNAL
+    JOURNAL = journal
+
+
+def set_repeat_policy(policy: RepeatPolicy):
+    """Set what the repeat handler does when a track is repeated."""
+    global REPEAT_POLICY
+    REPEAT_POLICY = policy
+
 
 async def history_handler(event: Union[DubtrackSkip, DubtrackPlaying, DubtrackDub]):
-    """Make sure to record in the database all the data we are currently keeping records of."""
+    """Make sure to record in the database all the data we are currently keeping records of.
+
+    If there is a journal, the event is only written to it, so that it's not lost if the database is not available.
+    The track playing is set in the recommender right away, it doesn't wait for it to be in the database.
+    """
+    if isinstance(event, DubtrackPlaying):
+        set_playing_track(event.song_type, event.song_external_id, event.song_name)
+    if JOURNAL:
+        await JOURNAL.append(event_to_record(event))
+        return
     async with query.ensure_connection(None) as conn:
         if isinstance(event, DubtrackPlaying):
             await ensure_dubtrack_playing(event=event, conn=conn)
@@ -24,11 +54,59 @@ async def history_handler(event: Union[DubtrackSkip, DubtrackPlaying, DubtrackDu
             await ensure_dubtrack_dub(event=event, conn=conn)
 
 
+async def skip_playing(event: DubtrackPlaying):
+    """Skip the track playing, the bot user needs to be allowed to skip in the room."""
+    dubtrackws = event.backend.dubtrackws
+    room_id = await dubtrackws.get_room_id()
+    playlist_id = event._data.get('song', {}).get('_id')
+    await dubtrackws.api_post(f'https://api.dubtrack.fm/chat/skip/{room_id}/{playlist_id}', {})
+
+
+async def repeat_handler(event: DubtrackPlaying):
+    """Warn in the chat when a track played within the repeat window is played again, and skip it if set so.
+
+    The check is done against the recent plays kept in memory, so it doesn't go to the database.
+    """
+    if REPEAT_POLICY is RepeatPolicy.off:
+        return
+    played_before = record_playing(event)
+    if played_before is None:
+        return
+    minutes = (event.played - played_before) // datetime.timedelta(minutes=1)
+    logger.info(f'Track {event.song_external_id} repeated after {minutes} minutes')
+    if REPEAT_POLICY is RepeatPolicy.skip:
+        await event.channel.say(f'{event.song_name} was played {minutes} minutes ago, skipping it')
+        await skip_playing(event)
+    else:
+        await event.channel.say(f'{event.song_name} was played {minutes} minutes ago')
+
+
+async def fetch_room_queue(backend: DubtrackBotBackend):
+    """Get the room playlist details, the full room queue, to reconcile the room queue model with it."""
+    dubtrackws = backend.dubtrackws
+    room_id = await dubtrackws.get_room_id()
+    return await dubtrackws.api_get(f'https://api.dubtrack.fm/room/{room_id}/playlist/details')
+
+
+def backend_connected(backend: DubtrackBotBackend) -> bool:
+    """Check whether the backend joined the room, so the room can be fetched."""
+    return backend.dubtrack_channel is not None
+
+
+def room_listeners(backend: DubtrackBotBackend):
+    """Get the dubtrack ids of the users in the room, as known by the backend."""
+    return list(backend.dubtrack_users)
+
+
 async def availability_handler(event: Union[DubtrackPlaying, DubtrackRoomQueueReorder, DubtrackUserQueueUpdate,
                                             DubtrackUserPauseQueue, DubtrackUserUpdate]):
-    """WIP.
+    """Keep the room queue model up to date with the queue events, and warn when a track not available plays.
 
-    The idea is to know which tracks are in queue/playing and remove/skip them if they are not available
-    to any of the listening people. Still need to see if we need all these events or not.
+    The availability of the upcoming tracks is checked in the background, so here it's only looked up in the cache,
+    a track that wasn't checked yet is not reported.
     """
-    logger.info(f'Event for availability handler {event}')
+    apply_queue_event(event)
+    if isinstance(event, DubtrackPlaying):
+        blocked = blocked_countries(event.song_type, event.song_external_id)
+        if blocked:
+            await event.channel.say(f'{event.song_name} is not available in {", ".join(sorted(blocked))}')
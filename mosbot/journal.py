@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+
+"""Local, durable, append-only journal of records.
+
+Records are json serializable dicts, and they get a sequence number when appended. The journal is a directory with
+segment files named after the first sequence number they contain, one json record per line. Appending waits until the
+record is on disk, but the fsync is shared by all the appends that happened in the same `fsync_delay` window (group
+commit), so the cost of an fsync is paid once per batch, not once per record.
+
+Records are read back in order by sequence number, and segments are deleted once everything in them is released. Memory
+usage doesn't depend on how many records are pending, they are only on disk. Each journal directory has a random id,
+sequence numbers are only meaningful within it, a new directory starts again from 1.
+
+This is transversal, it doesn't know about the database or the bot, check :ref:`mosbot.usecase.event_journal` for the
+part that drains the events into the database.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import uuid
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_SUFFIX = '.journal'
+ID_FILE_NAME = 'journal.id'
+LEGACY_ID = 'legacy'
+"""Id of the directories that already had segments before journals had an id"""
+
+
+class Journal:
+    """Append-only journal in a directory.
+
+    :param str directory: Where the segments are stored, created if it doesn't exist
+    :param int segment_size: Size in bytes after which a new segment is started
+    :param float fsync_delay: Seconds to wait for more records before doing the fsync
+    """
+
+    def __init__(self, directory, *, segment_size=8 * 1024 * 1024, fsync_delay=0.01):  # noqa D107
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync_delay = fsync_delay
+        self.id = None
+        """Id of the directory, set when opened"""
+        self.next_seq = 1
+        self.durable_seq = 0
+        self._fd = None
+        self._sync_future = None
+        self._durable = asyncio.Event()
+        self._reader = None  # (segment path, offset, last seq read at that offset)
+
+    def segments(self):
+        """List of (first sequence number, path) of the segments, ordered."""
+        segments = []
+        for name in os.listdir(self.directory):
+            if name.endswith(SEGMENT_SUFFIX):
+                segments.append((int(name[:-len(SEGMENT_SUFFIX)]), os.path.join(self.directory, name)))
+        return sorted(segments)
+
+    def open(self, *, min_seq=1):
+        """Open the journal for appending, recovering the sequence number from the last segment.
+
+        A partially written record at the end of the last segment (a crash while writing) is truncated, that is any
+        last line without its newline, even if it's valid json, otherwise the next record would be appended to it.
+
+        :param int min_seq: The next sequence number will be at least this one. Useful when the segments have been
+        removed but the consumer already processed some sequence numbers
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        segments = self.segments()
+        self.id = self._load_id(segments)
+        last_seq = 0
+        if segments:
+            first_seq, path = segments[-1]
+            last_seq = first_seq - 1
+            valid_size = 0
+            with open(path, 'rb') as fd:
+                for line in fd:
+                    if not line.endswith(b'\n'):
+                        break
+                    try:
+                        last_seq = json.loads(line)['seq']
+                    except ValueError:
+                        break
+                    valid_size += len(line)
+            if valid_size != os.path.getsize(path):
+                logger.error(f'Truncating partially written record at the end of {path}')
+                with open(path, 'r+b') as fd:
+                    fd.truncate(valid_size)
+        self.next_seq = max(last_seq + 1, min_seq)
+        self.durable_seq = self.next_seq - 1
+        if segments and self.next_seq == last_seq + 1:
+            self._fd = open(segments[-1][1], 'a', encoding='utf-8')
+        else:
+            self._start_segment()
+        return self
+
+    def _load_id(self, segments):
+        path = os.path.join(self.directory, ID_FILE_NAME)
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as fd:
+                return fd.read().strip()
+        id = LEGACY_ID if segments else uuid.uuid4().hex
+        with open(f'{path}.tmp', 'w', encoding='utf-8') as fd:
+            fd.write(id)
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.replace(f'{path}.tmp', path)
+        return id
+
+    def _start_segment(self):
+        if self._fd:
+            self._fd.close()
+        path = os.path.join(self.directory, f'{self.next_seq:020d}{SEGMENT_SUFFIX}')
+        self._fd = open(path, 'a', encoding='utf-8')
+
+    def close(self):  # noqa D102
+        if self._fd:
+            self._fd.flush()
+            os.fsync(self._fd.fileno())
+            self._fd.close()
+            self._fd = None
+
+    async def append(self, record: dict) -> int:
+        """Append a record, and wait until it's durable.
+
+        :param dict record: A json serializable dict, `seq` key is reserved
+        :return: The sequence number given to the record
+        """
+        seq = self.next_seq
+        self.next_seq += 1
+        self._fd.write(json.dumps(dict(record, seq=seq), separators=(',', ':'), default=str) + '\n')
+        if self._sync_future is None:
+            self._sync_future = asyncio.get_event_loop().create_future()
+            asyncio.ensure_future(self._sync())
+        await asyncio.shield(self._sync_future)
+        return seq
+
+    async def _sync(self):
+        await asyncio.sleep(self.fsync_delay)
+        future, self._sync_future = self._sync_future, None
+        synced_seq = self.next_seq - 1
+        try:
+            self._fd.flush()
+            await asyncio.get_event_loop().run_in_executor(None, os.fsync, self._fd.fileno())
+            if self._fd.tell() >= self.segment_size and self._sync_future is None:
+                self._start_segment()
+        except Exception as e:
+            logger.exception('Failed to write journal')
+            future.set_exception(e)
+            return
+        self.durable_seq = synced_seq
+        self._durable.set()
+        future.set_result(synced_seq)
+
+    async def read(self, after_seq: int, limit: int = 100):
+        """Read durable records after a sequence number, waiting for them if there are none yet.
+
+        :param int after_seq: Sequence number of the last record processed
+        :param int limit: Maximum number of records to return
+        :return: List of records in order, at least one
+        """
+        while self.durable_seq <= after_seq:
+            self._durable.clear()
+            await self._durable.wait()
+        return self.read_durable(after_seq, limit)
+
+    def read_durable(self, after_seq: int, limit: int = 100):
+        """Read durable records after a sequence number, without waiting."""
+        records = []
+        segments = self.segments()
+        for index, (first_seq, path) in enumerate(segments):
+            if index + 1 < len(segments) and segments[index + 1][0] <= after_seq + 1:
+                continue  # All the records of this segment are already read
+            offset = 0
+            if self._reader and self._reader[0] == path and self._reader[2] <= after_seq:
+                offset = self._reader[1]
+            with open(path, 'rb') as fd:
+                fd.seek(offset)
+                while len(records) < limit:
+                    line = fd.readline()
+                    if not line.endswith(b'\n'):
+                        break
+                    record = json.loads(line.decode('utf-8'))
+                    if record['seq'] > self.durable_seq:
+                        break
+                    offset += len(line)
+                    if record['seq'] > after_seq:
+                        records.append(record)
+                        self._reader = (path, offset, record['seq'])
+            if len(records) >= limit:
+                break
+        return records
+
+    def release(self, seq: int):
+        """Remove the segments whose records are all processed, up to and including `seq`."""
+        segments = self.segments()
+        for (_, path), (next_first_seq, _) in zip(segments, segments[1:]):
+            if next_first_seq - 1 > seq:
+                break
+            logger.debug(f'Removing processed journal segment {path}')
+            os.remove(path)
+            if self._reader and self._reader[0] == path:
+                self._reader = None
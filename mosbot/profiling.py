@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+
+"""On-demand profiling of the running bot. This is transversal, like util, and it only knows about the python runtime,
+not about the database or the bot internals.
+
+There are two modes:
+
+* CPU: a sampling profiler running in a separate thread that looks at the event loop thread stack every few
+  milliseconds. The output is written in the "collapsed stacks" format, that can be fed directly to flamegraph.pl or
+  speedscope. Coroutines that are suspended (waiting for the database for example) are sampled too, into a separate
+  wall clock profile, so that time can be attributed to `save_history_chunk`, `history_handler` and friends, even if
+  they are not using the CPU, without the tasks sleeping most of the time drowning the CPU stacks.
+* Memory: a tracemalloc snapshot taken after some seconds of tracing, useful for long history syncs.
+"""
+
+import asyncio
+import collections
+import datetime
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+PROFILE_DIR = None
+"""Directory in which profiles are written, if None, profiling is disabled"""
+
+_profiling_lock = threading.Lock()
+
+
+def set_profile_dir(profile_dir):
+    """Enable profiling by setting the directory where profiles will be written.
+
+    :param str profile_dir: Directory to write to, it will be created if it doesn't exist. None disables profiling
+    """
+    global PROFILE_DIR
+    if profile_dir:
+        os.makedirs(profile_dir, exist_ok=True)
+    PROFILE_DIR = profile_dir
+
+
+def frame_name(frame):
+    """Name a frame in a way that is understandable once collapsed.
+
+    :param frame: A python frame object
+    :return: The frame name as `function (file:line)`
+    """
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+def collapse_frame(frame):
+    """Collapse a frame and its parents into a root-first list of frame names."""
+    stack = []
+    while frame is not None:
+        stack.append(frame_name(frame))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+def collapse_task(task):
+    """Collapse the await chain of a suspended task into a root-first list of frame names.
+
+    Task stacks go from the outermost coroutine to the innermost one, so they are already root-first.
+    """
+    return [frame_name(frame) for frame in task.get_stack()]
+
+
+class SamplingProfiler:
+    """Sampling profiler that looks at a given thread every `interval` seconds.
+
+    It's designed to have a really low overhead, it doesn't use `sys.setprofile`, but a thread that reads
+    `sys._current_frames()`. When `loop` is given, suspended tasks of that loop are also sampled, in `awaiting_stacks`,
+    so the waiting time is attributed to the coroutine waiting.
+    """
+
+    def __init__(self, *, thread_id=None, loop=None, interval=0.005):  # noqa D107
+        self.thread_id = thread_id or threading.get_ident()
+        self.loop = loop
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.awaiting_stacks = collections.Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):  # noqa D102
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='mosbot-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):  # noqa D102
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        """Take a single sample of the thread and of the suspended tasks."""
+        self.samples += 1
+        frame = sys._current_frames().get(self.thread_id)
+        running_frames = set()
+        if frame is not None:
+            self.stacks[';'.join(collapse_frame(frame))] += 1
+            while frame is not None:
+                running_frames.add(frame)
+                frame = frame.f_back
+        if self.loop is None:
+            return
+        try:
+            tasks = list(asyncio.all_tasks(self.loop))
+        except RuntimeError:  # pragma: no cover  # The set changed while we were copying it, next time
+            return
+        for task in tasks:
+            if task.done():
+                continue
+            # The task running has its coroutine in the thread stack, it's already sampled
+            coroutine_frame = task.get_stack(limit=1)
+            if not coroutine_frame or coroutine_frame[0] in running_frames:
+                continue
+            self.awaiting_stacks[';'.join(collapse_task(task))] += 1
+
+    def write_collapsed(self, path, *, awaiting=False):
+        """Write the samples in flamegraph collapsed format, `frame;frame;frame count`, one per line.
+
+        :param bool awaiting: Write the stacks of the suspended tasks instead of the thread ones
+        """
+        stacks = self.awaiting_stacks if awaiting else self.stacks
+        with open(path, 'w') as fd:
+            for stack, count in sorted(stacks.items()):
+                fd.write(f'{stack} {count}\n')
+
+
+def profile_filename(kind, extension, *, when=None):  # noqa D103
+    when = (when or datetime.datetime.utcnow()).strftime('%Y%m%dT%H%M%S')
+    return os.path.join(PROFILE_DIR, f'{kind}-{when}-{os.getpid()}.{extension}')
+
+
+async def profile_cpu(seconds, *, interval=0.005):
+    """Sample the running event loop for some seconds, and write the collapsed stacks to the profile directory.
+
+    The stacks of the suspended tasks are written to a separate wall clock profile, with the same name but `wall`
+    instead of `cpu`, if there are any.
+
+    :param float seconds: How long to sample for
+    :param float interval: Time between samples
+    :return: The path of the CPU profile written
+    """
+    if not PROFILE_DIR:
+        raise ValueError('Profiling is not enabled, there is no profile directory set')
+    if not _profiling_lock.acquire(blocking=False):
+        raise RuntimeError('There is already a profile running')
+    try:
+        profiler = SamplingProfiler(loop=asyncio.get_event_loop(), interval=interval)
+        started = time.monotonic()
+        profiler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.stop()
+        now = datetime.datetime.utcnow()
+        path = profile_filename('cpu', 'collapsed', when=now)
+        profiler.write_collapsed(path)
+        logger.info(f'Written {profiler.samples} samples taken in {time.monotonic() - started:.1f}s to {path}')
+        if profiler.awaiting_stacks:
+            wall_path = profile_filename('wall', 'collapsed', when=now)
+            profiler.write_collapsed(wall_path, awaiting=True)
+            logger.info(f'Written the suspended tasks to {wall_path}')
+        return path
+    finally:
+        _profiling_lock.release()
+
+
+async def profile_memory(seconds, *, frames=10, top=50):
+    """Trace allocations for some seconds and write a tracemalloc snapshot to the profile directory.
+
+    Along with the snapshot (loadable with `tracemalloc.Snapshot.load`), a text summary is written with the top
+    allocation sites.
+
+    :param float seconds: How long to trace for
+    :param int frames: Number of frames tracemalloc stores per allocation
+    :param int top: Number of lines of the text summary
+    :return: The path of the snapshot written
+    """
+    if not PROFILE_DIR:
+        raise ValueError('Profiling is not enabled, there is no profile directory set')
+    if not _profiling_lock.acquire(blocking=False):
+        raise RuntimeError('There is already a profile running')
+    try:
+        was_tracing = tracemalloc.is_tracing()
+        if not was_tracing:
+            tracemalloc.start(frames)
+        try:
+            await asyncio.sleep(seconds)
+            snapshot = tracemalloc.take_snapshot()
+        finally:
+            if not was_tracing:
+                tracemalloc.stop()
+        path = profile_filename('memory', 'tracemalloc')
+        snapshot.dump(path)
+        with open(path + '.txt', 'w') as fd:
+            for stat in snapshot.statistics('traceback')[:top]:
+                fd.write(f'{stat}\n')
+                for line in stat.traceback.format():
+                    fd.write(f'{line}\n')
+        logger.info(f'Written memory snapshot to {path}')
+        return path
+    finally:
+        _profiling_lock.release()
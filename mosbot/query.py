@@ -7,19 +7,36 @@ else than db and config if any.
 Queries to retrieve, insert or update data should be written here.
 """
 
+import collections
+import contextlib
+import datetime
+import enum
+import io
+import itertools
 import logging
-from typing import List, Optional
+from typing import AsyncIterator, List, Optional
 
+import psycopg2
 import sqlalchemy as sa
 import sqlalchemy.sql.functions as saf
 from asyncio_extras import async_contextmanager
 from sqlalchemy.dialects import postgresql as psa
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.base import Executable
+from sqlalchemy.sql.expression import ClauseElement
 
 from mosbot import db
-from mosbot.db import Action, Origin, Playback, Track, User, UserAction, get_engine
+from mosbot.db import Action, ActivityDaily, ActivityDirty, ActivityHourly, HistoryStaging, Origin, Playback, \
+    PlaybackSummary, Track, TrackCanonical, TrackStats, User, UserAction, UserStats, get_engine
+from mosbot.util import SingleFlight
 
 logger = logging.getLogger(__name__)
 
+user_flight = SingleFlight('user')
+track_flight = SingleFlight('track')
+playback_flight = SingleFlight('playback')
+"""Concurrent get_or_save calls for the same entity are coalesced, these keep the count of how many were"""
+
 
 @async_contextmanager
 async def ensure_connection(conn):
@@ -42,6 +59,126 @@ async def ensure_connection(conn):
             await conn.close()
 
 
+@async_contextmanager
+async def ensure_read_connection(conn):
+    """Like :ref:`ensure_connection`, but the connection may be to the read replica.
+
+    Only for read only queries that don't need to see the latest writes, as the replica may lag a bit behind. If there
+    is no replica or it lags too much, it's the same as :ref:`ensure_connection`.
+    """
+    engine = None if conn else await db.get_replica_engine()
+    if engine is None:
+        async with ensure_connection(conn) as conn:
+            yield conn
+        return
+    conn = await engine.acquire()
+    try:
+        yield conn
+    finally:
+        await conn.close()
+
+
+@async_contextmanager
+async def ensure_transaction(conn):
+    """Ensure that what is run inside is in a transaction, the one already open in `conn` if any."""
+    if conn.in_transaction:
+        yield conn
+        return
+    async with conn.begin():
+        yield conn
+
+
+def shareable_connection(conn) -> bool:
+    """Whether what is read/written through this connection is visible to other connections.
+
+    Results obtained inside of a transaction can't be shared with other callers, because it may not be committed yet.
+    Neither can a call inside of a transaction wait for a call on other connection, which may be waiting for a row
+    locked by that same transaction, a deadlock Postgres can't detect because the cycle goes through the event loop.
+    """
+    return conn is None or not conn.in_transaction
+
+
+def single_flight_metrics() -> dict:
+    """Return the coalescing metrics of the get_or_save functions."""
+    return {flight.name: flight.metrics() for flight in (user_flight, track_flight, playback_flight)}
+
+
+class DeclareCursor(Executable, ClauseElement):
+    """`DECLARE name CURSOR FOR select`, a server side cursor to fetch the select results in chunks."""
+
+    def __init__(self, name, select):  # noqa D107
+        self.name = name
+        self.select = select
+
+
+@compiles(DeclareCursor, 'postgresql')
+def _pg_declare_cursor(element, compiler, **kwargs):
+    return f'DECLARE {element.name} NO SCROLL CURSOR FOR {compiler.process(element.select, **kwargs)}'
+
+
+_cursor_ids = itertools.count()
+
+
+async def _iter_fetches(query, fetch_size, conn):
+    name = f'mosbot_cursor_{next(_cursor_ids)}'
+    fetch = sa.text(f'FETCH FORWARD {int(fetch_size)} FROM {name}') \
+        .columns(*(sa.column(column.key, column.type) for column in query.c))
+    async with ensure_read_connection(conn) as conn:
+        trans = None if conn.in_transaction else await conn.begin()
+        try:
+            await conn.execute(DeclareCursor(name, query))
+            while True:
+                rows = await (await conn.execute(fetch)).fetchall()
+                if rows:
+                    yield rows
+                if len(rows) < fetch_size:
+                    break
+        finally:
+            if trans is not None:
+                await trans.rollback()  # Nothing was written, and it closes the cursor
+            else:
+                with contextlib.suppress(psycopg2.Error):
+                    await conn.execute(f'CLOSE {name}')
+
+
+async def iter_query(query, *, fetch_size=1000, conn=None) -> AsyncIterator[dict]:
+    """Iterate over the results of a select with a server side cursor, holding at most `fetch_size` rows in memory.
+
+    The cursor lives in a transaction, the one open in `conn` if any, otherwise one is opened just for the scan. The
+    connection is busy until the iteration finishes, so don't use it for anything else meanwhile. If the iteration can
+    be stopped early, with a break or an exception, close the iterator, otherwise the connection and the transaction
+    are held until it's garbage collected: `async with aclosing(iter_query(...)) as records:`, from :ref:`mosbot.util`.
+
+    :param query: SQLAlchemy select
+    :param int fetch_size: Number of rows fetched from the database at a time
+    :param conn: A connection if any open, otherwise the read replica may be used
+    :return: Async iterator of records
+    """
+    fetches = _iter_fetches(query, fetch_size, conn)
+    try:
+        async for rows in fetches:
+            for row in rows:
+                yield dict(row)
+    finally:
+        await fetches.aclose()  # Right away if the iteration is stopped, to finish the scan
+
+
+async def iter_query_chunks(query, *, fetch_size=1000, conn=None) -> AsyncIterator[List[tuple]]:
+    """Iterate over the results of a select as in :ref:`iter_query`, but a whole fetch at a time, as tuples.
+
+    It's for consumers that process the rows in bulk, they skip building a record for each row. Close it the same way
+    if the iteration can be stopped early.
+
+    :return: Async iterator of lists of at most `fetch_size` tuples, with the values in the order of the select
+    """
+    fetches = _iter_fetches(query, fetch_size, conn)
+    try:
+        async for rows in fetches:
+            yield [row.as_tuple() for row in rows]
+    finally:
+        await fetches.aclose()
+
+
 async def execute_and_first(*, query, conn=None):  # noqa D103
     async with ensure_connection(conn) as conn:
         result_proxy = await conn.execute(query)
@@ -99,7 +236,21 @@ async def save_user(*, user_dict: dict, conn=None) -> dict:
 
 
 async def get_or_save_user(*, user_dict: dict, conn=None) -> dict:
-    """Try to retrieve a given user. If it doesn't exist, try to create it."""
+    """Try to retrieve a given user. If it doesn't exist, try to create it.
+
+    Concurrent calls for the same dtid are coalesced into one, unless they are inside of a transaction.
+    """
+    dtid = user_dict.get('dtid')
+    if dtid is None:
+        return await _get_or_save_user(user_dict=user_dict, conn=conn)
+    return await user_flight.do(
+        dtid,
+        lambda: _get_or_save_user(user_dict=user_dict, conn=conn),
+        share=shareable_connection(conn),
+    )
+
+
+async def _get_or_save_user(*, user_dict: dict, conn=None) -> dict:
     user = await get_user(user_dict=user_dict, conn=conn)
     if user:
         return user
@@ -156,7 +307,21 @@ async def save_track(*, track_dict: dict, conn=None) -> Optional[dict]:
     return await execute_and_first(query=query, conn=conn)
 
 
-async def get_or_save_track(*, track_dict: dict, conn=None) -> dict:  # noqa D103  TODO
+async def get_or_save_track(*, track_dict: dict, conn=None) -> dict:
+    """Try to retrieve a given track. If it doesn't exist, try to create it.
+
+    Concurrent calls for the same origin/extid are coalesced into one, unless they are inside of a transaction.
+    """
+    origin = track_dict.get('origin')
+    key = (getattr(origin, 'name', origin), track_dict.get('extid'))
+    return await track_flight.do(
+        key,
+        lambda: _get_or_save_track(track_dict=track_dict, conn=conn),
+        share=shareable_connection(conn),
+    )
+
+
+async def _get_or_save_track(*, track_dict: dict, conn=None) -> dict:
     track = await get_track(track_dict=track_dict, conn=conn)
     if track:
         return track
@@ -206,7 +371,19 @@ async def save_playback(*, playback_dict: dict, conn=None) -> Optional[dict]:
     return await execute_and_first(query=query, conn=conn)
 
 
-async def get_or_save_playback(*, playback_dict: dict, conn=None) -> dict:  # noqa D103  TODO
+async def get_or_save_playback(*, playback_dict: dict, conn=None) -> dict:
+    """Try to retrieve a given playback. If it doesn't exist, try to create it.
+
+    Concurrent calls for the same start are coalesced into one, unless they are inside of a transaction.
+    """
+    return await playback_flight.do(
+        playback_dict.get('start'),
+        lambda: _get_or_save_playback(playback_dict=playback_dict, conn=conn),
+        share=shareable_connection(conn),
+    )
+
+
+async def _get_or_save_playback(*, playback_dict: dict, conn=None) -> dict:
     playback = await get_playback(playback_dict=playback_dict, conn=conn)
     if playback:
         return playback
@@ -239,19 +416,37 @@ async def get_user_action(*, user_action_dict: dict, conn=None) -> Optional[dict
 async def save_user_action(*, user_action_dict: dict, conn=None) -> Optional[dict]:
     """Save/Update a user action.
 
+    The ts is moved up to :ref:`ACTION_CLOCK_SKEW` before the start of the playback if it's earlier, as the queries
+    on the actions of some playbacks rely on it to read only the partitions since then.
+
     :param dict user_action_dict: Keys as in table columns in the database
     :param conn: A connection if any open
     :return: None if not saved, else the saved record
     """
     assert 'playback_id' in user_action_dict
-    query = psa.insert(UserAction) \
-        .values(user_action_dict) \
-        .returning(UserAction) \
-        .on_conflict_do_update(
-        index_elements=[UserAction.c.id],
-        set_=user_action_dict
-    )
-    return await execute_and_first(query=query, conn=conn)
+    values = dict(user_action_dict)
+    if 'ts' in values:
+        earliest_ts = sa.select([Playback.c.start - ACTION_CLOCK_SKEW]) \
+            .where(Playback.c.id == values['playback_id']) \
+            .as_scalar()
+        values['ts'] = sa.func.greatest(sa.cast(values['ts'], UserAction.c.ts.type), earliest_ts)
+    user_action = None
+    if 'id' in values:
+        # The table is partitioned, there can't be a unique constraint on the id alone to do an upsert
+        query = UserAction.update() \
+            .where(UserAction.c.id == values['id']) \
+            .values(values) \
+            .returning(UserAction)
+        user_action = await execute_and_first(query=query, conn=conn)
+    if not user_action:
+        query = psa.insert(UserAction) \
+            .values(values) \
+            .returning(UserAction)
+        user_action = await execute_and_first(query=query, conn=conn)
+    if user_action and 'ts' in values and user_action['ts'] != user_action_dict['ts']:
+        logger.warning(f'User action {user_action["id"]} at {user_action_dict["ts"]} is before its playback started, '
+                       f'saved at {user_action["ts"]}')
+    return user_action
 
 
 async def save_bot_data(key, value, *, conn=None):
@@ -295,7 +490,7 @@ async def get_last_playback(*, conn=None) -> dict:
     """Get last playback from the database.
 
     The last playback is the most recent playback in the database. It cannot be assured that the track is still
-    playing.
+    playing. This is always read from the primary, as it needs to see the playbacks just saved.
 
     :param conn: A connection if any open
     :return: The last recorded playback
@@ -310,13 +505,12 @@ async def get_user_user_actions(user_id, *, conn=None) -> List[dict]:
     """Get the user actions for a given user, no more filters than that.
 
     :param str user_id: User id for who we want to retrieve the records for
-    :param conn: A connection if any open
+    :param conn: A connection if any open, otherwise the read replica may be used
     :return: List of user_action items
     """
-    query = sa.select([db.UserAction]) \
-        .where(UserAction.c.user_id == user_id)
+    query = _user_user_actions_query(user_id)
     result = []
-    async with ensure_connection(conn) as conn:
+    async with ensure_read_connection(conn) as conn:
         async for user_action in await conn.execute(query):
             result.append(dict(user_action))
         return result
@@ -326,19 +520,56 @@ async def get_user_dub_user_actions(user_id, *, conn=None) -> List[dict]:
     """Get the user dubs (upvote/downvote) only, not specific to a given playback.
 
     :param str user_id: User id for who we want to retrieve the records for
-    :param conn: A connection if any open
+    :param conn: A connection if any open, otherwise the read replica may be used
     :return: List of records
     """
-    query = sa.select([db.UserAction]) \
-        .where(UserAction.c.user_id == user_id) \
-        .where(UserAction.c.action.in_([Action.upvote, Action.downvote]))
-    async with ensure_connection(conn) as conn:
+    query = _user_dub_user_actions_query(user_id)
+    async with ensure_read_connection(conn) as conn:
         result = []
         async for user_action in await conn.execute(query):
             result.append(dict(user_action))
         return result
 
 
+def _user_user_actions_query(user_id):
+    return sa.select([db.UserAction]) \
+        .where(UserAction.c.user_id == user_id)
+
+
+def _user_dub_user_actions_query(user_id):
+    return _user_user_actions_query(user_id) \
+        .where(UserAction.c.action.in_([Action.upvote, Action.downvote]))
+
+
+def _after_id(query, after_id):
+    """Order a user action query by id, starting after `after_id`, for resumable scans."""
+    if after_id is not None:
+        query = query.where(UserAction.c.id > after_id)
+    return query.order_by(UserAction.c.id)
+
+
+def iter_user_user_actions(user_id, *, after_id=None, fetch_size=1000, conn=None) -> AsyncIterator[dict]:
+    """Iterate over the user actions of a given user, in id order, with a constant memory usage.
+
+    :param str user_id: User id for who we want to retrieve the records for
+    :param int after_id: Only actions with a greater id, to resume a scan from the last id seen
+    :param int fetch_size: Number of rows fetched from the database at a time
+    :param conn: A connection if any open, otherwise the read replica may be used
+    :return: Async iterator of user_action items
+    """
+    query = _after_id(_user_user_actions_query(user_id), after_id)
+    return iter_query(query, fetch_size=fetch_size, conn=conn)
+
+
+def iter_user_dub_user_actions(user_id, *, after_id=None, fetch_size=1000, conn=None) -> AsyncIterator[dict]:
+    """Iterate over the user dubs (upvote/downvote) of a given user, in id order, with a constant memory usage.
+
+    Check :ref:`iter_user_user_actions` for the parameters.
+    """
+    query = _after_id(_user_dub_user_actions_query(user_id), after_id)
+    return iter_query(query, fetch_size=fetch_size, conn=conn)
+
+
 def get_dub_action(dub):
     """Transform a name received by the api into an internal action.
 
@@ -384,15 +615,73 @@ async def query_simplified_user_actions(playback_id, *, conn=None) -> List[dict]
     and the skip if any.
 
     :param str playback_id: The playback id we want to get the actions for
-    :param conn: A connection if any open
+    :param conn: A connection if any open, otherwise the read replica may be used
     :return: A list of the records
     """
+    query = _simplified_user_actions_query(playback_id)
+    async with ensure_read_connection(conn) as conn:
+        result = []
+        async for user_action in await conn.execute(query):
+            result.append(dict(user_action))
+        return result
+
+
+ACTION_CLOCK_SKEW = datetime.timedelta(hours=1)
+"""How much before the start of its playback a user action can be, because the clocks are not in sync.
+
+It's enforced by :ref:`save_user_action`, the other writes use the start of the playback or later.
+"""
+
+
+def _user_actions_of_playbacks(from_id, to_id):
+    """Condition for the user actions of the playbacks with ids in [from_id, to_id).
+
+    It also limits the ts of the actions to the start of the first playback, so that only the partitions of
+    :ref:`UserAction` since then are read.
+    """
+    first_start = sa.select([saf.min(Playback.c.start)]) \
+        .where(Playback.c.id >= from_id) \
+        .where(Playback.c.id < to_id) \
+        .as_scalar()
+    return sa.and_(
+        UserAction.c.playback_id >= from_id,
+        UserAction.c.playback_id < to_id,
+        UserAction.c.ts >= first_start - ACTION_CLOCK_SKEW,
+    )
+
+
+def _user_actions_of_playbacks_started(since, until):
+    """Condition for the user actions of the playbacks started in [since, until), None to not limit either end.
+
+    As in :ref:`_user_actions_of_playbacks`, only the partitions of :ref:`UserAction` since then are read.
+    """
+    playback_ids = sa.select([Playback.c.id]).where(_playbacks_started(since, until))
+    condition = UserAction.c.playback_id.in_(playback_ids)
+    if since is not None:
+        condition = sa.and_(condition, UserAction.c.ts >= since - ACTION_CLOCK_SKEW)
+    return condition
+
+
+def _playbacks_started(since, until):
+    """Condition for the playbacks started in [since, until), None to not limit either end."""
+    return sa.and_(
+        Playback.c.start >= since if since is not None else sa.true(),
+        Playback.c.start < until if until is not None else sa.true(),
+    )
+
+
+def _simplified_user_actions_query(playback_id):
+    return _simplified_user_actions_of(_user_actions_of_playbacks(playback_id, playback_id + 1))
+
+
+def _simplified_user_actions_of(condition):
+    """Select the final user actions, as in :ref:`query_simplified_user_actions`, of the ones matching `condition`."""
     sub_query = sa.select([
         db.UserAction.c.user_id,
         saf.max(db.UserAction.c.ts).label('ts'),
         db.UserAction.c.playback_id,
     ]).where(
-        db.UserAction.c.playback_id == playback_id
+        condition
     ).group_by(
         db.UserAction.c.user_id,
         db.UserAction.c.playback_id,
@@ -401,7 +690,7 @@ async def query_simplified_user_actions(playback_id, *, conn=None) -> List[dict]
         ], else_=0)
     ).alias()
 
-    query = sa.select([
+    return sa.select([
         sa.distinct(db.UserAction.c.id),
         db.UserAction.c.action,
         db.UserAction.c.playback_id,
@@ -421,9 +710,1189 @@ async def query_simplified_user_actions(playback_id, *, conn=None) -> List[dict]
                 ], else_=db.UserAction.c.user_id == sub_query.c.user_id)
             )
         )
+    ).where(
+        condition
+    )
+
+
+def iter_simplified_user_actions(playback_id, *, after_id=None, fetch_size=1000, conn=None) -> AsyncIterator[dict]:
+    """Iterate over the final user actions of a given playback, in id order, with a constant memory usage.
+
+    Check :ref:`query_simplified_user_actions` for what final means and :ref:`iter_user_user_actions` for the
+    parameters.
+    """
+    query = _after_id(_simplified_user_actions_query(playback_id), after_id)
+    return iter_query(query, fetch_size=fetch_size, conn=conn)
+
+
+def iter_simplified_user_actions_between(since, until, *, fetch_size=1000, conn=None) -> AsyncIterator[dict]:
+    """Iterate over the final user actions of the playbacks started in [since, until), with a constant memory usage.
+
+    Check :ref:`query_simplified_user_actions` for what final means. They are ordered by playback and id.
+
+    :param datetime.datetime since: Start of the first playback
+    :param datetime.datetime until: Start after the one of the last playback
+    :param int fetch_size: Number of rows fetched from the database at a time
+    :param conn: A connection if any open, otherwise the read replica may be used
+    :return: Async iterator of records
+    """
+    query = _simplified_user_actions_of(_user_actions_of_playbacks_started(since, until)).order_by(
+        UserAction.c.playback_id, UserAction.c.id,
     )
+    return iter_query(query, fetch_size=fetch_size, conn=conn)
+
+
+def iter_playbacks_after(after_id, *, fetch_size=1000, conn=None) -> AsyncIterator[dict]:
+    """Iterate over the playbacks with ids after `after_id`, in start order, with their canonical track.
+
+    The track is the canonical one in :ref:`TrackCanonical`, so the playbacks of duplicated uploads of a song are of
+    the same track. The origin and extid are the ones of the track played, to know its canonical track when it plays.
+
+    :param int after_id: Last playback id already seen, 0 for all of them
+    :param int fetch_size: Number of rows fetched from the database at a time
+    :param conn: A connection if any open, otherwise the read replica may be used
+    :return: Async iterator of records with the playback id, start, track_id, user_id, track_name, origin and extid
+    """
+    track_id = _canonical_track_id(Playback.c.track_id)
+    played = Track.alias('played')
+    query = sa.select([
+        Playback.c.id,
+        Playback.c.start,
+        track_id.label('track_id'),
+        Playback.c.user_id,
+        Track.c.name.label('track_name'),
+        played.c.origin,
+        played.c.extid,
+    ]).select_from(
+        Playback.outerjoin(TrackCanonical, TrackCanonical.c.track_id == Playback.c.track_id)
+        .join(Track, Track.c.id == track_id)
+        .join(played, played.c.id == Playback.c.track_id)
+    ).where(Playback.c.id > after_id).order_by(Playback.c.start)
+    return iter_query(query, fetch_size=fetch_size, conn=conn)
+
+
+def iter_track_plays_since(since, *, fetch_size=1000, conn=None) -> AsyncIterator[dict]:
+    """Iterate over the playbacks started since a time, in start order, with the origin and extid of their track.
+
+    :param datetime.datetime since: Start of the first playback, included
+    :param int fetch_size: Number of rows fetched from the database at a time
+    :param conn: A connection if any open, otherwise the read replica may be used
+    :return: Async iterator of records with the origin, extid and start
+    """
+    query = sa.select([Track.c.origin, Track.c.extid, Playback.c.start]) \
+        .select_from(Playback.join(Track, Track.c.id == Playback.c.track_id)) \
+        .where(Playback.c.start >= since) \
+        .order_by(Playback.c.start)
+    return iter_query(query, fetch_size=fetch_size, conn=conn)
+
+
+def _epoch_us(column):
+    """Microseconds since the epoch of a timestamp, as a bigint."""
+    return sa.cast(sa.extract('epoch', column) * 1000000, sa.BigInteger)
+
+
+NO_USER_ID = -1
+"""User id of the rows without user in :ref:`iter_playback_rows` and :ref:`iter_user_action_rows`"""
+
+
+def iter_playback_rows(since, until, *, fetch_size=10000, conn=None) -> AsyncIterator[List[tuple]]:
+    """Iterate over the playbacks started in [since, until) as plain numbers, a fetch at a time, for bulk processing.
+
+    :param datetime.datetime since: Only playbacks started at or after this, None to not limit
+    :param datetime.datetime until: Only playbacks started before this, None to not limit
+    :param int fetch_size: Number of rows fetched from the database at a time
+    :param conn: A connection if any open, otherwise the read replica may be used
+    :return: Async iterator of lists of (id, start in microseconds since the epoch, track id, user id or
+    :ref:`NO_USER_ID`, track length) tuples, in id order
+    """
+    query = sa.select([
+        Playback.c.id,
+        _epoch_us(Playback.c.start).label('start'),
+        Playback.c.track_id,
+        sa.func.coalesce(Playback.c.user_id, NO_USER_ID).label('user_id'),
+        Track.c.length,
+    ]).select_from(
+        Playback.join(Track, Track.c.id == Playback.c.track_id)
+    ).where(_playbacks_started(since, until)).order_by(Playback.c.id)
+    return iter_query_chunks(query, fetch_size=fetch_size, conn=conn)
+
+
+def iter_user_action_rows(since, until, *, fetch_size=10000, conn=None) -> AsyncIterator[List[tuple]]:
+    """Iterate over the user actions of the playbacks started in [since, until) as plain numbers, a fetch at a time.
+
+    All of them, not only the final ones. Check :ref:`iter_playback_rows` for the parameters.
+
+    :return: Async iterator of lists of (id, playback id, user id or :ref:`NO_USER_ID`, ts in microseconds since the
+    epoch, :ref:`Action` value) tuples
+    """
+    query = sa.select([
+        UserAction.c.id,
+        UserAction.c.playback_id,
+        sa.func.coalesce(UserAction.c.user_id, NO_USER_ID).label('user_id'),
+        _epoch_us(UserAction.c.ts).label('ts'),
+        sa.case([(UserAction.c.action == action, action.value) for action in Action]).label('action'),
+    ]).where(_user_actions_of_playbacks_started(since, until))
+    return iter_query_chunks(query, fetch_size=fetch_size, conn=conn)
+
+
+async def get_playback_start_range(*, conn=None):
+    """Get the start of the first and the last playback, both None if there are none."""
+    query = sa.select([saf.min(Playback.c.start).label('first'), saf.max(Playback.c.start).label('last')])
+    async with ensure_read_connection(conn) as conn:
+        result = await (await conn.execute(query)).first()
+        return result['first'], result['last']
+
+
+def _playback_timeline_query(since, until, *, after=None, limit=500):
+    page = sa.select([Playback]).order_by(Playback.c.start).limit(limit)
+    if since is not None:
+        page = page.where(Playback.c.start >= since)
+    if until is not None:
+        page = page.where(Playback.c.start < until)
+    if after is not None:
+        page = page.where(Playback.c.start > after)
+    return _playback_timeline_select(page.cte('page')).order_by(page.c.start)
+
+
+def _playback_timeline_select(page):
+    """Select the playbacks of `page` with their track, user and votes, as in :ref:`get_playback_timeline_page`."""
+    return sa.select([
+        page.c.id,
+        page.c.start,
+        page.c.track_id,
+        Track.c.name.label('track_name'),
+        Track.c.origin,
+        Track.c.extid,
+        Track.c.length,
+        page.c.user_id,
+        User.c.username,
+        sa.func.coalesce(PlaybackSummary.c.upvotes, 0).label('upvotes'),
+        sa.func.coalesce(PlaybackSummary.c.downvotes, 0).label('downvotes'),
+        sa.func.coalesce(PlaybackSummary.c.skipped, False).label('skipped'),
+    ]).select_from(
+        page.join(Track, Track.c.id == page.c.track_id)
+            .outerjoin(User, User.c.id == page.c.user_id)
+            .outerjoin(PlaybackSummary, PlaybackSummary.c.playback_id == page.c.id)
+    )
+
+
+async def get_playback_timeline_page(since, until, *, after=None, limit=500, conn=None) -> List[dict]:
+    """Get a page of the playbacks started in a time range, with their track, user and votes.
+
+    Pages are keyed by start, which is unique, so getting any page costs the same, no matter how far it is.
+
+    :param datetime.datetime since: Only playbacks started at or after this, None to not limit
+    :param datetime.datetime until: Only playbacks started before this, None to not limit
+    :param datetime.datetime after: Only playbacks started after this, the start of the last playback of the previous
+    page, None for the first page
+    :param int limit: Maximum number of playbacks
+    :param conn: A connection if any open, otherwise the read replica may be used
+    :return: List of playbacks ordered by start, with the track name, origin, extid and length, the username, the
+    number of upvotes and downvotes and whether it was skipped, from :ref:`PlaybackSummary`
+    """
+    query = _playback_timeline_query(since, until, after=after, limit=limit)
+    async with ensure_read_connection(conn) as conn:
+        result = []
+        async for playback in await conn.execute(query):
+            result.append(dict(playback))
+        return result
+
+
+async def get_recent_playbacks(limit, *, conn=None) -> List[dict]:
+    """Get the last `limit` playbacks, in start order, with the same data as :ref:`get_playback_timeline_page`."""
+    page = sa.select([Playback]).order_by(sa.desc(Playback.c.start)).limit(limit).cte('page')
+    query = _playback_timeline_select(page).order_by(page.c.start)
+    async with ensure_read_connection(conn) as conn:
+        return [dict(playback) for playback in await (await conn.execute(query)).fetchall()]
+
+
+async def iter_playback_timeline(since, until, *, after=None, page_size=500, conn=None) -> AsyncIterator[dict]:
+    """Iterate over the playbacks started in a time range, a page at a time.
+
+    Check :ref:`get_playback_timeline_page` for the parameters and the records. To resume an iteration, pass the start
+    of the last playback seen as `after`.
+    """
+    while True:
+        page = await get_playback_timeline_page(since, until, after=after, limit=page_size, conn=conn)
+        for playback in page:
+            yield playback
+        if len(page) < page_size:
+            return
+        after = page[-1]['start']
+
+
+def _last_votes_query(condition):
+    """Last up/down vote of each voter in each playback, of the user actions matching `condition`.
+
+    Votes from history have no user, so each of them counts as a different voter.
+    """
+    voter = sa.func.coalesce(UserAction.c.user_id, -UserAction.c.id)
+    return sa.select([UserAction.c.playback_id, UserAction.c.action]) \
+        .distinct(UserAction.c.playback_id, voter) \
+        .where(condition) \
+        .where(UserAction.c.action.in_([Action.upvote, Action.downvote])) \
+        .order_by(UserAction.c.playback_id, voter, sa.desc(UserAction.c.ts), sa.desc(UserAction.c.id)) \
+        .alias('last_votes')
+
+
+def _playback_summary_query(from_id, to_id):
+    """Compute the :ref:`PlaybackSummary` of the playbacks with ids in [from_id, to_id) from the user actions."""
+    in_range = _user_actions_of_playbacks(from_id, to_id)
+    last_votes = _last_votes_query(in_range)
+    votes = sa.select([
+        last_votes.c.playback_id,
+        saf.count().filter(last_votes.c.action == Action.upvote).label('upvotes'),
+        saf.count().filter(last_votes.c.action == Action.downvote).label('downvotes'),
+        saf.count().label('voters'),
+    ]).group_by(last_votes.c.playback_id).alias('votes')
+    skips = sa.select([UserAction.c.playback_id, saf.min(UserAction.c.ts).label('skip_ts')]) \
+        .where(in_range) \
+        .where(UserAction.c.action == Action.skip) \
+        .group_by(UserAction.c.playback_id) \
+        .alias('skips')
+
+    playbacks = Playback \
+        .outerjoin(votes, votes.c.playback_id == Playback.c.id) \
+        .outerjoin(skips, skips.c.playback_id == Playback.c.id)
+    return sa.select([
+        Playback.c.id.label('playback_id'),
+        sa.func.coalesce(votes.c.upvotes, 0).label('upvotes'),
+        sa.func.coalesce(votes.c.downvotes, 0).label('downvotes'),
+        sa.func.coalesce(votes.c.voters, 0).label('voters'),
+        skips.c.skip_ts.isnot(None).label('skipped'),
+        skips.c.skip_ts,
+    ]).select_from(playbacks).where(Playback.c.id >= from_id).where(Playback.c.id < to_id)
+
+
+async def refresh_playback_summaries(from_id, to_id, *, stats: 'StatsDeltas' = None, conn=None) -> List[dict]:
+    """Recompute and store the :ref:`PlaybackSummary` of the playbacks with ids in [from_id, to_id).
+
+    The :ref:`UserStats` of the DJs and the :ref:`TrackStats` of the tracks are updated with the difference. The
+    playbacks are locked while doing it, so concurrent refreshes of the same playback don't overwrite each other.
+
+    :param int from_id: First playback id
+    :param int to_id: Playback id after the last one
+    :param stats: Where to add the difference of the stats instead of storing it, to store it later with
+        :ref:`store_stats_deltas`
+    :param conn: A connection if any open
+    :return: The summaries stored
+    """
+    summary = _playback_summary_query(from_id, to_id)
+    query = psa.insert(PlaybackSummary).from_select([c.key for c in summary.c], summary)
+    query = query.on_conflict_do_update(
+        index_elements=[PlaybackSummary.c.playback_id],
+        set_={column: query.excluded[column] for column in ('upvotes', 'downvotes', 'voters', 'skipped', 'skip_ts')},
+    ).returning(PlaybackSummary)
+    lock_query = sa.select([Playback.c.id, Playback.c.user_id, Playback.c.track_id, Playback.c.start, Track.c.length]) \
+        .select_from(Playback.join(Track, Track.c.id == Playback.c.track_id)) \
+        .where(Playback.c.id >= from_id) \
+        .where(Playback.c.id < to_id) \
+        .with_for_update(of=Playback)
+    old_query = sa.select([PlaybackSummary]) \
+        .where(PlaybackSummary.c.playback_id >= from_id) \
+        .where(PlaybackSummary.c.playback_id < to_id)
     async with ensure_connection(conn) as conn:
+        async with ensure_transaction(conn):
+            playbacks = {row['id']: dict(row) async for row in await conn.execute(lock_query)}
+            if not playbacks:
+                return []
+            old_summaries = {row['playback_id']: dict(row) async for row in await conn.execute(old_query)}
+            result = []
+            async for playback_summary in await conn.execute(query):
+                result.append(dict(playback_summary))
+            if stats is None:
+                deltas = StatsDeltas()
+                deltas.add_summaries(playbacks, old_summaries, result)
+                await store_stats_deltas(deltas, conn=conn)
+            else:
+                stats.add_summaries(playbacks, old_summaries, result)
+        return result
+
+
+async def refresh_playback_summary(playback_id, *, stats: 'StatsDeltas' = None, conn=None) -> dict:
+    """Recompute and store the :ref:`PlaybackSummary` of a playback, to be called after saving its user actions.
+
+    Only the actions of that playback are read, so the cost doesn't depend on the size of the table.
+
+    :param int playback_id: The playback to refresh
+    :param stats: Where to add the difference of the stats instead of storing it, as in
+        :ref:`refresh_playback_summaries`
+    :param conn: A connection if any open
+    :return: The summary stored
+    """
+    summaries = await refresh_playback_summaries(playback_id, playback_id + 1, stats=stats, conn=conn)
+    return summaries[0] if summaries else {}
+
+
+async def lock_playback(playback_id, *, conn):
+    """Lock a playback until the end of the transaction, as :ref:`refresh_playback_summaries` does.
+
+    For what is read before refreshing the summary, like the last dub of a user, so that it doesn't change meanwhile.
+    """
+    await conn.execute(sa.select([Playback.c.id]).where(Playback.c.id == playback_id).with_for_update())
+
+
+async def get_playback_summary(playback_id, *, conn=None) -> dict:
+    """Get the stored :ref:`PlaybackSummary` of a playback, empty if there is none."""
+    query = sa.select([PlaybackSummary]).where(PlaybackSummary.c.playback_id == playback_id)
+    return await execute_and_first(query=query, conn=conn)
+
+
+async def get_playback_summary_mismatches(from_id, to_id, *, conn=None) -> List[dict]:
+    """Compare the stored :ref:`PlaybackSummary` of the playbacks with ids in [from_id, to_id) with the user actions.
+
+    :return: List of the summaries that differ, as `{'playback_id', 'expected', 'stored'}`, where stored is None if
+    there is no summary stored
+    """
+    expected = _playback_summary_query(from_id, to_id).alias('expected')
+    columns = ('upvotes', 'downvotes', 'voters', 'skipped', 'skip_ts')
+    query = sa.select([expected, *(PlaybackSummary.c[column].label(f'stored_{column}') for column in columns),
+                       PlaybackSummary.c.playback_id.label('stored_playback_id')]) \
+        .select_from(expected.outerjoin(PlaybackSummary, PlaybackSummary.c.playback_id == expected.c.playback_id)) \
+        .where(sa.or_(
+            PlaybackSummary.c.playback_id.is_(None),
+            *(expected.c[column].is_distinct_from(PlaybackSummary.c[column]) for column in columns)
+        )) \
+        .order_by(expected.c.playback_id)
+    async with ensure_read_connection(conn) as conn:
         result = []
-        async for user_action in await conn.execute(query):
-            result.append(dict(user_action))
+        async for row in await conn.execute(query):
+            result.append({
+                'playback_id': row['playback_id'],
+                'expected': {column: row[column] for column in columns},
+                'stored': {column: row[f'stored_{column}'] for column in columns}
+                if row['stored_playback_id'] is not None else None,
+            })
         return result
+
+
+async def get_playback_id_range(*, conn=None):
+    """Get the lowest and highest playback ids, (None, None) if there are no playbacks."""
+    return await get_id_range(Playback, conn=conn)
+
+
+STATS_COUNTERS = ('plays', 'listened_seconds', 'updubs', 'downdubs', 'skips')
+"""Counters in both :ref:`UserStats` and :ref:`TrackStats`"""
+USER_STATS_COUNTERS = STATS_COUNTERS + ('updubs_given', 'downdubs_given')
+
+
+def listened_seconds(playback: dict, summary: Optional[dict]) -> int:
+    """Seconds a playback was listened, until it was skipped or the track finished.
+
+    :param dict playback: The playback, with the `start` and the track `length`
+    :param dict summary: Its :ref:`PlaybackSummary`, if None, it's not counted
+    """
+    if summary is None:
+        return 0
+    if summary['skipped']:
+        return min(playback['length'], max(0, int((summary['skip_ts'] - playback['start']).total_seconds())))
+    return playback['length']
+
+
+def _listened_seconds_column():
+    """Compute :ref:`listened_seconds` in SQL, for a select from Playback, Track and PlaybackSummary."""
+    skipped_after = sa.func.floor(sa.extract('epoch', PlaybackSummary.c.skip_ts - Playback.c.start))
+    return sa.case([
+        (PlaybackSummary.c.skipped, sa.func.least(Track.c.length, sa.func.greatest(0, skipped_after))),
+    ], else_=Track.c.length)
+
+
+def _stats_delta(playback, old_summary, new_summary) -> dict:
+    old = old_summary or {'upvotes': 0, 'downvotes': 0, 'skipped': False}
+    return {
+        'plays': 0 if old_summary else 1,
+        'listened_seconds': listened_seconds(playback, new_summary) - listened_seconds(playback, old_summary),
+        'updubs': new_summary['upvotes'] - old['upvotes'],
+        'downdubs': new_summary['downvotes'] - old['downvotes'],
+        'skips': int(new_summary['skipped']) - int(old['skipped']),
+    }
+
+
+class StatsDeltas:
+    """Differences of the :ref:`UserStats` and :ref:`TrackStats` counters, gathered to store them all at once.
+
+    A long transaction, like the one of a history chunk, adds to it the difference of every playback it refreshes and
+    stores it at the end with :ref:`store_stats_deltas`. The stats rows are locked only for the last statements then,
+    always in the same order, so concurrent transactions don't deadlock on them.
+    """
+
+    def __init__(self):  # noqa D107
+        self.users = collections.defaultdict(collections.Counter)
+        self.tracks = collections.defaultdict(collections.Counter)
+        self.user_last_played = {}
+        self.track_last_played = {}
+
+    def add_user(self, user_id, **deltas):
+        """Add to the counters of a user, the deltas can be negative."""
+        self.users[user_id].update(deltas)
+
+    def add_summaries(self, playbacks, old_summaries, new_summaries):
+        """Add the difference between the old and the new :ref:`PlaybackSummary` of some playbacks.
+
+        :param dict playbacks: The playbacks by id, with the `user_id`, `track_id`, `start` and track `length`
+        :param dict old_summaries: The summaries before, by playback id, missing if they were not played yet
+        :param list new_summaries: The summaries now
+        """
+        for new_summary in new_summaries:
+            playback = playbacks[new_summary['playback_id']]
+            old_summary = old_summaries.get(new_summary['playback_id'])
+            delta = _stats_delta(playback, old_summary, new_summary)
+            keys = [(self.tracks, self.track_last_played, playback['track_id'])]
+            if playback['user_id'] is not None:
+                keys.append((self.users, self.user_last_played, playback['user_id']))
+            for deltas, last_played, key in keys:
+                deltas[key].update(delta)
+                if not old_summary:
+                    last_played[key] = max(last_played.get(key, playback['start']), playback['start'])
+
+
+async def store_stats_deltas(stats: StatsDeltas, *, conn=None):
+    """Add the differences gathered to the :ref:`UserStats` and :ref:`TrackStats`, the users first, in id order."""
+    async with ensure_connection(conn) as conn:
+        await _add_stats(UserStats, UserStats.c.user_id, USER_STATS_COUNTERS, stats.users, stats.user_last_played,
+                         conn=conn)
+        await _add_stats(TrackStats, TrackStats.c.track_id, STATS_COUNTERS, stats.tracks, stats.track_last_played,
+                         conn=conn)
+
+
+async def _add_stats(table, key_column, counters, deltas, last_played, *, conn):
+    values = [
+        dict({counter: delta.get(counter, 0) for counter in counters},
+             **{key_column.key: key, 'last_played': last_played.get(key)})
+        for key, delta in sorted(deltas.items())
+        if any(delta.values()) or key in last_played
+    ]
+    if not values:
+        return
+    query = psa.insert(table).values(values)
+    query = query.on_conflict_do_update(
+        index_elements=[key_column],
+        set_=dict(
+            {counter: table.c[counter] + query.excluded[counter] for counter in counters},
+            last_played=sa.func.greatest(table.c.last_played, query.excluded.last_played),
+        ),
+    )
+    await conn.execute(query)
+
+
+async def add_user_stats(user_id, *, conn=None, **deltas):
+    """Add to the :ref:`UserStats` counters of a user.
+
+    :param int user_id: The user
+    :param conn: A connection if any open
+    :param deltas: Counter name and how much to add, it can be negative
+    """
+    stats = StatsDeltas()
+    stats.add_user(user_id, **deltas)
+    await store_stats_deltas(stats, conn=conn)
+
+
+async def get_user_last_dub(playback_id, user_id, *, conn=None) -> Optional[Action]:
+    """Get the last vote (upvote/downvote) of a user for a playback, None if the user didn't vote."""
+    query = sa.select([UserAction.c.action]) \
+        .where(_user_actions_of_playbacks(playback_id, playback_id + 1)) \
+        .where(UserAction.c.user_id == user_id) \
+        .where(UserAction.c.action.in_([Action.upvote, Action.downvote])) \
+        .order_by(sa.desc(UserAction.c.ts), sa.desc(UserAction.c.id)) \
+        .limit(1)
+    return (await execute_and_first(query=query, conn=conn)).get('action')
+
+
+async def get_user_stats(user_id, *, conn=None) -> dict:
+    """Get the :ref:`UserStats` of a user, empty if there are none."""
+    query = sa.select([UserStats]).where(UserStats.c.user_id == user_id)
+    return await execute_and_first(query=query, conn=conn)
+
+
+async def get_track_stats(track_id, *, conn=None) -> dict:
+    """Get the :ref:`TrackStats` of a track, empty if there are none."""
+    query = sa.select([TrackStats]).where(TrackStats.c.track_id == track_id)
+    return await execute_and_first(query=query, conn=conn)
+
+
+def _played_stats_query(key_column, from_id, to_id):
+    """Count the playbacks grouped by `key_column`, for the keys in [from_id, to_id).
+
+    Only the playbacks with a :ref:`PlaybackSummary` are counted, same as when updating the stats with the difference.
+    """
+    return sa.select([
+        key_column.label('key'),
+        saf.count().label('plays'),
+        saf.sum(_listened_seconds_column()).label('listened_seconds'),
+        saf.sum(PlaybackSummary.c.upvotes).label('updubs'),
+        saf.sum(PlaybackSummary.c.downvotes).label('downdubs'),
+        saf.count().filter(PlaybackSummary.c.skipped).label('skips'),
+        saf.max(Playback.c.start).label('last_played'),
+    ]).select_from(
+        Playback
+        .join(Track, Track.c.id == Playback.c.track_id)
+        .join(PlaybackSummary, PlaybackSummary.c.playback_id == Playback.c.id)
+    ).where(key_column >= from_id).where(key_column < to_id).group_by(key_column).alias('played')
+
+
+def _stats_columns(played):
+    return [sa.func.coalesce(played.c[counter], 0).label(counter) for counter in STATS_COUNTERS] + \
+           [played.c.last_played]
+
+
+async def rebuild_user_stats(from_id, to_id, *, conn=None):
+    """Recompute the :ref:`UserStats` of the users with ids in [from_id, to_id).
+
+    The counters are computed from the playbacks, their summaries and the user actions, not from the stored values.
+    """
+    played = _played_stats_query(Playback.c.user_id, from_id, to_id)
+    last_votes = sa.select([UserAction.c.user_id, UserAction.c.action]) \
+        .distinct(UserAction.c.playback_id, UserAction.c.user_id) \
+        .where(UserAction.c.user_id >= from_id) \
+        .where(UserAction.c.user_id < to_id) \
+        .where(UserAction.c.action.in_([Action.upvote, Action.downvote])) \
+        .order_by(UserAction.c.playback_id, UserAction.c.user_id, sa.desc(UserAction.c.ts), sa.desc(UserAction.c.id)) \
+        .alias('last_votes')
+    given = sa.select([
+        last_votes.c.user_id,
+        saf.count().filter(last_votes.c.action == Action.upvote).label('updubs_given'),
+        saf.count().filter(last_votes.c.action == Action.downvote).label('downdubs_given'),
+    ]).group_by(last_votes.c.user_id).alias('given')
+    stats = sa.select([
+        User.c.id.label('user_id'),
+        *_stats_columns(played),
+        sa.func.coalesce(given.c.updubs_given, 0).label('updubs_given'),
+        sa.func.coalesce(given.c.downdubs_given, 0).label('downdubs_given'),
+    ]).select_from(
+        User.outerjoin(played, played.c.key == User.c.id).outerjoin(given, given.c.user_id == User.c.id)
+    ).where(User.c.id >= from_id).where(User.c.id < to_id)
+    await _replace_stats(UserStats, UserStats.c.user_id, stats, conn=conn)
+
+
+async def rebuild_track_stats(from_id, to_id, *, conn=None):
+    """Recompute the :ref:`TrackStats` of the tracks with ids in [from_id, to_id).
+
+    The counters are computed from the playbacks and their summaries, not from the stored values.
+    """
+    played = _played_stats_query(Playback.c.track_id, from_id, to_id)
+    stats = sa.select([Track.c.id.label('track_id'), *_stats_columns(played)]) \
+        .select_from(Track.outerjoin(played, played.c.key == Track.c.id)) \
+        .where(Track.c.id >= from_id) \
+        .where(Track.c.id < to_id)
+    await _replace_stats(TrackStats, TrackStats.c.track_id, stats, conn=conn)
+
+
+async def _replace_stats(table, key_column, stats, *, conn):
+    query = psa.insert(table).from_select([c.key for c in stats.c], stats)
+    query = query.on_conflict_do_update(
+        index_elements=[key_column],
+        set_={c.key: query.excluded[c.key] for c in stats.c if c.key != key_column.key},
+    )
+    async with ensure_connection(conn) as conn:
+        await conn.execute(query)
+
+
+async def get_id_range(table, *, conn=None):
+    """Get the lowest and highest ids of a table, (None, None) if it's empty."""
+    query = sa.select([saf.min(table.c.id).label('min_id'), saf.max(table.c.id).label('max_id')])
+    result = await execute_and_first(query=query, conn=conn)
+    return result['min_id'], result['max_id']
+
+
+def truncate_hour(ts: datetime.datetime) -> datetime.datetime:
+    """Start of the hour of a timestamp, the bucket of :ref:`ActivityHourly` it's in."""
+    return ts.replace(minute=0, second=0, microsecond=0)
+
+
+async def mark_activity_dirty(timestamps, *, conn=None):
+    """Mark the hours of some timestamps so their activity rollups are refreshed.
+
+    :param timestamps: Iterable of datetimes, UTC
+    :param conn: A connection if any open
+    """
+    hours = sorted({truncate_hour(ts) for ts in timestamps})
+    if not hours:
+        return
+    async with ensure_connection(conn) as conn:
+        await conn.execute(ActivityDirty.insert().values([{'hour': hour} for hour in hours]))
+
+
+async def pop_activity_dirty_hours(*, conn=None) -> set:
+    """Remove all the hours marked by :ref:`mark_activity_dirty` and return them."""
+    query = ActivityDirty.delete().returning(ActivityDirty.c.hour)
+    async with ensure_connection(conn) as conn:
+        return {row['hour'] async for row in await conn.execute(query)}
+
+
+async def get_activity_hours_after(playback_id, user_action_id, *, conn=None):
+    """Get the hours with playbacks or user actions newer than the given ids.
+
+    :param int playback_id: Last playback id already rolled up
+    :param int user_action_id: Last user action id already rolled up
+    :param conn: A connection if any open
+    :return: The set of hours, and the new last playback id and user action id
+    """
+    hours = set()
+    last_ids = []
+    async with ensure_connection(conn) as conn:
+        for column, ts_column, after_id in ((Playback.c.id, Playback.c.start, playback_id),
+                                            (UserAction.c.id, UserAction.c.ts, user_action_id)):
+            hour = sa.func.date_trunc('hour', ts_column)
+            query = sa.select([hour.label('hour'), saf.max(column).label('last_id')]) \
+                .where(column > after_id) \
+                .group_by(hour)
+            last_id = after_id
+            async for row in await conn.execute(query):
+                hours.add(row['hour'])
+                last_id = max(last_id, row['last_id'])
+            last_ids.append(last_id)
+    return (hours, *last_ids)
+
+
+async def get_last_activity_ids(*, conn=None):
+    """Get the last playback id and user action id, 0 if there are none."""
+    query = sa.select([
+        sa.select([sa.func.coalesce(saf.max(Playback.c.id), 0)]).as_scalar().label('playback_id'),
+        sa.select([sa.func.coalesce(saf.max(UserAction.c.id), 0)]).as_scalar().label('user_action_id'),
+    ])
+    result = await execute_and_first(query=query, conn=conn)
+    return result['playback_id'], result['user_action_id']
+
+
+def _activity_query(precision, since, until):
+    """Activity between `since` and `until` grouped in buckets of `precision` ('hour' or 'day'), None for no limit."""
+    def in_range(query, ts_column):
+        if since is not None:
+            query = query.where(ts_column >= since)
+        if until is not None:
+            query = query.where(ts_column < until)
+        return query
+
+    play_bucket = sa.func.date_trunc(precision, Playback.c.start)
+    plays = in_range(sa.select([
+        play_bucket.label('bucket'),
+        saf.count().label('plays'),
+        saf.count(Playback.c.user_id.distinct()).label('djs'),
+    ]), Playback.c.start).group_by(play_bucket).alias('plays')
+    action_bucket = sa.func.date_trunc(precision, UserAction.c.ts)
+    actions = in_range(sa.select([
+        action_bucket.label('bucket'),
+        saf.count().filter(UserAction.c.action == Action.upvote).label('upvotes'),
+        saf.count().filter(UserAction.c.action == Action.downvote).label('downvotes'),
+        saf.count().filter(UserAction.c.action == Action.skip).label('skips'),
+    ]), UserAction.c.ts).group_by(action_bucket).alias('actions')
+    return sa.select([
+        sa.func.coalesce(plays.c.bucket, actions.c.bucket).label('bucket'),
+        *(sa.func.coalesce(plays.c[column], 0).label(column) for column in ('plays', 'djs')),
+        *(sa.func.coalesce(actions.c[column], 0).label(column) for column in ('upvotes', 'downvotes', 'skips')),
+    ]).select_from(plays.outerjoin(actions, actions.c.bucket == plays.c.bucket, full=True))
+
+
+async def refresh_activity(since=None, until=None, *, conn=None):
+    """Recompute the :ref:`ActivityHourly` and :ref:`ActivityDaily` rollups between two timestamps.
+
+    The whole days are recomputed for the daily rollups, so the hours should be aligned to days to keep both in sync.
+
+    :param datetime.datetime since: First hour, None to start from the beginning
+    :param datetime.datetime until: Hour after the last one, None to go until the end
+    :param conn: A connection if any open
+    """
+    async with ensure_connection(conn) as conn:
+        async with ensure_transaction(conn):
+            for table, precision in ((ActivityHourly, 'hour'), (ActivityDaily, 'day')):
+                delete = table.delete()
+                if since is not None:
+                    delete = delete.where(table.c.bucket >= since)
+                if until is not None:
+                    delete = delete.where(table.c.bucket < until)
+                await conn.execute(delete)
+                activity = _activity_query(precision, since, until)
+                await conn.execute(table.insert().from_select([c.key for c in activity.c], activity))
+
+
+async def lock_activity_rollups(*, conn):
+    """Lock the activity rollups until the end of the transaction, so only one refresh runs at a time."""
+    await conn.execute(sa.select([sa.func.pg_advisory_xact_lock(sa.func.hashtext(ActivityHourly.name))]))
+
+
+async def get_activity(since, until, *, daily=False, conn=None) -> List[dict]:
+    """Get the activity rollups between two timestamps, hourly or daily.
+
+    :param datetime.datetime since: First bucket
+    :param datetime.datetime until: Bucket after the last one
+    :param bool daily: Daily buckets instead of hourly
+    :param conn: A connection if any open
+    :return: The buckets with activity, ordered
+    """
+    table = ActivityDaily if daily else ActivityHourly
+    query = sa.select([table]).where(table.c.bucket >= since).where(table.c.bucket < until).order_by(table.c.bucket)
+    async with ensure_read_connection(conn) as conn:
+        return [dict(row) async for row in await conn.execute(query)]
+
+
+_trigram_search = None
+"""Whether the database has the pg_trgm extension, checked by the first search"""
+
+
+async def has_trigram_search(*, conn=None) -> bool:
+    """Check whether the database has the pg_trgm extension, which the search indexes need. It's checked once."""
+    global _trigram_search
+    if _trigram_search is None:
+        query = sa.text("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm')")
+        async with ensure_read_connection(conn) as conn:
+            _trigram_search = bool(await (await conn.execute(query)).scalar())
+    return _trigram_search
+
+
+def _escape_like(text):
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _search_query(columns, column, text, *, limit, trigram):
+    """Select `columns` of the rows whose `column` contains or, with `trigram`, looks like a word in `text`.
+
+    With trigram, the score is the word similarity, and `<%` and `ILIKE` are both served by the trigram GIN index.
+    Without it, the score is the fraction of the column that matched.
+    """
+    contains = column.ilike(f'%{_escape_like(text)}%', escape='\\')
+    if trigram:
+        condition = sa.or_(contains, sa.literal(text).op('<%')(column))
+        score = sa.func.word_similarity(text, column)
+    else:
+        condition = contains
+        score = sa.cast(len(text), sa.Float) / sa.func.greatest(sa.func.length(column), 1)
+    return sa.select(columns + [score.label('score')]) \
+        .where(condition) \
+        .order_by(sa.desc('score'), column, columns[0]) \
+        .limit(limit)
+
+
+async def search_tracks(text, *, limit=10, conn=None) -> List[dict]:
+    """Search tracks by a partial or, with pg_trgm, approximate name, best matches first.
+
+    :param str text: Part of the name
+    :param int limit: Maximum number of tracks
+    :param conn: A connection if any open, otherwise the read replica may be used
+    :return: List of tracks with their id, name, origin and extid, and the `score` of the match, from 0 to 1
+    """
+    trigram = await has_trigram_search(conn=conn)
+    query = _search_query([Track.c.id, Track.c.name, Track.c.origin, Track.c.extid], Track.c.name, text,
+                          limit=limit, trigram=trigram)
+    async with ensure_read_connection(conn) as conn:
+        return [dict(row) for row in await (await conn.execute(query)).fetchall()]
+
+
+async def search_users(text, *, limit=10, conn=None) -> List[dict]:
+    """Search users by a partial or approximate username, as :ref:`search_tracks`.
+
+    :return: List of users with their id, username and dtid, and the `score` of the match
+    """
+    trigram = await has_trigram_search(conn=conn)
+    query = _search_query([User.c.id, User.c.username, User.c.dtid], User.c.username, text, limit=limit,
+                          trigram=trigram)
+    async with ensure_read_connection(conn) as conn:
+        return [dict(row) for row in await (await conn.execute(query)).fetchall()]
+
+
+async def get_user_countries(dtids, *, conn=None) -> set:
+    """Get the countries of the users with the given dubtrack ids, skipping the ones without a country."""
+    dtids = list(dtids)
+    if not dtids:
+        return set()
+    query = sa.select([User.c.country]).distinct().where(User.c.dtid.in_(dtids) & User.c.country.isnot(None))
+    async with ensure_read_connection(conn) as conn:
+        return {row.country for row in await (await conn.execute(query)).fetchall()}
+
+
+async def has_user_countries(*, conn=None) -> bool:
+    """Check if the country of any user is known, nothing in the bot sets it, it's filled in by hand."""
+    query = sa.select([sa.exists().where(User.c.country.isnot(None))])
+    async with ensure_read_connection(conn) as conn:
+        return await (await conn.execute(query)).scalar()
+
+
+def _canonical_track_id(track_id):
+    """Canonical track of a track id column, with :ref:`TrackCanonical` outer joined on it."""
+    return saf.coalesce(TrackCanonical.c.canonical_track_id, track_id)
+
+
+def iter_tracks_after(after_id, *, fetch_size=1000, conn=None) -> AsyncIterator[dict]:
+    """Iterate over the tracks with ids after `after_id`, in id order, with their name and length.
+
+    :param int after_id: Last track id already seen, 0 for all of them
+    :param int fetch_size: Number of rows fetched from the database at a time
+    :param conn: A connection if any open, otherwise the read replica may be used
+    :return: Async iterator of records with the track id, name and length
+    """
+    query = sa.select([Track.c.id, Track.c.name, Track.c.length]) \
+        .where(Track.c.id > after_id) \
+        .order_by(Track.c.id)
+    return iter_query(query, fetch_size=fetch_size, conn=conn)
+
+
+async def save_canonical_tracks(mappings: List[dict], *, conn=None):
+    """Save the canonical track of duplicated tracks, replacing the one they had if any.
+
+    :param mappings: List of :ref:`TrackCanonical` rows, with track_id, canonical_track_id and similarity
+    """
+    if not mappings:
+        return
+    query = psa.insert(TrackCanonical).values(mappings)
+    query = query.on_conflict_do_update(
+        index_elements=[TrackCanonical.c.track_id],
+        set_={
+            'canonical_track_id': query.excluded.canonical_track_id,
+            'similarity': query.excluded.similarity,
+        },
+    )
+    async with ensure_connection(conn) as conn:
+        await conn.execute(query)
+
+
+async def get_canonical_track_id(track_id, *, conn=None) -> int:
+    """Get the canonical track of a track, the track itself if it's not a known duplicate."""
+    query = sa.select([TrackCanonical.c.canonical_track_id]).where(TrackCanonical.c.track_id == track_id)
+    async with ensure_read_connection(conn) as conn:
+        canonical_track_id = await (await conn.execute(query)).scalar()
+    return track_id if canonical_track_id is None else canonical_track_id
+
+
+async def get_song_stats(track_id, *, conn=None) -> dict:
+    """Get the :ref:`TrackStats` of a song, added up over all of the uploads of it in :ref:`TrackCanonical`.
+
+    :return: The counters and last_played, with the canonical_track_id and the number of tracks added up
+    """
+    canonical_track_id = await get_canonical_track_id(track_id, conn=conn)
+    duplicates = sa.select([TrackCanonical.c.track_id]) \
+        .where(TrackCanonical.c.canonical_track_id == canonical_track_id)
+    counters = [saf.coalesce(saf.sum(TrackStats.c[counter]), 0).label(counter) for counter in STATS_COUNTERS]
+    query = sa.select(
+        [saf.count().label('tracks'), *counters, saf.max(TrackStats.c.last_played).label('last_played')]
+    ).where(sa.or_(TrackStats.c.track_id == canonical_track_id, TrackStats.c.track_id.in_(duplicates)))
+    stats = await execute_and_first(query=query, conn=conn)
+    return dict(stats, canonical_track_id=canonical_track_id)
+
+
+RANKING_ORDERS = ('plays', 'updubs')
+"""Counters the rankings can be ordered by"""
+
+
+def _ranking_counters(stats_table=None):
+    """Plays, updubs and downdubs added up from a stats table, or from the playbacks and their summaries if None."""
+    if stats_table is not None:
+        counters = {counter: saf.sum(stats_table.c[counter]) for counter in ('plays', 'updubs', 'downdubs')}
+    else:
+        counters = {
+            'plays': saf.count(),
+            'updubs': saf.sum(PlaybackSummary.c.upvotes),
+            'downdubs': saf.sum(PlaybackSummary.c.downvotes),
+        }
+    return {name: saf.coalesce(counter, 0) for name, counter in counters.items()}
+
+
+def _played_since(since):
+    """Playbacks with their summaries, and the condition for the ones started since a date."""
+    return Playback.join(PlaybackSummary, PlaybackSummary.c.playback_id == Playback.c.id), Playback.c.start >= since
+
+
+async def get_dj_ranking(*, since=None, order_by='plays', limit=10, conn=None) -> List[dict]:
+    """Get the users that played the most, or got the most updubs.
+
+    All time rankings are read from :ref:`UserStats`, the ones since a date add up the playbacks started since then.
+
+    :param datetime.datetime since: Only playbacks started at or after this, None for all time
+    :param str order_by: One of :ref:`RANKING_ORDERS`
+    :param int limit: Users in the ranking
+    :param conn: A connection if any open, otherwise the read replica may be used
+    :return: List of users with their user_id, username, plays, updubs and downdubs, the first one first
+    """
+    if since is None:
+        counters = _ranking_counters(UserStats)
+        user_id = UserStats.c.user_id
+        select_from, condition = UserStats, UserStats.c.plays > 0
+    else:
+        counters = _ranking_counters()
+        user_id = Playback.c.user_id
+        select_from, condition = _played_since(since)
+    query = sa.select([user_id.label('user_id'), User.c.username] + [
+        counter.label(name) for name, counter in counters.items()
+    ]).select_from(select_from.join(User, User.c.id == user_id)).where(condition) \
+        .group_by(user_id, User.c.username).order_by(sa.desc(counters[order_by]), User.c.username).limit(limit)
+    async with ensure_read_connection(conn) as conn:
+        return [dict(row) for row in await (await conn.execute(query)).fetchall()]
+
+
+async def get_track_ranking(*, since=None, order_by='plays', limit=10, conn=None) -> List[dict]:
+    """Get the songs played the most, or that got the most updubs, adding up the duplicated uploads of each song.
+
+    As in :ref:`get_dj_ranking`, all time rankings are read from :ref:`TrackStats`.
+
+    :return: List of songs with their canonical track_id, name, plays, updubs and downdubs, the first one first
+    """
+    if since is None:
+        counters = _ranking_counters(TrackStats)
+        track_id = TrackStats.c.track_id
+        select_from, condition = TrackStats, TrackStats.c.plays > 0
+    else:
+        counters = _ranking_counters()
+        track_id = Playback.c.track_id
+        select_from, condition = _played_since(since)
+    canonical_track_id = _canonical_track_id(track_id)
+    ranked = sa.select([canonical_track_id.label('track_id')] + [
+        counter.label(name) for name, counter in counters.items()
+    ]).select_from(
+        select_from.outerjoin(TrackCanonical, TrackCanonical.c.track_id == track_id)
+    ).where(condition).group_by(canonical_track_id).alias('ranked')
+    query = sa.select([ranked.c.track_id, Track.c.name, ranked.c.plays, ranked.c.updubs, ranked.c.downdubs]) \
+        .select_from(ranked.join(Track, Track.c.id == ranked.c.track_id)) \
+        .order_by(sa.desc(ranked.c[order_by]), Track.c.name).limit(limit)
+    async with ensure_read_connection(conn) as conn:
+        return [dict(row) for row in await (await conn.execute(query)).fetchall()]
+
+
+USER_ACTION_DEFAULT_PARTITION = 'user_action_default'
+"""Partition of :ref:`UserAction` for the actions of months without their own partition"""
+
+
+def add_months(ts: datetime.datetime, months: int) -> datetime.datetime:
+    """Start of the month `months` after the one of `ts`, it can be negative."""
+    month_index = ts.year * 12 + ts.month - 1 + months
+    return datetime.datetime(month_index // 12, month_index % 12 + 1, 1)
+
+
+def user_action_partition_name(month: datetime.datetime) -> str:
+    """Name of the partition of :ref:`UserAction` for a month."""
+    return f'{UserAction.name}_y{month.year:04d}m{month.month:02d}'
+
+
+async def get_user_action_partitions(*, conn=None) -> List[str]:
+    """Get the names of the partitions of :ref:`UserAction`, sorted."""
+    query = sa.text('SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid '
+                    'WHERE i.inhparent = CAST(:table AS regclass) ORDER BY c.relname').bindparams(table=UserAction.name)
+    async with ensure_connection(conn) as conn:
+        return [row[0] async for row in await conn.execute(query)]
+
+
+async def create_user_action_partition(month: datetime.datetime, *, conn=None) -> str:
+    """Create the partition of :ref:`UserAction` for a month.
+
+    The actions of the month that went to the default partition are moved to the new one, otherwise it can't be
+    attached. It's done in a transaction, the default partition is locked meanwhile.
+
+    :param datetime.datetime month: Any time in the month
+    :param conn: A connection if any open
+    :return: The name of the partition
+    """
+    since, until = add_months(month, 0), add_months(month, 1)
+    name = user_action_partition_name(since)
+    columns = ', '.join(column.name for column in UserAction.c)
+    bounds = f"ts >= '{since.isoformat()}' AND ts < '{until.isoformat()}'"
+    async with ensure_connection(conn) as conn:
+        async with ensure_transaction(conn):
+            await conn.execute(f'CREATE TABLE {name} (LIKE {UserAction.name} INCLUDING DEFAULTS)')
+            await conn.execute(f'WITH moved AS (DELETE FROM {USER_ACTION_DEFAULT_PARTITION} WHERE {bounds} '
+                               f'RETURNING {columns}) INSERT INTO {name} ({columns}) SELECT {columns} FROM moved')
+            await conn.execute(f"ALTER TABLE {UserAction.name} ATTACH PARTITION {name} "
+                               f"FOR VALUES FROM ('{since.isoformat()}') TO ('{until.isoformat()}')")
+    return name
+
+
+def _copy_value(value) -> str:
+    """Format a value for the text format of `COPY`."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, enum.Enum):
+        value = value.name
+    elif isinstance(value, datetime.datetime):
+        value = value.isoformat()
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def copy_rows(table, rows, *, conn):
+    """Load rows into a table with `COPY`, which is much faster than inserting them.
+
+    :param table: The table, the rows have to have a key for each of its columns, missing ones are NULL
+    :param rows: Iterable of dicts
+    :param conn: A blocking connection, aiopg can't do `COPY`. Check :ref:`mosbot.db.create_blocking_engine`
+    """
+    columns = [column.name for column in table.c]
+    data = io.StringIO()
+    for row in rows:
+        data.write('\t'.join(_copy_value(row.get(column)) for column in columns))
+        data.write('\n')
+    data.seek(0)
+    with conn.connection.cursor() as cursor:
+        cursor.copy_expert(f'COPY {table.name} ({", ".join(columns)}) FROM STDIN', data)
+
+
+def bulk_save_history(rows, *, conn) -> List[int]:
+    """Save many songs of the dubtrack history at once, with a few set based statements instead of one per song.
+
+    The songs are copied to :ref:`HistoryStaging` and merged from there with the same rules as saving them one by one:
+    users are unique by dtid, tracks by origin/extid and playbacks by start, and the ones that exist are kept as they
+    are. A skip is added to the skipped playbacks that don't have one, at the start of the next song, and votes without
+    user are added until the playbacks have as many as the song.
+
+    The playback summaries are not refreshed, as it's done in batches afterwards.
+
+    :param rows: Iterable of dicts with the columns of :ref:`HistoryStaging`
+    :param conn: A blocking connection, inside of a transaction. Check :ref:`mosbot.db.create_blocking_engine`
+    :return: The ids of the playbacks of the songs, sorted
+    """
+    staging = HistoryStaging
+    staging.create(conn)
+    copy_rows(staging, rows, conn=conn)
+    conn.execute(f'ANALYZE {staging.name}')
+
+    users = sa.select([staging.c.dtid, staging.c.username]) \
+        .distinct(staging.c.dtid) \
+        .order_by(staging.c.dtid, staging.c.played)
+    query = psa.insert(User).from_select(['dtid', 'username'], users) \
+        .on_conflict_do_nothing(index_elements=[User.c.dtid])
+    saved_users = conn.execute(query).rowcount
+
+    tracks = sa.select([staging.c.origin, staging.c.extid, staging.c.length, staging.c.name]) \
+        .distinct(staging.c.origin, staging.c.extid) \
+        .order_by(staging.c.origin, staging.c.extid, staging.c.played)
+    query = psa.insert(Track).from_select(['origin', 'extid', 'length', 'name'], tracks) \
+        .on_conflict_do_nothing(index_elements=[Track.c.origin, Track.c.extid])
+    saved_tracks = conn.execute(query).rowcount
+
+    playbacks = sa.select([Track.c.id.label('track_id'), User.c.id.label('user_id'), staging.c.played]) \
+        .select_from(staging
+                     .join(User, User.c.dtid == staging.c.dtid)
+                     .join(Track, sa.and_(Track.c.origin == staging.c.origin, Track.c.extid == staging.c.extid))) \
+        .order_by(staging.c.played)
+    query = psa.insert(Playback).from_select(['track_id', 'user_id', 'start'], playbacks) \
+        .on_conflict_do_nothing(index_elements=[Playback.c.start])
+    saved_playbacks = conn.execute(query).rowcount
+
+    staged = staging.join(Playback, Playback.c.start == staging.c.played)
+    action_type = UserAction.c.action.type
+
+    has_skip = sa.exists() \
+        .where(UserAction.c.playback_id == Playback.c.id) \
+        .where(UserAction.c.action == Action.skip) \
+        .where(UserAction.c.ts >= Playback.c.start - ACTION_CLOCK_SKEW)
+    skips = sa.select([staging.c.next_played, Playback.c.id, sa.literal(Action.skip, action_type)]) \
+        .select_from(staged) \
+        .where(staging.c.skipped) \
+        .where(staging.c.next_played.isnot(None)) \
+        .where(~has_skip)
+    saved_skips = conn.execute(UserAction.insert().from_select(['ts', 'playback_id', 'action'], skips)).rowcount
+
+    first_played = sa.select([saf.min(staging.c.played)]).as_scalar()
+    last_votes = _last_votes_query(sa.and_(
+        UserAction.c.playback_id.in_(sa.select([Playback.c.id]).select_from(staged)),
+        UserAction.c.ts >= first_played - ACTION_CLOCK_SKEW,
+    ))
+    counts = sa.select([
+        Playback.c.id.label('playback_id'),
+        staging.c.played,
+        staging.c.updubs,
+        staging.c.downdubs,
+        saf.count().filter(last_votes.c.action == Action.upvote).label('upvotes'),
+        saf.count().filter(last_votes.c.action == Action.downvote).label('downvotes'),
+    ]).select_from(
+        staged.outerjoin(last_votes, last_votes.c.playback_id == Playback.c.id)
+    ).group_by(Playback.c.id, staging.c.played, staging.c.updubs, staging.c.downdubs).cte('counts')
+
+    def missing_votes(action, votes, saved):
+        series = sa.func.generate_series(1, votes - saved).alias('series')
+        action = sa.cast(sa.literal(action, action_type), action_type)
+        return sa.select([counts.c.played, counts.c.playback_id, action]) \
+            .select_from(counts.join(series, sa.true()))
+
+    votes = sa.union_all(
+        missing_votes(Action.upvote, counts.c.updubs, counts.c.upvotes),
+        missing_votes(Action.downvote, counts.c.downdubs, counts.c.downvotes),
+    )
+    saved_votes = conn.execute(UserAction.insert().from_select(['ts', 'playback_id', 'action'], votes)).rowcount
+
+    query = sa.select([Playback.c.id]).select_from(staged).order_by(Playback.c.id)
+    playback_ids = [row[0] for row in conn.execute(query)]
+    staging.drop(conn)
+    logger.info(f'Bulk saved {saved_users} users, {saved_tracks} tracks, {saved_playbacks} playbacks, '
+                f'{saved_skips} skips and {saved_votes} votes')
+    return playback_ids
+
+
+def _copy_target(table, conn):
+    preparer = conn.dialect.identifier_preparer
+    return preparer.format_table(table), ', '.join(preparer.quote(column.name) for column in table.c)
+
+
+def copy_table_out(table, fileobj, *, conn) -> int:
+    """Write all the rows of a table to a file, in the binary format of `COPY`.
+
+    :param table: The table, partitioned ones included
+    :param fileobj: Binary file to write to
+    :param conn: A blocking connection. Check :ref:`mosbot.db.create_blocking_engine`
+    :return: Number of rows written
+    """
+    name, columns = _copy_target(table, conn)
+    with conn.connection.cursor() as cursor:
+        cursor.copy_expert(f'COPY (SELECT {columns} FROM {name}) TO STDOUT (FORMAT binary)', fileobj)
+        return cursor.rowcount
+
+
+def copy_table_in(table, fileobj, *, conn) -> int:
+    """Load rows into a table from a file written by :ref:`copy_table_out`.
+
+    :param table: The table, it has to have the same columns as the one written
+    :param fileobj: Binary file to read from
+    :param conn: A blocking connection. Check :ref:`mosbot.db.create_blocking_engine`
+    :return: Number of rows loaded
+    """
+    name, columns = _copy_target(table, conn)
+    with conn.connection.cursor() as cursor:
+        cursor.copy_expert(f'COPY {name} ({columns}) FROM STDIN (FORMAT binary)', fileobj)
+        return cursor.rowcount
+
+
+def export_transaction_snapshot(*, conn) -> str:
+    """Export the snapshot of the current transaction, so other connections can read the same data.
+
+    It's valid until the transaction ends, which has to be `REPEATABLE READ` or `SERIALIZABLE`.
+    """
+    return conn.execute('SELECT pg_export_snapshot()').scalar()
+
+
+def set_transaction_snapshot(snapshot_id, *, conn):
+    """Make the current transaction read the data of a snapshot exported by :ref:`export_transaction_snapshot`.
+
+    It has to be run first in the transaction, which has to be `REPEATABLE READ` or `SERIALIZABLE`.
+    """
+    conn.execute(sa.text('SET TRANSACTION SNAPSHOT :snapshot_id').bindparams(snapshot_id=snapshot_id))
+
+
+def get_schema_revision(*, conn) -> Optional[str]:
+    """Get the Alembic revision the database is in, None if it has none."""
+    return conn.execute('SELECT version_num FROM alembic_version').scalar()
+
+
+def get_user_action_ts_range(*, conn):
+    """Get the first and last ts of :ref:`UserAction`, both None if there are none."""
+    return tuple(conn.execute(sa.select([saf.min(UserAction.c.ts), saf.max(UserAction.c.ts)])).first())
+
+
+def get_tables_with_rows(tables, *, conn) -> List[str]:
+    """Get the names of the tables that have any row."""
+    return [
+        table.name for table in tables
+        if conn.execute(sa.select([sa.exists(sa.select([sa.literal(1)]).select_from(table))])).scalar()
+    ]
+
+
+def truncate_tables(tables, *, conn):
+    """Remove all the rows of the tables, and restart their sequences."""
+    preparer = conn.dialect.identifier_preparer
+    conn.execute(f'TRUNCATE {", ".join(preparer.format_table(table) for table in tables)} RESTART IDENTITY')
+
+
+def reset_sequences(tables, *, conn):
+    """Set the sequences of the serial primary keys of the tables after the largest value, after loading rows."""
+    preparer = conn.dialect.identifier_preparer
+    for table in tables:
+        for column in table.primary_key.columns:
+            if not isinstance(column.type, sa.Integer) or column.foreign_keys:
+                continue
+            name, column_name = preparer.format_table(table), preparer.quote(column.name)
+            query = sa.text(f'SELECT setval(pg_get_serial_sequence(:table, :column), '
+                            f'coalesce(max({column_name}), 0) + 1, false) FROM {name}')
+            conn.execute(query.bindparams(table=name, column=column.name))
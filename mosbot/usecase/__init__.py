@@ -5,4 +5,34 @@ from .event_persistence import (  # noqa: F401
     ensure_dubtrack_skip
 )
 
+from .activity import (  # noqa: F401
+    rebuild_activity_rollups,
+    refresh_activity_rollups,
+    refresh_activity_rollups_forever
+)
+from .analytics_export import export_parquet  # noqa: F401
+from .availability import (  # noqa: F401
+    AvailabilityChecker,
+    YoutubeAvailabilityProvider,
+    blocked_countries,
+    check_upcoming_availability_forever,
+    set_availability_checker
+)
+from .duplicates import refresh_duplicate_tracks, refresh_duplicate_tracks_forever  # noqa: F401
+from .event_journal import drain_journal, open_journal  # noqa: F401
 from .history_sync import save_history_songs  # noqa: F401
+from .leaderboards import leaderboard_wait, refresh_leaderboards_forever, top_djs, top_tracks, user_stats  # noqa: F401
+from .partitions import ensure_user_action_partitions, ensure_user_action_partitions_forever  # noqa: F401
+from .playback_summary import check_playback_summaries, rebuild_playback_summaries  # noqa: F401
+from .recent_playbacks import (  # noqa: F401
+    find_recent_playback,
+    latest_playbacks,
+    minutes_ago,
+    warm_up_recent_playbacks
+)
+from .recommendations import refresh_recommendations_forever, set_playing_track, suggest_tracks  # noqa: F401
+from .repeats import RepeatPolicy, record_playing, warm_up_recent_plays  # noqa: F401
+from .room_queue import apply_queue_event, reconcile_room_queue_forever, room_queue_fresh, upcoming_tracks  # noqa: F401
+from .search import cached_search  # noqa: F401
+from .snapshot import export_snapshot, import_snapshot  # noqa: F401
+from .stats import rebuild_stats  # noqa: F401
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import datetime
+import logging
+
+from mosbot.db import BotConfig
+from mosbot.query import ensure_connection, ensure_transaction, get_activity_hours_after, get_last_activity_ids, \
+    load_bot_data, lock_activity_rollups, pop_activity_dirty_hours, refresh_activity, save_bot_data
+
+logger = logging.getLogger(__name__)
+
+ONE_DAY = datetime.timedelta(days=1)
+
+
+def day_ranges(hours):
+    """Group hours in ranges of whole consecutive days.
+
+    :param hours: Iterable of datetimes
+    :return: Sorted list of (since, until) with `since` the start of the first day and `until` the start of the day
+    after the last one
+    """
+    ranges = []
+    for day in sorted({datetime.datetime.combine(hour.date(), datetime.time()) for hour in hours}):
+        if ranges and ranges[-1][1] == day:
+            ranges[-1] = (ranges[-1][0], day + ONE_DAY)
+        else:
+            ranges.append((day, day + ONE_DAY))
+    return ranges
+
+
+async def refresh_activity_rollups(*, conn=None) -> int:
+    """Refresh the activity rollups of the days that changed since the last refresh.
+
+    These are the days with hours marked with :ref:`mark_activity_dirty` and the days with playbacks or user actions
+    newer than the watermark in :ref:`BotConfig.activity_rollup_watermark`. The watermark alone would miss rows that
+    are committed after others with higher ids, that's why the handlers mark the hours too. Without a watermark,
+    everything is rolled up.
+
+    :param conn: A connection if any open
+    :return: Number of days refreshed
+    """
+    async with ensure_connection(conn) as conn:
+        async with ensure_transaction(conn):
+            await lock_activity_rollups(conn=conn)
+            watermark = await load_bot_data(BotConfig.activity_rollup_watermark, conn=conn) or {}
+            hours, playback_id, user_action_id = await get_activity_hours_after(
+                watermark.get('playback_id', 0), watermark.get('user_action_id', 0), conn=conn,
+            )
+            hours |= await pop_activity_dirty_hours(conn=conn)
+            days = 0
+            for since, until in day_ranges(hours):
+                await refresh_activity(since, until, conn=conn)
+                days += (until - since).days
+            await save_bot_data(BotConfig.activity_rollup_watermark, {
+                'playback_id': playback_id,
+                'user_action_id': user_action_id,
+            }, conn=conn)
+    if days:
+        logger.info(f'Refreshed the activity rollups of {days} days')
+    return days
+
+
+async def rebuild_activity_rollups(*, conn=None):
+    """Recompute all the activity rollups from the playbacks and user actions."""
+    async with ensure_connection(conn) as conn:
+        async with ensure_transaction(conn):
+            await lock_activity_rollups(conn=conn)
+            await pop_activity_dirty_hours(conn=conn)
+            playback_id, user_action_id = await get_last_activity_ids(conn=conn)
+            await refresh_activity(conn=conn)
+            await save_bot_data(BotConfig.activity_rollup_watermark, {
+                'playback_id': playback_id,
+                'user_action_id': user_action_id,
+            }, conn=conn)
+
+
+async def refresh_activity_rollups_forever(interval):
+    """Refresh the activity rollups every `interval` seconds, forever."""
+    while True:
+        try:
+            await refresh_activity_rollups()
+        except Exception:
+            logger.exception('Failed to refresh the activity rollups')
+        await asyncio.sleep(interval)
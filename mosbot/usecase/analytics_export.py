@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import datetime
+import logging
+import os
+
+from mosbot.db import Action, Origin
+from mosbot.query import add_months, get_playback_start_range, iter_playback_timeline, \
+    iter_simplified_user_actions_between
+from mosbot.util import aclosing
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+logger = logging.getLogger(__name__)
+
+PARQUET_FILE_NAME = 'data.parquet'
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise RuntimeError('The Parquet export needs pyarrow, install it with `pip install mosbot[parquet]`')
+
+
+def _enum_type():
+    return pa.dictionary(pa.int8(), pa.string())
+
+
+def playback_schema():
+    """Arrow schema of the exported playbacks, the ones of :ref:`iter_playback_timeline`."""
+    _require_pyarrow()
+    return pa.schema([
+        ('id', pa.int32()),
+        ('start', pa.timestamp('us')),
+        ('track_id', pa.int32()),
+        ('track_name', pa.string()),
+        ('origin', _enum_type()),
+        ('extid', pa.string()),
+        ('length', pa.int32()),
+        ('user_id', pa.int32()),
+        ('username', pa.string()),
+        ('upvotes', pa.int32()),
+        ('downvotes', pa.int32()),
+        ('skipped', pa.bool_()),
+    ])
+
+
+def user_action_schema():
+    """Arrow schema of the exported user actions, the ones of :ref:`iter_simplified_user_actions_between`."""
+    _require_pyarrow()
+    return pa.schema([
+        ('id', pa.int32()),
+        ('action', _enum_type()),
+        ('playback_id', pa.int32()),
+        ('ts', pa.timestamp('us')),
+        ('user_id', pa.int32()),
+    ])
+
+
+_ENUMS = {
+    'origin': Origin,
+    'action': Action,
+}
+"""Enum of each dictionary encoded column, the dictionary is always the names of all the members in order"""
+
+
+def _enum_array(enum_class, values):
+    members = list(enum_class)
+    indices = pa.array([members.index(value) for value in values], pa.int8())
+    return pa.DictionaryArray.from_arrays(indices, pa.array([member.name for member in members], pa.string()))
+
+
+def to_record_batch(records, schema):
+    """Build an Arrow record batch from a list of records, encoding the enums with a fixed dictionary."""
+    arrays = []
+    for field in schema:
+        values = [record[field.name] for record in records]
+        if field.name in _ENUMS:
+            arrays.append(_enum_array(_ENUMS[field.name], values))
+        else:
+            arrays.append(pa.array(values, field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def month_partition(month: datetime.datetime) -> str:
+    """Name of the hive style partition directory of a month."""
+    return f'month={month.year:04d}-{month.month:02d}'
+
+
+class _BatchWriter:
+    """Write the records to a Parquet file in record batches of `batch_size` rows, opening it with the first one."""
+
+    def __init__(self, path, schema, batch_size):  # noqa D107
+        self.path = path
+        self.schema = schema
+        self.batch_size = batch_size
+        self.records = []
+        self.rows = 0
+        self.writer = None
+
+    async def add(self, record):
+        self.records.append(record)
+        if len(self.records) >= self.batch_size:
+            await self.flush()
+
+    def _write(self, records):
+        if self.writer is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.writer = pq.ParquetWriter(self.path, self.schema)
+        self.writer.write_batch(to_record_batch(records, self.schema), row_group_size=self.batch_size)
+
+    async def flush(self):
+        if not self.records:
+            return
+        records, self.records = self.records, []
+        self.rows += len(records)
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self._write, records)
+
+    async def close(self):
+        await self.flush()
+        if self.writer is not None:
+            self.writer.close()
+
+
+async def _export_month(directory, month, batch_size, conn):
+    since, until = month, add_months(month, 1)
+    playbacks = _BatchWriter(
+        os.path.join(directory, 'playbacks', month_partition(month), PARQUET_FILE_NAME), playback_schema(), batch_size)
+    try:
+        async for playback in iter_playback_timeline(since, until, page_size=batch_size, conn=conn):
+            await playbacks.add(playback)
+    finally:
+        await playbacks.close()
+
+    user_actions = _BatchWriter(
+        os.path.join(directory, 'user_actions', month_partition(month), PARQUET_FILE_NAME), user_action_schema(),
+        batch_size)
+    try:
+        user_action_records = iter_simplified_user_actions_between(since, until, fetch_size=batch_size, conn=conn)
+        async with aclosing(user_action_records):
+            async for user_action in user_action_records:
+                await user_actions.add(user_action)
+    finally:
+        await user_actions.close()
+
+    logger.info(f'Exported {playbacks.rows} playbacks and {user_actions.rows} user actions of {month:%Y-%m}')
+    return playbacks.rows, user_actions.rows
+
+
+async def export_parquet(directory, *, batch_size=10000, conn=None) -> dict:
+    """Export the playbacks and their final user actions to Parquet files, for offline analytics.
+
+    The files are partitioned by the month the playbacks started, as `playbacks/month=YYYY-MM/data.parquet` and
+    `user_actions/month=YYYY-MM/data.parquet`, which pandas, pyarrow and most query engines read as a hive partitioned
+    dataset. The rows are streamed from the database and written in row groups of `batch_size` rows, so at most that
+    many are held in memory. The playbacks have their track, user and votes, as in :ref:`iter_playback_timeline`, and
+    the user actions are the simplified ones, as in :ref:`query_simplified_user_actions`. Origins and actions are
+    dictionary encoded.
+
+    :param str directory: Directory to write the dataset to, the files of the exported months are replaced
+    :param int batch_size: Rows per record batch and row group
+    :param conn: A connection if any open, otherwise the read replica may be used
+    :return: The number of months, playbacks and user actions exported
+    """
+    _require_pyarrow()
+    first, last = await get_playback_start_range(conn=conn)
+    result = {'months': 0, 'playbacks': 0, 'user_actions': 0}
+    if first is None:
+        return result
+    month = add_months(first, 0)
+    while month <= last:
+        playbacks, user_actions = await _export_month(directory, month, batch_size, conn)
+        result['months'] += 1
+        result['playbacks'] += playbacks
+        result['user_actions'] += user_actions
+        month = add_months(month, 1)
+    return result
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+import abc
+import asyncio
+import logging
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import aiohttp
+
+from mosbot import config
+from mosbot.db import Origin
+from mosbot.query import get_user_countries
+from mosbot.usecase.room_queue import QueueItem, upcoming_tracks
+from mosbot.util import TTLCache
+
+logger = logging.getLogger(__name__)
+
+Availability = Dict[Tuple[str, str], bool]
+"""Whether each (extid, country) is available"""
+
+
+class AvailabilityProvider(abc.ABC):
+    """Source of the availability of the tracks of an origin in each country, looked up in batches."""
+
+    origin: Origin = None
+    batch_size = 50
+    """Most tracks looked up at once"""
+
+    @abc.abstractmethod
+    async def check(self, extids: List[str], countries: Set[str]) -> Availability:
+        """Get whether each track is available in each of the countries.
+
+        A track that doesn't exist anymore is not available anywhere.
+        """
+
+
+class FakeAvailabilityProvider(AvailabilityProvider):
+    """Provider with the tracks blocked given beforehand, that keeps the batches it's asked for, to use in tests.
+
+    :param blocked: Countries where each extid is blocked, None if it's not available anywhere
+    """
+
+    def __init__(self, blocked: Dict[str, Optional[Set[str]]] = None, *, origin=Origin.youtube,  # noqa D107
+                 batch_size=50):
+        self.blocked = blocked or {}
+        self.origin = origin
+        self.batch_size = batch_size
+        self.batches = []
+
+    async def check(self, extids, countries):  # noqa D102
+        self.batches.append((list(extids), set(countries)))
+        availability = {}
+        for extid in extids:
+            blocked = self.blocked.get(extid, set())
+            for country in countries:
+                availability[extid, country] = blocked is not None and country not in blocked
+        return availability
+
+
+class YoutubeAvailabilityProvider(AvailabilityProvider):
+    """Availability of youtube videos, from the region restrictions of the YouTube Data API.
+
+    Videos that are not found, or can't be embedded, are not available anywhere.
+    """
+
+    origin = Origin.youtube
+    url = 'https://www.googleapis.com/youtube/v3/videos'
+
+    def __init__(self, api_key):  # noqa D107
+        self.api_key = api_key
+
+    async def check(self, extids, countries):  # noqa D102
+        params = {'part': 'contentDetails,status', 'id': ','.join(extids), 'key': self.api_key}
+        async with aiohttp.ClientSession() as session:
+            async with session.get(self.url, params=params) as response:
+                response.raise_for_status()
+                videos = {video['id']: video for video in (await response.json()).get('items', [])}
+        availability = {}
+        for extid in extids:
+            video = videos.get(extid)
+            embeddable = video is not None and video.get('status', {}).get('embeddable', True)
+            restriction = (video or {}).get('contentDetails', {}).get('regionRestriction', {})
+            for country in countries:
+                if not embeddable:
+                    available = False
+                elif 'allowed' in restriction:
+                    available = country in restriction['allowed']
+                else:
+                    available = country not in restriction.get('blocked', ())
+                availability[extid, country] = available
+        return availability
+
+
+class AvailabilityChecker:
+    """Cache of the availability of the tracks in the countries of the listeners, filled in batches ahead of time.
+
+    Unavailable tracks are cached too, for `negative_ttl`, so that a track blocked, or deleted, isn't looked up again
+    on each check. Tracks of other origins than the provider one are always considered available. Checking a track
+    in the cache is a dict lookup, so it can be done as it plays.
+
+    The countries of the listeners are the ones in `user.country`, which Dubtrack doesn't give, so it has to be filled
+    in by hand, the bot doesn't check the availability until the country of some user is known.
+    """
+
+    def __init__(self, provider: AvailabilityProvider, *, ttl=config.AVAILABILITY_TTL,  # noqa D107
+                 negative_ttl=config.AVAILABILITY_NEGATIVE_TTL, maxsize=config.AVAILABILITY_CACHE_SIZE,
+                 clock=time.monotonic):
+        self.provider = provider
+        self.negative_ttl = negative_ttl
+        self.cache = TTLCache(maxsize, ttl, clock=clock)
+        """Whether each (extid, country) is available"""
+        self.countries = set()
+        """Countries of the listeners in the room on the last check"""
+        self.lookups = 0
+
+    def blocked_countries(self, origin: Origin, extid: str, countries: Iterable[str] = None) -> Set[str]:
+        """Get the countries, the ones of the last check by default, where a track is known to be unavailable."""
+        if origin != self.provider.origin:
+            return set()
+        if countries is None:
+            countries = self.countries
+        return {country for country in countries if self.cache.get((extid, country)) is False}
+
+    async def check(self, items: Iterable[QueueItem], countries: Iterable[str]) -> Dict[str, Set[str]]:
+        """Look up the tracks not cached in the countries, in batches, and get where each of them is unavailable.
+
+        :return: Countries where each unavailable extid is blocked, the available ones are left out
+        """
+        countries = set(countries)
+        self.countries = countries
+        extids = [item.extid for item in items if getattr(Origin, item.origin, None) == self.provider.origin]
+        extids = list(dict.fromkeys(extids))
+        missing = [extid for extid in extids
+                   if any(self.cache.get((extid, country)) is None for country in countries)]
+        batch_size = self.provider.batch_size
+        for start in range(0, len(missing), batch_size):
+            batch = missing[start:start + batch_size]
+            self.lookups += 1
+            for key, available in (await self.provider.check(batch, countries)).items():
+                self.cache.set(key, available, ttl=None if available else self.negative_ttl)
+        blocked = {}
+        for extid in extids:
+            extid_blocked = self.blocked_countries(self.provider.origin, extid, countries)
+            if extid_blocked:
+                blocked[extid] = extid_blocked
+        return blocked
+
+    def metrics(self) -> dict:
+        """Get the lookups done to the provider and the counters of the cache."""
+        return dict(self.cache.metrics(), lookups=self.lookups)
+
+
+AVAILABILITY: Optional[AvailabilityChecker] = None
+"""Availability checker of the running bot, None if tracks availability is not checked"""
+
+
+def set_availability_checker(checker: Optional[AvailabilityChecker]):
+    """Set the availability checker of the bot, None to not check the availability of the tracks."""
+    global AVAILABILITY
+    AVAILABILITY = checker
+
+
+def blocked_countries(origin: str, extid: str) -> Set[str]:
+    """Get the countries of the listeners where a track is known to be unavailable, without looking it up."""
+    if AVAILABILITY is None:
+        return set()
+    return AVAILABILITY.blocked_countries(getattr(Origin, origin, None), extid)
+
+
+async def check_upcoming_availability(listeners: Callable[[], Iterable[str]], *, limit=config.AVAILABILITY_UPCOMING,
+                                      checker: AvailabilityChecker = None, conn=None) -> Dict[str, Set[str]]:
+    """Check the availability of the next tracks of the room queue in the countries of the listeners.
+
+    Listeners without a country are left out, none of them has one unless it was filled in by hand.
+
+    :param listeners: Function returning the dubtrack ids of the users in the room
+    :param limit: Upcoming tracks checked
+    :param checker: The availability checker, the bot one by default
+    :return: Countries where each unavailable extid is blocked
+    """
+    if checker is None:
+        checker = AVAILABILITY
+    countries = await get_user_countries(listeners(), conn=conn)
+    blocked = await checker.check(upcoming_tracks(limit), countries)
+    if blocked:
+        logger.info(f'Upcoming tracks blocked: {blocked}')
+    return blocked
+
+
+async def check_upcoming_availability_forever(listeners: Callable[[], Iterable[str]], interval):
+    """Check the availability of the next tracks every `interval` seconds, forever, so they are cached before playing.
+
+    The first check is after `interval`, so that the backend is connected by then.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await check_upcoming_availability(listeners)
+        except Exception:
+            logger.exception('Failed to check the availability of the upcoming tracks')
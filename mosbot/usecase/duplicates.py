@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import collections
+import itertools
+import logging
+import math
+import re
+import sys
+import unicodedata
+from typing import Iterable, List, Optional, Tuple
+
+from mosbot import config
+from mosbot.query import iter_tracks_after, save_canonical_tracks
+from mosbot.util import IdWatermark, aclosing
+
+logger = logging.getLogger(__name__)
+
+NOISE_WORDS = frozenset((
+    'official', 'video', 'audio', 'music', 'lyrics', 'lyric', 'hd', 'hq', '4k', 'mv', 'clip', 'videoclip',
+))
+"""Words uploaders add to the song name, they are left out when comparing names"""
+VERSION_WORDS = frozenset((
+    'remix', 'mix', 'edit', 'live', 'acoustic', 'cover', 'instrumental', 'karaoke', 'remastered', 'extended', 'slowed',
+    'nightcore',
+))
+"""Words that tell apart another version of a song, names differing in any of them are not duplicates"""
+
+_WORD = re.compile(r'\w+')
+_NON_ASCII = re.compile(r'[^\x00-\x7f]')
+
+
+def normalize_track_name(name) -> Tuple[str, ...]:
+    """Split a track name into its words, lowercase, without accents or :ref:`NOISE_WORDS`, sorted and unique.
+
+    So "Björk - Army of Me (Official Video)" and "bjork army of me [HD]" are the same.
+    """
+    name = name.casefold()
+    if _NON_ASCII.search(name):
+        name = unicodedata.normalize('NFKD', name)
+        name = ''.join(char for char in name if not unicodedata.combining(char))
+    return tuple(sorted({sys.intern(word) for word in _WORD.findall(name) if word not in NOISE_WORDS}))
+
+
+def name_similarity(words, other_words) -> float:
+    """Jaccard similarity of the words of two normalized names, 0 if only one of them has a :ref:`VERSION_WORDS`."""
+    words = set(words)
+    if not VERSION_WORDS.isdisjoint(words.symmetric_difference(other_words)):
+        return 0
+    shared = len(words.intersection(other_words))
+    return shared / (len(words) + len(other_words) - shared)
+
+
+class TrackDeduplicator:
+    """Detect the tracks that are another upload of a song already saved, by how similar their names are.
+
+    Instead of comparing each track with all the others, the tracks are indexed by the words of their normalized name,
+    the blocking keys, and a new track is only compared with the ones sharing one of them. The words in more than
+    `max_block_size` tracks, like "the" or "feat", stop being keys, so the comparisons per track are bounded and the
+    index is kept small, at the cost of not detecting the duplicates whose names only have common words. Candidates
+    that share too few keys to be similar enough are not even compared.
+
+    Tracks are expected in id order. A duplicate gets the canonical track of its most similar match, and tracks are
+    never merged afterwards, so the first upload of a song is its canonical track and the mapping is stable. A track
+    committed after others saved later is added after them, so it can get a later upload as canonical track.
+    """
+
+    def __init__(self, *, threshold=config.DUPLICATE_TRACK_SIMILARITY,  # noqa D107
+                 length_tolerance=config.DUPLICATE_TRACK_LENGTH_TOLERANCE, max_block_size=1000,
+                 id_overlap=config.INCREMENTAL_REFRESH_ID_OVERLAP):
+        self.threshold = threshold
+        self.length_tolerance = length_tolerance
+        self.max_block_size = max_block_size
+        self.tracks = {}
+        """Normalized name and length of each track indexed"""
+        self.blocks = collections.defaultdict(list)
+        """Track ids with each blocking key"""
+        self.common_words = set()
+        """Words that are not blocking keys anymore"""
+        self.canonical = {}
+        self.watermark = IdWatermark(id_overlap)
+        """Tracks added, the refreshes read the ones after it"""
+
+    def find_match(self, words, length) -> Optional[Tuple[float, int]]:
+        """Find the most similar track of the ones indexed, preferring the lowest id on ties.
+
+        :return: (similarity, track id) of the match, None if no track is similar enough
+        """
+        blocks = [self.blocks[word] for word in words if word in self.blocks]
+        # A match shares at least `threshold` of the words, and all of them but the common ones are in the blocks
+        common = sum(1 for word in words if word in self.common_words)
+        needed = max(1, math.ceil(round(self.threshold * len(words), 6)) - common)
+        best = None
+        for track_id, shared in collections.Counter(itertools.chain.from_iterable(blocks)).items():
+            if shared < needed:
+                continue
+            other_words, other_length = self.tracks[track_id]
+            # The similarity can't be higher than the ratio of the name sizes
+            if min(len(words), len(other_words)) < self.threshold * max(len(words), len(other_words)):
+                continue
+            if length and other_length and abs(length - other_length) > self.length_tolerance:
+                continue
+            similarity = name_similarity(words, other_words)
+            if similarity >= self.threshold and (best is None or (similarity, -track_id) > (best[0], -best[1])):
+                best = similarity, track_id
+        return best
+
+    def add_tracks(self, tracks: Iterable[dict]) -> List[dict]:
+        """Add tracks with their id, name and length, and find the ones that are duplicates.
+
+        :return: List of :ref:`TrackCanonical` rows of the duplicates found
+        """
+        mappings = []
+        for track in tracks:
+            words = normalize_track_name(track['name'])
+            if not words:
+                continue
+            match = self.find_match(words, track['length'])
+            if match is not None:
+                similarity, match_id = match
+                canonical_track_id = self.canonical.get(match_id, match_id)
+                self.canonical[track['id']] = canonical_track_id
+                mappings.append({
+                    'track_id': track['id'],
+                    'canonical_track_id': canonical_track_id,
+                    'similarity': similarity,
+                })
+            self.tracks[track['id']] = words, track['length']
+            for word in words:
+                if word in self.common_words:
+                    continue
+                block = self.blocks[word]
+                block.append(track['id'])
+                if len(block) > self.max_block_size:
+                    del self.blocks[word]
+                    self.common_words.add(word)
+        return mappings
+
+
+DEDUPLICATOR = TrackDeduplicator()
+"""Deduplicator of the running bot, kept up to date by :ref:`refresh_duplicate_tracks_forever`"""
+
+
+async def refresh_duplicate_tracks(deduplicator: TrackDeduplicator = None, *, fetch_size=1000, conn=None) -> int:
+    """Check the tracks saved since the last refresh for duplicates, and save the canonical track of the ones found.
+
+    The first refresh checks all the tracks, and saves again the duplicates that were already found. The last tracks
+    checked are read again, as a track can be committed after others saved later, and the ones already checked are
+    skipped.
+
+    :param deduplicator: The deduplicator to refresh, :ref:`DEDUPLICATOR` if None
+    :param int fetch_size: Tracks read and checked at a time
+    :param conn: A connection if any open
+    :return: Number of duplicates found
+    """
+    if deduplicator is None:
+        deduplicator = DEDUPLICATOR
+    watermark = deduplicator.watermark
+    found = 0
+    batch = []
+    async with aclosing(iter_tracks_after(watermark.after_id, fetch_size=fetch_size, conn=conn)) as tracks:
+        async for track in tracks:
+            if not watermark.see(track['id']):
+                continue
+            batch.append(track)
+            if len(batch) == fetch_size:
+                mappings = deduplicator.add_tracks(batch)
+                await save_canonical_tracks(mappings, conn=conn)
+                found, batch = found + len(mappings), []
+                watermark.prune()
+    mappings = deduplicator.add_tracks(batch)
+    await save_canonical_tracks(mappings, conn=conn)
+    found += len(mappings)
+    watermark.prune()
+    if found:
+        logger.info(f'Found {found} duplicated tracks')
+    return found
+
+
+async def refresh_duplicate_tracks_forever(interval):
+    """Check the new tracks for duplicates every `interval` seconds, forever."""
+    while True:
+        try:
+            await refresh_duplicate_tracks()
+        except Exception:
+            logger.exception('Failed to check the tracks for duplicates')
+        await asyncio.sleep(interval)
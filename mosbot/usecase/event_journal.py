@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import datetime
+import logging
+
+import psycopg2
+from abot.dubtrack import DubtrackDub, DubtrackPlaying, DubtrackSkip
+
+from mosbot.db import BotConfig
+from mosbot.event_log import ReplayBackend, record_to_event
+from mosbot.journal import LEGACY_ID, Journal
+from mosbot.query import ensure_connection, load_bot_data, save_bot_data
+from mosbot.usecase.event_persistence import ensure_dubtrack_dub, ensure_dubtrack_playing, ensure_dubtrack_skip
+
+logger = logging.getLogger(__name__)
+
+TRANSIENT_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError, OSError, asyncio.TimeoutError)
+"""Errors that mean the database is not reachable, records failing with these are retried forever"""
+
+
+def open_journal(directory, **kwargs) -> Journal:
+    """Open the journal, without going to the database, so events are journaled even if it's down when starting.
+
+    The sequence numbers continue from the last segment, which is never released, so they are not reused. A new
+    directory starts again from 1 with a new id, and :ref:`store_journal_record` doesn't take its records for the ones
+    already stored from the previous one.
+    """
+    return Journal(directory, **kwargs).open()
+
+
+async def store_journal_record(*, record: dict, journal_id: str, backend: ReplayBackend, conn) -> bool:
+    """Store the event of a journal record in the database, only once.
+
+    The sequence number of the record is saved in the same transaction as the event, along with the id of the journal,
+    so if the record was already stored (because we crashed before releasing it from the journal), it's skipped. The
+    sequence number stored is ignored if it's from another journal, as the numbers start again in a new directory.
+
+    :param str journal_id: Id of the journal the record is from
+    :return: True if it was stored, False if it had already been
+    """
+    async with conn.begin():
+        stored_journal_id = await load_bot_data(BotConfig.journal_id, conn=conn)
+        drained_seq = await load_bot_data(BotConfig.journal_drained_seq, conn=conn) or 0
+        # Before the journals had an id, only the directory that was in use has segments when upgrading
+        if stored_journal_id != journal_id and not (stored_journal_id is None and journal_id == LEGACY_ID):
+            if drained_seq:
+                logger.warning(f'Journal {journal_id} is not the one drained up to {drained_seq} '
+                               f'({stored_journal_id}), storing its records from the start')
+            drained_seq = 0
+        if record['seq'] <= drained_seq:
+            return False
+        if stored_journal_id != journal_id:
+            await save_bot_data(BotConfig.journal_id, journal_id, conn=conn)
+        event = record_to_event(record, backend)
+        ts = datetime.datetime.utcfromtimestamp(record['ts'])
+        if isinstance(event, DubtrackPlaying):
+            await ensure_dubtrack_playing(event=event, conn=conn)
+        elif isinstance(event, DubtrackSkip):
+            await ensure_dubtrack_skip(event=event, conn=conn, ts=ts)
+        elif isinstance(event, DubtrackDub):
+            await ensure_dubtrack_dub(event=event, conn=conn, ts=ts)
+        await save_bot_data(BotConfig.journal_drained_seq, record['seq'], conn=conn)
+    return True
+
+
+async def drain_journal(journal: Journal, *, batch_size=100, max_attempts=3, retry_delay=1, max_retry_delay=60):
+    """Store the journal records in the database as they come, forever.
+
+    While the database is unavailable the records stay in the journal, and they are retried with an exponential
+    backoff. Records failing for other reasons are retried `max_attempts` times and then skipped, so that a single
+    broken record doesn't stop the rest.
+
+    It starts from the first record in the journal, the ones already stored are skipped by
+    :ref:`store_journal_record`, this way it doesn't need the database to start.
+    """
+    backend = ReplayBackend()
+    drained_seq = 0
+    while True:
+        records = await journal.read(drained_seq, batch_size)
+        for record in records:
+            attempt, delay = 0, retry_delay
+            while True:
+                attempt += 1
+                try:
+                    async with ensure_connection(None) as conn:
+                        await store_journal_record(record=record, journal_id=journal.id, backend=backend, conn=conn)
+                    break
+                except TRANSIENT_ERRORS:
+                    logger.warning(f'Database unavailable storing journal record {record["seq"]}, retrying in {delay}s')
+                except Exception:
+                    if attempt >= max_attempts:
+                        logger.exception(f'Skipping journal record {record}, failed {attempt} times')
+                        break
+                    logger.exception(f'Failed to store journal record {record["seq"]}, retrying in {delay}s')
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, max_retry_delay)
+            drained_seq = record['seq']
+        journal.release(drained_seq)
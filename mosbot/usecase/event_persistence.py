@@ -5,10 +5,19 @@ from abot.dubtrack import DubtrackEntity, DubtrackPlaying, DubtrackSkip, Dubtrac
 
 from mosbot.db import Origin, Action
 from mosbot.query import get_last_playback, \
-    save_user_action, get_dub_action, get_or_save_user, get_or_save_track, get_or_save_playback
+    save_user_action, get_dub_action, get_or_save_user, get_or_save_track, get_or_save_playback, \
+    refresh_playback_summary, get_user_last_dub, mark_activity_dirty, StatsDeltas, store_stats_deltas, \
+    ensure_connection, ensure_transaction, lock_playback
+from mosbot.usecase.recent_playbacks import record_dub, record_playback, record_skip
+from mosbot.usecase.repeats import record_playing
 
 logger = logging.getLogger(__name__)
 
+GIVEN_DUB_COUNTERS = {
+    Action.upvote: 'updubs_given',
+    Action.downvote: 'downdubs_given',
+}
+
 
 async def ensure_dubtrack_entity(*, user: DubtrackEntity, conn=None):
     """Ensure that a given Dubtrack entity is registered in the database."""
@@ -20,68 +29,109 @@ async def ensure_dubtrack_entity(*, user: DubtrackEntity, conn=None):
 
 
 async def ensure_dubtrack_playing(*, event: DubtrackPlaying, conn=None):
-    """Ensure that the database contains the track and the playback specified within the event parameter."""
-    user = await ensure_dubtrack_entity(user=event.sender, conn=conn)
-    user_id = user['id']
-    track_dict = {
-        'length': event.length.total_seconds(),
-        'origin': getattr(Origin, event.song_type),
-        'extid': event.song_external_id,
-        'name': event.song_name,
-    }
-    track = await get_or_save_track(track_dict=track_dict, conn=conn)
-    track_id = track['id']
-
-    playback_dict = {
-        'user_id': user_id,
-        'track_id': track_id,
-        'start': event.played,
-    }
-    await get_or_save_playback(playback_dict=playback_dict, conn=conn)
-
+    """Ensure that the database contains the track and the playback specified within the event parameter.
 
-async def ensure_dubtrack_skip(*, event: DubtrackSkip, conn=None):
+    Everything is written in a transaction, so the summary of the playback is never out of sync with it. The play is
+    added to the recent plays and playbacks too, once written, to check for repeats and answer the chat commands
+    without going to the database.
+    """
+    async with ensure_connection(conn) as conn:
+        async with ensure_transaction(conn):
+            user = await ensure_dubtrack_entity(user=event.sender, conn=conn)
+            user_id = user['id']
+            track_dict = {
+                'length': event.length.total_seconds(),
+                'origin': getattr(Origin, event.song_type),
+                'extid': event.song_external_id,
+                'name': event.song_name,
+            }
+            track = await get_or_save_track(track_dict=track_dict, conn=conn)
+            track_id = track['id']
+
+            playback_dict = {
+                'user_id': user_id,
+                'track_id': track_id,
+                'start': event.played,
+            }
+            playback = await get_or_save_playback(playback_dict=playback_dict, conn=conn)
+            await refresh_playback_summary(playback['id'], conn=conn)
+            await mark_activity_dirty([event.played], conn=conn)
+    record_playing(event)
+    record_playback(playback_id=playback['id'], start=event.played, track_id=track_id, track_name=event.song_name,
+                    user_id=user_id, username=user['username'])
+
+
+async def ensure_dubtrack_skip(*, event: DubtrackSkip, conn=None, ts=None):
     """Make sure to record an skip in the last playback we have.
 
+    `ts` is when the skip happened, now if not given. The skip and the summary of the playback are written in a
+    transaction.
+
     Warning: This can put at risk db integrity because we don't know what is the song it skipped. We are entirely
     relying on that dubtrack backend will send first a chat skip event and then a playing event. Also, this may have
     a race condition because of the asyncronicity of the library/bot. We may end up processing this event untimed and
     wrong... Hope there is not such race condition for now.
 
     """
-    playback = await get_last_playback(conn=conn)
-    user = await ensure_dubtrack_entity(user=event.sender, conn=conn)
-    playback_id = playback['id']
-    user_id = user['id']
-    await save_user_action(user_action_dict={
-        'playback_id': playback_id,
-        'user_id': user_id,
-        'action': Action.skip,
-        'ts': datetime.datetime.utcnow(),
-    }, conn=conn)
-
-
-async def ensure_dubtrack_dub(*, event: DubtrackDub, conn=None):
+    async with ensure_connection(conn) as conn:
+        async with ensure_transaction(conn):
+            playback = await get_last_playback(conn=conn)
+            user = await ensure_dubtrack_entity(user=event.sender, conn=conn)
+            playback_id = playback['id']
+            user_id = user['id']
+            ts = ts or datetime.datetime.utcnow()
+            await save_user_action(user_action_dict={
+                'playback_id': playback_id,
+                'user_id': user_id,
+                'action': Action.skip,
+                'ts': ts,
+            }, conn=conn)
+            await refresh_playback_summary(playback_id, conn=conn)
+            await mark_activity_dirty([ts], conn=conn)
+    record_skip(playback_id)
+
+
+async def ensure_dubtrack_dub(*, event: DubtrackDub, conn=None, ts=None):
     """Ensure that a user action (user upvote/downvote) is being stored.
 
     Because we don't have all the track info,
     we cannot be 100% sure of the track, but we check start time, that is unique, if this checks, better to lose the
-    data than to put a wrong dub from a person
+    data than to put a wrong dub from a person. `ts` is when the dub happened, now if not given.
+
+    It's written in a transaction, with the playback locked before reading the previous dub of the user, so two dubs
+    of the same user at once don't both count as the first one in the dubs given.
     """
-    playback = await get_last_playback(conn=conn)
-    if not event.played == playback['start']:
-        logger.error(f'Last saved playback is {playback["start"]} but this vote is for {event.played}')
-        return
-    playback_id = playback['id']
-
-    user = await ensure_dubtrack_entity(user=event.sender, conn=conn)
-    user_id = user['id']
-    action_type = get_dub_action(event.dubtype)
-
-    user_action_dict = {
-        'ts': datetime.datetime.utcnow(),
-        'playback_id': playback_id,
-        'user_id': user_id,
-        'action': action_type,
-    }
-    await save_user_action(user_action_dict=user_action_dict, conn=conn)
+    async with ensure_connection(conn) as conn:
+        async with ensure_transaction(conn):
+            playback = await get_last_playback(conn=conn)
+            if not event.played == playback['start']:
+                logger.error(f'Last saved playback is {playback["start"]} but this vote is for {event.played}')
+                return
+            playback_id = playback['id']
+
+            user = await ensure_dubtrack_entity(user=event.sender, conn=conn)
+            user_id = user['id']
+            action_type = get_dub_action(event.dubtype)
+
+            ts = ts or datetime.datetime.utcnow()
+            user_action_dict = {
+                'ts': ts,
+                'playback_id': playback_id,
+                'user_id': user_id,
+                'action': action_type,
+            }
+            await lock_playback(playback_id, conn=conn)
+            previous_action = await get_user_last_dub(playback_id, user_id, conn=conn)
+            await save_user_action(user_action_dict=user_action_dict, conn=conn)
+            # The stats of the DJ, the track and the voter are stored at once, locked in the same order as elsewhere
+            stats = StatsDeltas()
+            await refresh_playback_summary(playback_id, stats=stats, conn=conn)
+            if previous_action != action_type:
+                deltas = {GIVEN_DUB_COUNTERS[action_type]: 1}
+                if previous_action:
+                    deltas[GIVEN_DUB_COUNTERS[previous_action]] = -1
+                stats.add_user(user_id, **deltas)
+            await store_stats_deltas(stats, conn=conn)
+            await mark_activity_dirty([ts], conn=conn)
+    if previous_action != action_type:
+        record_dub(playback_id, user_id, action_type, previous_action)
@@ -10,17 +10,21 @@ import datetime
 import logging
 import sqlalchemy as sa
 from abot.dubtrack import DubtrackWS
+from typing import List
 
-from mosbot.db import BotConfig, UserAction, Action, Origin, get_engine
+from mosbot.db import BotConfig, UserAction, Action, Origin, create_blocking_engine, get_engine
 from mosbot.query import get_dub_action, load_bot_data, \
     query_simplified_user_actions, save_bot_data, save_user_action, \
-    execute_and_first, get_or_save_user, get_or_save_track, get_or_save_playback
+    execute_and_first, get_or_save_user, get_or_save_track, get_or_save_playback, refresh_playback_summary, \
+    mark_activity_dirty, bulk_save_history, ensure_connection, refresh_playback_summaries, StatsDeltas, \
+    store_stats_deltas
+from mosbot.usecase.partitions import create_missing_user_action_partitions
 from mosbot.util import retries
 
 logger = logging.getLogger(__name__)
 
 
-async def save_history_songs():
+async def save_history_songs(*, since=None, bulk=False):
     """Make sure we haven't lost a single playback.
 
     Gets in charge of going to dubtrack up to the previous saved history moment, and fills the database.
@@ -28,15 +32,21 @@ async def save_history_songs():
     It makes parallel queries and everything to maximise throughput.
 
     Saves previous to first unsuccessful storage, or last successful. This is, it doesn't save 5 if 4 failed.
+
+    :param float since: Timestamp to go back to instead of the previous saved history moment, to fill a new database
+    :param bool bulk: Save the songs with :ref:`bulk_persist_history`, for big backfills
+    :return: The timestamp of the last song saved, None if none was
     """
-    last_song = await load_bot_data(BotConfig.last_saved_history)
-    if not last_song:
+    last_song = since if since is not None else await load_bot_data(BotConfig.last_saved_history)
+    if last_song is None:
         logger.error('There is no bot data regarding last saved playback')
         return
 
     history_songs = await dubtrack_songs_since_ts(last_song)
 
-    await persist_history(history_songs)
+    if bulk:
+        return await bulk_persist_history(history_songs)
+    return await persist_history(history_songs)
 
 
 async def persist_history(history_songs):  # noqa: D103
@@ -73,6 +83,78 @@ async def persist_history(history_songs):  # noqa: D103
     return last_successful_song
 
 
+def history_rows(history_songs) -> List[dict]:
+    """Convert the songs of the dubtrack history to rows of :ref:`HistoryStaging`, sorted by when they were played."""
+    rows = []
+    for _, song in sorted(history_songs.items()):
+        song_played = datetime.datetime.utcfromtimestamp(song['played'] / 1000)
+        if rows:
+            rows[-1]['next_played'] = song_played
+        rows.append({
+            'played': song_played,
+            'next_played': None,
+            'skipped': song['skipped'],
+            'dtid': song['userid'],
+            'username': song['_user']['username'],
+            'origin': getattr(Origin, song['_song']['type']),
+            'extid': song['_song']['fkid'],
+            'name': song['_song']['name'],
+            'length': song['_song']['songLength'] / 1000,
+            'updubs': song['updubs'],
+            'downdubs': song['downdubs'],
+        })
+    return rows
+
+
+def id_windows(ids, size):
+    """Split sorted ids into [from_id, to_id) windows of at most `size` ids, skipping the gaps between them."""
+    to_id = None
+    for id_ in ids:
+        if to_id is None or id_ >= to_id:
+            to_id = id_ + size
+            yield id_, to_id
+
+
+def _bulk_save_history(rows):
+    engine = create_blocking_engine()
+    try:
+        with engine.begin() as conn:
+            return bulk_save_history(rows, conn=conn)
+    finally:
+        engine.dispose()
+
+
+async def bulk_persist_history(history_songs, *, batch_size=1000):
+    """Save the history songs as :ref:`persist_history` does, but all at once, for big backfills.
+
+    The songs are copied to the database and merged with a few statements in a single transaction, so either all of
+    them are saved or none. It's done in a thread, as aiopg can't `COPY`. The partitions of the months of the songs
+    are created first, and the playback summaries are refreshed in batches afterwards.
+
+    :param dict history_songs: Songs by played timestamp, as returned by :ref:`dubtrack_songs_since_ts`
+    :param int batch_size: Number of playback ids per summary refresh
+    :return: The timestamp of the last song, None if there were none
+    """
+    if not history_songs:
+        return None
+    rows = history_rows(history_songs)
+    await create_missing_user_action_partitions(rows[0]['played'], rows[-1]['played'])
+
+    logger.info(f'Bulk saving {len(rows)} songs in database')
+    loop = asyncio.get_event_loop()
+    playback_ids = await loop.run_in_executor(None, _bulk_save_history, rows)
+
+    async with ensure_connection(None) as conn:
+        for from_id, to_id in id_windows(playback_ids, batch_size):
+            await refresh_playback_summaries(from_id, to_id, conn=conn)
+        await mark_activity_dirty([row['played'] for row in rows], conn=conn)
+
+    last_song = max(history_songs)
+    logger.info(f'Successfully saved until {last_song}')
+    await save_bot_data(BotConfig.last_saved_history, last_song)
+    return last_song
+
+
 async def dubtrack_songs_since_ts(last_song):  # noqa: D103
     dws = DubtrackWS()
     await dws.initialize()
@@ -95,7 +177,10 @@ async def dubtrack_songs_since_ts(last_song):  # noqa: D103
 
 @retries(final_message='Failed to commit song-chunk: [{songs}]')
 async def save_history_chunk(*, songs, conn: asa.SAConnection):
-    """In charge of saving a chunck of continuous songs."""
+    """In charge of saving a chunck of continuous songs.
+
+    The stats are stored once at the end, so the shared stats rows are locked only until the chunk commits.
+    """
     # {'__v': 0,
     #  '_id': '583bf4a9d9abb248008a698a',
     #  '_song': {
@@ -177,7 +262,9 @@ async def save_history_chunk(*, songs, conn: asa.SAConnection):
     #  'userid': '57595c7a16c34f3d00b5ea8d'
     #  }
     song_played = None
+    played = []
     previous_song, previous_playback_id = {}, None
+    stats = StatsDeltas()
     async with conn.begin():
         for song in songs:
             # Generate Action skip for the previous Playback entry
@@ -188,6 +275,7 @@ async def save_history_chunk(*, songs, conn: asa.SAConnection):
                     song_played=song_played,
                     conn=conn,
                 )
+                await refresh_playback_summary(previous_playback_id, stats=stats, conn=conn)
 
             # Query or create the User for the Playback entry
             user = await get_or_create_user(song=song, conn=conn)
@@ -212,8 +300,12 @@ async def save_history_chunk(*, songs, conn: asa.SAConnection):
                 playback_id=playback_id,
                 conn=conn,
             )
+            await refresh_playback_summary(playback_id, stats=stats, conn=conn)
 
             previous_song, previous_playback_id = song, playback_id
+            played.append(song_played)
+        await store_stats_deltas(stats, conn=conn)
+        await mark_activity_dirty(played, conn=conn)
         logger.info(f'Saved songs up to {song_played}')
     await conn.close()
 
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import datetime
+import logging
+import time
+from typing import Awaitable, Callable, List, Optional
+
+from mosbot import config
+from mosbot.query import get_dj_ranking, get_track_ranking, get_user, get_user_stats
+from mosbot.util import RateLimiter, SingleFlight, TTLCache
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class ResultCache:
+    """Cache of the results of the leaderboard queries, recomputed in the background while they keep being asked for.
+
+    A result is computed on the first request, and concurrent requests of the same key wait for that same query. Then
+    :ref:`refresh` computes again the ones requested within `ttl`, so that the requests are answered from the cache,
+    and the ones not requested anymore expire.
+    """
+
+    def __init__(self, *, ttl=config.LEADERBOARD_TTL, maxsize=config.LEADERBOARD_CACHE_SIZE,  # noqa D107
+                 clock=time.monotonic):
+        self.cache = TTLCache(maxsize, ttl, clock=clock)
+        self.flight = SingleFlight('leaderboards')
+        self.clock = clock
+        self.requested = {}
+        """(when it was last requested, function computing it) of each key, the least recently requested first"""
+
+    async def get(self, key, compute: Callable[[], Awaitable]):
+        """Get the result of `key`, computing it with `compute` if it's not cached."""
+        self.requested.pop(key, None)
+        self.requested[key] = (self.clock(), compute)
+        while len(self.requested) > self.cache.maxsize:
+            del self.requested[next(iter(self.requested))]
+        result = self.cache.get(key, _MISSING)
+        if result is _MISSING:
+            result = await self.flight.do(key, compute)
+            self.cache.set(key, result)
+        return result
+
+    async def refresh(self) -> int:
+        """Compute again the results requested within the ttl, and forget the rest.
+
+        :return: Number of results refreshed
+        """
+        now = self.clock()
+        for key, (requested, compute) in list(self.requested.items()):
+            if now - requested > self.cache.ttl:
+                del self.requested[key]
+                continue
+            self.cache.set(key, await self.flight.do(key, compute))
+        return len(self.requested)
+
+    def metrics(self) -> dict:
+        """Get the counters of the cache, and the results kept fresh."""
+        return dict(self.cache.metrics(), requested=len(self.requested))
+
+
+LEADERBOARDS = ResultCache()
+"""Leaderboards of the running bot, refreshed by :ref:`refresh_leaderboards_forever`"""
+RATE_LIMITER = RateLimiter(config.LEADERBOARD_RATE, config.LEADERBOARD_RATE_PERIOD)
+"""Limit of the leaderboard requests of each user"""
+
+
+def leaderboard_wait(dtid) -> float:
+    """Take a leaderboard request of a user, and get 0 if it's allowed, otherwise the seconds to wait."""
+    return RATE_LIMITER.wait(dtid)
+
+
+def _since_date(since: Optional[datetime.timedelta]) -> Optional[datetime.datetime]:
+    return datetime.datetime.utcnow() - since if since is not None else None
+
+
+async def top_djs(limit, *, since: datetime.timedelta = None, order_by='plays',
+                  cache: ResultCache = None) -> List[dict]:
+    """Get the DJs that played the most or got the most updubs, within `since` before now, or all time if None.
+
+    Check :ref:`get_dj_ranking` for the records. They come from the leaderboards, the bot ones by default, which
+    keep the first :ref:`config.LEADERBOARD_SIZE` of each ranking.
+    """
+    if cache is None:
+        cache = LEADERBOARDS
+    ranking = await cache.get(('djs', since, order_by), lambda: get_dj_ranking(
+        since=_since_date(since), order_by=order_by, limit=config.LEADERBOARD_SIZE,
+    ))
+    return ranking[:limit]
+
+
+async def top_tracks(limit, *, since: datetime.timedelta = None, order_by='plays',
+                     cache: ResultCache = None) -> List[dict]:
+    """Get the songs played the most or that got the most updubs, as :ref:`top_djs`."""
+    if cache is None:
+        cache = LEADERBOARDS
+    ranking = await cache.get(('tracks', since, order_by), lambda: get_track_ranking(
+        since=_since_date(since), order_by=order_by, limit=config.LEADERBOARD_SIZE,
+    ))
+    return ranking[:limit]
+
+
+async def _get_stats_of(dtid) -> Optional[dict]:
+    user = await get_user(user_dict={'dtid': dtid})
+    if not user:
+        return None
+    return dict(await get_user_stats(user['id']) or {}, username=user['username'])
+
+
+async def user_stats(dtid, *, cache: ResultCache = None) -> Optional[dict]:
+    """Get the :ref:`UserStats` of a user by dubtrack id, with the username, None if the user is not known."""
+    if cache is None:
+        cache = LEADERBOARDS
+    return await cache.get(('user', dtid), lambda: _get_stats_of(dtid))
+
+
+async def refresh_leaderboards_forever(interval):
+    """Refresh the leaderboards requested recently every `interval` seconds, forever."""
+    while True:
+        try:
+            await LEADERBOARDS.refresh()
+        except Exception:
+            logger.exception('Failed to refresh the leaderboards')
+        await asyncio.sleep(interval)
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import datetime
+import logging
+from typing import List
+
+from mosbot.query import add_months, create_user_action_partition, ensure_connection, get_user_action_partitions, \
+    user_action_partition_name
+
+logger = logging.getLogger(__name__)
+
+
+async def create_missing_user_action_partitions(since, until, *, conn=None) -> List[str]:
+    """Create the missing partitions of :ref:`UserAction` for the months from the one of `since` to the one of `until`.
+
+    :param datetime.datetime since: Any time in the first month
+    :param datetime.datetime until: Any time in the last month, included
+    :param conn: A connection if any open
+    :return: The names of the partitions created
+    """
+    created = []
+    async with ensure_connection(conn) as conn:
+        existing = set(await get_user_action_partitions(conn=conn))
+        month = add_months(since, 0)
+        while month <= until:
+            if user_action_partition_name(month) not in existing:
+                created.append(await create_user_action_partition(month, conn=conn))
+            month = add_months(month, 1)
+    if created:
+        logger.info(f'Created user action partitions {", ".join(created)}')
+    return created
+
+
+async def ensure_user_action_partitions(*, months_ahead=3, conn=None) -> List[str]:
+    """Create the missing partitions of :ref:`UserAction` for the current month and the next `months_ahead`.
+
+    They are created in advance, so that the actions never go to the default partition, moving them out of it locks
+    it.
+
+    :param int months_ahead: Months after the current one that should have a partition
+    :param conn: A connection if any open
+    :return: The names of the partitions created
+    """
+    now = datetime.datetime.utcnow()
+    return await create_missing_user_action_partitions(now, add_months(now, months_ahead), conn=conn)
+
+
+async def ensure_user_action_partitions_forever(interval, *, months_ahead=3):
+    """Ensure the partitions of :ref:`UserAction` every `interval` seconds, forever."""
+    while True:
+        try:
+            await ensure_user_action_partitions(months_ahead=months_ahead)
+        except Exception:
+            logger.exception('Failed to create the user action partitions')
+        await asyncio.sleep(interval)
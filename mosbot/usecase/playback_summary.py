@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+import logging
+
+from mosbot.query import ensure_connection, get_playback_id_range, get_playback_summary_mismatches, \
+    refresh_playback_summaries
+
+logger = logging.getLogger(__name__)
+
+
+async def rebuild_playback_summaries(*, batch_size=1000, conn=None) -> int:
+    """Recompute the summary of every playback from the user actions, a batch of playback ids at a time.
+
+    Each batch is a single statement, so it's consistent by itself and doesn't block the live updates for long.
+
+    :param int batch_size: Number of playback ids per batch
+    :param conn: A connection if any open
+    :return: Number of summaries stored
+    """
+    async with ensure_connection(conn) as conn:
+        min_id, max_id = await get_playback_id_range(conn=conn)
+        if min_id is None:
+            return 0
+        rebuilt = 0
+        for from_id in range(min_id, max_id + 1, batch_size):
+            rebuilt += len(await refresh_playback_summaries(from_id, from_id + batch_size, conn=conn))
+            logger.info(f'Rebuilt playback summaries up to {min(from_id + batch_size - 1, max_id)}/{max_id}')
+        return rebuilt
+
+
+async def check_playback_summaries(*, batch_size=1000, conn=None):
+    """Check the stored summary of every playback against the user actions.
+
+    :param int batch_size: Number of playback ids per batch
+    :param conn: A connection if any open
+    :return: The number of playback ids checked, and the list of mismatches
+    """
+    async with ensure_connection(conn) as conn:
+        min_id, max_id = await get_playback_id_range(conn=conn)
+        if min_id is None:
+            return 0, []
+        mismatches = []
+        for from_id in range(min_id, max_id + 1, batch_size):
+            mismatches.extend(await get_playback_summary_mismatches(from_id, from_id + batch_size, conn=conn))
+        return max_id - min_id + 1, mismatches
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+import datetime
+import logging
+from typing import List, Optional
+
+from mosbot import config
+from mosbot.db import Action
+from mosbot.query import get_recent_playbacks
+
+logger = logging.getLogger(__name__)
+
+
+class RecentPlayback:
+    """Playback kept in :ref:`PlaybackRing`, with the track, the DJ and the votes so far."""
+
+    __slots__ = ('id', 'start', 'track_id', 'track_name', 'user_id', 'username', 'updubs', 'downdubs', 'skipped',
+                 'votes')
+
+    def __init__(self, id, start, track_id, track_name, user_id, username,  # noqa D107
+                 updubs=0, downdubs=0, skipped=False):
+        self.id = id
+        self.start = start
+        self.track_id = track_id
+        self.track_name = track_name
+        self.user_id = user_id
+        self.username = username
+        self.updubs = updubs
+        self.downdubs = downdubs
+        self.skipped = skipped
+        self.votes = {}
+        """Last vote of each user counted, so counting it again doesn't change the tally"""
+
+    def __repr__(self):
+        """Show the playback and its votes, for debugging."""
+        return f'<RecentPlayback {self.id} {self.track_name!r} by {self.username} +{self.updubs}/-{self.downdubs}>'
+
+
+class PlaybackRing:
+    """Fixed size ring buffer of the last playbacks, the newest one replacing the oldest one when it's full.
+
+    Playbacks are expected in start order, and are also indexed by id and start, so adding the same playback again, or
+    updating its votes, is a dict lookup. Nothing is read from the database, so it can answer on every chat message.
+
+    Updates can be applied again, as when a transaction is rolled back and retried: a playback is identified by its
+    start, which doesn't change if it's stored again under other id, and a vote is counted once per user.
+    """
+
+    __slots__ = ('size', 'slots', 'position', 'by_id', 'by_start')
+
+    def __init__(self, size=config.RECENT_PLAYBACKS_SIZE):  # noqa D107
+        self.size = size
+        self.slots: List[Optional[RecentPlayback]] = [None] * size
+        self.position = 0
+        """Slot of the next playback added, the one of the oldest playback once it's full"""
+        self.by_id = {}
+        self.by_start = {}
+
+    def __len__(self):
+        """Return the number of playbacks kept."""
+        return len(self.by_id)
+
+    def add(self, playback: RecentPlayback) -> RecentPlayback:
+        """Add a playback, replacing the oldest one if it's full, and get the one kept, the existing one if any.
+
+        If a playback with the same start is kept with other id, it takes the new one.
+        """
+        existing = self.by_start.get(playback.start)
+        if existing is not None:
+            if existing.id != playback.id:
+                del self.by_id[existing.id]
+                existing.id = playback.id
+                self.by_id[existing.id] = existing
+            return existing
+        oldest = self.slots[self.position]
+        if oldest is not None:
+            del self.by_id[oldest.id]
+            del self.by_start[oldest.start]
+        self.slots[self.position] = playback
+        self.by_id[playback.id] = playback
+        self.by_start[playback.start] = playback
+        self.position = (self.position + 1) % self.size
+        return playback
+
+    def get(self, playback_id) -> Optional[RecentPlayback]:
+        """Get a playback by id, None if it's not one of the last ones."""
+        return self.by_id.get(playback_id)
+
+    def latest(self, limit=None) -> List[RecentPlayback]:
+        """Get the last playbacks, the newest one first."""
+        if limit is None:
+            limit = self.size
+        playbacks = []
+        for offset in range(1, min(limit, self.size) + 1):
+            playback = self.slots[(self.position - offset) % self.size]
+            if playback is None:
+                break
+            playbacks.append(playback)
+        return playbacks
+
+    def find(self, text) -> Optional[RecentPlayback]:
+        """Get the last playback whose track name contains `text`, ignoring the case."""
+        text = text.casefold()
+        for playback in self.latest():
+            if text in playback.track_name.casefold():
+                return playback
+        return None
+
+    def dub(self, playback_id, user_id, action: Action, previous_action: Optional[Action] = None):
+        """Count a vote of a user in a playback, replacing the previous vote of the user if any.
+
+        :param previous_action: The previous vote of the user, used if none of the user was counted yet, as for the
+            playbacks read from the database
+        """
+        playback = self.by_id.get(playback_id)
+        if playback is None:
+            return
+        previous_action = playback.votes.get(user_id, previous_action)
+        if action == previous_action:
+            return
+        playback.votes[user_id] = action
+        for counted, delta in ((action, 1), (previous_action, -1)):
+            if counted is Action.upvote:
+                playback.updubs += delta
+            elif counted is Action.downvote:
+                playback.downdubs += delta
+
+    def skip(self, playback_id):
+        """Mark a playback as skipped."""
+        playback = self.by_id.get(playback_id)
+        if playback is not None:
+            playback.skipped = True
+
+
+RECENT_PLAYBACKS = PlaybackRing()
+"""Last playbacks of the running bot, warmed up by :ref:`warm_up_recent_playbacks` and updated as events come"""
+
+
+def record_playback(*, playback_id, start, track_id, track_name, user_id, username,
+                    ring: PlaybackRing = None) -> RecentPlayback:
+    """Add a playback to the recent playbacks, the bot ones by default."""
+    if ring is None:
+        ring = RECENT_PLAYBACKS
+    return ring.add(RecentPlayback(playback_id, start, track_id, track_name, user_id, username))
+
+
+def record_dub(playback_id, user_id, action: Action, previous_action: Optional[Action] = None, *,
+               ring: PlaybackRing = None):
+    """Count a vote of a user in the recent playbacks, the bot ones by default."""
+    if ring is None:
+        ring = RECENT_PLAYBACKS
+    ring.dub(playback_id, user_id, action, previous_action)
+
+
+def record_skip(playback_id, *, ring: PlaybackRing = None):
+    """Mark a playback as skipped in the recent playbacks, the bot ones by default."""
+    if ring is None:
+        ring = RECENT_PLAYBACKS
+    ring.skip(playback_id)
+
+
+def latest_playbacks(limit=None, *, ring: PlaybackRing = None) -> List[RecentPlayback]:
+    """Get the last playbacks, the newest one, usually playing, first, without going to the database."""
+    if ring is None:
+        ring = RECENT_PLAYBACKS
+    return ring.latest(limit)
+
+
+def find_recent_playback(text, *, ring: PlaybackRing = None) -> Optional[RecentPlayback]:
+    """Get the last playback of a track whose name contains `text`, without going to the database."""
+    if ring is None:
+        ring = RECENT_PLAYBACKS
+    return ring.find(text)
+
+
+def minutes_ago(playback: RecentPlayback, now: datetime.datetime = None) -> int:
+    """Get how many minutes ago a playback started."""
+    if now is None:
+        now = datetime.datetime.utcnow()
+    return max(0, (now - playback.start) // datetime.timedelta(minutes=1))
+
+
+async def warm_up_recent_playbacks(*, ring: PlaybackRing = None, conn=None) -> int:
+    """Add the last playbacks in the database to the recent playbacks, the bot ones by default.
+
+    :param ring: The recent playbacks to warm up, :ref:`RECENT_PLAYBACKS` if None
+    :param conn: A connection if any open, otherwise the read replica may be used
+    :return: Number of playbacks kept
+    """
+    if ring is None:
+        ring = RECENT_PLAYBACKS
+    for playback in await get_recent_playbacks(ring.size, conn=conn):
+        ring.add(RecentPlayback(
+            playback['id'], playback['start'], playback['track_id'], playback['track_name'], playback['user_id'],
+            playback['username'], playback['upvotes'], playback['downvotes'], playback['skipped'],
+        ))
+    logger.info(f'Warmed up the recent playbacks with {len(ring)} playbacks')
+    return len(ring)
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import bisect
+import collections
+import datetime
+import heapq
+import logging
+from typing import Iterable, List, Optional, Tuple
+
+from mosbot import config
+from mosbot.db import Origin
+from mosbot.query import iter_playbacks_after
+from mosbot.util import IdWatermark, aclosing
+
+logger = logging.getLogger(__name__)
+
+
+class TrackRecommender:
+    """Recommend tracks by how often they were played close in time to others, more if by the same DJ.
+
+    It keeps a sparse track by track co-occurrence matrix, as a dict of counters, and the `top_k` tracks that
+    co-occur the most with each track. Playbacks are added incrementally, and only the rows of the matrix they change
+    are ranked again, so getting the recommendations of a track is just a dict lookup.
+
+    Playbacks are expected in start order. The ones within `window` of the latest start are kept to pair them with the
+    next ones, so a late playback older than that only pairs with the ones added along with it.
+
+    The track playing is set by :ref:`set_playing`, as it starts, as its playback is only added on the next refresh.
+    """
+
+    def __init__(self, *, window=config.RECOMMENDATION_WINDOW, top_k=config.RECOMMENDATION_TOP_K,  # noqa D107
+                 same_dj_weight=2, id_overlap=config.INCREMENTAL_REFRESH_ID_OVERLAP):
+        self.window = datetime.timedelta(seconds=window)
+        self.top_k = top_k
+        self.same_dj_weight = same_dj_weight
+        self.cooccurrences = collections.defaultdict(collections.Counter)
+        self.neighbors = {}
+        self.track_names = {}
+        self.track_ids = {}
+        """Canonical track id of each (origin, extid) played"""
+        self.recent = []
+        """(start, id, track_id, user_id) of the playbacks within the window of the latest one, sorted"""
+        self.watermark = IdWatermark(id_overlap)
+        """Playbacks added, the refreshes read the ones after it"""
+        self.latest_track_id = None
+        """Track of the latest playback added, the one playing until :ref:`set_playing` is called"""
+        self.playing = None
+        """(origin, extid, track name) of the track playing"""
+
+    def add_playbacks(self, playbacks: Iterable[dict]) -> int:
+        """Add playbacks with their id, start, track_id, user_id and track_name, and rank again what they change.
+
+        Two playbacks of different tracks that started within the window add 1 to both of their cells of the matrix,
+        or `same_dj_weight` if the same DJ played both.
+
+        :return: Number of tracks whose recommendations changed
+        """
+        changed = set()
+        for playback in playbacks:
+            self.track_names[playback['track_id']] = playback['track_name']
+            self.track_ids[playback['origin'], playback['extid']] = playback['track_id']
+            start = playback['start']
+            for other_start, _, track_id, user_id in self.recent:
+                if track_id == playback['track_id'] or abs(other_start - start) > self.window:
+                    continue
+                same_dj = user_id is not None and user_id == playback['user_id']
+                weight = self.same_dj_weight if same_dj else 1
+                self.cooccurrences[track_id][playback['track_id']] += weight
+                self.cooccurrences[playback['track_id']][track_id] += weight
+                changed.update((track_id, playback['track_id']))
+            bisect.insort(self.recent, (start, playback['id'], playback['track_id'], playback['user_id']))
+            while self.recent[-1][0] - self.recent[0][0] > self.window:
+                self.recent.pop(0)
+            if self.recent[-1][1] == playback['id']:
+                self.latest_track_id = playback['track_id']
+        for track_id in changed:
+            self.neighbors[track_id] = heapq.nlargest(self.top_k, self.cooccurrences[track_id].items(),
+                                                      key=lambda item: (item[1], -item[0]))
+        return len(changed)
+
+    def recommend(self, track_id, limit=None) -> List[Tuple[int, int]]:
+        """Get the (track id, weight) of the tracks that co-occur the most with a track, most first."""
+        return self.neighbors.get(track_id, [])[:limit]
+
+    def set_playing(self, origin: Origin, extid: str, track_name: str):
+        """Set the track that started playing."""
+        self.playing = (origin, extid, track_name)
+
+    def current_track(self) -> Tuple[Optional[int], Optional[str]]:
+        """Get the canonical id, None if it was never played before, and the name of the track playing.
+
+        If no track started playing since the bot started, it's the one of the latest playback added, if any.
+        """
+        if self.playing is None:
+            if self.latest_track_id is None:
+                return None, None
+            return self.latest_track_id, self.track_names[self.latest_track_id]
+        origin, extid, track_name = self.playing
+        return self.track_ids.get((origin, extid)), track_name
+
+
+RECOMMENDER = TrackRecommender()
+"""Recommender of the running bot, kept up to date by :ref:`refresh_recommendations_forever`"""
+
+
+async def refresh_recommendations(recommender: TrackRecommender = None, *, fetch_size=1000, conn=None) -> int:
+    """Add the playbacks saved since the last refresh to the recommender, the bot one by default.
+
+    The last playbacks added are read again, as a playback can be committed after others saved later, and the ones
+    already added are skipped.
+
+    :param recommender: The recommender to refresh, :ref:`RECOMMENDER` if None
+    :param int fetch_size: Playbacks read and added at a time
+    :param conn: A connection if any open, otherwise the read replica may be used
+    :return: Number of playbacks added
+    """
+    if recommender is None:
+        recommender = RECOMMENDER
+    watermark = recommender.watermark
+    added = 0
+    batch = []
+    async with aclosing(iter_playbacks_after(watermark.after_id, fetch_size=fetch_size, conn=conn)) as playbacks:
+        async for playback in playbacks:
+            if not watermark.see(playback['id']):
+                continue
+            batch.append(playback)
+            if len(batch) == fetch_size:
+                recommender.add_playbacks(batch)
+                added, batch = added + len(batch), []
+                watermark.prune()
+    recommender.add_playbacks(batch)
+    added += len(batch)
+    watermark.prune()
+    if added:
+        logger.info(f'Added {added} playbacks to the recommendations')
+    return added
+
+
+async def refresh_recommendations_forever(interval):
+    """Refresh the bot recommendations every `interval` seconds, forever."""
+    while True:
+        try:
+            await refresh_recommendations()
+        except Exception:
+            logger.exception('Failed to refresh the recommendations')
+        await asyncio.sleep(interval)
+
+
+def set_playing_track(origin: str, extid: str, track_name: str, *, recommender: TrackRecommender = None):
+    """Set the track that started playing, so the suggestions are for it without waiting for the next refresh.
+
+    :param str origin: Name of the :ref:`Origin` of the track
+    :param recommender: The recommender to use, :ref:`RECOMMENDER` if None
+    """
+    if recommender is None:
+        recommender = RECOMMENDER
+    recommender.set_playing(Origin.__members__.get(origin), extid, track_name)
+
+
+def suggest_tracks(limit, *, recommender: TrackRecommender = None) -> Tuple[Optional[str], List[str]]:
+    """Suggest tracks similar to the one playing, without going to the database.
+
+    :param int limit: Maximum number of suggestions
+    :param recommender: The recommender to use, :ref:`RECOMMENDER` if None
+    :return: The name of the track playing, None if it's not known, and the names of the tracks suggested
+    """
+    if recommender is None:
+        recommender = RECOMMENDER
+    track_id, track_name = recommender.current_track()
+    suggestions = recommender.recommend(track_id, limit)
+    return track_name, [recommender.track_names[track_id] for track_id, _ in suggestions]
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+import collections
+import datetime
+import enum
+import logging
+from typing import Optional, Tuple
+
+from abot.dubtrack import DubtrackPlaying
+
+from mosbot import config
+from mosbot.db import Origin
+from mosbot.query import iter_track_plays_since
+from mosbot.util import aclosing
+
+logger = logging.getLogger(__name__)
+
+
+class RepeatPolicy(enum.Enum):
+    """What the bot does when a track played within the repeat window is played again."""
+
+    off = 'off'
+    warn = 'warn'
+    skip = 'skip'
+
+
+class RecentPlays:
+    """Index of when each (origin, extid) was last played, forgetting the plays older than `window`.
+
+    Looking up and adding a play are dict operations. The plays are expired in the order they were added, so they are
+    expected in start order, a play added out of order may be kept a bit longer, but it's never reported as recent.
+    The two last plays of each track are kept, so adding the same play twice gives the same result.
+    """
+
+    def __init__(self, window=config.REPEAT_WINDOW):  # noqa D107
+        self.window = datetime.timedelta(seconds=window)
+        self.plays = {}
+        """(last play, the one before or None) of each (origin, extid)"""
+        self.expiry = collections.deque()
+        """(start, key) of the plays, in the order they were added"""
+
+    def __len__(self):
+        """Return the number of tracks with a recent play."""
+        return len(self.plays)
+
+    def expire(self, now: datetime.datetime):
+        """Forget the plays started more than `window` before `now`."""
+        while self.expiry and now - self.expiry[0][0] > self.window:
+            start, key = self.expiry.popleft()
+            last, previous = self.plays.get(key, (None, None))
+            if last == start:
+                del self.plays[key]
+            elif previous == start:
+                self.plays[key] = last, None
+
+    def add(self, key: Tuple[Origin, str], start: datetime.datetime) -> Optional[datetime.datetime]:
+        """Add a play of a track, and get when it was played before within the window.
+
+        :param key: Origin and extid of the track
+        :param start: When the play started
+        :return: When it was last played before `start`, None if it wasn't within the window
+        """
+        self.expire(start)
+        last, previous = self.plays.get(key, (None, None))
+        if start != last:
+            if last is None or start > last:
+                last, previous = start, last
+            elif previous is None or start > previous:
+                previous = start
+            self.plays[key] = last, previous
+            self.expiry.append((start, key))
+        before = previous if start == last else None
+        if before is not None and start - before <= self.window:
+            return before
+        return None
+
+    def last_played(self, key: Tuple[Origin, str], now: datetime.datetime) -> Optional[datetime.datetime]:
+        """Get when a track was last played, None if it wasn't within the window before `now`."""
+        last, _ = self.plays.get(key, (None, None))
+        if last is not None and now - last <= self.window:
+            return last
+        return None
+
+
+RECENT_PLAYS = RecentPlays()
+"""Recent plays of the running bot, warmed up by :ref:`warm_up_recent_plays` and updated as tracks are played"""
+
+
+def playing_key(event: DubtrackPlaying) -> Tuple[Origin, str]:
+    """Key of the track playing in :ref:`RecentPlays`."""
+    return getattr(Origin, event.song_type), event.song_external_id
+
+
+def record_playing(event: DubtrackPlaying, *, recent: RecentPlays = None) -> Optional[datetime.datetime]:
+    """Add the track playing to the recent plays, the bot ones by default, and get when it was played before.
+
+    :return: When it was last played within the repeat window, None if it wasn't
+    """
+    if recent is None:
+        recent = RECENT_PLAYS
+    return recent.add(playing_key(event), event.played)
+
+
+async def warm_up_recent_plays(now=None, *, recent: RecentPlays = None, conn=None) -> int:
+    """Add the plays within the window before `now` to the recent plays, the bot ones by default.
+
+    :param datetime.datetime now: End of the window, now if None
+    :param recent: The recent plays to warm up, :ref:`RECENT_PLAYS` if None
+    :param conn: A connection if any open, otherwise the read replica may be used
+    :return: Number of tracks played within the window
+    """
+    if recent is None:
+        recent = RECENT_PLAYS
+    if now is None:
+        now = datetime.datetime.utcnow()
+    async with aclosing(iter_track_plays_since(now - recent.window, conn=conn)) as plays:
+        async for play in plays:
+            recent.add((play['origin'], play['extid']), play['start'])
+    logger.info(f'Warmed up the recent plays with {len(recent)} tracks')
+    return len(recent)
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import collections
+import logging
+from typing import Awaitable, Callable, List, Optional
+
+from abot.dubtrack import DubtrackEvent, DubtrackPlaying, DubtrackRoomQueueReorder, DubtrackUserPauseQueue, \
+    DubtrackUserQueueUpdate, DubtrackUserUpdate
+
+logger = logging.getLogger(__name__)
+
+QueueItem = collections.namedtuple('QueueItem', 'id user_id origin extid name length')
+"""Track queued in the room, with its queue item id, the dubtrack id of the DJ and the length in seconds"""
+
+
+def parse_queue_details(details: List[dict]) -> List[QueueItem]:
+    """Get the queue items of the room playlist details, as dubtrack sends them, in play order."""
+    return [
+        QueueItem(
+            id=item['_id'],
+            user_id=item['userid'],
+            origin=item['_song']['type'],
+            extid=item['_song']['fkid'],
+            name=item['_song']['name'],
+            length=item['_song']['songLength'] // 1000,
+        )
+        for item in details
+    ]
+
+
+class RoomQueue:
+    """Model of the room queue, updated with the events of the room, and reconciled against a full snapshot.
+
+    The events don't say which track a DJ queued, only that the queue of the DJ or the order of the room changed, so
+    those DJs are marked as stale until the next reconciliation, while the tracks played and the DJs that pause or
+    empty their queue are applied as they come. How much the model drifted from each snapshot is kept in the metrics.
+    """
+
+    def __init__(self):  # noqa D107
+        self.items: List[QueueItem] = []
+        self.paused = set()
+        """Dubtrack ids of the DJs with their queue paused"""
+        self.stale_users = set()
+        """Dubtrack ids of the DJs whose queued tracks may have changed since the last reconciliation"""
+        self.order_stale = False
+        self.reconciled = False
+        self.counters = collections.Counter()
+
+    @property
+    def fresh(self) -> bool:
+        """Whether the model is known to be the same as the room queue."""
+        return self.reconciled and not self.stale_users and not self.order_stale
+
+    def upcoming(self, limit=None) -> List[QueueItem]:
+        """Get the next tracks that will play, the first one next."""
+        return self.items[:limit]
+
+    def user_queue(self, user_id) -> List[QueueItem]:
+        """Get the tracks queued by a DJ, in the order they will play."""
+        return [item for item in self.items if item.user_id == user_id]
+
+    def _remove_user_items(self, user_id):
+        self.items = [item for item in self.items if item.user_id != user_id]
+
+    def playing(self, item_id, user_id):
+        """Apply that a queue item started playing, the DJ queues another track afterwards."""
+        self.counters['events'] += 1
+        self.items = [item for item in self.items if item.id != item_id]
+        if user_id:
+            self.stale_users.add(user_id)
+
+    def queue_updated(self, user_id):
+        """Apply that a DJ changed their queue."""
+        self.counters['events'] += 1
+        self.stale_users.add(user_id)
+
+    def reordered(self):
+        """Apply that the order of the DJs in the room queue changed."""
+        self.counters['events'] += 1
+        self.order_stale = True
+
+    def queue_paused(self, user_id, paused, songs_in_queue=None):
+        """Apply that a DJ paused or resumed their queue, a paused DJ has nothing upcoming."""
+        self.counters['events'] += 1
+        if paused:
+            self.paused.add(user_id)
+            self._remove_user_items(user_id)
+        else:
+            self.paused.discard(user_id)
+            self.stale_users.add(user_id)
+        if songs_in_queue == 0:
+            self._remove_user_items(user_id)
+
+    def user_updated(self, user_id, songs_in_queue):
+        """Apply the counters of a DJ, a DJ without tracks has nothing upcoming."""
+        self.counters['events'] += 1
+        if songs_in_queue == 0:
+            self._remove_user_items(user_id)
+
+    def reconcile(self, snapshot: List[QueueItem]) -> dict:
+        """Replace the model with a snapshot of the room queue, measuring how different it was.
+
+        :return: Items `missing` from the model, `unexpected` in it and `misplaced`, in another position relative to
+            the others, and whether it was `stale`
+        """
+        snapshot_ids = [item.id for item in snapshot]
+        model_ids = [item.id for item in self.items]
+        missing = set(snapshot_ids).difference(model_ids)
+        unexpected = set(model_ids).difference(snapshot_ids)
+        common = [item_id for item_id in model_ids if item_id not in unexpected]
+        misplaced = sum(1 for item_id, other_id in zip(common, (i for i in snapshot_ids if i not in missing))
+                        if item_id != other_id)
+        drift = {
+            'missing': len(missing),
+            'unexpected': len(unexpected),
+            'misplaced': misplaced,
+            'stale': not self.fresh,
+        }
+        self.counters['reconciliations'] += 1
+        for key in ('missing', 'unexpected', 'misplaced'):
+            self.counters[key] += drift[key]
+        if self.reconciled and (missing or unexpected or misplaced):
+            self.counters['drifted'] += 1
+        self.items = list(snapshot)
+        self.paused.difference_update(item.user_id for item in snapshot)
+        self.stale_users.clear()
+        self.order_stale = False
+        self.reconciled = True
+        return drift
+
+    def metrics(self) -> dict:
+        """Get the events applied, reconciliations done, the ones with drift and the items that drifted."""
+        metrics = {key: self.counters[key] for key in (
+            'events', 'reconciliations', 'drifted', 'missing', 'unexpected', 'misplaced')}
+        metrics.update(size=len(self.items), fresh=self.fresh)
+        return metrics
+
+
+ROOM_QUEUE = RoomQueue()
+"""Model of the queue of the room the bot is in"""
+
+
+def _event_user_id(event: DubtrackEvent) -> Optional[str]:
+    user = event._data.get('user', {})
+    return user.get('userInfo', {}).get('userid') or user.get('_id') or user.get('userid')
+
+
+def apply_queue_event(event: DubtrackEvent, *, queue: RoomQueue = None):
+    """Update the room queue model, the bot one by default, with an event of the room."""
+    if queue is None:
+        queue = ROOM_QUEUE
+    if isinstance(event, DubtrackPlaying):
+        song = event._data.get('song', {})
+        queue.playing(song.get('_id'), song.get('userid'))
+    elif isinstance(event, DubtrackRoomQueueReorder):
+        queue.reordered()
+    elif isinstance(event, DubtrackUserQueueUpdate):
+        queue.queue_updated(_event_user_id(event))
+    elif isinstance(event, DubtrackUserPauseQueue):
+        user_queue = event._data.get('user_queue', {})
+        queue.queue_paused(user_queue.get('userid') or _event_user_id(event), bool(user_queue.get('queuePaused')),
+                           user_queue.get('songsInQueue'))
+    elif isinstance(event, DubtrackUserUpdate):
+        user = event._data.get('user', {})
+        queue.user_updated(user.get('userid'), user.get('songsInQueue'))
+
+
+def upcoming_tracks(limit=None, *, queue: RoomQueue = None) -> List[QueueItem]:
+    """Get the next tracks in the room queue model, the bot one by default, without fetching the queue."""
+    if queue is None:
+        queue = ROOM_QUEUE
+    return queue.upcoming(limit)
+
+
+def room_queue_fresh(*, queue: RoomQueue = None) -> Optional[bool]:
+    """Get whether the room queue model, the bot one by default, is the same as the room queue.
+
+    :return: None if it wasn't reconciled yet, so nothing is known, False if it may have changed since the last time
+    """
+    if queue is None:
+        queue = ROOM_QUEUE
+    return queue.fresh if queue.reconciled else None
+
+
+async def reconcile_room_queue(fetch: Callable[[], Awaitable[List[dict]]], *, queue: RoomQueue = None) -> dict:
+    """Reconcile the room queue model, the bot one by default, against a snapshot.
+
+    :param fetch: Coroutine function that gets the room playlist details from dubtrack
+    :return: The drift, check :ref:`RoomQueue.reconcile`
+    """
+    if queue is None:
+        queue = ROOM_QUEUE
+    drift = queue.reconcile(parse_queue_details(await fetch()))
+    if drift['missing'] or drift['unexpected'] or drift['misplaced']:
+        logger.info(f'The room queue drifted: {drift}')
+    return drift
+
+
+async def reconcile_room_queue_forever(fetch: Callable[[], Awaitable[List[dict]]], interval, *,
+                                       connected: Callable[[], bool] = lambda: True, connect_poll_interval=1):
+    """Reconcile the bot room queue model as soon as the backend is connected, and every `interval` seconds, forever.
+
+    :param connected: Function returning whether the backend is connected, checked every `connect_poll_interval`
+    """
+    while not connected():
+        await asyncio.sleep(connect_poll_interval)
+    while True:
+        try:
+            await reconcile_room_queue(fetch)
+        except Exception:
+            logger.exception('Failed to reconcile the room queue')
+        await asyncio.sleep(interval)
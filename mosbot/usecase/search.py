@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+import logging
+from typing import List
+
+from mosbot import config
+from mosbot.query import search_tracks, search_users
+from mosbot.util import TTLCache
+
+logger = logging.getLogger(__name__)
+
+SEARCH_CACHE = TTLCache(config.SEARCH_CACHE_SIZE, config.SEARCH_CACHE_TTL)
+"""Results of the recent searches, so repeating one doesn't go to the database"""
+
+
+def normalize_search(text) -> str:
+    """Normalize the search text, so that searches differing only in case and spaces are the same."""
+    return ' '.join(text.split()).lower()
+
+
+async def cached_search(text, *, users=False, limit=5, cache: TTLCache = SEARCH_CACHE) -> List[dict]:
+    """Search tracks, or users with `users`, keeping the results of the recent searches in `cache`.
+
+    Check :ref:`search_tracks` and :ref:`search_users` for the results.
+    """
+    text = normalize_search(text)
+    key = ('users' if users else 'tracks', text, limit)
+    results = cache.get(key)
+    if results is None:
+        search = search_users if users else search_tracks
+        results = await search(text, limit=limit)
+        cache.set(key, results)
+    return results
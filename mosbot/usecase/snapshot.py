@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import concurrent.futures
+import datetime
+import gzip
+import io
+import json
+import logging
+import os
+import tarfile
+import tempfile
+from typing import List
+
+from mosbot.db import BotData, create_blocking_engine, metadata
+from mosbot.query import copy_table_in, copy_table_out, export_transaction_snapshot, get_schema_revision, \
+    get_tables_with_rows, get_user_action_ts_range, reset_sequences, set_transaction_snapshot, truncate_tables
+from mosbot.usecase.partitions import create_missing_user_action_partitions
+from mosbot.util import alembic_head_revision
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FORMAT = 1
+"""Version of the layout of the snapshot archives, to be increased when it changes"""
+MANIFEST_NAME = 'manifest.json'
+COMPRESS_LEVEL = 6
+
+
+def parse_timestamp(text) -> datetime.datetime:
+    """Parse a timestamp of the manifest, as written by `datetime.isoformat`, which leaves out zero microseconds."""
+    return datetime.datetime.strptime(text, '%Y-%m-%dT%H:%M:%S.%f' if '.' in text else '%Y-%m-%dT%H:%M:%S')
+
+
+def table_member_name(table) -> str:
+    """Name of the file with the rows of a table in the snapshot archive."""
+    return f'{table.name}.copy.gz'
+
+
+def dependency_levels(tables) -> List[list]:
+    """Group the tables so that the ones they have foreign keys to are in a previous group.
+
+    The tables of a group can be loaded at the same time, once the previous groups are loaded.
+    """
+    levels = {}
+    for table in tables:
+        levels[table] = max((levels[fk.column.table] + 1 for fk in table.foreign_keys
+                             if fk.column.table is not table and fk.column.table in levels), default=0)
+    return [
+        [table for table in tables if levels[table] == level]
+        for level in range(max(levels.values(), default=-1) + 1)
+    ]
+
+
+def _export_table(engine, snapshot_id, table, path):
+    with engine.connect().execution_options(isolation_level='REPEATABLE READ') as conn:
+        with conn.begin():
+            set_transaction_snapshot(snapshot_id, conn=conn)
+            with gzip.open(path, 'wb', compresslevel=COMPRESS_LEVEL) as fileobj:
+                rows = copy_table_out(table, fileobj, conn=conn)
+    logger.info(f'Exported {rows} rows of {table.name}')
+    return rows
+
+
+def _export_snapshot(path, workers):
+    tables = metadata.sorted_tables
+    engine = create_blocking_engine()
+    try:
+        with engine.connect().execution_options(isolation_level='REPEATABLE READ') as conn, conn.begin(), \
+                tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(path))) as directory, \
+                concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            snapshot_id = export_transaction_snapshot(conn=conn)
+            first_ts, last_ts = get_user_action_ts_range(conn=conn)
+            futures = [
+                executor.submit(_export_table, engine, snapshot_id, table,
+                                os.path.join(directory, table_member_name(table)))
+                for table in tables
+            ]
+            manifest = {
+                'format': SNAPSHOT_FORMAT,
+                'revision': get_schema_revision(conn=conn),
+                'created': datetime.datetime.utcnow().isoformat(),
+                'user_action_ts': [first_ts.isoformat(), last_ts.isoformat()] if first_ts else None,
+                'tables': {
+                    table.name: {'rows': future.result(), 'columns': [column.name for column in table.c]}
+                    for table, future in zip(tables, futures)
+                },
+            }
+            with tarfile.open(path, 'w') as archive:
+                data = json.dumps(manifest, indent=2, sort_keys=True).encode()
+                info = tarfile.TarInfo(MANIFEST_NAME)
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+                for table in tables:
+                    archive.add(os.path.join(directory, table_member_name(table)), table_member_name(table))
+        return manifest
+    finally:
+        engine.dispose()
+
+
+async def export_snapshot(path, *, workers=4) -> dict:
+    """Export all the tables to a snapshot archive, to restore them in another database with :ref:`import_snapshot`.
+
+    The archive is a tar with a manifest and the rows of each table in the binary format of `COPY`, compressed. The
+    tables are exported at the same time by `workers` connections, all of them reading the same snapshot of the
+    database, so it's consistent even if the bot is running.
+
+    :param str path: File to write the archive to
+    :param int workers: Tables exported at the same time
+    :return: The manifest, with the Alembic revision and the rows of each table
+    """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, _export_snapshot, path, workers)
+
+
+def read_manifest(path) -> dict:
+    """Read the manifest of a snapshot archive."""
+    with tarfile.open(path) as archive:
+        return json.load(archive.extractfile(MANIFEST_NAME))
+
+
+def check_manifest(manifest):
+    """Check that a snapshot can be imported in the current schema, raising ValueError if it can't."""
+    if manifest.get('format') != SNAPSHOT_FORMAT:
+        raise ValueError(f'Snapshot format {manifest.get("format")} is not supported, it should be {SNAPSHOT_FORMAT}')
+    head = alembic_head_revision()
+    if manifest['revision'] != head:
+        raise ValueError(f'Snapshot is of revision {manifest["revision"]} but the schema is of {head}')
+    expected = {table.name: [column.name for column in table.c] for table in metadata.sorted_tables}
+    found = {name: table['columns'] for name, table in manifest['tables'].items()}
+    if found != expected:
+        raise ValueError('Snapshot tables are not the ones of the current schema')
+
+
+def _import_table(engine, path, table):
+    with engine.begin() as conn, tarfile.open(path) as archive:
+        with gzip.open(archive.extractfile(table_member_name(table))) as fileobj:
+            rows = copy_table_in(table, fileobj, conn=conn)
+    logger.info(f'Imported {rows} rows of {table.name}')
+    return rows
+
+
+def _prepare_import(force):
+    tables = metadata.sorted_tables
+    engine = create_blocking_engine()
+    try:
+        with engine.begin() as conn:
+            # Migrations store some bot data, it's replaced by the one in the snapshot
+            with_rows = get_tables_with_rows([table for table in tables if table is not BotData], conn=conn)
+            if with_rows and not force:
+                raise ValueError(f'Tables {", ".join(with_rows)} are not empty')
+            truncate_tables(tables, conn=conn)
+    finally:
+        engine.dispose()
+
+
+def _import_tables(path, workers):
+    tables = metadata.sorted_tables
+    engine = create_blocking_engine()
+    try:
+        rows = {}
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            for level in dependency_levels(tables):
+                futures = [executor.submit(_import_table, engine, path, table) for table in level]
+                rows.update({table.name: future.result() for table, future in zip(level, futures)})
+        with engine.begin() as conn:
+            reset_sequences(tables, conn=conn)
+        return rows
+    finally:
+        engine.dispose()
+
+
+async def import_snapshot(path, *, workers=4, force=False) -> dict:
+    """Import a snapshot archive written by :ref:`export_snapshot`, replacing all the data of the database.
+
+    The database has to be in the same Alembic revision as the snapshot. The tables are loaded at the same time by
+    `workers` connections, each table after the ones it references, and each of them in its own transaction, so if it
+    fails it has to be imported again with `force`.
+
+    :param str path: The snapshot archive
+    :param int workers: Tables imported at the same time
+    :param bool force: Import it even if the database has data, which is removed
+    :return: The rows imported of each table
+    """
+    loop = asyncio.get_event_loop()
+    manifest = await loop.run_in_executor(None, read_manifest, path)
+    check_manifest(manifest)
+    await loop.run_in_executor(None, _prepare_import, force)
+    if manifest['user_action_ts']:
+        first_ts, last_ts = (parse_timestamp(ts) for ts in manifest['user_action_ts'])
+        await create_missing_user_action_partitions(first_ts, last_ts)
+    rows = await loop.run_in_executor(None, _import_tables, path, workers)
+    expected = {name: table['rows'] for name, table in manifest['tables'].items()}
+    if rows != expected:
+        raise ValueError(f'Imported rows {rows} are not the ones in the snapshot {expected}')
+    return rows
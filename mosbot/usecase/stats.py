@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+
+from mosbot.db import Track, User
+from mosbot.query import ensure_connection, get_id_range, rebuild_track_stats, rebuild_user_stats
+
+logger = logging.getLogger(__name__)
+
+
+async def rebuild_stats(*, workers=4, batch_size=1000, conn=None) -> int:
+    """Recompute the :ref:`UserStats` and :ref:`TrackStats` of every user and track, a batch of ids at a time.
+
+    The batches run concurrently, each one in its own connection, up to `workers` at the same time. If a connection is
+    given they run one after the other in it.
+
+    :param int workers: Maximum number of batches running at the same time
+    :param int batch_size: Number of user/track ids per batch
+    :param conn: A connection if any open
+    :return: Number of batches run
+    """
+    batches = []
+    for table, rebuild in ((User, rebuild_user_stats), (Track, rebuild_track_stats)):
+        min_id, max_id = await get_id_range(table, conn=conn)
+        if min_id is not None:
+            batches.extend((rebuild, from_id, from_id + batch_size)
+                           for from_id in range(min_id, max_id + 1, batch_size))
+
+    if conn is not None:
+        for rebuild, from_id, to_id in batches:
+            await rebuild(from_id, to_id, conn=conn)
+        return len(batches)
+
+    semaphore = asyncio.Semaphore(workers)
+
+    async def run_batch(rebuild, from_id, to_id):
+        async with semaphore:
+            async with ensure_connection(None) as batch_conn:
+                await rebuild(from_id, to_id, conn=batch_conn)
+            logger.info(f'Rebuilt {rebuild.__name__[len("rebuild_"):]} from {from_id} to {to_id - 1}')
+
+    await asyncio.gather(*(run_batch(*batch) for batch in batches))
+    return len(batches)
@@ -3,9 +3,14 @@ from __future__ import absolute_import, print_function, unicode_literals
 
 import sys
 
+import asyncio
+import collections
+import datetime
 import logging.config
+import math
 import os
 import pprint
+import time
 import traceback
 from alembic.config import Config
 from alembic.runtime.environment import EnvironmentContext
@@ -42,12 +47,17 @@ def setup_logging(debug=False):
         logger.info('Level is info now')
 
 
+def alembic_head_revision():
+    """Get the latest Alembic revision of the code, the one the database should be in."""
+    script = ScriptDirectory.from_config(Config('alembic.ini'))
+    return script.get_revisions(script.get_heads())[0].revision
+
+
 def check_alembic_in_latest_version():
     """Make sure we are using the latest Alembic."""
     config = Config('alembic.ini')
     script = ScriptDirectory.from_config(config)
-    heads = script.get_revisions(script.get_heads())
-    head = heads[0].revision
+    head = alembic_head_revision()
     current_head = None
 
     def _f(rev, context):
@@ -62,6 +72,245 @@ def check_alembic_in_latest_version():
         raise RuntimeError(f'Database is not upgraded to latest head {head} from {current_head}')
 
 
+def latency_summary(latencies):
+    """Summarize a list of latencies (in seconds) in a json serializable dict.
+
+    Percentiles use the nearest-rank method, which is good enough for reporting and doesn't need numpy.
+
+    :param list latencies: Latencies measured, in seconds
+    :return: Dict with count, mean, min, max and p50/p90/p95/p99 in milliseconds
+    """
+    if not latencies:
+        return {'count': 0}
+    ordered = sorted(latencies)
+    count = len(ordered)
+
+    def percentile(pct):
+        # The rank is multiplied first, so that it's exact, 7 / 100 * 100 is not 7
+        return ordered[max(0, math.ceil(pct * count / 100) - 1)] * 1000
+
+    return {
+        'count': count,
+        'mean_ms': sum(ordered) / count * 1000,
+        'min_ms': ordered[0] * 1000,
+        'p50_ms': percentile(50),
+        'p90_ms': percentile(90),
+        'p95_ms': percentile(95),
+        'p99_ms': percentile(99),
+        'max_ms': ordered[-1] * 1000,
+    }
+
+
+class SingleFlight:
+    """Coalesce concurrent calls for the same key into a single one.
+
+    While a call for a key is in flight, other callers asking for the same key wait for its result instead of doing the
+    work again. Once it finishes, the next call starts a new flight, nothing is cached.
+
+    :param str name: Name used in the metrics
+    """
+
+    def __init__(self, name):  # noqa D107
+        self.name = name
+        self.in_flight = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    async def do(self, key, func, *, share=True):
+        """Call `func()` unless there is a call in flight for `key`, in which case wait for that one.
+
+        :param key: Hashable key identifying the call
+        :param func: Function returning the awaitable to run
+        :param bool share: If False, the call bypasses the flights, it doesn't join the one in flight nor do others join
+            it. Calls that can wait on something the call in flight is waiting for, like a lock held by their
+            transaction, must not join it, or they would wait on each other forever
+        :return: The result of the call
+        """
+        self.calls += 1
+        if not share:
+            return await func()
+        flight = self.in_flight.get(key)
+        if flight is not None:
+            self.coalesced += 1
+            return await asyncio.shield(flight)
+        flight = self.in_flight[key] = asyncio.ensure_future(func())
+        flight.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        return await asyncio.shield(flight)
+
+    def metrics(self):
+        """Return the counters as a dict."""
+        return {
+            'calls': self.calls,
+            'coalesced': self.coalesced,
+            'in_flight': len(self.in_flight),
+        }
+
+
+class TTLCache:
+    """Least recently used cache whose entries expire `ttl` seconds after they are set.
+
+    :param int maxsize: Entries kept, the least recently used are dropped first
+    :param float ttl: Seconds an entry is valid
+    :param clock: Function returning the current time in seconds
+    """
+
+    def __init__(self, maxsize, ttl, *, clock=time.monotonic):  # noqa D107
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """Get the value of `key` if it's cached and not expired, otherwise `default`."""
+        entry = self.entries.get(key)
+        if entry is None or entry[0] <= self.clock():
+            self.entries.pop(key, None)
+            self.misses += 1
+            return default
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value, ttl=None):
+        """Cache `value` for `key`, `ttl` seconds if given, dropping the least recently used entries if it's full."""
+        self.entries[key] = (self.clock() + (self.ttl if ttl is None else ttl), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        """Drop all the entries."""
+        self.entries.clear()
+
+    def metrics(self):
+        """Return the counters as a dict."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self.entries),
+        }
+
+
+class RateLimiter:
+    """Token bucket for each key, allowing bursts of `rate` calls and then one call every `period` / `rate` seconds.
+
+    :param int rate: Calls allowed in `period`
+    :param float period: Seconds to refill the bucket
+    :param int maxsize: Keys kept, the least recently used are dropped first, so they start with a full bucket
+    :param clock: Function returning the current time in seconds
+    """
+
+    def __init__(self, rate, period, *, maxsize=10000, clock=time.monotonic):  # noqa D107
+        self.rate = rate
+        self.period = period
+        self.maxsize = maxsize
+        self.clock = clock
+        self.buckets = collections.OrderedDict()
+        """(tokens, time they were counted) of each key"""
+        self.limited = 0
+
+    def wait(self, key) -> float:
+        """Take a call of `key` if it's allowed, and get 0, otherwise get the seconds until it's allowed."""
+        now = self.clock()
+        tokens, counted = self.buckets.pop(key, (self.rate, now))
+        tokens = min(self.rate, tokens + (now - counted) * self.rate / self.period)
+        if tokens >= 1:
+            tokens -= 1
+            wait = 0
+        else:
+            wait = (1 - tokens) * self.period / self.rate
+            self.limited += 1
+        self.buckets[key] = (tokens, now)
+        while len(self.buckets) > self.maxsize:
+            self.buckets.popitem(last=False)
+        return wait
+
+
+class IdWatermark:
+    """Greatest id read of a table, to read only the rows inserted after it, even the ones committed out of order.
+
+    Ids are given when the rows are inserted, but the rows are seen once their transaction commits, so a row can be
+    seen after others with greater ids. The rows are read again from `overlap` ids before the greatest one seen, and
+    the ones already seen are skipped. A row committed more than `overlap` ids late is missed.
+
+    :param int overlap: Ids before the greatest one seen that are read again
+    """
+
+    def __init__(self, overlap):  # noqa D107
+        self.overlap = overlap
+        self.last_id = 0
+        self.seen = set()
+        """Ids seen that may be read again"""
+
+    @property
+    def after_id(self) -> int:
+        """Id after which the rows are read."""
+        return max(0, self.last_id - self.overlap)
+
+    def see(self, id) -> bool:
+        """Mark an id as seen, and get whether it wasn't seen before."""
+        if id in self.seen:
+            return False
+        self.seen.add(id)
+        self.last_id = max(self.last_id, id)
+        return True
+
+    def prune(self):
+        """Forget the ids seen that won't be read again."""
+        after_id = self.after_id
+        self.seen = {id for id in self.seen if id > after_id}
+
+
+class aclosing:
+    """Async context manager that closes an async generator on exit, as `contextlib.aclosing` of Python 3.10.
+
+    An async generator stopped with a break or an exception is only closed when it's garbage collected, so whatever it
+    holds, like the connection of :ref:`mosbot.query.iter_query`, is held until then. Use it as
+    `async with aclosing(iter_query(...)) as rows:` and iterate over `rows`.
+    """
+
+    def __init__(self, generator):  # noqa D107
+        self.generator = generator
+
+    async def __aenter__(self):  # noqa D105
+        return self.generator
+
+    async def __aexit__(self, *exc_info):  # noqa D105
+        await self.generator.aclose()
+
+
+DURATION_UNITS = collections.OrderedDict((
+    ('w', datetime.timedelta(weeks=1)),
+    ('d', datetime.timedelta(days=1)),
+    ('h', datetime.timedelta(hours=1)),
+    ('m', datetime.timedelta(minutes=1)),
+    ('s', datetime.timedelta(seconds=1)),
+))
+"""Units of the durations as in 7d, the larger first"""
+
+
+def parse_duration(text: str) -> datetime.timedelta:
+    """Parse a duration as a number and a unit of :ref:`DURATION_UNITS`, like 7d or 12h.
+
+    :raises ValueError: If it's not a positive duration
+    """
+    text = text.strip().lower()
+    unit = DURATION_UNITS.get(text[-1:])
+    if unit is None or not text[:-1].isdigit() or not int(text[:-1]):
+        raise ValueError(f'{text} is not a duration like 7d, 12h or 30m')
+    return int(text[:-1]) * unit
+
+
+def format_duration(duration: datetime.timedelta) -> str:
+    """Format a duration with the largest unit of :ref:`DURATION_UNITS` that fits it exactly, as in 7d."""
+    for name, unit in DURATION_UNITS.items():
+        if duration >= unit and not duration % unit:
+            return f'{duration // unit}{name}'
+    return f'{int(duration.total_seconds())}s'
+
+
 def retries(*, tries=10, final_message):  # pragma: no cover  # noqa D103
     def retry(func):
         @wraps(func)
@@ -30,10 +30,15 @@ setup(
     },
     install_requires=[
         'abot==0.0.1a1.post0.dev23',
+        'aiohttp',
         'aiopg',
-        'alembic',
+        'alembic>=1.2',
         'asyncio-extras',
         'click',
         'sqlalchemy',
-    ]
+    ],
+    extras_require={
+        'analytics': ['numpy'],
+        'parquet': ['pyarrow'],
+    },
 )
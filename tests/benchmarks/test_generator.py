@@ -0,0 +1,34 @@
+from abot.dubtrack import DubtrackDub, DubtrackPlaying, DubtrackSkip
+
+from benchmarks.generator import DubtrackGenerator
+
+
+def test_generator_is_deterministic():
+    assert DubtrackGenerator(seed=1).history(50) == DubtrackGenerator(seed=1).history(50)
+    assert DubtrackGenerator(seed=1).history(50) != DubtrackGenerator(seed=2).history(50)
+
+
+def test_generator_continues_in_time():
+    generator = DubtrackGenerator()
+    first = generator.history(10)
+    second = generator.history(10)
+    assert max(first) < min(second)
+
+
+def test_history_pages():
+    pages = DubtrackGenerator().history_pages(45, page_size=20)
+    assert [len(page) for page in pages] == [20, 20, 5]
+    played = [song['played'] for page in pages for song in page]
+    assert played == sorted(played, reverse=True)
+
+
+def test_live_events():
+    generator = DubtrackGenerator(skip_ratio=1)
+    events = list(generator.live_events(3))
+
+    playing = [e for e in events if isinstance(e, DubtrackPlaying)]
+    assert len(playing) == 3
+    assert len([e for e in events if isinstance(e, DubtrackSkip)]) == 3
+    assert all(e.sender.username for e in events)
+    for dub in (e for e in events if isinstance(e, DubtrackDub)):
+        assert dub.played in {p.played for p in playing}
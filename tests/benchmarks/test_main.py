@@ -0,0 +1,22 @@
+import pytest
+
+from benchmarks.__main__ import database_is_empty
+from mosbot.db import close_engine
+
+
+@pytest.mark.asyncio
+async def test_database_is_empty_without_tables():
+    # Before any test of the module creates the tables
+    try:
+        assert await database_is_empty()
+    finally:
+        await close_engine()
+
+
+@pytest.mark.asyncio
+async def test_database_is_empty(db_conn, user_generator, track_generator, playback_generator):
+    assert await database_is_empty()
+
+    await playback_generator(user=await user_generator(), track=await track_generator())
+
+    assert not await database_is_empty()
@@ -10,7 +10,7 @@ from aiopg import Connection
 from alembic.command import downgrade, upgrade
 from alembic.config import Config
 
-from mosbot.db import get_engine
+from mosbot.db import close_engine
 from mosbot.query import save_user, save_track, save_playback, save_user_action
 
 config = Config('alembic.ini')
@@ -62,10 +62,7 @@ async def db_conn(database):
 
         await trans.rollback()
         await roll_conn.close()
-        # This four lines are required to close the engine properly
-        engine = await get_engine()
-        engine.close()
-        await engine.wait_closed()
+        await close_engine()
 
         mosbot.query.ensure_connection = old_ensure
 
@@ -0,0 +1,183 @@
+import datetime
+import math
+
+import pytest
+
+from mosbot.analytics import compute_room_analytics, dj_rankings, load_playbacks, load_user_actions, \
+    playback_outcomes, room_metrics, track_metrics
+from mosbot.db import Action
+from mosbot.query import NO_USER_ID, get_playback_summary, get_track_stats, get_user_stats, listened_seconds, \
+    refresh_playback_summaries
+
+np = pytest.importorskip('numpy')
+
+SECOND = 1000000
+UP, DOWN, SKIP = Action.upvote.value, Action.downvote.value, Action.skip.value
+
+
+def playback_arrays(*playbacks):
+    fields = ('id', 'start', 'track_id', 'user_id', 'length')
+    dtypes = ('int32', 'int64', 'int32', 'int32', 'int32')
+    return {field: np.array([playback[i] for playback in playbacks], dtype=dtype)
+            for i, (field, dtype) in enumerate(zip(fields, dtypes))}
+
+
+def user_action_arrays(*user_actions):
+    fields = ('id', 'playback_id', 'user_id', 'ts', 'action')
+    dtypes = ('int32', 'int32', 'int32', 'int64', 'uint8')
+    return {field: np.array([user_action[i] for user_action in user_actions], dtype=dtype)
+            for i, (field, dtype) in enumerate(zip(fields, dtypes))}
+
+
+@pytest.fixture
+def playbacks():
+    return playback_arrays(
+        (1, 0, 10, 100, 120),
+        (2, 200 * SECOND, 11, 101, 120),
+        (3, 400 * SECOND, 10, NO_USER_ID, 0),
+        (4, 600 * SECOND, 10, 101, 60),
+    )
+
+
+@pytest.fixture
+def user_actions():
+    return user_action_arrays(
+        # A voter changes its vote, another upvotes, two votes without user
+        (1, 1, 200, 1 * SECOND, UP),
+        (2, 1, 200, 2 * SECOND, DOWN),
+        (3, 1, 201, 3 * SECOND, UP),
+        (4, 1, NO_USER_ID, 4 * SECOND, DOWN),
+        (5, 1, NO_USER_ID, 5 * SECOND, DOWN),
+        # Skipped twice, the first one counts, and before it started, which is listened for 0 seconds
+        (7, 2, 200, 230 * SECOND + SECOND // 2, SKIP),
+        (6, 2, 201, 210 * SECOND, SKIP),
+        (8, 4, 201, 599 * SECOND, SKIP),
+        (9, 4, 200, 601 * SECOND, UP),
+        # Of a playback that isn't loaded
+        (10, 5, 200, 800 * SECOND, UP),
+    )
+
+
+def test_playback_outcomes(playbacks, user_actions):
+    outcomes = playback_outcomes(playbacks, user_actions)
+
+    assert outcomes['upvotes'].tolist() == [1, 0, 0, 1]
+    assert outcomes['downvotes'].tolist() == [3, 0, 0, 0]
+    assert outcomes['skipped'].tolist() == [False, True, False, True]
+    assert outcomes['listened_seconds'].tolist() == [120, 10, 0, 0]
+    assert outcomes['listened_fraction'][[0, 1, 3]].tolist() == [1, 10 / 120, 0]
+    assert math.isnan(outcomes['listened_fraction'][2])
+
+
+def test_playback_outcomes_empty():
+    outcomes = playback_outcomes(playback_arrays(), user_action_arrays((1, 1, 200, 0, UP)))
+
+    assert all(len(array) == 0 for array in outcomes.values())
+    assert room_metrics(outcomes)['plays'] == 0
+    assert math.isnan(room_metrics(outcomes)['skip_rate'])
+
+
+def test_track_metrics(playbacks, user_actions):
+    metrics = track_metrics(playbacks, playback_outcomes(playbacks, user_actions))
+
+    assert metrics['track_id'].tolist() == [10, 11]
+    assert metrics['plays'].tolist() == [3, 1]
+    assert metrics['skips'].tolist() == [1, 1]
+    assert metrics['skip_rate'].tolist() == [1 / 3, 1]
+    # The playback without length doesn't count for the listened fraction
+    assert metrics['listened_fraction'].tolist() == [0.5, 10 / 120]
+    assert metrics['upvotes'].tolist() == [2, 0]
+    assert metrics['downvotes'].tolist() == [3, 0]
+    assert metrics['vote_ratio'][0] == 2 / 5
+    assert math.isnan(metrics['vote_ratio'][1])
+
+
+def test_dj_rankings(playbacks, user_actions):
+    rankings = dj_rankings(playbacks, playback_outcomes(playbacks, user_actions))
+
+    # 101 has a net vote of +1, 100 of -2, the playback without DJ is left out
+    assert rankings['user_id'].tolist() == [101, 100]
+    assert rankings['plays'].tolist() == [2, 1]
+    assert rankings['vote_ratio'].tolist() == [1, 1 / 4]
+
+
+def test_room_metrics(playbacks, user_actions):
+    assert room_metrics(playback_outcomes(playbacks, user_actions)) == {
+        'plays': 4,
+        'skips': 2,
+        'skip_rate': 0.5,
+        'listened_fraction': (1 + 10 / 120 + 0) / 3,
+        'upvotes': 2,
+        'downvotes': 3,
+        'vote_ratio': 2 / 5,
+    }
+
+
+@pytest.mark.parametrize('fetch_size', (2, 10000))
+@pytest.mark.asyncio
+async def test_compute_room_analytics(
+        db_conn,
+        track_generator,
+        user_generator,
+        playback_generator,
+        user_action_generator,
+        fetch_size,
+):
+    tracks = [await track_generator(length=120), await track_generator(length=200)]
+    djs = [await user_generator(), await user_generator()]
+    voters = [await user_generator() for _ in range(3)]
+    playbacks = [await playback_generator(user=djs[n % 2], track=tracks[n % 3 % 2]) for n in range(6)]
+    for n, playback in enumerate(playbacks):
+        for voter, action in zip(voters, ('upvote', 'downvote', 'upvote', 'downvote')[n % 3:]):
+            await user_action_generator(user=voter, playback=playback, action=action)
+    await user_action_generator(user={'id': None}, playback=playbacks[0], action='downvote')
+    await user_action_generator(user=voters[0], playback=playbacks[2], action='skip',
+                                ts=playbacks[2]['start'] + datetime.timedelta(seconds=42, microseconds=900000))
+    await refresh_playback_summaries(playbacks[0]['id'], playbacks[-1]['id'] + 1, conn=db_conn)
+
+    loaded = await load_playbacks(fetch_size=fetch_size, conn=db_conn)
+    outcomes = playback_outcomes(loaded, await load_user_actions(fetch_size=fetch_size, conn=db_conn))
+    assert loaded['id'].tolist() == [playback['id'] for playback in playbacks]
+    for n, playback in enumerate(playbacks):
+        summary = await get_playback_summary(playback['id'], conn=db_conn)
+        assert outcomes['upvotes'][n] == summary['upvotes']
+        assert outcomes['downvotes'][n] == summary['downvotes']
+        assert outcomes['skipped'][n] == summary['skipped']
+        assert outcomes['listened_seconds'][n] == listened_seconds(
+            dict(playback, length=tracks[n % 3 % 2]['length']), summary)
+
+    # The counters kept by the bot are the same
+    analytics = await compute_room_analytics(fetch_size=fetch_size, conn=db_conn)
+    for metrics, key, get_stats in ((analytics['tracks'], 'track_id', get_track_stats),
+                                    (analytics['djs'], 'user_id', get_user_stats)):
+        for n, id in enumerate(metrics[key].tolist()):
+            stats = await get_stats(id, conn=db_conn)
+            assert (metrics['plays'][n], metrics['skips'][n], metrics['upvotes'][n], metrics['downvotes'][n]) == \
+                (stats['plays'], stats['skips'], stats['updubs'], stats['downdubs'])
+    assert analytics['room']['plays'] == 6
+
+
+@pytest.mark.asyncio
+async def test_load_playbacks_range(db_conn, track_generator, user_generator, playback_generator,
+                                    user_action_generator):
+    track = await track_generator()
+    user = await user_generator()
+    starts = [datetime.datetime(2000, 1, 1), datetime.datetime(2000, 2, 1), datetime.datetime(2000, 3, 1)]
+    playbacks = [await playback_generator(user=user, track=track, start=start) for start in starts]
+    actions = [await user_action_generator(user=user, playback=playback) for playback in playbacks]
+
+    since, until = starts[1], starts[2]
+    loaded = await load_playbacks(since, until, conn=db_conn)
+    loaded_actions = await load_user_actions(since, until, conn=db_conn)
+
+    assert {field: array.tolist() for field, array in loaded.items()} == {
+        'id': [playbacks[1]['id']],
+        'start': [int((starts[1] - datetime.datetime(1970, 1, 1)).total_seconds()) * SECOND],
+        'track_id': [track['id']],
+        'user_id': [user['id']],
+        'length': [track['length']],
+    }
+    assert loaded['start'].dtype == np.int64
+    assert loaded_actions['id'].tolist() == [actions[1]['id']]
+    assert loaded_actions['action'].dtype == np.uint8
+    assert loaded_actions['action'].tolist() == [actions[1]['action'].value]
@@ -1,3 +1,6 @@
+import datetime
+import json
+
 import asynctest as am
 import pytest
 from abot.bot import current_event
@@ -7,7 +10,11 @@ from unittest import mock
 from mosbot import config
 from mosbot.__main__ import main
 from mosbot.command import BotConfigValueType
-from mosbot.handler import history_handler, availability_handler
+from mosbot.handler import history_handler, availability_handler, backend_connected, fetch_room_queue, repeat_handler, \
+    room_listeners
+from mosbot.usecase import RepeatPolicy
+from mosbot.usecase.recent_playbacks import RecentPlayback
+from mosbot.usecase.room_queue import QueueItem
 
 
 @pytest.fixture
@@ -38,6 +45,109 @@ def load_bot_data_mock():
         yield m
 
 
+@pytest.fixture
+def profiling_mock(mocker):
+    m = mocker.patch('mosbot.command.profiling')
+    m.profile_cpu = am.CoroutineMock(return_value='cpu.collapsed')
+    m.profile_memory = am.CoroutineMock(return_value='memory.tracemalloc')
+    return m
+
+
+@pytest.fixture
+def event_recorder_mock(mocker):
+    return mocker.patch('mosbot.command.EventRecorder')
+
+
+@pytest.fixture
+def replay_records_mock(mocker):
+    return mocker.patch('mosbot.command.replay_records', new_callable=am.CoroutineMock)
+
+
+@pytest.fixture
+def warm_up_engine_mock(mocker):
+    return mocker.patch('mosbot.command.warm_up_engine')
+
+
+@pytest.fixture
+def close_engine_mock(mocker):
+    return mocker.patch('mosbot.command.close_engine')
+
+
+@pytest.fixture
+def read_records_mock(mocker):
+    return mocker.patch('mosbot.command.read_records')
+
+
+@pytest.fixture
+def set_journal_mock(mocker):
+    return mocker.patch('mosbot.command.set_journal')
+
+
+@pytest.fixture
+def open_journal_mock(mocker):
+    return mocker.patch('mosbot.command.open_journal')
+
+
+@pytest.fixture
+def drain_journal_mock(mocker):
+    return mocker.patch('mosbot.command.drain_journal')
+
+
+@pytest.fixture
+def ensure_user_action_partitions_forever_mock(mocker):
+    return mocker.patch('mosbot.command.ensure_user_action_partitions_forever')
+
+
+@pytest.fixture
+def refresh_activity_rollups_forever_mock(mocker):
+    return mocker.patch('mosbot.command.refresh_activity_rollups_forever')
+
+
+@pytest.fixture
+def refresh_recommendations_forever_mock(mocker):
+    return mocker.patch('mosbot.command.refresh_recommendations_forever')
+
+
+@pytest.fixture
+def refresh_duplicate_tracks_forever_mock(mocker):
+    return mocker.patch('mosbot.command.refresh_duplicate_tracks_forever')
+
+
+@pytest.fixture
+def reconcile_room_queue_forever_mock(mocker):
+    return mocker.patch('mosbot.command.reconcile_room_queue_forever')
+
+
+@pytest.fixture
+def check_upcoming_availability_forever_mock(mocker):
+    return mocker.patch('mosbot.command.check_upcoming_availability_forever')
+
+
+@pytest.fixture
+def refresh_leaderboards_forever_mock(mocker):
+    return mocker.patch('mosbot.command.refresh_leaderboards_forever')
+
+
+@pytest.fixture
+def set_availability_checker_mock(mocker):
+    return mocker.patch('mosbot.command.set_availability_checker')
+
+
+@pytest.fixture
+def set_repeat_policy_mock(mocker):
+    return mocker.patch('mosbot.command.set_repeat_policy')
+
+
+@pytest.fixture
+def warm_up_recent_plays_mock(mocker):
+    return mocker.patch('mosbot.command.warm_up_recent_plays')
+
+
+@pytest.fixture
+def warm_up_recent_playbacks_mock(mocker):
+    return mocker.patch('mosbot.command.warm_up_recent_playbacks')
+
+
 @pytest.fixture
 def bot_mock(mocker):
     return mocker.patch('mosbot.command.Bot')
@@ -148,6 +258,268 @@ def test_config(
         load_bot_data_mock.assert_awaited_once_with(key)
 
 
+@pytest.mark.parametrize('args,profile_dir,error,expected_output', (
+        ([], None, None, 'Profiling is disabled, run the bot with --profile-dir'),
+        ([], 'dir', None, 'Starting CPU profile for 30s\nProfile written to cpu.collapsed'),
+        (['-s', '5', '-m'], 'dir', None, 'Starting memory profile for 5s\nProfile written to memory.tracemalloc'),
+        (['--cpu'], 'dir', RuntimeError('There is already a profile running'),
+         'Starting CPU profile for 30s\nThere is already a profile running'),
+))
+def test_profile(
+        event_loop,
+        profiling_mock,
+        args,
+        profile_dir,
+        error,
+        expected_output,
+):
+    profiling_mock.PROFILE_DIR = profile_dir
+    profiling_mock.profile_cpu.side_effect = error
+    runner = CliRunner()
+
+    result = runner.invoke(main, ['profile'] + args)
+
+    assert result.exit_code == 0, result.output
+    assert result.output.strip() == expected_output
+
+
+@pytest.mark.parametrize('args,suggestions,expected_output', (
+        ([], (None, []), 'There are no suggestions yet'),
+        ([], ('Track 1', []), 'There are no suggestions for Track 1 yet'),
+        (['-l', '2'], ('Track 1', ['Track 2', 'Track 3']), 'Similar to Track 1: Track 2, Track 3'),
+))
+def test_suggest(event_loop, mocker, args, suggestions, expected_output):
+    suggest_tracks_mock = mocker.patch('mosbot.command.suggest_tracks', return_value=suggestions)
+    runner = CliRunner()
+
+    result = runner.invoke(main, ['suggest'] + args)
+
+    assert result.exit_code == 0, result.output
+    assert result.output.strip() == expected_output
+    suggest_tracks_mock.assert_called_once_with(int(args[1]) if args else 5)
+
+
+@pytest.mark.parametrize('args,playbacks,expected_output', (
+        ([], [], 'Nothing was played yet'),
+        (['-l', '2'], [
+            RecentPlayback(2, None, 2, 'Track 2', 1, 'dj', 3, 1),
+            RecentPlayback(1, None, 1, 'Track 1', 2, 'other'),
+        ], 'Track 2 by dj (+3/-1)\nTrack 1 by other (+0/-0)'),
+))
+def test_last(event_loop, mocker, args, playbacks, expected_output):
+    latest_playbacks_mock = mocker.patch('mosbot.command.latest_playbacks', return_value=playbacks)
+    runner = CliRunner()
+
+    result = runner.invoke(main, ['last'] + args)
+
+    assert result.exit_code == 0, result.output
+    assert result.output.strip() == expected_output
+    latest_playbacks_mock.assert_called_once_with(int(args[1]) if args else 1)
+
+
+@pytest.mark.parametrize('playback,expected_output', (
+        (None, 'blue monday was not played recently'),
+        (RecentPlayback(1, None, 1, 'Blue Monday', 1, 'dj'), 'Blue Monday was played by dj 5 minutes ago'),
+))
+def test_whoplayed(event_loop, mocker, playback, expected_output):
+    find_recent_playback_mock = mocker.patch('mosbot.command.find_recent_playback', return_value=playback)
+    mocker.patch('mosbot.command.minutes_ago', return_value=5)
+    runner = CliRunner()
+
+    result = runner.invoke(main, ['whoplayed', 'blue', 'monday'])
+
+    assert result.exit_code == 0, result.output
+    assert result.output.strip() == expected_output
+    find_recent_playback_mock.assert_called_once_with('blue monday')
+
+
+@pytest.mark.parametrize('args,djs,tracks,expected_output', (
+        (['djs'], [], [], 'Nothing was played'),
+        (['djs', '-l', '2'], [{'username': 'dj', 'plays': 3}, {'username': 'other', 'plays': 1}], [],
+         'Top djs: dj (3), other (1)'),
+        (['tracks', '--since', '7d'], [], [{'name': 'Track 1', 'plays': 2}], 'Top tracks of the last 1w: Track 1 (2)'),
+))
+def test_top(event_loop, mocker, args, djs, tracks, expected_output):
+    mocker.patch('mosbot.command.leaderboard_wait', return_value=0)
+    top_djs_mock = mocker.patch('mosbot.command.top_djs', new_callable=am.CoroutineMock, return_value=djs)
+    top_tracks_mock = mocker.patch('mosbot.command.top_tracks', new_callable=am.CoroutineMock, return_value=tracks)
+    runner = CliRunner()
+
+    result = runner.invoke(main, ['top'] + args)
+
+    assert result.exit_code == 0, result.output
+    assert result.output.strip() == expected_output
+    limit = int(args[2]) if '-l' in args else 5
+    since = datetime.timedelta(days=7) if '--since' in args else None
+    called_mock, not_called_mock = (top_djs_mock, top_tracks_mock) if args[0] == 'djs' else \
+        (top_tracks_mock, top_djs_mock)
+    called_mock.assert_awaited_once_with(limit, since=since)
+    not_called_mock.assert_not_awaited()
+
+
+@pytest.mark.parametrize('args', (['djs', '--since', '7'], ['djs', '-l', '11'], ['users']))
+def test_top_invalid(event_loop, mocker, args):
+    top_djs_mock = mocker.patch('mosbot.command.top_djs', new_callable=am.CoroutineMock)
+    runner = CliRunner()
+
+    result = runner.invoke(main, ['top'] + args)
+
+    assert result.exit_code == 2, result.output
+    top_djs_mock.assert_not_awaited()
+
+
+@pytest.mark.parametrize('args,djs,since,expected_output', (
+        ([], [], datetime.timedelta(days=7), 'Nothing was played of the last 1w'),
+        (['-s', '12h'], [{'username': 'dj', 'updubs': 5}, {'username': 'other', 'updubs': 2}],
+         datetime.timedelta(hours=12), 'Leaderboard of the last 12h: dj +5, other +2'),
+))
+def test_leaderboard(event_loop, mocker, args, djs, since, expected_output):
+    mocker.patch('mosbot.command.leaderboard_wait', return_value=0)
+    top_djs_mock = mocker.patch('mosbot.command.top_djs', new_callable=am.CoroutineMock, return_value=djs)
+    runner = CliRunner()
+
+    result = runner.invoke(main, ['leaderboard'] + args)
+
+    assert result.exit_code == 0, result.output
+    assert result.output.strip() == expected_output
+    top_djs_mock.assert_awaited_once_with(5, since=since, order_by='updubs')
+
+
+@pytest.mark.parametrize('stats,expected_output', (
+        (None, 'There are no stats of you yet'),
+        ({'username': 'dj'}, 'There are no stats of you yet'),
+        ({'username': 'dj', 'plays': 3, 'updubs': 5, 'downdubs': 1, 'skips': 1, 'updubs_given': 7,
+          'downdubs_given': 0}, 'dj: 3 plays, +5/-1 received, 1 skipped, +7/-0 given'),
+))
+def test_mystats(event_loop, mocker, stats, expected_output):
+    mocker.patch('mosbot.command.leaderboard_wait', return_value=0)
+    user_stats_mock = mocker.patch('mosbot.command.user_stats', new_callable=am.CoroutineMock, return_value=stats)
+    runner = CliRunner()
+
+    result = runner.invoke(main, ['mystats'])
+
+    assert result.exit_code == 0, result.output
+    assert result.output.strip() == expected_output
+    user_stats_mock.assert_awaited_once_with('')
+
+
+@pytest.mark.parametrize('args', (['top', 'djs'], ['leaderboard'], ['mystats']))
+def test_leaderboard_rate_limited(event_loop, mocker, args):
+    leaderboard_wait_mock = mocker.patch('mosbot.command.leaderboard_wait', return_value=4.2)
+    top_djs_mock = mocker.patch('mosbot.command.top_djs', new_callable=am.CoroutineMock)
+    user_stats_mock = mocker.patch('mosbot.command.user_stats', new_callable=am.CoroutineMock)
+    runner = CliRunner()
+
+    result = runner.invoke(main, args)
+
+    assert result.exit_code == 0, result.output
+    assert result.output.strip() == 'Too many requests, try again in 5 seconds'
+    leaderboard_wait_mock.assert_called_once_with('')
+    top_djs_mock.assert_not_awaited()
+    user_stats_mock.assert_not_awaited()
+
+
+@pytest.mark.parametrize('args,items,fresh,expected_output', (
+        ([], [], True, 'The queue is empty'),
+        (['-l', '2'], [QueueItem('1', 'dj', 'youtube', 'a', 'Track 1', 100),
+                       QueueItem('2', 'dj', 'youtube', 'b', 'Track 2', 100)], True, 'Next: Track 1, Track 2'),
+        ([], [], False, 'The queue is empty, it may have changed since it was last checked'),
+        ([], [QueueItem('1', 'dj', 'youtube', 'a', 'Track 1', 100)], False,
+         'Next: Track 1, it may have changed since it was last checked'),
+))
+def test_queue(event_loop, mocker, args, items, fresh, expected_output):
+    mocker.patch('mosbot.command.room_queue_fresh', return_value=fresh)
+    upcoming_tracks_mock = mocker.patch('mosbot.command.upcoming_tracks', return_value=items)
+    runner = CliRunner()
+
+    result = runner.invoke(main, ['queue'] + args)
+
+    assert result.exit_code == 0, result.output
+    assert result.output.strip() == expected_output
+    upcoming_tracks_mock.assert_called_once_with(int(args[1]) if args else 5)
+
+
+def test_queue_not_reconciled(event_loop, mocker):
+    mocker.patch('mosbot.command.room_queue_fresh', return_value=None)
+    upcoming_tracks_mock = mocker.patch('mosbot.command.upcoming_tracks')
+    runner = CliRunner()
+
+    result = runner.invoke(main, ['queue'])
+
+    assert result.exit_code == 0, result.output
+    assert result.output.strip() == 'The queue is not known yet'
+    upcoming_tracks_mock.assert_not_called()
+
+
+@pytest.mark.parametrize('args,results,expected_output', (
+        (['queen'], [], 'Nothing found for queen'),
+        (['-l', '2', 'bohemian', 'rhapsody'], [{'name': 'Bohemian Rhapsody'}, {'name': 'Rhapsody in Blue'}],
+         'Tracks: Bohemian Rhapsody, Rhapsody in Blue'),
+        (['--users', 'tom'], [{'username': 'Tom'}, {'username': 'atomic'}], 'Users: Tom, atomic'),
+))
+def test_search(event_loop, mocker, args, results, expected_output):
+    cached_search_mock = mocker.patch('mosbot.command.cached_search', new=am.CoroutineMock(return_value=results))
+    runner = CliRunner()
+
+    result = runner.invoke(main, ['search'] + args)
+
+    assert result.exit_code == 0, result.output
+    assert result.output.strip() == expected_output
+    text = ' '.join(arg for arg in args if not arg.startswith('-') and not arg.isdigit())
+    limit = int(args[1]) if '-l' in args else 5
+    cached_search_mock.assert_awaited_once_with(text, users='--users' in args, limit=limit)
+
+
+def test_run_journal(
+        event_loop,
+        check_alembic_in_latest_version_mock,
+        setup_logging_mock,
+        set_journal_mock,
+        open_journal_mock,
+        drain_journal_mock,
+        warm_up_engine_mock,
+        close_engine_mock,
+        refresh_activity_rollups_forever_mock,
+        refresh_recommendations_forever_mock,
+        refresh_duplicate_tracks_forever_mock,
+        refresh_leaderboards_forever_mock,
+        reconcile_room_queue_forever_mock,
+        set_repeat_policy_mock,
+        warm_up_recent_plays_mock,
+        warm_up_recent_playbacks_mock,
+        ensure_user_action_partitions_forever_mock,
+        bot_mock,
+        dubtrackbotbackend_mock,
+        asyncio_mock,
+):
+    runner = CliRunner()
+
+    result = runner.invoke(main, ['run', '--journal-dir', 'journal', '--activity-refresh-interval', '0',
+                                  '--recommendations-refresh-interval', '0',
+                                  '--duplicate-tracks-refresh-interval', '0', '--repeat-policy', 'off',
+                                  '--queue-reconcile-interval', '0', '--leaderboards-refresh-interval', '0'])
+
+    assert result.exit_code == 0
+    loop_object = asyncio_mock.get_event_loop.return_value
+    open_journal_mock.assert_called_once_with('journal')
+    assert loop_object.run_until_complete.mock_calls == [
+        mock.call(warm_up_engine_mock.return_value),
+        mock.call(warm_up_recent_playbacks_mock.return_value),
+        mock.call(bot_mock.return_value.run_forever.return_value),
+        mock.call(close_engine_mock.return_value),
+    ]
+    set_journal_mock.assert_called_once_with(open_journal_mock.return_value)
+    drain_journal_mock.assert_called_once_with(open_journal_mock.return_value)
+    assert loop_object.create_task.mock_calls == [
+        mock.call(drain_journal_mock.return_value),
+        mock.call(ensure_user_action_partitions_forever_mock.return_value),
+    ]
+    set_repeat_policy_mock.assert_called_once_with(RepeatPolicy.off)
+    warm_up_recent_plays_mock.assert_not_called()
+    reconcile_room_queue_forever_mock.assert_not_called()
+    refresh_leaderboards_forever_mock.assert_not_called()
+
+
 def test_test(
         event_loop,
 ):
@@ -158,6 +530,14 @@ def test_test(
     assert result.exit_code == 0
 
 
+@pytest.mark.parametrize('record_arg,record_events', (
+        ([], None),
+        (['--record-events', 'events.log'], 'events.log'),
+))
+@pytest.mark.parametrize('profile_arg,profile_dir', (
+        ([], None),
+        (['--profile-dir', 'profiles'], 'profiles'),
+))
 @pytest.mark.parametrize('debug_arg,debug', (
         ('', False),
         ('-d', True),
@@ -168,16 +548,35 @@ def test_run(
         event_loop,
         check_alembic_in_latest_version_mock,
         setup_logging_mock,
+        profiling_mock,
+        event_recorder_mock,
+        warm_up_engine_mock,
+        close_engine_mock,
+        refresh_activity_rollups_forever_mock,
+        refresh_recommendations_forever_mock,
+        refresh_duplicate_tracks_forever_mock,
+        refresh_leaderboards_forever_mock,
+        reconcile_room_queue_forever_mock,
+        set_repeat_policy_mock,
+        warm_up_recent_plays_mock,
+        warm_up_recent_playbacks_mock,
+        ensure_user_action_partitions_forever_mock,
         bot_mock,
         dubtrackbotbackend_mock,
         asyncio_mock,
         debug_arg,
         debug,
+        profile_arg,
+        profile_dir,
+        record_arg,
+        record_events,
 ):
     runner = CliRunner()
     args = ['run']
     if debug_arg:
         args.append(debug_arg)
+    args.extend(profile_arg)
+    args.extend(record_arg)
 
     result = runner.invoke(main, args)
 
@@ -185,6 +584,7 @@ def test_run(
 
     check_alembic_in_latest_version_mock.assert_called_once_with()
     setup_logging_mock.assert_called_once_with(debug)
+    profiling_mock.set_profile_dir.assert_called_once_with(profile_dir)
 
     bot_mock.assert_called_once_with()
     bot_object = bot_mock.return_value
@@ -198,13 +598,465 @@ def test_run(
     bot_object.attach_backend.assert_called_once_with(
         backend=dubtrack_backend_object
     )
-    assert bot_object.add_event_handler.mock_calls == [
+    repeat_policy = RepeatPolicy(config.REPEAT_POLICY)
+    set_repeat_policy_mock.assert_called_once_with(repeat_policy)
+    handler_calls = [
         mock.call(func=history_handler),
         mock.call(func=availability_handler),
     ]
+    if repeat_policy is not RepeatPolicy.off:
+        handler_calls.append(mock.call(func=repeat_handler))
+    if record_events:
+        event_recorder_mock.assert_called_once_with(record_events)
+        handler_calls.insert(0, mock.call(func=event_recorder_mock.return_value.record_event))
+        event_recorder_mock.return_value.close.assert_called_once_with()
+    else:
+        event_recorder_mock.assert_not_called()
+    assert bot_object.add_event_handler.mock_calls == handler_calls
 
     asyncio_mock.get_event_loop.assert_called_once_with()
     loop_object = asyncio_mock.get_event_loop.return_value
-    loop_object.run_until_complete.assert_called_once_with(
-        bot_object.run_forever.return_value
+    warm_up_engine_mock.assert_called_once_with()
+    close_engine_mock.assert_called_once_with()
+    warm_up_calls = [mock.call(warm_up_recent_plays_mock.return_value)] if repeat_policy is not RepeatPolicy.off else []
+    assert loop_object.run_until_complete.mock_calls == [
+        mock.call(warm_up_engine_mock.return_value),
+        mock.call(warm_up_recent_playbacks_mock.return_value),
+        *warm_up_calls,
+        mock.call(bot_object.run_forever.return_value),
+        mock.call(close_engine_mock.return_value),
+    ]
+    refresh_activity_rollups_forever_mock.assert_called_once_with(config.ACTIVITY_REFRESH_INTERVAL)
+    refresh_recommendations_forever_mock.assert_called_once_with(config.RECOMMENDATIONS_REFRESH_INTERVAL)
+    refresh_duplicate_tracks_forever_mock.assert_called_once_with(config.DUPLICATE_TRACKS_REFRESH_INTERVAL)
+    refresh_leaderboards_forever_mock.assert_called_once_with(config.LEADERBOARD_REFRESH_INTERVAL)
+    ensure_user_action_partitions_forever_mock.assert_called_once_with(
+        config.USER_ACTION_PARTITION_CHECK_INTERVAL,
+        months_ahead=config.USER_ACTION_PARTITION_MONTHS_AHEAD,
     )
+    assert loop_object.create_task.mock_calls == [
+        mock.call(ensure_user_action_partitions_forever_mock.return_value),
+        mock.call(refresh_activity_rollups_forever_mock.return_value),
+        mock.call(refresh_recommendations_forever_mock.return_value),
+        mock.call(refresh_duplicate_tracks_forever_mock.return_value),
+        mock.call(refresh_leaderboards_forever_mock.return_value),
+        mock.call(reconcile_room_queue_forever_mock.return_value),
+    ]
+    fetch, interval = reconcile_room_queue_forever_mock.call_args[0]
+    assert fetch.func == fetch_room_queue
+    assert fetch.args == (dubtrack_backend_object,)
+    assert interval == config.ROOM_QUEUE_RECONCILE_INTERVAL
+    connected = reconcile_room_queue_forever_mock.call_args[1]['connected']
+    assert connected.func == backend_connected
+    assert connected.args == (dubtrack_backend_object,)
+
+
+def test_run_skip_repeats(
+        event_loop,
+        check_alembic_in_latest_version_mock,
+        setup_logging_mock,
+        warm_up_engine_mock,
+        close_engine_mock,
+        refresh_activity_rollups_forever_mock,
+        refresh_recommendations_forever_mock,
+        refresh_duplicate_tracks_forever_mock,
+        refresh_leaderboards_forever_mock,
+        reconcile_room_queue_forever_mock,
+        set_repeat_policy_mock,
+        warm_up_recent_plays_mock,
+        warm_up_recent_playbacks_mock,
+        ensure_user_action_partitions_forever_mock,
+        bot_mock,
+        dubtrackbotbackend_mock,
+        asyncio_mock,
+):
+    runner = CliRunner()
+
+    result = runner.invoke(main, ['run', '--repeat-policy', 'skip'])
+
+    assert result.exit_code == 0, result.output
+    set_repeat_policy_mock.assert_called_once_with(RepeatPolicy.skip)
+    warm_up_recent_plays_mock.assert_called_once_with()
+    assert mock.call(func=repeat_handler) in bot_mock.return_value.add_event_handler.mock_calls
+
+
+def test_run_availability(
+        event_loop,
+        mocker,
+        check_alembic_in_latest_version_mock,
+        setup_logging_mock,
+        warm_up_engine_mock,
+        close_engine_mock,
+        refresh_activity_rollups_forever_mock,
+        refresh_recommendations_forever_mock,
+        refresh_duplicate_tracks_forever_mock,
+        refresh_leaderboards_forever_mock,
+        reconcile_room_queue_forever_mock,
+        check_upcoming_availability_forever_mock,
+        set_availability_checker_mock,
+        set_repeat_policy_mock,
+        warm_up_recent_plays_mock,
+        warm_up_recent_playbacks_mock,
+        ensure_user_action_partitions_forever_mock,
+        bot_mock,
+        dubtrackbotbackend_mock,
+        asyncio_mock,
+):
+    mocker.patch('mosbot.command.mos_config.YOUTUBE_API_KEY', 'key')
+    has_user_countries_mock = mocker.patch('mosbot.command.has_user_countries')
+    runner = CliRunner()
+
+    result = runner.invoke(main, ['run', '--availability-check-interval', '60'])
+
+    assert result.exit_code == 0, result.output
+    has_user_countries_mock.assert_called_once_with()
+    checker, = set_availability_checker_mock.call_args[0]
+    assert checker.provider.api_key == 'key'
+    listeners, interval = check_upcoming_availability_forever_mock.call_args[0]
+    assert listeners.func == room_listeners
+    assert listeners.args == (dubtrackbotbackend_mock.return_value,)
+    assert interval == 60
+    loop_object = asyncio_mock.get_event_loop.return_value
+    assert loop_object.create_task.mock_calls[-1] == mock.call(check_upcoming_availability_forever_mock.return_value)
+
+
+def test_run_availability_without_countries(
+        event_loop,
+        mocker,
+        check_alembic_in_latest_version_mock,
+        setup_logging_mock,
+        warm_up_engine_mock,
+        close_engine_mock,
+        refresh_activity_rollups_forever_mock,
+        refresh_recommendations_forever_mock,
+        refresh_duplicate_tracks_forever_mock,
+        refresh_leaderboards_forever_mock,
+        reconcile_room_queue_forever_mock,
+        check_upcoming_availability_forever_mock,
+        set_availability_checker_mock,
+        set_repeat_policy_mock,
+        warm_up_recent_plays_mock,
+        warm_up_recent_playbacks_mock,
+        ensure_user_action_partitions_forever_mock,
+        bot_mock,
+        dubtrackbotbackend_mock,
+        asyncio_mock,
+):
+    mocker.patch('mosbot.command.mos_config.YOUTUBE_API_KEY', 'key')
+    has_user_countries_mock = mocker.patch('mosbot.command.has_user_countries')
+    asyncio_mock.get_event_loop.return_value.run_until_complete.side_effect = \
+        lambda coro: False if coro is has_user_countries_mock.return_value else mock.DEFAULT
+    runner = CliRunner()
+
+    result = runner.invoke(main, ['run', '--availability-check-interval', '60'])
+
+    assert result.exit_code == 0, result.output
+    assert 'no user has a country' in result.output
+    set_availability_checker_mock.assert_not_called()
+    check_upcoming_availability_forever_mock.assert_not_called()
+
+
+@pytest.mark.parametrize('args,speed,max_in_flight', (
+        ([], 1.0, 100),
+        (['--speed', '0'], 0, 100),
+        (['-s', '10', '--max-in-flight', '5'], 10, 5),
+))
+def test_replay(
+        event_loop,
+        tmpdir,
+        check_alembic_in_latest_version_mock,
+        setup_logging_mock,
+        read_records_mock,
+        replay_records_mock,
+        close_engine_mock,
+        args,
+        speed,
+        max_in_flight,
+):
+    event_log = tmpdir.join('events.log')
+    event_log.write('')
+    output = tmpdir.join('report.json')
+    close_engine_mock.side_effect = am.CoroutineMock()
+    replay_records_mock.return_value = {
+        'events': 10,
+        'seconds': 2,
+        'events_per_second': 5,
+        'handlers': {
+            'history_handler': {'calls': 10, 'errors': {'KeyError': 1}, 'latency': {'p50_ms': 1, 'p95_ms': 2,
+                                                                                    'p99_ms': 3}},
+            'availability_handler': {'calls': 0, 'errors': {}, 'latency': {'count': 0}},
+        },
+    }
+    runner = CliRunner()
+
+    result = runner.invoke(main, ['replay', str(event_log), '-o', str(output)] + args)
+
+    assert result.exit_code == 0, result.output
+    assert 'Replayed 10 events in 2.00s (5.0 events/s)' in result.output
+    assert "history_handler: 10 calls, errors {'KeyError': 1}, p50 1.0ms p95 2.0ms p99 3.0ms" in result.output
+    assert json.loads(output.read())['events'] == 10
+    read_records_mock.assert_called_once_with(str(event_log))
+    handlers = replay_records_mock.call_args[0][1]
+    assert handlers['history_handler'][0] == history_handler
+    assert handlers['availability_handler'][0] == availability_handler
+    assert replay_records_mock.call_args[1] == {'speed': speed, 'max_in_flight': max_in_flight}
+    close_engine_mock.assert_called_once_with()
+
+
+@pytest.mark.parametrize('args, since, bulk', (
+        ([], None, False),
+        (['--bulk', '--since', '0'], 0, True),
+))
+@pytest.mark.parametrize('last_song', (None, 1234.5))
+def test_history_import(
+        event_loop,
+        check_alembic_in_latest_version_mock,
+        setup_logging_mock,
+        save_history_songs_mock,
+        close_engine_mock,
+        args,
+        since,
+        bulk,
+        last_song,
+):
+    save_history_songs_mock.return_value = last_song
+    close_engine_mock.side_effect = am.CoroutineMock()
+    runner = CliRunner()
+
+    result = runner.invoke(main, ['history_import'] + args)
+
+    save_history_songs_mock.assert_awaited_once_with(since=since, bulk=bulk)
+    close_engine_mock.assert_called_once_with()
+    if last_song is None:
+        assert result.exit_code == 1, result.output
+        assert 'No history was saved' in result.output
+    else:
+        assert result.exit_code == 0, result.output
+        assert 'Saved the history until 1234.5' in result.output
+
+
+@pytest.fixture
+def rebuild_playback_summaries_mock(mocker):
+    return mocker.patch('mosbot.command.rebuild_playback_summaries', new_callable=am.CoroutineMock, return_value=3)
+
+
+@pytest.fixture
+def check_playback_summaries_mock(mocker):
+    return mocker.patch('mosbot.command.check_playback_summaries', new_callable=am.CoroutineMock)
+
+
+def test_summary_rebuild(
+        event_loop,
+        check_alembic_in_latest_version_mock,
+        setup_logging_mock,
+        rebuild_playback_summaries_mock,
+        close_engine_mock,
+):
+    close_engine_mock.side_effect = am.CoroutineMock()
+    runner = CliRunner()
+
+    result = runner.invoke(main, ['summary_rebuild', '--batch-size', '10'])
+
+    assert result.exit_code == 0, result.output
+    assert 'Rebuilt 3 playback summaries' in result.output
+    rebuild_playback_summaries_mock.assert_awaited_once_with(batch_size=10)
+    close_engine_mock.assert_called_once_with()
+
+
+@pytest.mark.parametrize('mismatches', ([], [{'playback_id': 1, 'stored': None, 'expected': {'upvotes': 1}}]))
+def test_summary_check(
+        event_loop,
+        check_alembic_in_latest_version_mock,
+        setup_logging_mock,
+        check_playback_summaries_mock,
+        close_engine_mock,
+        mismatches,
+):
+    close_engine_mock.side_effect = am.CoroutineMock()
+    check_playback_summaries_mock.return_value = (5, mismatches)
+    runner = CliRunner()
+
+    result = runner.invoke(main, ['summary_check'])
+
+    assert 'Checked 5 playbacks, {} mismatches'.format(len(mismatches)) in result.output
+    if mismatches:
+        assert result.exit_code == 1
+        assert "Playback 1: stored None, expected {'upvotes': 1}" in result.output
+    else:
+        assert result.exit_code == 0, result.output
+    check_playback_summaries_mock.assert_awaited_once_with(batch_size=1000)
+
+
+@pytest.fixture
+def rebuild_stats_mock(mocker):
+    return mocker.patch('mosbot.command.rebuild_stats', new_callable=am.CoroutineMock, return_value=4)
+
+
+def test_stats_rebuild(
+        event_loop,
+        check_alembic_in_latest_version_mock,
+        setup_logging_mock,
+        rebuild_stats_mock,
+        close_engine_mock,
+):
+    close_engine_mock.side_effect = am.CoroutineMock()
+    runner = CliRunner()
+
+    result = runner.invoke(main, ['stats_rebuild', '--batch-size', '10', '--workers', '2'])
+
+    assert result.exit_code == 0, result.output
+    assert 'Rebuilt stats in 4 batches' in result.output
+    rebuild_stats_mock.assert_awaited_once_with(workers=2, batch_size=10)
+    close_engine_mock.assert_called_once_with()
+
+
+@pytest.fixture
+def refresh_duplicate_tracks_mock(mocker):
+    return mocker.patch('mosbot.command.refresh_duplicate_tracks', new_callable=am.CoroutineMock, return_value=3)
+
+
+def test_tracks_dedupe(
+        event_loop,
+        check_alembic_in_latest_version_mock,
+        setup_logging_mock,
+        refresh_duplicate_tracks_mock,
+        close_engine_mock,
+):
+    close_engine_mock.side_effect = am.CoroutineMock()
+    runner = CliRunner()
+
+    result = runner.invoke(main, ['tracks_dedupe', '--batch-size', '10'])
+
+    assert result.exit_code == 0, result.output
+    assert result.output == 'Found 3 duplicated tracks\n'
+    refresh_duplicate_tracks_mock.assert_awaited_once_with(fetch_size=10)
+    close_engine_mock.assert_called_once_with()
+
+
+@pytest.fixture
+def refresh_activity_rollups_mock(mocker):
+    return mocker.patch('mosbot.command.refresh_activity_rollups', new_callable=am.CoroutineMock, return_value=2)
+
+
+@pytest.fixture
+def rebuild_activity_rollups_mock(mocker):
+    return mocker.patch('mosbot.command.rebuild_activity_rollups', new_callable=am.CoroutineMock)
+
+
+@pytest.mark.parametrize('rebuild_arg,expected_output', (
+        ([], 'Refreshed the activity rollups of 2 days'),
+        (['--rebuild'], 'Rebuilt the activity rollups'),
+))
+def test_activity_refresh(
+        event_loop,
+        check_alembic_in_latest_version_mock,
+        setup_logging_mock,
+        refresh_activity_rollups_mock,
+        rebuild_activity_rollups_mock,
+        close_engine_mock,
+        rebuild_arg,
+        expected_output,
+):
+    close_engine_mock.side_effect = am.CoroutineMock()
+    runner = CliRunner()
+
+    result = runner.invoke(main, ['activity_refresh', *rebuild_arg])
+
+    assert result.exit_code == 0, result.output
+    assert expected_output in result.output
+    if rebuild_arg:
+        rebuild_activity_rollups_mock.assert_awaited_once_with()
+        refresh_activity_rollups_mock.assert_not_awaited()
+    else:
+        refresh_activity_rollups_mock.assert_awaited_once_with()
+        rebuild_activity_rollups_mock.assert_not_awaited()
+    close_engine_mock.assert_called_once_with()
+
+
+@pytest.fixture
+def ensure_user_action_partitions_mock(mocker):
+    return mocker.patch('mosbot.command.ensure_user_action_partitions', new_callable=am.CoroutineMock)
+
+
+@pytest.mark.parametrize('created,expected_output', (
+        ([], 'Created 0 partitions\n'),
+        (['user_action_y2000m01', 'user_action_y2000m02'],
+         'Created 2 partitions: user_action_y2000m01, user_action_y2000m02\n'),
+))
+def test_partitions_ensure(
+        event_loop,
+        check_alembic_in_latest_version_mock,
+        setup_logging_mock,
+        ensure_user_action_partitions_mock,
+        close_engine_mock,
+        created,
+        expected_output,
+):
+    close_engine_mock.side_effect = am.CoroutineMock()
+    ensure_user_action_partitions_mock.return_value = created
+    runner = CliRunner()
+
+    result = runner.invoke(main, ['partitions_ensure', '--months-ahead', '1'])
+
+    assert result.exit_code == 0, result.output
+    assert result.output == expected_output
+    ensure_user_action_partitions_mock.assert_awaited_once_with(months_ahead=1)
+    close_engine_mock.assert_called_once_with()
+
+
+def test_snapshot_export(event_loop, check_alembic_in_latest_version_mock, setup_logging_mock, mocker):
+    export_snapshot_mock = mocker.patch('mosbot.command.export_snapshot', new_callable=am.CoroutineMock)
+    export_snapshot_mock.return_value = {'revision': 'abc', 'tables': {'user': {'rows': 2}, 'track': {'rows': 3}}}
+    runner = CliRunner()
+
+    with runner.isolated_filesystem():
+        result = runner.invoke(main, ['snapshot_export', '--workers', '2', 'snapshot.tar'])
+
+    assert result.exit_code == 0, result.output
+    assert 'Exported 5 rows of 2 tables at revision abc' in result.output
+    export_snapshot_mock.assert_awaited_once_with('snapshot.tar', workers=2)
+
+
+@pytest.mark.parametrize('error', (None, ValueError('Tables user are not empty')))
+def test_snapshot_import(event_loop, check_alembic_in_latest_version_mock, setup_logging_mock, close_engine_mock,
+                         mocker, error):
+    import_snapshot_mock = mocker.patch('mosbot.command.import_snapshot', new_callable=am.CoroutineMock)
+    import_snapshot_mock.return_value = {'user': 2, 'track': 3}
+    import_snapshot_mock.side_effect = error
+    close_engine_mock.side_effect = am.CoroutineMock()
+    runner = CliRunner()
+
+    with runner.isolated_filesystem():
+        open('snapshot.tar', 'w').close()
+        result = runner.invoke(main, ['snapshot_import', '--force', 'snapshot.tar'])
+
+    import_snapshot_mock.assert_awaited_once_with('snapshot.tar', workers=4, force=True)
+    close_engine_mock.assert_called_once_with()
+    if error:
+        assert result.exit_code == 1, result.output
+        assert 'Tables user are not empty' in result.output
+    else:
+        assert result.exit_code == 0, result.output
+        assert 'Imported 5 rows of 2 tables' in result.output
+
+
+@pytest.mark.parametrize('error', (None, RuntimeError('The Parquet export needs pyarrow')))
+def test_analytics_export(event_loop, check_alembic_in_latest_version_mock, setup_logging_mock, close_engine_mock,
+                          mocker, error):
+    export_parquet_mock = mocker.patch('mosbot.command.export_parquet', new_callable=am.CoroutineMock)
+    export_parquet_mock.return_value = {'months': 2, 'playbacks': 10, 'user_actions': 30}
+    export_parquet_mock.side_effect = error
+    close_engine_mock.side_effect = am.CoroutineMock()
+    runner = CliRunner()
+
+    with runner.isolated_filesystem():
+        result = runner.invoke(main, ['analytics_export', '--format', 'parquet', '--batch-size', '100', 'dataset'])
+
+    export_parquet_mock.assert_awaited_once_with('dataset', batch_size=100)
+    close_engine_mock.assert_called_once_with()
+    if error:
+        assert result.exit_code == 1, result.output
+        assert 'The Parquet export needs pyarrow' in result.output
+    else:
+        assert result.exit_code == 0, result.output
+        assert 'Exported 10 playbacks and 30 user actions of 2 months to dataset' in result.output
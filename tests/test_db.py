@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, print_function, unicode_literals
 
+import asyncio
+import decimal
+
 import asynctest as am
+import psycopg2
 import pytest
 
 import mosbot.db as db
@@ -29,8 +33,150 @@ async def test_get_engine(event_loop, engine_empty, create_engine_mock):
 
     assert db.ENGINE[event_loop] == engine
 
-    create_engine_mock.assert_called_once_with(db.config.DATABASE_URL, echo=False)
+    create_engine_mock.assert_called_once_with(db.config.DATABASE_URL, echo=False, **db.pool_settings())
 
     assert engine == await db.get_engine()
 
-    create_engine_mock.assert_called_once_with(db.config.DATABASE_URL, echo=False)
+    create_engine_mock.assert_called_once_with(db.config.DATABASE_URL, echo=False, **db.pool_settings())
+
+
+@pytest.mark.asyncio
+async def test_get_engine_concurrent(event_loop, engine_empty, create_engine_mock):
+    async def create_engine(*args, **kwargs):
+        await asyncio.sleep(0.01)
+        return engine
+
+    engine = object()
+    create_engine_mock.side_effect = create_engine
+
+    engines = await asyncio.gather(*(db.get_engine() for _ in range(5)))
+
+    assert engines == [engine] * 5
+    create_engine_mock.assert_called_once_with(db.config.DATABASE_URL, echo=False, **db.pool_settings())
+
+
+def test_pool_settings(mocker):
+    mocker.patch.multiple(db.config, DATABASE_POOL_MINSIZE=2, DATABASE_POOL_MAXSIZE=20, DATABASE_POOL_TIMEOUT=5,
+                          DATABASE_POOL_RECYCLE=-1)
+
+    assert db.pool_settings() == {'minsize': 2, 'maxsize': 20, 'timeout': 5, 'pool_recycle': -1}
+
+
+@pytest.mark.asyncio
+async def test_warm_up_and_close_engine(event_loop, engine_empty):
+    engine = await db.warm_up_engine()
+
+    assert engine.freesize == engine.minsize
+    assert db.ENGINE[event_loop] is engine
+
+    await db.close_engine()
+
+    assert event_loop not in db.ENGINE
+    assert engine.closed
+    await db.close_engine()  # Nothing to close
+
+
+@pytest.mark.asyncio
+async def test_warm_up_engine_broken_connection(event_loop, engine_empty):
+    with am.patch('aiopg.sa.connection.SAConnection.scalar', side_effect=psycopg2.OperationalError):
+        engine = await db.warm_up_engine()
+
+    assert engine.freesize == 0  # Discarded, it will be replaced when needed
+    async with engine.acquire() as conn:
+        assert await conn.scalar('SELECT 1') == 1
+    await db.close_engine()
+
+
+@pytest.yield_fixture
+def replica_empty():
+    engine, db.REPLICA_ENGINE = db.REPLICA_ENGINE, {}
+    lag, db._REPLICA_LAG = db._REPLICA_LAG, {}
+    failed, db._REPLICA_FAILED = db._REPLICA_FAILED, {}
+    yield
+    db.REPLICA_ENGINE = engine
+    db._REPLICA_LAG = lag
+    db._REPLICA_FAILED = failed
+
+
+@pytest.mark.asyncio
+async def test_get_replica_engine_not_configured(event_loop, replica_empty, mocker):
+    mocker.patch.object(db.config, 'DATABASE_REPLICA_URL', None)
+
+    assert await db.get_replica_engine() is None
+
+
+@pytest.mark.asyncio
+async def test_get_replica_engine(event_loop, engine_empty, replica_empty, mocker):
+    mocker.patch.object(db.config, 'DATABASE_REPLICA_URL', db.config.DATABASE_URL)
+
+    replica = await db.get_replica_engine()
+
+    assert replica is not None
+    assert replica is not await db.get_engine()
+    assert await db.replica_lag(replica) == 0
+    await db.close_engine()
+    assert not db.REPLICA_ENGINE
+
+
+@pytest.mark.parametrize('lag,max_lag,use_replica', (
+        (0, 5, True),
+        (5, 5, True),
+        (6, 5, False),
+        (None, 5, False),
+))
+@pytest.mark.asyncio
+async def test_get_replica_engine_lag(event_loop, replica_empty, mocker, lag, max_lag, use_replica):
+    mocker.patch.multiple(db.config, DATABASE_REPLICA_URL='postgresql://replica', DATABASE_REPLICA_MAX_LAG=max_lag)
+    replica = object()
+    mocker.patch('mosbot.db._get_or_create_engine', new_callable=am.CoroutineMock, return_value=replica)
+    replica_lag_mock = mocker.patch('mosbot.db.replica_lag', new_callable=am.CoroutineMock, return_value=lag)
+
+    engine = await db.get_replica_engine()
+
+    assert engine is (replica if use_replica else None)
+    replica_lag_mock.assert_awaited_once_with(replica)
+
+
+@pytest.mark.asyncio
+async def test_get_replica_engine_unreachable(event_loop, replica_empty, create_engine_mock, mocker):
+    mocker.patch.object(db.config, 'DATABASE_REPLICA_URL', 'postgresql://replica')
+    create_engine_mock.side_effect = psycopg2.OperationalError
+
+    assert await db.get_replica_engine() is None
+
+
+@pytest.mark.asyncio
+async def test_get_replica_engine_retry(event_loop, replica_empty, mocker):
+    mocker.patch.multiple(db.config, DATABASE_REPLICA_URL='postgresql://replica', DATABASE_REPLICA_RETRY_INTERVAL=30)
+    replica = object()
+    get_or_create_engine_mock = mocker.patch('mosbot.db._get_or_create_engine', new_callable=am.CoroutineMock,
+                                             side_effect=[psycopg2.OperationalError(), replica])
+    mocker.patch('mosbot.db.replica_lag', new_callable=am.CoroutineMock, return_value=0)
+    time_mock = mocker.patch.object(event_loop, 'time', return_value=100)
+
+    assert await db.get_replica_engine() is None
+    # The failure is remembered, it doesn't wait for the connection again
+    time_mock.return_value = 129
+    assert await db.get_replica_engine() is None
+    assert get_or_create_engine_mock.await_count == 1
+
+    time_mock.return_value = 130
+    assert await db.get_replica_engine() is replica
+    assert get_or_create_engine_mock.await_count == 2
+    assert not db._REPLICA_FAILED
+
+
+@pytest.mark.asyncio
+async def test_replica_lag_cached(event_loop, replica_empty, mocker):
+    mocker.patch.object(db.config, 'DATABASE_REPLICA_LAG_CHECK_INTERVAL', 60)
+    engine = am.MagicMock()
+    conn = engine.acquire.return_value.__aenter__.return_value
+    conn.scalar = am.CoroutineMock(return_value=decimal.Decimal('1.5'))
+
+    assert await db.replica_lag(engine) == 1.5
+    assert await db.replica_lag(engine) == 1.5
+    conn.scalar.assert_awaited_once_with(db.REPLICA_LAG_QUERY)
+
+    conn.scalar.side_effect = psycopg2.OperationalError
+    db._REPLICA_LAG.clear()
+    assert await db.replica_lag(engine) is None
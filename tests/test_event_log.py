@@ -0,0 +1,113 @@
+import asyncio
+
+import pytest
+from abot.dubtrack import DubtrackDub, DubtrackEvent, DubtrackPlaying, DubtrackSkip
+
+from benchmarks.generator import DubtrackGenerator
+from mosbot.event_log import EventRecorder, ReplayBackend, event_to_record, read_records, record_to_event, \
+    replay_records
+
+
+@pytest.fixture
+def events():
+    return list(DubtrackGenerator(skip_ratio=0.5).live_events(5))
+
+
+@pytest.mark.parametrize('filename', ('events.log', 'events.log.gz'))
+@pytest.mark.asyncio
+async def test_record_and_read(tmpdir, events, filename):
+    path = str(tmpdir.join(filename))
+    recorder = EventRecorder(path)
+    for event in events[:3]:
+        await recorder.record_event(event)
+    recorder.close()
+    # Appending keeps the previous records
+    recorder = EventRecorder(path)
+    for event in events[3:]:
+        await recorder.record_event(event)
+    recorder.close()
+
+    records = list(read_records(path))
+    assert recorder.recorded == len(events) - 3
+    assert [r['type'] for r in records] == [e.__class__.__name__ for e in events]
+
+    backend = ReplayBackend()
+    replayed = [record_to_event(r, backend) for r in records]
+    for original, event in zip(events, replayed):
+        assert event.__class__ == original.__class__
+        assert event._data == original._data
+        assert event.sender.id == original.sender.id
+        assert event.sender.username == original.sender.username
+
+
+@pytest.mark.asyncio
+async def test_record_flush_interval(tmpdir, events):
+    path = tmpdir.join('events.log')
+    now = [0]
+    recorder = EventRecorder(str(path), flush_interval=1, clock=lambda: now[0])
+
+    await recorder.record_event(events[0])
+    assert path.read() == ''
+
+    now[0] = 1
+    await recorder.record_event(events[1])
+    assert len(path.read().splitlines()) == 2
+    await recorder.record_event(events[2])
+    assert len(path.read().splitlines()) == 2
+
+    recorder.close()
+    assert len(path.read().splitlines()) == 3
+
+
+def test_read_records_skips_corrupted(tmpdir, events):
+    path = tmpdir.join('events.log')
+    path.write('{"ts": 1, "type": "DubtrackSkip", "data": {}, "sender": null}\n{"ts": 2, "ty')
+    assert len(list(read_records(str(path)))) == 1
+
+
+@pytest.mark.parametrize('type', ('DubtrackWS', 'NotExisting', 'datetime'))
+def test_record_to_event_invalid_type(type):
+    with pytest.raises(ValueError):
+        record_to_event({'type': type, 'data': {}}, ReplayBackend())
+
+
+@pytest.mark.asyncio
+async def test_replay_records(event_loop, events):
+    records = [event_to_record(event, ts=num * 0.001) for num, event in enumerate(events)]
+    records.insert(1, {'ts': 0, 'type': 'Unknown', 'data': {}})
+    received = []
+
+    async def history(event):
+        received.append(event)
+        await asyncio.sleep(0)
+
+    async def failing(event):
+        raise KeyError()
+
+    report = await replay_records(records, {
+        'history': (history, (DubtrackPlaying, DubtrackSkip, DubtrackDub)),
+        'skips': (failing, (DubtrackSkip,)),
+    }, speed=0)
+
+    skips = [e for e in events if isinstance(e, DubtrackSkip)]
+    assert report['events'] == len(events)
+    assert report['decode_errors'] == {'ValueError': 1}
+    assert report['handlers']['history']['calls'] == len(events)
+    assert report['handlers']['history']['errors'] == {}
+    assert report['handlers']['history']['latency']['count'] == len(events)
+    assert report['handlers']['skips']['calls'] == len(skips)
+    assert report['handlers']['skips']['errors'] == ({'KeyError': len(skips)} if skips else {})
+    assert [e._data for e in received] == [e._data for e in events]
+
+
+@pytest.mark.asyncio
+async def test_replay_records_keeps_time(event_loop, events):
+    records = [event_to_record(event, ts=num * 0.1) for num, event in enumerate(events[:3])]
+
+    async def handler(event):
+        pass
+
+    report = await replay_records(records, {'handler': (handler, (DubtrackEvent,))}, speed=10)
+
+    assert 0.02 <= report['seconds'] < 0.2
+    assert report['speed'] == 10
@@ -1,8 +1,15 @@
+import datetime
+
 import asynctest as am
 import pytest
 from abot.dubtrack import DubtrackPlaying, DubtrackSkip, DubtrackDub, DubtrackUserUpdate
 
-from mosbot.handler import history_handler, availability_handler
+from mosbot import handler
+from mosbot.handler import history_handler, availability_handler, backend_connected, fetch_room_queue, \
+    repeat_handler, room_listeners, set_journal, set_repeat_policy, skip_playing
+from mosbot.usecase import RepeatPolicy
+from mosbot.usecase.repeats import RecentPlays
+from mosbot.usecase.room_queue import QueueItem, RoomQueue
 
 
 @pytest.yield_fixture
@@ -23,6 +30,12 @@ def ensure_dubtrack_skip_mock():
         yield m
 
 
+@pytest.yield_fixture
+def set_playing_track_mock():
+    with am.patch('mosbot.handler.set_playing_track') as m:
+        yield m
+
+
 @pytest.mark.parametrize('event, func', (
         (DubtrackPlaying, 'edp'),
         (DubtrackSkip, 'eds'),
@@ -35,12 +48,18 @@ async def test_history_handler(
         ensure_dubtrack_playing_mock,
         ensure_dubtrack_dub_mock,
         ensure_dubtrack_skip_mock,
+        set_playing_track_mock,
         event,
         func
 ):
     event = event(data=am.MagicMock(), dubtrack_backend=am.MagicMock())
     await history_handler(event=event)
 
+    if func == 'edp':
+        set_playing_track_mock.assert_called_once_with(event.song_type, event.song_external_id, event.song_name)
+    else:
+        set_playing_track_mock.assert_not_called()
+
     if func is None:
         return
 
@@ -52,6 +71,168 @@ async def test_history_handler(
     called_func.assert_awaited_once_with(event=event, conn=db_conn)
 
 
+@pytest.yield_fixture
+def journal():
+    journal = am.MagicMock()
+    journal.append = am.CoroutineMock()
+    set_journal(journal)
+    yield journal
+    set_journal(None)
+
+
+@pytest.mark.asyncio
+async def test_history_handler_journal(
+        journal,
+        ensure_dubtrack_playing_mock,
+        set_playing_track_mock,
+):
+    event = DubtrackPlaying(data={'song': {}}, dubtrack_backend=am.MagicMock())
+
+    await history_handler(event=event)
+
+    assert handler.JOURNAL is journal
+    journal.append.assert_awaited_once()
+    record, = journal.append.await_args[0]
+    assert record['type'] == 'DubtrackPlaying'
+    assert record['data'] == {'song': {}}
+    ensure_dubtrack_playing_mock.assert_not_awaited()
+    # It doesn't wait for the playback to be stored
+    set_playing_track_mock.assert_called_once_with(event.song_type, event.song_external_id, event.song_name)
+
+
 @pytest.mark.asyncio
 async def test_availability_handler():
-    await availability_handler(event=None)
+    queue = RoomQueue()
+    queue.items = [QueueItem('item', 'dj', 'youtube', 'a', 'Song a', 100)]
+
+    with am.patch('mosbot.usecase.room_queue.ROOM_QUEUE', queue):
+        await availability_handler(event=None)
+        await availability_handler(event=DubtrackUserUpdate(data={'user': {'userid': 'dj', 'songsInQueue': 0}},
+                                                            dubtrack_backend=am.MagicMock()))
+
+    assert queue.items == []
+    assert queue.metrics()['events'] == 1
+
+
+@pytest.mark.asyncio
+async def test_availability_handler_blocked():
+    event = playing_event(0)
+
+    with am.patch('mosbot.usecase.room_queue.ROOM_QUEUE', RoomQueue()), \
+            am.patch('mosbot.handler.blocked_countries', return_value={'FR', 'ES'}) as blocked_countries_mock:
+        await availability_handler(event=event)
+
+    blocked_countries_mock.assert_called_once_with('youtube', 'a')
+    event.channel.say.assert_awaited_once_with('Song a is not available in ES, FR')
+
+
+@pytest.mark.asyncio
+async def test_availability_handler_available():
+    event = playing_event(0)
+
+    with am.patch('mosbot.usecase.room_queue.ROOM_QUEUE', RoomQueue()):
+        await availability_handler(event=event)
+
+    event.channel.say.assert_not_awaited()
+
+
+def test_backend_connected():
+    backend = am.MagicMock()
+    backend.dubtrack_channel = None
+    assert not backend_connected(backend)
+
+    backend.dubtrack_channel = am.MagicMock()
+    assert backend_connected(backend)
+
+
+def test_room_listeners():
+    backend = am.MagicMock()
+    backend.dubtrack_users = {'dj1': {}, 'dj2': {}}
+
+    assert room_listeners(backend) == ['dj1', 'dj2']
+
+
+@pytest.mark.asyncio
+async def test_fetch_room_queue():
+    backend = am.MagicMock()
+    backend.dubtrackws.get_room_id = am.CoroutineMock(return_value='room')
+    backend.dubtrackws.api_get = am.CoroutineMock(return_value=[])
+
+    assert await fetch_room_queue(backend) == []
+
+    backend.dubtrackws.api_get.assert_awaited_once_with('https://api.dubtrack.fm/room/room/playlist/details')
+
+
+def playing_event(minute, extid='a'):
+    backend = am.MagicMock()
+    backend.dubtrackws.get_room_id = am.CoroutineMock(return_value='room')
+    backend.dubtrackws.api_post = am.CoroutineMock()
+    event = DubtrackPlaying(data={
+        'song': {'_id': 'queued', 'played': (946684800 + minute * 60) * 1000},
+        'songInfo': {'type': 'youtube', 'fkid': extid, 'name': f'Song {extid}'},
+    }, dubtrack_backend=backend)
+    event.channel = am.MagicMock()
+    event.channel.say = am.CoroutineMock()
+    return event
+
+
+@pytest.yield_fixture
+def repeat_policy():
+    def set_policy(policy):
+        set_repeat_policy(policy)
+        return policy
+
+    with am.patch('mosbot.usecase.repeats.RECENT_PLAYS', RecentPlays(window=3600)):
+        yield set_policy
+    set_repeat_policy(RepeatPolicy.off)
+
+
+@pytest.mark.asyncio
+async def test_repeat_handler_warn(repeat_policy):
+    repeat_policy(RepeatPolicy.warn)
+    first, other, repeated = playing_event(0), playing_event(10, extid='b'), playing_event(45)
+
+    for event in (first, other, repeated):
+        await repeat_handler(event=event)
+
+    first.channel.say.assert_not_awaited()
+    other.channel.say.assert_not_awaited()
+    repeated.channel.say.assert_awaited_once_with('Song a was played 45 minutes ago')
+    repeated.backend.dubtrackws.api_post.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_repeat_handler_skip(repeat_policy):
+    repeat_policy(RepeatPolicy.skip)
+    repeated = playing_event(30)
+
+    await repeat_handler(event=playing_event(0))
+    await repeat_handler(event=repeated)
+    # Out of the window
+    late = playing_event(100)
+    await repeat_handler(event=late)
+
+    repeated.channel.say.assert_awaited_once_with('Song a was played 30 minutes ago, skipping it')
+    repeated.backend.dubtrackws.api_post.assert_awaited_once_with('https://api.dubtrack.fm/chat/skip/room/queued', {})
+    late.channel.say.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_repeat_handler_off(repeat_policy):
+    repeat_policy(RepeatPolicy.off)
+    repeated = playing_event(30)
+
+    await repeat_handler(event=playing_event(0))
+    await repeat_handler(event=repeated)
+
+    repeated.channel.say.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_skip_playing():
+    event = playing_event(0)
+
+    await skip_playing(event)
+
+    assert event.played == datetime.datetime(2000, 1, 1)
+    event.backend.dubtrackws.api_post.assert_awaited_once_with('https://api.dubtrack.fm/chat/skip/room/queued', {})
@@ -0,0 +1,126 @@
+import asyncio
+import os
+
+import pytest
+
+from mosbot.journal import ID_FILE_NAME, LEGACY_ID, Journal
+
+
+@pytest.fixture
+def journal_dir(tmpdir):
+    return str(tmpdir.join('journal'))
+
+
+@pytest.mark.asyncio
+async def test_append_and_read(event_loop, journal_dir):
+    journal = Journal(journal_dir, fsync_delay=0).open()
+
+    seqs = await asyncio.gather(*(journal.append({'n': n}) for n in range(5)))
+
+    assert sorted(seqs) == [1, 2, 3, 4, 5]
+    assert journal.durable_seq == 5
+    records = await journal.read(0, limit=3)
+    assert [r['n'] for r in records] == [0, 1, 2]
+    assert [r['seq'] for r in records] == [1, 2, 3]
+    records = await journal.read(3)
+    assert [r['seq'] for r in records] == [4, 5]
+    assert journal.read_durable(5) == []
+
+
+@pytest.mark.asyncio
+async def test_append_shares_fsync(event_loop, journal_dir, mocker):
+    journal = Journal(journal_dir, fsync_delay=0.01).open()
+    fsync = mocker.patch('mosbot.journal.os.fsync')
+
+    await asyncio.gather(*(journal.append({'n': n}) for n in range(50)))
+
+    assert fsync.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_read_waits_for_records(event_loop, journal_dir):
+    journal = Journal(journal_dir, fsync_delay=0).open()
+    reading = asyncio.ensure_future(journal.read(0))
+    await asyncio.sleep(0.01)
+    assert not reading.done()
+
+    await journal.append({'n': 1})
+
+    assert [r['n'] for r in await reading] == [1]
+
+
+@pytest.mark.asyncio
+async def test_segments_rotation_and_release(event_loop, journal_dir):
+    journal = Journal(journal_dir, fsync_delay=0, segment_size=1).open()
+    for n in range(4):
+        await journal.append({'n': n})
+
+    assert [first for first, _ in journal.segments()] == [1, 2, 3, 4, 5]
+    assert [r['n'] for r in journal.read_durable(0)] == [0, 1, 2, 3]
+
+    journal.release(2)
+    assert [first for first, _ in journal.segments()] == [3, 4, 5]
+    assert [r['n'] for r in journal.read_durable(2)] == [2, 3]
+
+    journal.release(4)
+    assert [first for first, _ in journal.segments()] == [5]
+    assert journal.read_durable(4) == []
+
+
+@pytest.mark.asyncio
+async def test_reopen_recovers(event_loop, journal_dir):
+    journal = Journal(journal_dir, fsync_delay=0).open()
+    for n in range(3):
+        await journal.append({'n': n})
+    journal.close()
+    _, path = journal.segments()[-1]
+    with open(path, 'a') as fd:
+        fd.write('{"n": 3, "se')  # Crashed while writing
+
+    journal = Journal(journal_dir, fsync_delay=0).open()
+    assert journal.durable_seq == 3
+    assert await journal.append({'n': 4}) == 4
+    assert [r['n'] for r in journal.read_durable(0)] == [0, 1, 2, 4]
+
+
+@pytest.mark.asyncio
+async def test_reopen_truncates_line_without_newline(event_loop, journal_dir):
+    journal = Journal(journal_dir, fsync_delay=0).open()
+    await journal.append({'n': 0})
+    journal.close()
+    _, path = journal.segments()[-1]
+    with open(path, 'a') as fd:
+        fd.write('{"n":1,"seq":2}')  # Crashed before writing the newline
+
+    journal = Journal(journal_dir, fsync_delay=0).open()
+    assert journal.durable_seq == 1
+    assert await journal.append({'n': 2}) == 2
+    assert [r['n'] for r in journal.read_durable(0)] == [0, 2]
+
+
+@pytest.mark.asyncio
+async def test_open_min_seq(event_loop, journal_dir):
+    journal = Journal(journal_dir, fsync_delay=0).open()
+    await journal.append({'n': 0})
+    journal.close()
+
+    journal = Journal(journal_dir, fsync_delay=0).open(min_seq=10)
+    assert await journal.append({'n': 1}) == 10
+    assert [r['seq'] for r in journal.read_durable(0)] == [1, 10]
+    assert len(journal.segments()) == 2
+
+
+@pytest.mark.asyncio
+async def test_open_id(event_loop, journal_dir):
+    journal = Journal(journal_dir, fsync_delay=0).open()
+    await journal.append({'n': 0})
+    journal.close()
+    journal_id = journal.id
+
+    assert Journal(journal_dir, fsync_delay=0).open().id == journal_id
+    assert Journal(f'{journal_dir}-new', fsync_delay=0).open().id not in (journal_id, LEGACY_ID)
+
+    # Segments from before the journals had an id
+    os.remove(os.path.join(journal_dir, ID_FILE_NAME))
+    assert Journal(journal_dir, fsync_delay=0).open().id == LEGACY_ID
+    assert Journal(journal_dir, fsync_delay=0).open().id == LEGACY_ID
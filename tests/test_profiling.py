@@ -0,0 +1,109 @@
+import asyncio
+import os
+import threading
+
+import pytest
+
+from mosbot import profiling
+
+
+@pytest.yield_fixture
+def profile_dir(tmpdir):
+    old_dir = profiling.PROFILE_DIR
+    profiling.set_profile_dir(str(tmpdir.join('profiles')))
+    yield profiling.PROFILE_DIR
+    profiling.PROFILE_DIR = old_dir
+
+
+@pytest.yield_fixture
+def no_profile_dir():
+    old_dir = profiling.PROFILE_DIR
+    profiling.set_profile_dir(None)
+    yield
+    profiling.PROFILE_DIR = old_dir
+
+
+def test_set_profile_dir(profile_dir):
+    assert os.path.isdir(profile_dir)
+
+
+def test_collapse_frame():
+    def inner():
+        return profiling.collapse_frame(__import__('sys')._getframe())
+
+    stack = inner()
+    assert stack[-1].startswith('inner (test_profiling.py:')
+    assert stack[-2].startswith('test_collapse_frame (test_profiling.py:')
+
+
+@pytest.mark.asyncio
+async def test_sampling_profiler_attributes_suspended_tasks(event_loop, tmpdir):
+    async def waiting_coroutine():
+        await asyncio.sleep(10)
+
+    task = asyncio.ensure_future(waiting_coroutine())
+    await asyncio.sleep(0)
+    profiler = profiling.SamplingProfiler(thread_id=threading.get_ident(), loop=event_loop)
+    profiler.sample()
+    profiler.sample()
+    task.cancel()
+
+    assert profiler.samples == 2
+    awaiting = {s: c for s, c in profiler.awaiting_stacks.items() if s.startswith('waiting_coroutine')}
+    assert list(awaiting.values()) == [2]
+    # The task running, this test, is only in the thread stacks
+    assert not any('test_sampling_profiler' in stack for stack in profiler.awaiting_stacks)
+    assert sum(profiler.stacks.values()) == 2
+    assert not any('waiting_coroutine' in stack for stack in profiler.stacks)
+
+    for awaiting, stacks in ((False, profiler.stacks), (True, profiler.awaiting_stacks)):
+        path = str(tmpdir.join(f'{awaiting}.collapsed'))
+        profiler.write_collapsed(path, awaiting=awaiting)
+        with open(path) as fd:
+            lines = fd.read().splitlines()
+        assert len(lines) == len(stacks)
+        assert all(line.rsplit(' ', 1)[1].isdigit() for line in lines)
+
+
+@pytest.mark.asyncio
+async def test_profile_cpu(event_loop, profile_dir):
+    async def waiting_coroutine():
+        await asyncio.sleep(10)
+
+    task = asyncio.ensure_future(waiting_coroutine())
+    path = await profiling.profile_cpu(0.05, interval=0.001)
+    task.cancel()
+
+    assert os.path.dirname(path) == profile_dir
+    assert os.path.basename(path).startswith('cpu-')
+    with open(path) as fd:
+        cpu_stacks = fd.read()
+    assert cpu_stacks
+    assert 'waiting_coroutine' not in cpu_stacks
+    with open(os.path.join(profile_dir, os.path.basename(path).replace('cpu-', 'wall-', 1))) as fd:
+        assert 'waiting_coroutine' in fd.read()
+
+
+@pytest.mark.asyncio
+async def test_profile_memory(event_loop, profile_dir):
+    path = await profiling.profile_memory(0.01)
+
+    assert os.path.exists(path)
+    assert os.path.exists(path + '.txt')
+
+
+@pytest.mark.asyncio
+async def test_profile_disabled(event_loop, no_profile_dir):
+    with pytest.raises(ValueError):
+        await profiling.profile_cpu(1)
+    with pytest.raises(ValueError):
+        await profiling.profile_memory(1)
+
+
+@pytest.mark.asyncio
+async def test_profile_already_running(event_loop, profile_dir):
+    running = asyncio.ensure_future(profiling.profile_cpu(0.05))
+    await asyncio.sleep(0)
+    with pytest.raises(RuntimeError):
+        await profiling.profile_memory(1)
+    await running
@@ -1,17 +1,35 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, print_function, unicode_literals
 
+import asyncio
 import asynctest as am
+import io
 import datetime
 import pytest
+import sqlalchemy as sa
 from sqlalchemy.dialects import postgresql as psa
 from unittest import mock
 
-from mosbot.db import Origin, User, Action
+from mosbot.db import Origin, User, Action, PlaybackSummary, TrackStats, UserAction, UserStats, get_engine, \
+    create_blocking_engine, Playback, Track, ActivityDirty, ActivityHourly, TrackCanonical
 from mosbot.query import get_user, save_user, save_track, execute_and_first, get_track, get_playback, save_playback, \
     get_user_action, save_user_action, save_bot_data, load_bot_data, get_last_playback, get_user_user_actions, \
     get_user_dub_user_actions, get_dub_action, get_opposite_dub_action, query_simplified_user_actions, \
-    get_or_save_track, get_or_save_user, get_or_save_playback, ensure_connection
+    get_or_save_track, get_or_save_user, get_or_save_playback, ensure_connection, single_flight_metrics, \
+    ensure_read_connection, iter_query, iter_user_user_actions, iter_user_dub_user_actions, \
+    iter_simplified_user_actions, get_playback_timeline_page, iter_playback_timeline, refresh_playback_summaries, \
+    refresh_playback_summary, get_playback_summary, get_playback_summary_mismatches, get_playback_id_range, \
+    get_user_stats, get_track_stats, add_user_stats, get_user_last_dub, rebuild_user_stats, rebuild_track_stats, \
+    listened_seconds, truncate_hour, mark_activity_dirty, pop_activity_dirty_hours, get_activity_hours_after, \
+    get_last_activity_ids, refresh_activity, get_activity, add_months, user_action_partition_name, \
+    get_user_action_partitions, create_user_action_partition, _simplified_user_actions_query, bulk_save_history, \
+    StatsDeltas, store_stats_deltas, copy_table_in, copy_table_out, get_tables_with_rows, truncate_tables, \
+    reset_sequences, \
+    iter_simplified_user_actions_between, get_playback_start_range, iter_query_chunks, iter_playbacks_after, \
+    has_trigram_search, search_tracks, search_users, _search_query, iter_tracks_after, save_canonical_tracks, \
+    get_canonical_track_id, get_song_stats, iter_track_plays_since, get_user_countries, has_user_countries, \
+    get_recent_playbacks, get_dj_ranking, get_track_ranking, ACTION_CLOCK_SKEW
+from mosbot.util import aclosing
 
 
 @pytest.yield_fixture
@@ -82,6 +100,47 @@ async def test_ensure_connection(
         connection_object.close.assert_not_awaited()
 
 
+@pytest.yield_fixture
+def get_replica_engine_mock():
+    with am.patch('mosbot.query.db.get_replica_engine') as m:
+        m.return_value = am.CoroutineMock()
+        m.return_value.acquire = am.CoroutineMock()
+        m.return_value.acquire.return_value.close = am.CoroutineMock()
+        yield m
+
+
+@pytest.mark.parametrize('replica', (True, False))
+@pytest.mark.parametrize('connection', (True, False))
+@pytest.mark.asyncio
+async def test_ensure_read_connection(
+        get_engine_mock,
+        get_replica_engine_mock,
+        connection,
+        replica,
+):
+    if not replica:
+        get_replica_engine_mock.return_value = None
+    replica_engine = get_replica_engine_mock.return_value
+    primary_connection = get_engine_mock.return_value.acquire.return_value
+
+    async with ensure_read_connection(conn=connection) as conn:
+        if connection:
+            assert conn is True
+        elif replica:
+            assert conn == replica_engine.acquire.return_value
+        else:
+            assert conn == primary_connection
+
+    if connection:
+        get_replica_engine_mock.assert_not_awaited()
+        get_engine_mock.assert_not_awaited()
+    elif replica:
+        replica_engine.acquire.return_value.close.assert_awaited_once_with()
+        get_engine_mock.assert_not_awaited()
+    else:
+        primary_connection.close.assert_awaited_once_with()
+
+
 @pytest.mark.parametrize('data_dict,expected_result', (
         (
                 {'id': 1, 'dtid': '1234', 'username': 'username', 'country': 'ES'},
@@ -202,6 +261,53 @@ async def test_get_or_save_user(
         save_user_mock.assert_awaited_once_with(user_dict=user_dict, conn=conn)
 
 
+@pytest.mark.parametrize('in_transaction', (True, False))
+@pytest.mark.asyncio
+async def test_get_or_save_coalesced(get_user_mock, save_user_mock, in_transaction):
+    async def slow_get_user(**kwargs):
+        await asyncio.sleep(0.01)
+        return {}
+
+    get_user_mock.side_effect = slow_get_user
+    save_user_mock.return_value = {'id': 1}
+    conn = mock.Mock(in_transaction=in_transaction)
+    user_dict = {'dtid': 'dtid', 'username': 'username'}
+    coalesced = single_flight_metrics()['user']['coalesced']
+
+    results = await asyncio.gather(*(get_or_save_user(user_dict=user_dict, conn=conn) for _ in range(3)))
+
+    assert results == [{'id': 1}] * 3
+    if in_transaction:
+        assert get_user_mock.await_count == 3
+        assert single_flight_metrics()['user']['coalesced'] == coalesced
+    else:
+        get_user_mock.assert_awaited_once_with(user_dict=user_dict, conn=conn)
+        save_user_mock.assert_awaited_once_with(user_dict=user_dict, conn=conn)
+        assert single_flight_metrics()['user']['coalesced'] == coalesced + 2
+
+
+@pytest.mark.asyncio
+async def test_get_or_save_in_transaction_not_joining(get_user_mock, save_user_mock):
+    async def slow_get_user(**kwargs):
+        await asyncio.sleep(0.01)
+        return {}
+
+    get_user_mock.side_effect = slow_get_user
+    save_user_mock.return_value = {'id': 1}
+    autocommit_conn = mock.Mock(in_transaction=False)
+    transaction_conn = mock.Mock(in_transaction=True)
+    user_dict = {'dtid': 'dtid', 'username': 'username'}
+
+    await asyncio.gather(
+        get_or_save_user(user_dict=user_dict, conn=autocommit_conn),
+        get_or_save_user(user_dict=user_dict, conn=transaction_conn),
+    )
+
+    # The call in the transaction doesn't wait for the one in flight, it may hold a lock that one is waiting for
+    assert get_user_mock.await_count == 2
+    get_user_mock.assert_any_await(user_dict=user_dict, conn=transaction_conn)
+
+
 @pytest.mark.parametrize('track_dict, raises_exception', (
         ({'id': 1}, False),
         ({'extid': 'Extid 1'}, False),
@@ -578,3 +684,976 @@ async def test_query_simplified_user_actions(
     user_actions = await query_simplified_user_actions(playback_id=playback['id'], conn=db_conn)
     result = {ua['action'] for ua in user_actions}
     assert result == output
+
+
+@pytest.mark.parametrize('fetch_size', (1, 5, 1000))
+@pytest.mark.asyncio
+async def test_iter_user_user_actions(
+        db_conn,
+        track_generator,
+        user_generator,
+        playback_generator,
+        user_action_generator,
+        fetch_size,
+):
+    track = await track_generator()
+    user = await user_generator()
+    for _ in range(3):
+        playback = await playback_generator(user=user, track=track)
+        for _ in range(4):
+            await user_action_generator(user=user, playback=playback)
+    expected = sorted(await get_user_user_actions(user_id=user['id'], conn=db_conn), key=lambda ua: ua['id'])
+    expected_dubs = sorted(await get_user_dub_user_actions(user_id=user['id'], conn=db_conn), key=lambda ua: ua['id'])
+
+    user_actions = [ua async for ua in iter_user_user_actions(user['id'], fetch_size=fetch_size, conn=db_conn)]
+    assert user_actions == expected
+
+    dub_actions = [ua async for ua in iter_user_dub_user_actions(user['id'], fetch_size=fetch_size, conn=db_conn)]
+    assert dub_actions == expected_dubs
+
+    after_id = expected[4]['id']
+    resumed = [ua async for ua in iter_user_user_actions(user['id'], after_id=after_id, fetch_size=fetch_size,
+                                                         conn=db_conn)]
+    assert resumed == expected[5:]
+
+
+@pytest.mark.asyncio
+async def test_iter_simplified_user_actions(
+        db_conn,
+        track_generator,
+        user_generator,
+        playback_generator,
+        user_action_generator,
+):
+    track = await track_generator()
+    playback = await playback_generator(user=await user_generator(), track=track)
+    for action in ('upvote', 'downvote', 'upvote'):
+        for _ in range(3):
+            await user_action_generator(user=await user_generator(), playback=playback, action=action)
+    expected = sorted(await query_simplified_user_actions(playback['id'], conn=db_conn), key=lambda ua: ua['id'])
+
+    user_actions = [ua async for ua in iter_simplified_user_actions(playback['id'], fetch_size=2, conn=db_conn)]
+
+    assert user_actions == expected
+    assert all(isinstance(ua['action'], Action) for ua in user_actions)
+
+
+@pytest.mark.parametrize('fetch_size', (1, 1000))
+@pytest.mark.asyncio
+async def test_iter_simplified_user_actions_between(
+        db_conn,
+        track_generator,
+        user_generator,
+        playback_generator,
+        user_action_generator,
+        fetch_size,
+):
+    track = await track_generator()
+    user, voter = await user_generator(), await user_generator()
+    starts = [datetime.datetime(2000, 1, 31, 23, 59), datetime.datetime(2000, 2, 1), datetime.datetime(2000, 2, 29),
+              datetime.datetime(2000, 3, 1)]
+    playbacks = [await playback_generator(user=user, track=track, start=start) for start in starts]
+    for playback in playbacks:
+        await user_action_generator(user=voter, playback=playback, action='upvote')
+        await user_action_generator(user=voter, playback=playback, action='downvote')
+    expected = []
+    for playback in playbacks[1:3]:
+        expected.extend(sorted(await query_simplified_user_actions(playback['id'], conn=db_conn),
+                               key=lambda ua: ua['id']))
+
+    since, until = datetime.datetime(2000, 2, 1), datetime.datetime(2000, 3, 1)
+    user_actions = [
+        ua async for ua in iter_simplified_user_actions_between(since, until, fetch_size=fetch_size, conn=db_conn)
+    ]
+
+    assert len(expected) == 2
+    assert user_actions == expected
+    assert all(ua['action'] == Action.downvote for ua in user_actions)
+
+
+@pytest.mark.asyncio
+async def test_get_playback_start_range(db_conn, track_generator, user_generator, playback_generator):
+    assert await get_playback_start_range(conn=db_conn) == (None, None)
+
+    track = await track_generator()
+    user = await user_generator()
+    playbacks = [await playback_generator(user=user, track=track) for _ in range(3)]
+
+    assert await get_playback_start_range(conn=db_conn) == (playbacks[0]['start'], playbacks[-1]['start'])
+
+
+@pytest.mark.parametrize('stop_at', (None, 4))
+@pytest.mark.asyncio
+async def test_iter_query_own_transaction(db_conn, stop_at):
+    query = sa.select([sa.func.generate_series(1, 10).label('n')])
+    async with (await get_engine()).acquire() as conn:
+        rows = []
+        iterator = iter_query(query, fetch_size=3, conn=conn)
+        async for row in iterator:
+            rows.append(row['n'])
+            if len(rows) == stop_at:
+                await iterator.aclose()
+                break
+
+        assert rows == list(range(1, (stop_at or 10) + 1))
+        assert not conn.in_transaction
+
+
+@pytest.mark.asyncio
+async def test_iter_query_aclosing(db_conn):
+    query = sa.select([sa.func.generate_series(1, 10).label('n')])
+    async with (await get_engine()).acquire() as conn:
+        with pytest.raises(ValueError):
+            async with aclosing(iter_query(query, fetch_size=3, conn=conn)) as rows:
+                async for row in rows:
+                    if row['n'] == 2:
+                        raise ValueError()
+
+        # Released right away, not when the iterator is garbage collected
+        assert not conn.in_transaction
+
+
+@pytest.mark.asyncio
+async def test_iter_query_chunks(db_conn):
+    query = sa.select([sa.func.generate_series(1, 7).label('n'), sa.literal('a').label('letter')])
+
+    chunks = [chunk async for chunk in iter_query_chunks(query, fetch_size=3, conn=db_conn)]
+
+    assert chunks == [[(1, 'a'), (2, 'a'), (3, 'a')], [(4, 'a'), (5, 'a'), (6, 'a')], [(7, 'a')]]
+
+
+@pytest.mark.parametrize('page_size', (1, 2, 500))
+@pytest.mark.asyncio
+async def test_iter_playback_timeline(
+        db_conn,
+        track_generator,
+        user_generator,
+        playback_generator,
+        user_action_generator,
+        page_size,
+):
+    track = await track_generator()
+    dj = await user_generator()
+    voters = [await user_generator() for _ in range(3)]
+    playbacks = [await playback_generator(user=dj, track=track) for _ in range(5)]
+    # Second playback: a user changes its vote, another upvotes, two anonymous downvotes from history and a skip
+    await user_action_generator(user=voters[0], playback=playbacks[1], action='upvote')
+    await user_action_generator(user=voters[0], playback=playbacks[1], action='downvote')
+    await user_action_generator(user=voters[1], playback=playbacks[1], action='upvote')
+    await user_action_generator(user={'id': None}, playback=playbacks[1], action='downvote')
+    await user_action_generator(user={'id': None}, playback=playbacks[1], action='downvote')
+    await user_action_generator(user=voters[2], playback=playbacks[1], action='skip')
+    # Third playback: just an upvote
+    await user_action_generator(user=voters[2], playback=playbacks[2], action='upvote')
+    await refresh_playback_summaries(playbacks[0]['id'], playbacks[-1]['id'] + 1, conn=db_conn)
+
+    since, until = playbacks[1]['start'], playbacks[4]['start']
+    timeline = [playback async for playback in iter_playback_timeline(since, until, page_size=page_size,
+                                                                      conn=db_conn)]
+
+    assert [playback['id'] for playback in timeline] == [playback['id'] for playback in playbacks[1:4]]
+    assert timeline[0] == {
+        'id': playbacks[1]['id'],
+        'start': playbacks[1]['start'],
+        'track_id': track['id'],
+        'track_name': track['name'],
+        'origin': track['origin'],
+        'extid': track['extid'],
+        'length': track['length'],
+        'user_id': dj['id'],
+        'username': dj['username'],
+        'upvotes': 1,
+        'downvotes': 3,
+        'skipped': True,
+    }
+    assert (timeline[1]['upvotes'], timeline[1]['downvotes'], timeline[1]['skipped']) == (1, 0, False)
+    assert (timeline[2]['upvotes'], timeline[2]['downvotes'], timeline[2]['skipped']) == (0, 0, False)
+
+    resumed = [playback async for playback in iter_playback_timeline(since, until, after=timeline[0]['start'],
+                                                                     page_size=page_size, conn=db_conn)]
+    assert resumed == timeline[1:]
+
+
+@pytest.mark.asyncio
+async def test_get_playback_timeline_page_open_range(db_conn, track_generator, user_generator, playback_generator):
+    track = await track_generator()
+    user = await user_generator()
+    playbacks = [await playback_generator(user=user, track=track) for _ in range(3)]
+
+    page = await get_playback_timeline_page(None, None, limit=2, conn=db_conn)
+    assert [playback['id'] for playback in page] == [playback['id'] for playback in playbacks[:2]]
+
+    page = await get_playback_timeline_page(None, None, after=page[-1]['start'], limit=2, conn=db_conn)
+    assert [playback['id'] for playback in page] == [playbacks[2]['id']]
+
+
+@pytest.mark.asyncio
+async def test_get_recent_playbacks(db_conn, track_generator, user_generator, playback_generator):
+    track = await track_generator()
+    user = await user_generator()
+    playbacks = [await playback_generator(user=user, track=track) for _ in range(3)]
+
+    recent = await get_recent_playbacks(2, conn=db_conn)
+
+    assert [playback['id'] for playback in recent] == [playback['id'] for playback in playbacks[1:]]
+    assert recent[0]['track_name'] == track['name']
+    assert recent[0]['username'] == user['username']
+    assert (recent[0]['upvotes'], recent[0]['downvotes'], recent[0]['skipped']) == (0, 0, False)
+
+
+@pytest.mark.asyncio
+async def test_refresh_playback_summary(
+        db_conn,
+        track_generator,
+        user_generator,
+        playback_generator,
+        user_action_generator,
+):
+    track = await track_generator()
+    voters = [await user_generator() for _ in range(3)]
+    playback = await playback_generator(user=voters[0], track=track)
+    empty_playback = await playback_generator(user=voters[0], track=track)
+    assert await get_playback_summary(playback['id'], conn=db_conn) == {}
+
+    await user_action_generator(user=voters[0], playback=playback, action='upvote')
+    await user_action_generator(user=voters[0], playback=playback, action='downvote')
+    await user_action_generator(user=voters[1], playback=playback, action='upvote')
+    await user_action_generator(user={'id': None}, playback=playback, action='upvote')
+    skip = await user_action_generator(user=voters[2], playback=playback, action='skip')
+    await user_action_generator(user=voters[1], playback=playback, action='skip')
+
+    expected = {
+        'playback_id': playback['id'],
+        'upvotes': 2,
+        'downvotes': 1,
+        'voters': 3,
+        'skipped': True,
+        'skip_ts': skip['ts'],
+    }
+    assert await refresh_playback_summary(playback['id'], conn=db_conn) == expected
+    assert await get_playback_summary(playback['id'], conn=db_conn) == expected
+
+    assert await refresh_playback_summary(empty_playback['id'], conn=db_conn) == {
+        'playback_id': empty_playback['id'],
+        'upvotes': 0,
+        'downvotes': 0,
+        'voters': 0,
+        'skipped': False,
+        'skip_ts': None,
+    }
+    assert await refresh_playback_summary(empty_playback['id'] + 1, conn=db_conn) == {}
+    assert await get_playback_id_range(conn=db_conn) == (playback['id'], empty_playback['id'])
+
+
+@pytest.mark.asyncio
+async def test_get_playback_summary_mismatches(
+        db_conn,
+        track_generator,
+        user_generator,
+        playback_generator,
+        user_action_generator,
+):
+    track = await track_generator()
+    user = await user_generator()
+    playbacks = [await playback_generator(user=user, track=track) for _ in range(3)]
+    await refresh_playback_summaries(playbacks[0]['id'], playbacks[-1]['id'] + 1, conn=db_conn)
+    assert await get_playback_summary_mismatches(playbacks[0]['id'], playbacks[-1]['id'] + 1, conn=db_conn) == []
+
+    # An action saved without refreshing, and a summary missing
+    await user_action_generator(user=user, playback=playbacks[0], action='upvote')
+    await db_conn.execute(PlaybackSummary.delete().where(PlaybackSummary.c.playback_id == playbacks[2]['id']))
+
+    mismatches = await get_playback_summary_mismatches(playbacks[0]['id'], playbacks[-1]['id'] + 1, conn=db_conn)
+
+    empty = {'upvotes': 0, 'downvotes': 0, 'voters': 0, 'skipped': False, 'skip_ts': None}
+    assert mismatches == [
+        {'playback_id': playbacks[0]['id'], 'expected': dict(empty, upvotes=1, voters=1), 'stored': empty},
+        {'playback_id': playbacks[2]['id'], 'expected': empty, 'stored': None},
+    ]
+
+
+@pytest.mark.parametrize('summary, expected', (
+    (None, 0),
+    ({'skipped': False, 'skip_ts': None}, 120),
+    ({'skipped': True, 'skip_ts': datetime.datetime(2000, 1, 1, 0, 0, 30, 500000)}, 30),
+    ({'skipped': True, 'skip_ts': datetime.datetime(1999, 12, 31)}, 0),
+    ({'skipped': True, 'skip_ts': datetime.datetime(2000, 1, 2)}, 120),
+))
+def test_listened_seconds(summary, expected):
+    assert listened_seconds({'start': datetime.datetime(2000, 1, 1), 'length': 120}, summary) == expected
+
+
+@pytest.mark.asyncio
+async def test_refresh_playback_summaries_updates_stats(
+        db_conn,
+        track_generator,
+        user_generator,
+        playback_generator,
+        user_action_generator,
+):
+    track = await track_generator(length=120)
+    dj, voter = await user_generator(), await user_generator()
+    playbacks = [await playback_generator(user=dj, track=track) for _ in range(2)]
+    assert await get_user_stats(dj['id'], conn=db_conn) == {}
+
+    await refresh_playback_summaries(playbacks[0]['id'], playbacks[-1]['id'] + 1, conn=db_conn)
+    expected = {
+        'plays': 2,
+        'listened_seconds': 240,
+        'updubs': 0,
+        'downdubs': 0,
+        'skips': 0,
+        'last_played': playbacks[1]['start'],
+    }
+    assert await get_track_stats(track['id'], conn=db_conn) == dict(expected, track_id=track['id'])
+    assert await get_user_stats(dj['id'], conn=db_conn) == dict(
+        expected, user_id=dj['id'], updubs_given=0, downdubs_given=0,
+    )
+
+    # Votes and skips only change the counters, refreshing twice doesn't count twice
+    await user_action_generator(user=voter, playback=playbacks[0], action='downvote')
+    await user_action_generator(user=voter, playback=playbacks[0], action='upvote')
+    await user_action_generator(user=voter, playback=playbacks[1], action='skip',
+                                ts=playbacks[1]['start'] + datetime.timedelta(seconds=30))
+    await add_user_stats(voter['id'], updubs_given=1, conn=db_conn)
+    for _ in range(2):
+        await refresh_playback_summary(playbacks[0]['id'], conn=db_conn)
+        await refresh_playback_summary(playbacks[1]['id'], conn=db_conn)
+    expected.update(listened_seconds=150, updubs=1, skips=1)
+    user_stats = await get_user_stats(dj['id'], conn=db_conn)
+    track_stats = await get_track_stats(track['id'], conn=db_conn)
+    voter_stats = await get_user_stats(voter['id'], conn=db_conn)
+    assert track_stats == dict(expected, track_id=track['id'])
+    assert user_stats == dict(expected, user_id=dj['id'], updubs_given=0, downdubs_given=0)
+    assert voter_stats['updubs_given'] == 1
+
+    # Rebuilding from scratch gives the same
+    await db_conn.execute(UserStats.delete())
+    await db_conn.execute(TrackStats.delete())
+    await rebuild_user_stats(dj['id'], voter['id'] + 1, conn=db_conn)
+    await rebuild_track_stats(track['id'], track['id'] + 1, conn=db_conn)
+    assert await get_user_stats(dj['id'], conn=db_conn) == user_stats
+    assert await get_track_stats(track['id'], conn=db_conn) == track_stats
+    assert await get_user_stats(voter['id'], conn=db_conn) == dict(
+        voter_stats, plays=0, listened_seconds=0, skips=0, updubs=0, downdubs=0, last_played=None,
+    )
+
+
+@pytest.mark.asyncio
+async def test_refresh_playback_summaries_deferred_stats(
+        db_conn,
+        track_generator,
+        user_generator,
+        playback_generator,
+):
+    track = await track_generator(length=120)
+    dj, voter = await user_generator(), await user_generator()
+    playbacks = [await playback_generator(user=dj, track=track) for _ in range(2)]
+    stats = StatsDeltas()
+
+    for playback in playbacks:
+        await refresh_playback_summary(playback['id'], stats=stats, conn=db_conn)
+    stats.add_user(voter['id'], downdubs_given=1)
+
+    # Nothing is stored until asked to
+    assert await get_track_stats(track['id'], conn=db_conn) == {}
+    assert +stats.tracks[track['id']] == {'plays': 2, 'listened_seconds': 240}
+    assert stats.user_last_played == {dj['id']: playbacks[1]['start']}
+
+    await store_stats_deltas(stats, conn=db_conn)
+    assert (await get_track_stats(track['id'], conn=db_conn))['plays'] == 2
+    assert (await get_user_stats(dj['id'], conn=db_conn))['last_played'] == playbacks[1]['start']
+    assert (await get_user_stats(voter['id'], conn=db_conn))['downdubs_given'] == 1
+
+
+@pytest.mark.asyncio
+async def test_get_user_last_dub(
+        db_conn,
+        track_generator,
+        user_generator,
+        playback_generator,
+        user_action_generator,
+):
+    track = await track_generator()
+    user = await user_generator()
+    playback = await playback_generator(user=user, track=track)
+    assert await get_user_last_dub(playback['id'], user['id'], conn=db_conn) is None
+
+    await user_action_generator(user=user, playback=playback, action='upvote')
+    await user_action_generator(user=user, playback=playback, action='downvote')
+    await user_action_generator(user=user, playback=playback, action='skip')
+    assert await get_user_last_dub(playback['id'], user['id'], conn=db_conn) == Action.downvote
+
+
+@pytest.mark.asyncio
+async def test_mark_and_pop_activity_dirty_hours(db_conn):
+    await mark_activity_dirty([], conn=db_conn)
+    assert await pop_activity_dirty_hours(conn=db_conn) == set()
+
+    await mark_activity_dirty([
+        datetime.datetime(2000, 1, 1, 10, 59, 59),
+        datetime.datetime(2000, 1, 1, 10, 0),
+        datetime.datetime(2000, 1, 1, 11, 1),
+    ], conn=db_conn)
+    await mark_activity_dirty([datetime.datetime(2000, 1, 1, 11, 30)], conn=db_conn)
+
+    assert await pop_activity_dirty_hours(conn=db_conn) == {
+        datetime.datetime(2000, 1, 1, 10),
+        datetime.datetime(2000, 1, 1, 11),
+    }
+    assert await pop_activity_dirty_hours(conn=db_conn) == set()
+    assert truncate_hour(datetime.datetime(2000, 1, 1, 10, 59, 59, 999)) == datetime.datetime(2000, 1, 1, 10)
+
+
+@pytest.mark.asyncio
+async def test_get_activity_hours_after(
+        db_conn,
+        track_generator,
+        user_generator,
+        playback_generator,
+        user_action_generator,
+):
+    assert await get_activity_hours_after(0, 0, conn=db_conn) == (set(), 0, 0)
+    assert await get_last_activity_ids(conn=db_conn) == (0, 0)
+    track = await track_generator()
+    user = await user_generator()
+    first = await playback_generator(user=user, track=track, start=datetime.datetime(2000, 1, 1, 10, 30))
+    second = await playback_generator(user=user, track=track, start=datetime.datetime(2000, 1, 1, 12, 30))
+    action = await user_action_generator(user=user, playback=second, ts=datetime.datetime(2000, 1, 1, 13, 5))
+
+    assert await get_activity_hours_after(0, 0, conn=db_conn) == (
+        {datetime.datetime(2000, 1, 1, 10), datetime.datetime(2000, 1, 1, 12), datetime.datetime(2000, 1, 1, 13)},
+        second['id'],
+        action['id'],
+    )
+    assert await get_activity_hours_after(first['id'], action['id'], conn=db_conn) == (
+        {datetime.datetime(2000, 1, 1, 12)},
+        second['id'],
+        action['id'],
+    )
+    assert await get_last_activity_ids(conn=db_conn) == (second['id'], action['id'])
+
+
+@pytest.mark.asyncio
+async def test_refresh_activity(
+        db_conn,
+        track_generator,
+        user_generator,
+        playback_generator,
+        user_action_generator,
+):
+    track = await track_generator()
+    users = [await user_generator() for _ in range(2)]
+    day = datetime.datetime(2000, 1, 1)
+    playbacks = [
+        await playback_generator(user=users[0], track=track, start=day + datetime.timedelta(hours=10)),
+        await playback_generator(user=users[1], track=track, start=day + datetime.timedelta(hours=10, minutes=5)),
+        await playback_generator(user=users[0], track=track, start=day + datetime.timedelta(hours=11)),
+        await playback_generator(user=users[0], track=track, start=day + datetime.timedelta(days=1)),
+    ]
+    for action in ('upvote', 'upvote', 'downvote'):
+        await user_action_generator(user=users[1], playback=playbacks[0], action=action)
+    await user_action_generator(user=users[1], playback=playbacks[2], action='skip',
+                                ts=day + datetime.timedelta(hours=12))
+
+    await refresh_activity(conn=db_conn)
+
+    empty = {'plays': 0, 'djs': 0, 'upvotes': 0, 'downvotes': 0, 'skips': 0}
+    hourly = [
+        dict(empty, bucket=day + datetime.timedelta(hours=10), plays=2, djs=2, upvotes=2, downvotes=1),
+        dict(empty, bucket=day + datetime.timedelta(hours=11), plays=1, djs=1),
+        dict(empty, bucket=day + datetime.timedelta(hours=12), skips=1),
+        dict(empty, bucket=day + datetime.timedelta(days=1), plays=1, djs=1),
+    ]
+    daily = [
+        dict(empty, bucket=day, plays=3, djs=2, upvotes=2, downvotes=1, skips=1),
+        dict(empty, bucket=day + datetime.timedelta(days=1), plays=1, djs=1),
+    ]
+    assert await get_activity(day, day + datetime.timedelta(days=2), conn=db_conn) == hourly
+    assert await get_activity(day, day + datetime.timedelta(days=2), daily=True, conn=db_conn) == daily
+
+    # Only the given range is recomputed, and buckets left without activity are removed
+    await db_conn.execute(UserAction.delete())
+    await refresh_activity(day, day + datetime.timedelta(hours=11), conn=db_conn)
+    hourly[0].update(upvotes=0, downvotes=0)
+    assert await get_activity(day, day + datetime.timedelta(days=2), conn=db_conn) == hourly
+    await refresh_activity(day, day + datetime.timedelta(days=1), conn=db_conn)
+    assert await get_activity(day, day + datetime.timedelta(days=2), conn=db_conn) == hourly[:2] + hourly[3:]
+    daily[0].update(upvotes=0, downvotes=0, skips=0)
+    assert await get_activity(day, day + datetime.timedelta(days=2), daily=True, conn=db_conn) == daily
+
+
+@pytest.mark.parametrize('ts, months, expected', (
+        (datetime.datetime(2000, 1, 31, 23, 59), 0, datetime.datetime(2000, 1, 1)),
+        (datetime.datetime(2000, 1, 31), 1, datetime.datetime(2000, 2, 1)),
+        (datetime.datetime(2000, 12, 5), 1, datetime.datetime(2001, 1, 1)),
+        (datetime.datetime(2000, 1, 5), -1, datetime.datetime(1999, 12, 1)),
+        (datetime.datetime(2000, 1, 5), 25, datetime.datetime(2002, 2, 1)),
+))
+def test_add_months(ts, months, expected):
+    assert add_months(ts, months) == expected
+
+
+@pytest.mark.asyncio
+async def test_save_user_action_with_id(
+        db_conn,
+        track_generator,
+        user_generator,
+        playback_generator,
+):
+    track = await track_generator()
+    user = await user_generator()
+    playback = await playback_generator(user=user, track=track)
+    user_action_dict = {'id': 5, 'ts': datetime.datetime(2000, 1, 1), 'action': Action.upvote, 'user_id': user['id'],
+                        'playback_id': playback['id']}
+    assert await save_user_action(user_action_dict=user_action_dict, conn=db_conn) == user_action_dict
+
+    # Changing the ts moves it to another partition, but it's still the same action
+    user_action_dict.update(ts=datetime.datetime(2000, 2, 1), action=Action.downvote)
+    assert await save_user_action(user_action_dict=user_action_dict, conn=db_conn) == user_action_dict
+    assert [dict(row) for row in await (await db_conn.execute(sa.select([UserAction]))).fetchall()] == \
+        [user_action_dict]
+
+
+@pytest.mark.asyncio
+async def test_create_user_action_partition(
+        db_conn,
+        track_generator,
+        user_generator,
+        playback_generator,
+        user_action_generator,
+):
+    track = await track_generator()
+    user = await user_generator()
+    playback = await playback_generator(user=user, track=track, start=datetime.datetime(2000, 1, 1))
+    in_month = await user_action_generator(user=user, playback=playback, ts=datetime.datetime(2000, 1, 31, 23))
+    next_month = await user_action_generator(user=user, playback=playback, ts=datetime.datetime(2000, 2, 1))
+    name = user_action_partition_name(datetime.datetime(2000, 1, 1))
+    assert name == 'user_action_y2000m01'
+    assert 'user_action_default' in await get_user_action_partitions(conn=db_conn)
+    assert name not in await get_user_action_partitions(conn=db_conn)
+
+    assert await create_user_action_partition(datetime.datetime(2000, 1, 15), conn=db_conn) == name
+
+    assert name in await get_user_action_partitions(conn=db_conn)
+    query = sa.select([UserAction.c.id, sa.literal_column('tableoid::regclass::text').label('partition')]) \
+        .order_by(UserAction.c.id)
+    assert [tuple(row.values()) for row in await (await db_conn.execute(query)).fetchall()] == [
+        (in_month['id'], name),
+        (next_month['id'], 'user_action_default'),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_user_actions_of_playback_partition_pruning(
+        db_conn,
+        track_generator,
+        user_generator,
+        playback_generator,
+        user_action_generator,
+):
+    track = await track_generator()
+    user = await user_generator()
+    old_playback = await playback_generator(user=user, track=track, start=datetime.datetime(2000, 1, 1))
+    playback = await playback_generator(user=user, track=track, start=datetime.datetime(2000, 3, 1))
+    await user_action_generator(user=user, playback=old_playback)
+    action = await user_action_generator(user=user, playback=playback, action='upvote')
+    for month in range(1, 4):
+        await create_user_action_partition(datetime.datetime(2000, month, 1), conn=db_conn)
+
+    query = _simplified_user_actions_query(playback['id'])
+    assert [row['id'] for row in await (await db_conn.execute(query)).fetchall()] == [action['id']]
+    compiled = query.compile(dialect=psa.dialect())
+    plan = await db_conn.execute(f'EXPLAIN (ANALYZE, COSTS OFF) {compiled}', compiled.params)
+    plan = [row[0] for row in await plan.fetchall()]
+    # Pruned when the query starts, once the start of the playback is known
+    assert all('never executed' in line for line in plan if 'on user_action_y2000m01' in line)
+    assert not any('never executed' in line for line in plan if 'on user_action_y2000m03' in line)
+
+
+@pytest.mark.asyncio
+async def test_save_user_action_before_start(
+        db_conn,
+        track_generator,
+        user_generator,
+        playback_generator,
+):
+    track = await track_generator()
+    user = await user_generator()
+    playback = await playback_generator(user=user, track=track, start=datetime.datetime(2000, 3, 1))
+    for month in range(1, 4):
+        await create_user_action_partition(datetime.datetime(2000, month, 1), conn=db_conn)
+    user_action_dict = {'ts': datetime.datetime(2000, 1, 15), 'action': Action.upvote, 'user_id': user['id'],
+                        'playback_id': playback['id']}
+
+    # Stored within the clock skew before the start, where the queries of the playback look for it
+    action = await save_user_action(user_action_dict=user_action_dict, conn=db_conn)
+    assert action['ts'] == playback['start'] - ACTION_CLOCK_SKEW
+    query = _simplified_user_actions_query(playback['id'])
+    assert [row['id'] for row in await (await db_conn.execute(query)).fetchall()] == [action['id']]
+    assert (await refresh_playback_summary(playback['id'], conn=db_conn))['upvotes'] == 1
+    assert await get_user_last_dub(playback['id'], user['id'], conn=db_conn) == Action.upvote
+
+    # Also when updated
+    action = await save_user_action(user_action_dict=dict(user_action_dict, id=action['id']), conn=db_conn)
+    assert action['ts'] == playback['start'] - ACTION_CLOCK_SKEW
+
+
+@pytest.yield_fixture
+def blocking_conn(database):
+    engine = create_blocking_engine()
+    with engine.connect() as conn:
+        trans = conn.begin()
+        yield conn
+        trans.rollback()
+    engine.dispose()
+
+
+def history_row(minute, *, skipped=False, dtid='dtid 1', extid='extid 1', updubs=0, downdubs=0, **kwargs):
+    row = {
+        'played': datetime.datetime(2000, 1, 1, 0, minute),
+        'next_played': datetime.datetime(2000, 1, 1, 0, minute + 1),
+        'skipped': skipped,
+        'dtid': dtid,
+        'username': f'Username {dtid}',
+        'origin': Origin.youtube,
+        'extid': extid,
+        'name': f'Name {extid}',
+        'length': 120.4,
+        'updubs': updubs,
+        'downdubs': downdubs,
+    }
+    row.update(kwargs)
+    return row
+
+
+def test_bulk_save_history(blocking_conn):
+    conn = blocking_conn
+    user_id = conn.execute(User.insert().values(dtid='dtid 1', username='Old name').returning(User.c.id)).scalar()
+    track_id = conn.execute(Track.insert().values(
+        origin=Origin.youtube, extid='extid 1', name='Old name', length=100,
+    ).returning(Track.c.id)).scalar()
+    playback_id = conn.execute(Playback.insert().values(
+        track_id=track_id, user_id=user_id, start=datetime.datetime(2000, 1, 1, 0, 1),
+    ).returning(Playback.c.id)).scalar()
+    conn.execute(UserAction.insert().values([
+        {'playback_id': playback_id, 'user_id': None, 'action': Action.skip,
+         'ts': datetime.datetime(2000, 1, 1, 0, 1, 30)},
+        {'playback_id': playback_id, 'user_id': None, 'action': Action.upvote,
+         'ts': datetime.datetime(2000, 1, 1, 0, 1, 10)},
+        {'playback_id': playback_id, 'user_id': user_id, 'action': Action.upvote,
+         'ts': datetime.datetime(2000, 1, 1, 0, 1, 10)},
+        {'playback_id': playback_id, 'user_id': user_id, 'action': Action.downvote,
+         'ts': datetime.datetime(2000, 1, 1, 0, 1, 20)},
+    ]))
+    rows = [
+        history_row(0, dtid='dtid 2', username='Tab\tnew\nline\\', extid='extid 2', updubs=2, downdubs=1),
+        history_row(1, skipped=True, updubs=2, downdubs=1),
+        history_row(2, skipped=True, extid='extid 2', updubs=1),
+        history_row(3, skipped=True, next_played=None),
+    ]
+
+    playback_ids = bulk_save_history(rows, conn=conn)
+
+    playbacks = conn.execute(sa.select([Playback]).order_by(Playback.c.start)).fetchall()
+    assert sorted(playback['id'] for playback in playbacks) == playback_ids
+    assert len(playbacks) == 4
+    assert playbacks[1]['id'] == playback_id
+    users = {user['dtid']: user for user in conn.execute(sa.select([User])).fetchall()}
+    assert users['dtid 1']['username'] == 'Old name'
+    assert users['dtid 2']['username'] == 'Tab\tnew\nline\\'
+    assert [playback['user_id'] for playback in playbacks] == [users['dtid 2']['id'], user_id, user_id, user_id]
+    tracks = {track['extid']: track for track in conn.execute(sa.select([Track])).fetchall()}
+    assert tracks['extid 1']['name'] == 'Old name'
+    assert tracks['extid 2']['length'] == 120
+    assert [playback['track_id'] for playback in playbacks] == [
+        tracks['extid 2']['id'], track_id, tracks['extid 2']['id'], track_id,
+    ]
+
+    def actions():
+        query = sa.select([UserAction.c.playback_id, UserAction.c.action, UserAction.c.ts, UserAction.c.user_id]) \
+            .order_by(UserAction.c.playback_id, UserAction.c.action, UserAction.c.ts, UserAction.c.user_id.nullsfirst())
+        return [tuple(action) for action in conn.execute(query).fetchall()]
+
+    saved = actions()
+    assert saved == sorted([
+        (playbacks[0]['id'], Action.upvote, rows[0]['played'], None),
+        (playbacks[0]['id'], Action.upvote, rows[0]['played'], None),
+        (playbacks[0]['id'], Action.downvote, rows[0]['played'], None),
+        # The skip was there, the last vote of the user is a downvote, an upvote is missing
+        (playback_id, Action.skip, datetime.datetime(2000, 1, 1, 0, 1, 30), None),
+        (playback_id, Action.upvote, datetime.datetime(2000, 1, 1, 0, 1, 10), None),
+        (playback_id, Action.upvote, datetime.datetime(2000, 1, 1, 0, 1, 10), user_id),
+        (playback_id, Action.upvote, rows[1]['played'], None),
+        (playback_id, Action.downvote, datetime.datetime(2000, 1, 1, 0, 1, 20), user_id),
+        (playbacks[2]['id'], Action.skip, rows[3]['played'], None),
+        (playbacks[2]['id'], Action.upvote, rows[2]['played'], None),
+        # There is no next song to know when the last one was skipped
+    ], key=lambda action: (action[0], action[1].value, action[2], action[3] or 0))
+
+    assert bulk_save_history(rows, conn=conn) == playback_ids
+    assert actions() == saved
+
+
+def test_copy_table_out_and_in(blocking_conn):
+    conn = blocking_conn
+    hours = [datetime.datetime(2000, 1, 1, hour) for hour in (3, 1, 3)]
+    conn.execute(ActivityDirty.insert().values([{'hour': hour} for hour in hours]))
+    expected = [tuple(row) for row in conn.execute(ActivityDirty.select().order_by(ActivityDirty.c.id))]
+    data = io.BytesIO()
+
+    assert copy_table_out(ActivityDirty, data, conn=conn) == 3
+    assert get_tables_with_rows([ActivityDirty, ActivityHourly], conn=conn) == ['activity_dirty']
+
+    truncate_tables([ActivityDirty], conn=conn)
+    assert get_tables_with_rows([ActivityDirty, ActivityHourly], conn=conn) == []
+    data.seek(0)
+    assert copy_table_in(ActivityDirty, data, conn=conn) == 3
+    assert [tuple(row) for row in conn.execute(ActivityDirty.select().order_by(ActivityDirty.c.id))] == expected
+    assert [row[0] for row in expected] == [1, 2, 3]
+
+    reset_sequences([ActivityDirty, ActivityHourly], conn=conn)
+    assert conn.execute(ActivityDirty.insert().values(hour=hours[0]).returning(ActivityDirty.c.id)).scalar() == 4
+
+
+@pytest.mark.asyncio
+async def test_iter_playbacks_after(db_conn, track_generator, user_generator, playback_generator):
+    track = await track_generator()
+    user = await user_generator()
+    # Saved out of order, they are iterated in start order
+    late = await playback_generator(user=user, track=track, start=datetime.datetime(2000, 1, 2))
+    early = await playback_generator(user=user, track=track, start=datetime.datetime(2000, 1, 1))
+    latest = await playback_generator(user=user, track=track, start=datetime.datetime(2000, 1, 3))
+
+    playbacks = [playback async for playback in iter_playbacks_after(0, fetch_size=2, conn=db_conn)]
+    assert [playback['id'] for playback in playbacks] == [early['id'], late['id'], latest['id']]
+    assert playbacks[0] == dict(early, track_name=track['name'], origin=track['origin'], extid=track['extid'])
+
+    playbacks = [playback async for playback in iter_playbacks_after(early['id'], conn=db_conn)]
+    assert [playback['id'] for playback in playbacks] == [latest['id']]
+
+
+@pytest.mark.asyncio
+async def test_iter_playbacks_after_canonical(db_conn, track_generator, user_generator, playback_generator):
+    canonical, duplicate = await track_generator(), await track_generator()
+    await save_canonical_tracks([{'track_id': duplicate['id'], 'canonical_track_id': canonical['id'],
+                                  'similarity': 0.9}], conn=db_conn)
+    playback = await playback_generator(user=await user_generator(), track=duplicate)
+
+    playbacks = [playback async for playback in iter_playbacks_after(0, conn=db_conn)]
+
+    assert playbacks == [dict(playback, track_id=canonical['id'], track_name=canonical['name'],
+                              origin=duplicate['origin'], extid=duplicate['extid'])]
+
+
+@pytest.fixture
+def substring_search(mocker):
+    mocker.patch('mosbot.query._trigram_search', False)
+
+
+@pytest.mark.asyncio
+async def test_search_tracks(db_conn, substring_search, track_generator):
+    names = ['Bohemian Rhapsody', 'Rhapsody in Blue', 'Blue Monday', '100% Pure_Love']
+    tracks = [await track_generator(name=name) for name in names]
+
+    results = await search_tracks('rhapsody', conn=db_conn)
+    assert [track['id'] for track in results] == [tracks[1]['id'], tracks[0]['id']]
+    assert set(results[0]) == {'id', 'name', 'origin', 'extid', 'score'}
+    assert [track['id'] for track in await search_tracks('BLUE', limit=1, conn=db_conn)] == [tracks[2]['id']]
+    # Wildcards are searched literally
+    assert [track['id'] for track in await search_tracks('0% pure_', conn=db_conn)] == [tracks[3]['id']]
+    assert [track['id'] for track in await search_tracks('%', conn=db_conn)] == [tracks[3]['id']]
+    assert await search_tracks('queen', conn=db_conn) == []
+
+
+@pytest.mark.asyncio
+async def test_search_users(db_conn, substring_search, user_generator):
+    users = [await user_generator(username=username) for username in ('tomas', 'Tom', 'atomic')]
+
+    results = await search_users('tom', conn=db_conn)
+
+    assert [user['id'] for user in results] == [users[1]['id'], users[0]['id'], users[2]['id']]
+    assert set(results[0]) == {'id', 'username', 'dtid', 'score'}
+
+
+@pytest.mark.asyncio
+async def test_get_user_countries(db_conn, user_generator):
+    users = [await user_generator(country=country) for country in ('ES', 'ES', 'FR', 'US')]
+
+    assert await get_user_countries([user['dtid'] for user in users[:3]] + ['unknown'], conn=db_conn) == {'ES', 'FR'}
+    assert await get_user_countries([], conn=db_conn) == set()
+
+
+@pytest.mark.asyncio
+async def test_has_user_countries(db_conn, user_generator):
+    await save_user(user_dict={'username': 'No country', 'dtid': 'no-country'}, conn=db_conn)
+    assert not await has_user_countries(conn=db_conn)
+
+    await user_generator(country='ES')
+    assert await has_user_countries(conn=db_conn)
+
+
+def test_search_query_trigram():
+    query = _search_query([Track.c.id, Track.c.name], Track.c.name, 'queen', limit=3, trigram=True)
+
+    compiled = str(query.compile(dialect=psa.dialect(), compile_kwargs={'literal_binds': True}))
+    assert "track.name ILIKE '%%queen%%'" in compiled
+    assert "OR ('queen' <% track.name)" in compiled
+    assert 'word_similarity' in compiled
+    assert 'ORDER BY score DESC, track.name, track.id' in compiled
+
+
+@pytest.mark.asyncio
+async def test_search_tracks_trigram(db_conn, mocker, track_generator):
+    mocker.patch('mosbot.query._trigram_search', None)
+    if not await has_trigram_search(conn=db_conn):
+        pytest.skip('pg_trgm is not available')
+    tracks = [await track_generator(name=name) for name in ('Bohemian Rhapsody', 'Blue Monday')]
+
+    # Misspelled words match too
+    assert [track['id'] for track in await search_tracks('rapsody', conn=db_conn)] == [tracks[0]['id']]
+
+
+@pytest.mark.asyncio
+async def test_has_trigram_search(db_conn, mocker):
+    mocker.patch('mosbot.query._trigram_search', None)
+    query = sa.text("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm')")
+    expected = await (await db_conn.execute(query)).scalar()
+
+    assert await has_trigram_search(conn=db_conn) is expected
+    with mock.patch('mosbot.query.ensure_read_connection') as ensure_read_connection_mock:
+        assert await has_trigram_search(conn=db_conn) is expected
+    ensure_read_connection_mock.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_iter_tracks_after(db_conn, track_generator):
+    tracks = [await track_generator() for _ in range(3)]
+
+    assert [track async for track in iter_tracks_after(0, fetch_size=2, conn=db_conn)] == [
+        {'id': track['id'], 'name': track['name'], 'length': track['length']} for track in tracks
+    ]
+    assert [track['id'] async for track in iter_tracks_after(tracks[1]['id'], conn=db_conn)] == [tracks[2]['id']]
+
+
+@pytest.mark.asyncio
+async def test_save_canonical_tracks(db_conn, track_generator):
+    tracks = [await track_generator() for _ in range(3)]
+    await save_canonical_tracks([], conn=db_conn)
+
+    await save_canonical_tracks([
+        {'track_id': tracks[1]['id'], 'canonical_track_id': tracks[0]['id'], 'similarity': 0.8},
+        {'track_id': tracks[2]['id'], 'canonical_track_id': tracks[0]['id'], 'similarity': 0.9},
+    ], conn=db_conn)
+    await save_canonical_tracks([
+        {'track_id': tracks[2]['id'], 'canonical_track_id': tracks[1]['id'], 'similarity': 1},
+    ], conn=db_conn)
+
+    rows = await (await db_conn.execute(TrackCanonical.select().order_by(TrackCanonical.c.track_id))).fetchall()
+    assert [row.as_tuple() for row in rows] == [
+        (tracks[1]['id'], tracks[0]['id'], 0.8),
+        (tracks[2]['id'], tracks[1]['id'], 1),
+    ]
+    assert await get_canonical_track_id(tracks[2]['id'], conn=db_conn) == tracks[1]['id']
+    assert await get_canonical_track_id(tracks[0]['id'], conn=db_conn) == tracks[0]['id']
+
+
+@pytest.mark.asyncio
+async def test_get_song_stats(db_conn, track_generator):
+    tracks = [await track_generator() for _ in range(4)]
+    await save_canonical_tracks([
+        {'track_id': tracks[1]['id'], 'canonical_track_id': tracks[0]['id'], 'similarity': 0.8},
+        {'track_id': tracks[2]['id'], 'canonical_track_id': tracks[0]['id'], 'similarity': 0.9},
+    ], conn=db_conn)
+    last_played = [datetime.datetime(2000, 1, n) for n in range(1, 5)]
+    await db_conn.execute(TrackStats.insert().values([
+        {'track_id': track['id'], 'plays': n + 1, 'listened_seconds': 100, 'updubs': 2, 'downdubs': 1, 'skips': n,
+         'last_played': last_played[n]}
+        for n, track in enumerate(tracks)
+    ]))
+    expected = {'canonical_track_id': tracks[0]['id'], 'tracks': 3, 'plays': 6, 'listened_seconds': 300, 'updubs': 6,
+                'downdubs': 3, 'skips': 3, 'last_played': last_played[2]}
+
+    assert await get_song_stats(tracks[0]['id'], conn=db_conn) == expected
+    assert await get_song_stats(tracks[2]['id'], conn=db_conn) == expected
+    assert (await get_song_stats(tracks[3]['id'], conn=db_conn))['plays'] == 4
+    assert await get_song_stats(tracks[3]['id'] + 1, conn=db_conn) == {
+        'canonical_track_id': tracks[3]['id'] + 1, 'tracks': 0, 'plays': 0, 'listened_seconds': 0, 'updubs': 0,
+        'downdubs': 0, 'skips': 0, 'last_played': None,
+    }
+
+
+async def insert_summaries(db_conn, playbacks, votes):
+    await db_conn.execute(PlaybackSummary.insert().values([
+        {'playback_id': playback['id'], 'upvotes': upvotes, 'downvotes': 1, 'voters': upvotes + 1, 'skipped': False}
+        for playback, upvotes in zip(playbacks, votes)
+    ]))
+
+
+@pytest.mark.asyncio
+async def test_get_dj_ranking(db_conn, track_generator, user_generator, playback_generator):
+    track = await track_generator()
+    users = [await user_generator(username=username) for username in ('bob', 'alice', 'carol')]
+    await db_conn.execute(UserStats.insert().values([
+        {'user_id': user['id'], 'plays': plays, 'listened_seconds': 0, 'updubs': updubs, 'downdubs': 0, 'skips': 0,
+         'updubs_given': 0, 'downdubs_given': 0}
+        for user, plays, updubs in zip(users, (5, 5, 0), (1, 9, 0))
+    ]))
+    starts = [datetime.datetime(2000, 1, day) for day in (1, 8, 9, 10)]
+    playbacks = [await playback_generator(user=user, track=track, start=start)
+                 for user, start in zip((users[0], users[0], users[1], users[1]), starts)]
+    await insert_summaries(db_conn, playbacks, (10, 1, 2, 3))
+
+    ranking = await get_dj_ranking(conn=db_conn)
+    assert [(dj['username'], dj['plays'], dj['updubs']) for dj in ranking] == [('alice', 5, 9), ('bob', 5, 1)]
+    ranking = await get_dj_ranking(order_by='updubs', limit=1, conn=db_conn)
+    assert [dj['user_id'] for dj in ranking] == [users[1]['id']]
+
+    since = datetime.datetime(2000, 1, 8)
+    ranking = await get_dj_ranking(since=since, conn=db_conn)
+    assert ranking == [
+        {'user_id': users[1]['id'], 'username': 'alice', 'plays': 2, 'updubs': 5, 'downdubs': 2},
+        {'user_id': users[0]['id'], 'username': 'bob', 'plays': 1, 'updubs': 1, 'downdubs': 1},
+    ]
+    ranking = await get_dj_ranking(since=datetime.datetime(2000, 1, 1), order_by='updubs', conn=db_conn)
+    assert [dj['username'] for dj in ranking] == ['bob', 'alice']
+
+
+@pytest.mark.asyncio
+async def test_get_track_ranking(db_conn, track_generator, user_generator, playback_generator):
+    tracks = [await track_generator(name=name) for name in ('Song', 'Song (Official Video)', 'Other')]
+    await save_canonical_tracks([
+        {'track_id': tracks[1]['id'], 'canonical_track_id': tracks[0]['id'], 'similarity': 0.9},
+    ], conn=db_conn)
+    await db_conn.execute(TrackStats.insert().values([
+        {'track_id': track['id'], 'plays': plays, 'listened_seconds': 0, 'updubs': updubs, 'downdubs': 0,
+         'skips': 0}
+        for track, plays, updubs in zip(tracks, (2, 2, 3), (1, 1, 5))
+    ]))
+    user = await user_generator()
+    starts = [datetime.datetime(2000, 1, day) for day in (1, 8, 9)]
+    playbacks = [await playback_generator(user=user, track=track, start=start)
+                 for track, start in zip((tracks[2], tracks[1], tracks[0]), starts)]
+    await insert_summaries(db_conn, playbacks, (1, 2, 3))
+
+    ranking = await get_track_ranking(conn=db_conn)
+    assert [(track['name'], track['plays']) for track in ranking] == [('Song', 4), ('Other', 3)]
+    ranking = await get_track_ranking(order_by='updubs', conn=db_conn)
+    assert [track['track_id'] for track in ranking] == [tracks[2]['id'], tracks[0]['id']]
+
+    ranking = await get_track_ranking(since=datetime.datetime(2000, 1, 8), conn=db_conn)
+    assert ranking == [{'track_id': tracks[0]['id'], 'name': 'Song', 'plays': 2, 'updubs': 5, 'downdubs': 2}]
+
+
+@pytest.mark.asyncio
+async def test_iter_track_plays_since(db_conn, track_generator, user_generator, playback_generator):
+    track = await track_generator()
+    user = await user_generator()
+    starts = [datetime.datetime(2000, 1, 1, hour) for hour in (3, 1, 2)]
+    for start in starts:
+        await playback_generator(user=user, track=track, start=start)
+
+    plays = [play async for play in iter_track_plays_since(starts[2], conn=db_conn)]
+
+    assert plays == [{'origin': track['origin'], 'extid': track['extid'], 'start': start}
+                     for start in (starts[2], starts[0])]
@@ -1,10 +1,14 @@
+import asyncio
+import datetime
 import sys
 
 import pytest
 from alembic.command import upgrade, downgrade
 from alembic.config import Config
+from alembic.script import ScriptDirectory
 
-from mosbot.util import setup_logging, check_alembic_in_latest_version
+from mosbot.util import setup_logging, check_alembic_in_latest_version, latency_summary, alembic_head_revision, \
+    SingleFlight, TTLCache, RateLimiter, IdWatermark, aclosing, parse_duration, format_duration
 
 
 @pytest.fixture
@@ -52,3 +56,199 @@ def test_check_alembic_in_latest_version():
         check_alembic_in_latest_version()
     upgrade(config, 'head')
     check_alembic_in_latest_version()
+
+
+def test_alembic_head_revision():
+    script = ScriptDirectory.from_config(Config('alembic.ini'))
+    assert alembic_head_revision() == script.get_current_head()
+
+
+def test_latency_summary():
+    assert latency_summary([]) == {'count': 0}
+
+    summary = latency_summary([i / 1000 for i in range(100, 0, -1)])
+    assert summary['count'] == 100
+    assert summary['min_ms'] == pytest.approx(1)
+    assert summary['max_ms'] == pytest.approx(100)
+    assert summary['mean_ms'] == pytest.approx(50.5)
+    assert summary['p50_ms'] == pytest.approx(50)
+    assert summary['p99_ms'] == pytest.approx(99)
+
+    # The nearest rank rounds up, 2.5 is the 3rd
+    summary = latency_summary([i / 1000 for i in range(1, 6)])
+    assert summary['p50_ms'] == pytest.approx(3)
+    assert summary['p90_ms'] == pytest.approx(5)
+
+
+@pytest.mark.asyncio
+async def test_single_flight():
+    flight = SingleFlight('test')
+    calls = []
+
+    async def work(value):
+        calls.append(value)
+        await asyncio.sleep(0.01)
+        return value
+
+    results = await asyncio.gather(
+        flight.do('a', lambda: work(1)),
+        flight.do('a', lambda: work(2)),
+        flight.do('b', lambda: work(3)),
+    )
+    assert results == [1, 1, 3]
+    assert calls == [1, 3]
+    assert flight.metrics() == {'calls': 3, 'coalesced': 1, 'in_flight': 0}
+
+    # Once finished, a new call does the work again
+    assert await flight.do('a', lambda: work(4)) == 4
+    assert calls == [1, 3, 4]
+
+
+@pytest.mark.asyncio
+async def test_single_flight_not_shared():
+    flight = SingleFlight('test')
+    calls = []
+
+    async def work(value):
+        calls.append(value)
+        await asyncio.sleep(0.01)
+        return value
+
+    results = await asyncio.gather(
+        flight.do('a', lambda: work(1), share=False),
+        flight.do('a', lambda: work(2)),
+        flight.do('a', lambda: work(3), share=False),
+        flight.do('a', lambda: work(4)),
+    )
+    # The calls not shared neither lead nor join a flight
+    assert results == [1, 2, 3, 2]
+    assert sorted(calls) == [1, 2, 3]
+    assert flight.coalesced == 1
+
+
+@pytest.mark.asyncio
+async def test_single_flight_exception():
+    flight = SingleFlight('test')
+
+    async def work():
+        await asyncio.sleep(0.01)
+        raise ValueError()
+
+    results = await asyncio.gather(
+        flight.do('a', work),
+        flight.do('a', work),
+        return_exceptions=True,
+    )
+    assert [type(r) for r in results] == [ValueError, ValueError]
+    assert flight.in_flight == {}
+
+
+def test_ttl_cache():
+    now = [0]
+    cache = TTLCache(2, 10, clock=lambda: now[0])
+
+    assert cache.get('a') is None
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    # b is the least recently used now
+    cache.set('c', 3)
+    assert cache.get('b', 'missing') == 'missing'
+    assert cache.get('c') == 3
+
+    now[0] = 10
+    assert cache.get('a') is None
+    assert cache.metrics() == {'hits': 2, 'misses': 3, 'size': 1}
+    cache.clear()
+    assert cache.metrics()['size'] == 0
+
+
+def test_ttl_cache_entry_ttl():
+    now = [0]
+    cache = TTLCache(2, 10, clock=lambda: now[0])
+    cache.set('a', 1)
+    cache.set('b', 2, ttl=5)
+
+    now[0] = 5
+    assert cache.get('a') == 1
+    assert cache.get('b') is None
+
+
+def test_rate_limiter():
+    now = [0]
+    limiter = RateLimiter(2, 10, maxsize=2, clock=lambda: now[0])
+
+    assert [limiter.wait('a') for _ in range(3)] == [0, 0, 5]
+    assert limiter.wait('b') == 0
+    now[0] = 5
+    assert limiter.wait('a') == 0
+    assert limiter.wait('a') == pytest.approx(5)
+    assert limiter.limited == 2
+
+    # The least recently used key is dropped, and starts again
+    limiter.wait('c')
+    assert list(limiter.buckets) == ['a', 'c']
+
+
+def test_id_watermark():
+    watermark = IdWatermark(2)
+    assert watermark.after_id == 0
+
+    assert [watermark.see(id) for id in (1, 2, 4)] == [True, True, True]
+    assert watermark.after_id == 2
+    watermark.prune()
+    assert watermark.seen == {4}
+
+    # Committed after 4, and read again along with it
+    assert [watermark.see(id) for id in (3, 4, 5)] == [True, False, True]
+    assert watermark.last_id == 5
+    watermark.prune()
+    assert watermark.seen == {4, 5}
+
+
+@pytest.mark.asyncio
+async def test_aclosing():
+    closed = []
+
+    async def numbers():
+        try:
+            for n in range(10):
+                yield n
+        finally:
+            closed.append(True)
+
+    with pytest.raises(ValueError):
+        async with aclosing(numbers()) as iterator:
+            async for n in iterator:
+                if n == 2:
+                    raise ValueError()
+
+    assert closed == [True]
+
+
+@pytest.mark.parametrize('text,duration', (
+        ('7d', datetime.timedelta(days=7)),
+        ('12H', datetime.timedelta(hours=12)),
+        ('30m', datetime.timedelta(minutes=30)),
+        ('2w', datetime.timedelta(weeks=2)),
+        ('90s', datetime.timedelta(seconds=90)),
+))
+def test_parse_duration(text, duration):
+    assert parse_duration(text) == duration
+
+
+@pytest.mark.parametrize('text', ('', 'd', '7', '0d', '-1d', '7y', '1.5h'))
+def test_parse_duration_invalid(text):
+    with pytest.raises(ValueError):
+        parse_duration(text)
+
+
+@pytest.mark.parametrize('duration,text', (
+        (datetime.timedelta(days=7), '1w'),
+        (datetime.timedelta(days=3), '3d'),
+        (datetime.timedelta(hours=36), '36h'),
+        (datetime.timedelta(seconds=90), '90s'),
+        (datetime.timedelta(milliseconds=500), '0s'),
+))
+def test_format_duration(duration, text):
+    assert format_duration(duration) == text
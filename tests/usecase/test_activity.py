@@ -0,0 +1,98 @@
+import asyncio
+import datetime
+
+import asynctest as am
+import pytest
+
+from mosbot.db import BotConfig
+from mosbot.query import get_activity, load_bot_data, mark_activity_dirty
+from mosbot.usecase.activity import day_ranges, rebuild_activity_rollups, refresh_activity_rollups, \
+    refresh_activity_rollups_forever
+
+DAY = datetime.datetime(2000, 1, 1)
+
+
+def hours(*offsets):
+    return [DAY + datetime.timedelta(hours=offset) for offset in offsets]
+
+
+@pytest.mark.parametrize('input_hours,expected', (
+        ([], []),
+        (hours(1, 5, 23), [(DAY, DAY + datetime.timedelta(days=1))]),
+        (hours(1, 24, 48, 100), [(DAY, DAY + datetime.timedelta(days=3)),
+                                 (DAY + datetime.timedelta(days=4), DAY + datetime.timedelta(days=5))]),
+))
+def test_day_ranges(input_hours, expected):
+    assert day_ranges(input_hours) == expected
+
+
+@pytest.mark.asyncio
+async def test_refresh_activity_rollups(
+        db_conn,
+        track_generator,
+        user_generator,
+        playback_generator,
+        user_action_generator,
+):
+    track = await track_generator()
+    user = await user_generator()
+    playback = await playback_generator(user=user, track=track, start=DAY)
+    await user_action_generator(user=user, playback=playback, action='upvote')
+
+    # Without watermark everything is rolled up
+    assert await refresh_activity_rollups(conn=db_conn) == 1
+    assert await load_bot_data(BotConfig.activity_rollup_watermark, conn=db_conn) == {
+        'playback_id': playback['id'],
+        'user_action_id': 1,
+    }
+    assert [bucket['upvotes'] for bucket in await get_activity(DAY, DAY + datetime.timedelta(days=1), conn=db_conn)] \
+        == [1]
+    assert await refresh_activity_rollups(conn=db_conn) == 0
+
+    # New rows after the watermark and marked hours
+    next_playback = await playback_generator(user=user, track=track, start=DAY + datetime.timedelta(days=2))
+    await mark_activity_dirty([DAY + datetime.timedelta(days=5)], conn=db_conn)
+    assert await refresh_activity_rollups(conn=db_conn) == 2
+    assert (await load_bot_data(BotConfig.activity_rollup_watermark, conn=db_conn))['playback_id'] == \
+        next_playback['id']
+    daily = await get_activity(DAY, DAY + datetime.timedelta(days=10), daily=True, conn=db_conn)
+    assert [bucket['bucket'] for bucket in daily] == [DAY, DAY + datetime.timedelta(days=2)]
+
+    assert await refresh_activity_rollups(conn=db_conn) == 0
+
+
+@pytest.mark.asyncio
+async def test_rebuild_activity_rollups(
+        db_conn,
+        track_generator,
+        user_generator,
+        playback_generator,
+):
+    track = await track_generator()
+    user = await user_generator()
+    playback = await playback_generator(user=user, track=track, start=DAY)
+    await mark_activity_dirty([DAY], conn=db_conn)
+
+    await rebuild_activity_rollups(conn=db_conn)
+
+    assert await load_bot_data(BotConfig.activity_rollup_watermark, conn=db_conn) == {
+        'playback_id': playback['id'],
+        'user_action_id': 0,
+    }
+    assert [bucket['plays'] for bucket in await get_activity(DAY, DAY + datetime.timedelta(days=1), conn=db_conn)] \
+        == [1]
+    assert await refresh_activity_rollups(conn=db_conn) == 0
+
+
+@pytest.mark.asyncio
+async def test_refresh_activity_rollups_forever():
+    with am.patch('mosbot.usecase.activity.refresh_activity_rollups') as refresh_activity_rollups_mock, \
+            am.patch('mosbot.usecase.activity.asyncio.sleep') as sleep_mock:
+        refresh_activity_rollups_mock.side_effect = [ValueError(), 1]
+        sleep_mock.side_effect = [None, asyncio.CancelledError()]
+
+        with pytest.raises(asyncio.CancelledError):
+            await refresh_activity_rollups_forever(10)
+
+    assert refresh_activity_rollups_mock.await_count == 2
+    sleep_mock.assert_awaited_with(10)
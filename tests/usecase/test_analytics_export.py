@@ -0,0 +1,73 @@
+import datetime
+
+import pytest
+
+from mosbot.db import Action, Origin
+from mosbot.query import refresh_playback_summaries
+from mosbot.usecase.analytics_export import export_parquet, month_partition, playback_schema, to_record_batch
+
+pa = pytest.importorskip('pyarrow')
+pq = pytest.importorskip('pyarrow.parquet')
+
+
+def test_month_partition():
+    assert month_partition(datetime.datetime(2000, 2, 1)) == 'month=2000-02'
+
+
+def test_to_record_batch():
+    record = {
+        'id': 1, 'start': datetime.datetime(2000, 1, 1), 'track_id': 2, 'track_name': 'Name', 'extid': 'extid',
+        'length': 120, 'user_id': None, 'username': None, 'upvotes': 1, 'downvotes': 0, 'skipped': False,
+    }
+    records = [dict(record, origin=Origin.soundcloud), dict(record, origin=Origin.youtube)]
+
+    batch = to_record_batch(records, playback_schema())
+
+    assert batch.schema == playback_schema()
+    origin = batch.column(batch.schema.get_field_index('origin'))
+    # The dictionary is always all the members, so that every file has the same one
+    assert origin.dictionary.to_pylist() == ['youtube', 'soundcloud']
+    assert origin.indices.to_pylist() == [1, 0]
+    assert batch.column(batch.schema.get_field_index('user_id')).to_pylist() == [None, None]
+
+
+@pytest.mark.asyncio
+async def test_export_parquet(db_conn, tmpdir, track_generator, user_generator, playback_generator,
+                              user_action_generator):
+    track = await track_generator()
+    dj, voter = await user_generator(), await user_generator()
+    starts = [datetime.datetime(2000, 1, 1), datetime.datetime(2000, 1, 2), datetime.datetime(2000, 1, 3),
+              datetime.datetime(2000, 3, 1)]
+    playbacks = [await playback_generator(user=dj, track=track, start=start) for start in starts]
+    for playback in playbacks:
+        await user_action_generator(user=voter, playback=playback, action='downvote')
+        await user_action_generator(user=voter, playback=playback, action='upvote')
+    await refresh_playback_summaries(playbacks[0]['id'], playbacks[-1]['id'] + 1, conn=db_conn)
+
+    result = await export_parquet(str(tmpdir), batch_size=2, conn=db_conn)
+
+    assert result == {'months': 3, 'playbacks': 4, 'user_actions': 4}
+    january = pq.ParquetFile(str(tmpdir.join('playbacks', 'month=2000-01', 'data.parquet')))
+    assert january.metadata.num_row_groups == 2
+    assert not tmpdir.join('playbacks', 'month=2000-02').exists()
+    table = pq.read_table(str(tmpdir.join('playbacks', 'month=2000-01', 'data.parquet')))
+    assert table.column('id').to_pylist() == [playback['id'] for playback in playbacks[:3]]
+    assert table.column('upvotes').to_pylist() == [1] * 3
+    assert pa.types.is_dictionary(table.schema.field('origin').type)
+    assert set(table.column('origin').to_pylist()) == {Origin(track['origin']).name}
+
+    user_actions = pq.read_table(str(tmpdir.join('user_actions', 'month=2000-03', 'data.parquet')))
+    assert pa.types.is_dictionary(user_actions.schema.field('action').type)
+    assert user_actions.to_pylist() == [{
+        'id': user_actions.column('id')[0].as_py(),
+        'action': Action.upvote.name,
+        'playback_id': playbacks[3]['id'],
+        'ts': playbacks[3]['start'] + datetime.timedelta(seconds=1),
+        'user_id': voter['id'],
+    }]
+
+
+@pytest.mark.asyncio
+async def test_export_parquet_empty(db_conn, tmpdir):
+    assert await export_parquet(str(tmpdir), conn=db_conn) == {'months': 0, 'playbacks': 0, 'user_actions': 0}
+    assert tmpdir.listdir() == []
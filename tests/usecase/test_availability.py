@@ -0,0 +1,133 @@
+import asyncio
+
+import asynctest as am
+import pytest
+
+from mosbot.db import Origin
+from mosbot.usecase.availability import AvailabilityChecker, FakeAvailabilityProvider, \
+    YoutubeAvailabilityProvider, blocked_countries, check_upcoming_availability, \
+    check_upcoming_availability_forever, set_availability_checker
+from mosbot.usecase.room_queue import QueueItem
+
+
+def item(extid, origin='youtube'):
+    return QueueItem(f'item-{extid}', 'dj', origin, extid, f'Track {extid}', 200)
+
+
+@pytest.mark.asyncio
+async def test_fake_availability_provider():
+    provider = FakeAvailabilityProvider({'a': {'ES'}, 'b': None})
+
+    availability = await provider.check(['a', 'b', 'c'], {'ES', 'FR'})
+
+    assert availability == {
+        ('a', 'ES'): False, ('a', 'FR'): True,
+        ('b', 'ES'): False, ('b', 'FR'): False,
+        ('c', 'ES'): True, ('c', 'FR'): True,
+    }
+    assert provider.batches == [(['a', 'b', 'c'], {'ES', 'FR'})]
+
+
+@pytest.mark.asyncio
+async def test_availability_checker():
+    now = [0]
+    provider = FakeAvailabilityProvider({'a': {'ES'}, 'b': None}, batch_size=2)
+    checker = AvailabilityChecker(provider, ttl=100, negative_ttl=10, clock=lambda: now[0])
+    items = [item('a'), item('b'), item('c'), item('a'), item('d', origin='soundcloud')]
+
+    blocked = await checker.check(items, ['ES', 'FR'])
+
+    assert blocked == {'a': {'ES'}, 'b': {'ES', 'FR'}}
+    # Looked up in batches, once each and only the tracks of the provider origin
+    assert [extids for extids, _ in provider.batches] == [['a', 'b'], ['c']]
+    assert checker.countries == {'ES', 'FR'}
+    assert checker.blocked_countries(Origin.youtube, 'a') == {'ES'}
+    assert checker.blocked_countries(Origin.youtube, 'c') == set()
+    assert checker.blocked_countries(Origin.soundcloud, 'd') == set()
+
+    # A new country is looked up
+    await checker.check(items, ['ES', 'US'])
+    assert provider.batches[2:] == [(['a', 'b'], {'ES', 'US'}), (['c'], {'ES', 'US'})]
+
+    # Cached, both available and unavailable
+    now[0] = 5
+    assert await checker.check(items, ['ES', 'FR']) == blocked
+    assert len(provider.batches) == 4
+
+    # The unavailable ones expire first
+    now[0] = 12
+    provider.blocked = {}
+    assert await checker.check(items, ['ES', 'FR']) == {}
+    assert provider.batches[4:] == [(['a', 'b'], {'ES', 'FR'})]
+    assert checker.metrics()['lookups'] == 5
+
+
+@pytest.mark.asyncio
+async def test_youtube_availability_provider():
+    response = am.MagicMock()
+    response.raise_for_status = am.MagicMock()
+    response.json = am.CoroutineMock(return_value={'items': [
+        {'id': 'a', 'contentDetails': {'regionRestriction': {'blocked': ['ES']}}, 'status': {'embeddable': True}},
+        {'id': 'b', 'contentDetails': {'regionRestriction': {'allowed': ['ES']}}, 'status': {'embeddable': True}},
+        {'id': 'c', 'contentDetails': {}, 'status': {'embeddable': False}},
+        {'id': 'd', 'contentDetails': {}, 'status': {'embeddable': True}},
+    ]})
+    session = am.MagicMock()
+    session.get.return_value.__aenter__.return_value = response
+    provider = YoutubeAvailabilityProvider('key')
+
+    with am.patch('mosbot.usecase.availability.aiohttp.ClientSession') as client_session_mock:
+        client_session_mock.return_value.__aenter__.return_value = session
+        availability = await provider.check(['a', 'b', 'c', 'd', 'e'], {'ES', 'FR'})
+
+    assert {key for key, available in availability.items() if not available} == {
+        ('a', 'ES'), ('b', 'FR'), ('c', 'ES'), ('c', 'FR'), ('e', 'ES'), ('e', 'FR'),
+    }
+    assert len(availability) == 10
+    session.get.assert_called_once_with(YoutubeAvailabilityProvider.url, params={
+        'part': 'contentDetails,status', 'id': 'a,b,c,d,e', 'key': 'key',
+    })
+
+
+@pytest.mark.asyncio
+async def test_blocked_countries():
+    checker = AvailabilityChecker(FakeAvailabilityProvider({'a': {'ES'}}))
+    assert blocked_countries('youtube', 'a') == set()
+    await checker.check([item('a')], ['ES', 'FR'])
+
+    set_availability_checker(checker)
+    try:
+        assert blocked_countries('youtube', 'a') == {'ES'}
+        assert blocked_countries('soundcloud', 'a') == set()
+    finally:
+        set_availability_checker(None)
+
+
+@pytest.mark.asyncio
+async def test_check_upcoming_availability(db_conn, user_generator):
+    users = [await user_generator(country=country) for country in ('ES', 'FR')]
+    checker = AvailabilityChecker(FakeAvailabilityProvider({'a': {'ES'}}))
+
+    with am.patch('mosbot.usecase.availability.upcoming_tracks', return_value=[item('a'), item('b')]) as upcoming:
+        blocked = await check_upcoming_availability(lambda: [users[0]['dtid']], limit=2, checker=checker,
+                                                    conn=db_conn)
+
+    assert blocked == {'a': {'ES'}}
+    assert checker.countries == {'ES'}
+    upcoming.assert_called_once_with(2)
+
+
+@pytest.mark.asyncio
+async def test_check_upcoming_availability_forever():
+    listeners = am.MagicMock()
+    with am.patch('mosbot.usecase.availability.check_upcoming_availability') as check_mock, \
+            am.patch('mosbot.usecase.availability.asyncio.sleep') as sleep_mock:
+        check_mock.side_effect = [ValueError(), {}]
+        sleep_mock.side_effect = [None, None, asyncio.CancelledError()]
+
+        with pytest.raises(asyncio.CancelledError):
+            await check_upcoming_availability_forever(listeners, 30)
+
+    assert check_mock.await_count == 2
+    check_mock.assert_awaited_with(listeners)
+    sleep_mock.assert_awaited_with(30)
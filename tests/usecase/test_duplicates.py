@@ -0,0 +1,133 @@
+import asyncio
+
+import asynctest as am
+import pytest
+
+from mosbot.db import Track, TrackCanonical
+from mosbot.usecase.duplicates import TrackDeduplicator, name_similarity, normalize_track_name, \
+    refresh_duplicate_tracks, refresh_duplicate_tracks_forever
+
+
+def track(id, name, length=200):
+    return {'id': id, 'name': name, 'length': length}
+
+
+@pytest.mark.parametrize('name,words', (
+        ('Björk - Army of Me (Official Video)', ('army', 'bjork', 'me', 'of')),
+        ('BJORK army of me [HD] [HD]', ('army', 'bjork', 'me', 'of')),
+        ('Daft Punk - One More Time (Remix)', ('daft', 'more', 'one', 'punk', 'remix', 'time')),
+        ('Official Music Video', ()),
+))
+def test_normalize_track_name(name, words):
+    assert normalize_track_name(name) == words
+
+
+def test_name_similarity():
+    assert name_similarity(('a', 'b', 'c'), ('a', 'b', 'c')) == 1
+    assert name_similarity(('a', 'b', 'c'), ('a', 'b', 'd')) == 2 / 4
+    assert name_similarity(('a', 'b', 'c', 'd', 'live'), ('a', 'b', 'c', 'd')) == 0
+    assert name_similarity(('a', 'b', 'c', 'live'), ('a', 'b', 'd', 'live')) == 3 / 5
+
+
+def test_track_deduplicator():
+    deduplicator = TrackDeduplicator(threshold=0.8, length_tolerance=10)
+
+    mappings = deduplicator.add_tracks([
+        track(1, 'Björk - Army of Me (Official Video)'),
+        track(2, 'Bjork - Army Of Me [Lyrics]', length=205),
+        # Too different in length, another version
+        track(3, 'Bjork - Army of Me', length=400),
+        track(4, 'Daft Punk - One More Time'),
+        track(5, 'Daft Punk - One More Time (Remix)'),
+        track(6, 'Official Video'),
+    ])
+
+    assert mappings == [{'track_id': 2, 'canonical_track_id': 1, 'similarity': 1}]
+    # Matching a duplicate, it gets the canonical track of the duplicate
+    assert deduplicator.add_tracks([track(7, 'army of me bjork', length=212)]) == [
+        {'track_id': 7, 'canonical_track_id': 1, 'similarity': 1},
+    ]
+
+
+def test_track_deduplicator_best_match():
+    deduplicator = TrackDeduplicator(threshold=0.5)
+
+    mappings = deduplicator.add_tracks([
+        track(1, 'a b c d'),
+        track(2, 'a b c e'),
+        track(3, 'a b c e f'),
+    ])
+
+    # The closest match, then the lowest id
+    assert mappings == [
+        {'track_id': 2, 'canonical_track_id': 1, 'similarity': 3 / 5},
+        {'track_id': 3, 'canonical_track_id': 1, 'similarity': 4 / 5},
+    ]
+    assert deduplicator.add_tracks([track(4, 'a b c x')]) == [
+        {'track_id': 4, 'canonical_track_id': 1, 'similarity': 3 / 5},
+    ]
+
+
+def test_track_deduplicator_common_words():
+    deduplicator = TrackDeduplicator(threshold=0.5, max_block_size=2)
+
+    deduplicator.add_tracks([track(1, 'love song'), track(2, 'love you'), track(3, 'love me')])
+
+    assert 'love' in deduplicator.common_words
+    assert 'love' not in deduplicator.blocks
+    # Only matched by the words that are still blocking keys
+    assert deduplicator.add_tracks([track(4, 'love me')]) == [
+        {'track_id': 4, 'canonical_track_id': 3, 'similarity': 1},
+    ]
+    assert deduplicator.add_tracks([track(5, 'love')]) == []
+
+
+@pytest.mark.asyncio
+async def test_refresh_duplicate_tracks(db_conn, track_generator):
+    tracks = [await track_generator(name=name) for name in ('Army of Me', 'Army of Me (HD)', 'Hyperballad')]
+    deduplicator = TrackDeduplicator()
+
+    assert await refresh_duplicate_tracks(deduplicator, fetch_size=1, conn=db_conn) == 1
+    assert await refresh_duplicate_tracks(deduplicator, fetch_size=1, conn=db_conn) == 0
+    duplicate = await track_generator(name='Hyperballad [Official Video]')
+    assert await refresh_duplicate_tracks(deduplicator, conn=db_conn) == 1
+
+    rows = await (await db_conn.execute(TrackCanonical.select().order_by(TrackCanonical.c.track_id))).fetchall()
+    assert [row.as_tuple() for row in rows] == [
+        (tracks[1]['id'], tracks[0]['id'], 1),
+        (duplicate['id'], tracks[2]['id'], 1),
+    ]
+    # Starting again finds the same
+    assert await refresh_duplicate_tracks(TrackDeduplicator(), conn=db_conn) == 2
+
+
+@pytest.mark.asyncio
+async def test_refresh_duplicate_tracks_committed_out_of_order(db_conn, track_generator):
+    original = await track_generator(name='Army of Me')
+    # Saved before the last one, but committed after it was read
+    late = await track_generator(name='Army of Me (HD)')
+    latest = await track_generator(name='Hyperballad')
+    await db_conn.execute(Track.delete().where(Track.c.id == late['id']))
+    deduplicator = TrackDeduplicator(id_overlap=10)
+    assert await refresh_duplicate_tracks(deduplicator, conn=db_conn) == 0
+    assert deduplicator.watermark.last_id == latest['id']
+
+    await track_generator(id=late['id'], name=late['name'])
+
+    assert await refresh_duplicate_tracks(deduplicator, conn=db_conn) == 1
+    assert deduplicator.canonical == {late['id']: original['id']}
+    assert await refresh_duplicate_tracks(deduplicator, conn=db_conn) == 0
+
+
+@pytest.mark.asyncio
+async def test_refresh_duplicate_tracks_forever():
+    with am.patch('mosbot.usecase.duplicates.refresh_duplicate_tracks') as refresh_duplicate_tracks_mock, \
+            am.patch('mosbot.usecase.duplicates.asyncio.sleep') as sleep_mock:
+        refresh_duplicate_tracks_mock.side_effect = [ValueError(), 0]
+        sleep_mock.side_effect = [None, asyncio.CancelledError()]
+
+        with pytest.raises(asyncio.CancelledError):
+            await refresh_duplicate_tracks_forever(3600)
+
+    assert refresh_duplicate_tracks_mock.await_count == 2
+    sleep_mock.assert_awaited_with(3600)
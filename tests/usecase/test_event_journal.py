@@ -0,0 +1,216 @@
+import asyncio
+import datetime
+
+import asynctest as am
+import psycopg2
+import pytest
+from abot.dubtrack import DubtrackUserUpdate
+from unittest import mock
+
+from benchmarks.generator import DubtrackGenerator
+from mosbot.db import BotConfig
+from mosbot.journal import LEGACY_ID
+from mosbot.event_log import event_to_record
+from mosbot.usecase import drain_journal, open_journal
+from mosbot.query import load_bot_data
+from mosbot.usecase.event_journal import store_journal_record
+
+
+@pytest.yield_fixture
+def load_bot_data_mock():
+    with am.patch('mosbot.usecase.event_journal.load_bot_data') as m:
+        yield m
+
+
+@pytest.yield_fixture
+def save_bot_data_mock():
+    with am.patch('mosbot.usecase.event_journal.save_bot_data') as m:
+        yield m
+
+
+@pytest.yield_fixture
+def ensure_dubtrack_playing_mock():
+    with am.patch('mosbot.usecase.event_journal.ensure_dubtrack_playing') as m:
+        yield m
+
+
+@pytest.yield_fixture
+def ensure_dubtrack_dub_mock():
+    with am.patch('mosbot.usecase.event_journal.ensure_dubtrack_dub') as m:
+        yield m
+
+
+@pytest.yield_fixture
+def ensure_dubtrack_skip_mock():
+    with am.patch('mosbot.usecase.event_journal.ensure_dubtrack_skip') as m:
+        yield m
+
+
+@pytest.yield_fixture
+def store_journal_record_mock():
+    with am.patch('mosbot.usecase.event_journal.store_journal_record') as m:
+        yield m
+
+
+@pytest.yield_fixture
+def ensure_connection_mock():
+    with am.patch('mosbot.usecase.event_journal.ensure_connection') as m:
+        yield m
+
+
+@pytest.fixture
+def conn():
+    conn = mock.Mock()
+    conn.begin.return_value = am.MagicMock()
+    return conn
+
+
+@pytest.fixture
+def records():
+    events = DubtrackGenerator(skip_ratio=1).live_events(1)
+    return [dict(event_to_record(event, ts=1500000000 + n), seq=n + 1) for n, event in enumerate(events)]
+
+
+@pytest.mark.asyncio
+async def test_open_journal(tmpdir, load_bot_data_mock):
+    journal = open_journal(str(tmpdir), fsync_delay=0, segment_size=1)
+    assert await journal.append({}) == 1
+    assert await journal.append({}) == 2
+    journal.release(2)
+    journal.close()
+
+    # The database is not needed, the numbers go on from the last segment even if everything was released
+    journal = open_journal(str(tmpdir), fsync_delay=0)
+    assert await journal.append({}) == 3
+    load_bot_data_mock.assert_not_awaited()
+
+
+@pytest.mark.parametrize('drained_seq', (None, 0, 1, 2))
+@pytest.mark.asyncio
+async def test_store_journal_record(
+        load_bot_data_mock,
+        save_bot_data_mock,
+        ensure_dubtrack_playing_mock,
+        ensure_dubtrack_dub_mock,
+        ensure_dubtrack_skip_mock,
+        conn,
+        records,
+        drained_seq,
+):
+    bot_data = {BotConfig.journal_id: 'a', BotConfig.journal_drained_seq: drained_seq}
+    load_bot_data_mock.side_effect = lambda key, conn: bot_data[key]
+    playing, dub, skip = records[0], records[1], records[-1]
+    playing['seq'], dub['seq'], skip['seq'] = 1, 2, 3
+    backend = mock.Mock(_get_entity=lambda _: None)
+
+    stored = [
+        await store_journal_record(record=r, journal_id='a', backend=backend, conn=conn) for r in (playing, dub, skip)
+    ]
+
+    assert stored == [(drained_seq or 0) < seq for seq in (1, 2, 3)]
+    ts = datetime.datetime.utcfromtimestamp
+    assert ensure_dubtrack_playing_mock.await_count == (1 if stored[0] else 0)
+    if stored[1]:
+        ensure_dubtrack_dub_mock.assert_awaited_once_with(event=mock.ANY, conn=conn, ts=ts(dub['ts']))
+    ensure_dubtrack_skip_mock.assert_awaited_once_with(event=mock.ANY, conn=conn, ts=ts(skip['ts']))
+    assert save_bot_data_mock.await_args_list == [
+        mock.call(BotConfig.journal_drained_seq, seq, conn=conn) for seq in (1, 2, 3) if seq > (drained_seq or 0)
+    ]
+
+
+@pytest.mark.asyncio
+async def test_store_journal_record_other_events(load_bot_data_mock, save_bot_data_mock, conn):
+    load_bot_data_mock.return_value = None
+    event = DubtrackUserUpdate({'user': {}}, mock.Mock())
+    record = dict(event_to_record(event), seq=1)
+
+    assert await store_journal_record(record=record, journal_id='a', backend=mock.Mock(), conn=conn)
+
+    assert save_bot_data_mock.await_args_list == [
+        mock.call(BotConfig.journal_id, 'a', conn=conn),
+        mock.call(BotConfig.journal_drained_seq, 1, conn=conn),
+    ]
+
+
+@pytest.mark.parametrize('stored_journal_id,journal_id,stored', (
+        ('a', 'a', False),
+        ('a', 'b', True),  # Another directory, numbered from 1 again
+        (None, 'b', True),
+        (None, LEGACY_ID, False),  # The directory in use before the journals had an id
+))
+@pytest.mark.asyncio
+async def test_store_journal_record_journal_id(
+        load_bot_data_mock,
+        save_bot_data_mock,
+        conn,
+        stored_journal_id,
+        journal_id,
+        stored,
+):
+    bot_data = {BotConfig.journal_id: stored_journal_id, BotConfig.journal_drained_seq: 5}
+    load_bot_data_mock.side_effect = lambda key, conn: bot_data[key]
+    record = dict(event_to_record(DubtrackUserUpdate({'user': {}}, mock.Mock())), seq=1)
+
+    assert await store_journal_record(record=record, journal_id=journal_id, backend=mock.Mock(), conn=conn) == stored
+
+    if stored:
+        assert save_bot_data_mock.await_args_list == [
+            mock.call(BotConfig.journal_id, journal_id, conn=conn),
+            mock.call(BotConfig.journal_drained_seq, 1, conn=conn),
+        ]
+    else:
+        save_bot_data_mock.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_store_journal_record_new_directory(db_conn, tmpdir):
+    backend = mock.Mock()
+    journal = open_journal(str(tmpdir.join('old')), fsync_delay=0)
+    for _ in range(3):
+        seq = await journal.append(event_to_record(DubtrackUserUpdate({'user': {}}, mock.Mock())))
+        await store_journal_record(record=journal.read_durable(seq - 1)[0], journal_id=journal.id, backend=backend,
+                                   conn=db_conn)
+    journal.close()
+
+    # The directory is lost, the new one is numbered from 1 again
+    journal = open_journal(str(tmpdir.join('new')), fsync_delay=0)
+    seq = await journal.append(event_to_record(DubtrackUserUpdate({'user': {}}, mock.Mock())))
+    record = journal.read_durable(0)[0]
+
+    assert seq == 1
+    assert await store_journal_record(record=record, journal_id=journal.id, backend=backend, conn=db_conn)
+    assert not await store_journal_record(record=record, journal_id=journal.id, backend=backend, conn=db_conn)
+    assert await load_bot_data(BotConfig.journal_drained_seq, conn=db_conn) == 1
+    assert await load_bot_data(BotConfig.journal_id, conn=db_conn) == journal.id
+
+
+@pytest.mark.asyncio
+async def test_drain_journal(
+        event_loop,
+        store_journal_record_mock,
+        ensure_connection_mock,
+        records,
+        mocker,
+):
+    sleep_mock = mocker.patch('mosbot.usecase.event_journal.asyncio.sleep', new_callable=am.CoroutineMock)
+    journal = mock.Mock()
+    journal.read = am.CoroutineMock(side_effect=[records[:2], records[2:3], asyncio.CancelledError()])
+    store_journal_record_mock.side_effect = [
+        psycopg2.OperationalError(),  # Database down, retried without limit
+        psycopg2.OperationalError(),
+        psycopg2.OperationalError(),
+        True,
+        ValueError(),  # Broken record, skipped after 3 attempts
+        ValueError(),
+        ValueError(),
+        True,
+    ]
+
+    with pytest.raises(asyncio.CancelledError):
+        await drain_journal(journal, max_attempts=3, retry_delay=1, max_retry_delay=3)
+
+    assert journal.read.await_args_list == [mock.call(0, 100), mock.call(2, 100), mock.call(3, 100)]
+    stored = [c[1]['record']['seq'] for c in store_journal_record_mock.await_args_list]
+    assert stored == [1, 1, 1, 1, 2, 2, 2, 3]
+    assert sleep_mock.await_args_list == [mock.call(1), mock.call(2), mock.call(3), mock.call(1), mock.call(2)]
+    assert journal.release.call_args_list == [mock.call(2), mock.call(3)]
@@ -1,8 +1,12 @@
+import asyncio
+import datetime
+
 import asynctest as am
 import pytest
 from unittest import mock
 
-from mosbot.db import Origin, Action
+from mosbot.db import Origin, Action, close_engine, get_engine
+from mosbot.query import get_user_stats, save_playback, save_track, save_user
 from mosbot.usecase import ensure_dubtrack_skip
 from mosbot.usecase.event_persistence import ensure_dubtrack_entity, ensure_dubtrack_playing, ensure_dubtrack_dub
 
@@ -43,6 +47,67 @@ def save_user_action_mock():
         yield m
 
 
+@pytest.yield_fixture
+def refresh_playback_summary_mock():
+    with am.patch('mosbot.usecase.event_persistence.refresh_playback_summary') as m:
+        yield m
+
+
+@pytest.yield_fixture
+def lock_playback_mock():
+    with am.patch('mosbot.usecase.event_persistence.lock_playback') as m:
+        yield m
+
+
+@pytest.yield_fixture
+def get_user_last_dub_mock():
+    with am.patch('mosbot.usecase.event_persistence.get_user_last_dub') as m:
+        yield m
+
+
+@pytest.yield_fixture
+def store_stats_deltas_mock():
+    with am.patch('mosbot.usecase.event_persistence.store_stats_deltas') as m:
+        yield m
+
+
+@pytest.yield_fixture
+def mark_activity_dirty_mock():
+    with am.patch('mosbot.usecase.event_persistence.mark_activity_dirty') as m:
+        yield m
+
+
+@pytest.yield_fixture
+def record_playing_mock():
+    with am.patch('mosbot.usecase.event_persistence.record_playing') as m:
+        yield m
+
+
+@pytest.yield_fixture
+def record_playback_mock():
+    with am.patch('mosbot.usecase.event_persistence.record_playback') as m:
+        yield m
+
+
+@pytest.yield_fixture
+def record_skip_mock():
+    with am.patch('mosbot.usecase.event_persistence.record_skip') as m:
+        yield m
+
+
+@pytest.yield_fixture
+def record_dub_mock():
+    with am.patch('mosbot.usecase.event_persistence.record_dub') as m:
+        yield m
+
+
+@pytest.fixture
+def conn():
+    conn = mock.Mock(in_transaction=False)
+    conn.begin.return_value = am.MagicMock()
+    return conn
+
+
 @pytest.fixture
 def datetime_mock(mocker):
     return mocker.patch('mosbot.usecase.event_persistence.datetime')
@@ -73,15 +138,21 @@ async def test_ensure_dubtrack_playing(
         ensure_dubtrack_entity_mock,
         get_or_save_track_mock,
         get_or_save_playback_mock,
+        refresh_playback_summary_mock,
+        mark_activity_dirty_mock,
+        record_playing_mock,
+        record_playback_mock,
+        conn,
 ):
-    ensure_dubtrack_entity_mock.return_value = {'id': 1}
+    ensure_dubtrack_entity_mock.return_value = {'id': 1, 'username': 'dj'}
     get_or_save_track_mock.return_value = {'id': 2}
+    get_or_save_playback_mock.return_value = {'id': 3}
 
     dp = mock.Mock()
     dp.song_type = 'youtube'
-    conn = mock.Mock()
     await ensure_dubtrack_playing(event=dp, conn=conn)
 
+    conn.begin.assert_called_once_with()
     ensure_dubtrack_entity_mock.assert_awaited_once_with(user=dp.sender, conn=conn)
     get_or_save_track_mock.assert_awaited_once_with(track_dict={
         'length': dp.length.total_seconds.return_value,
@@ -94,62 +165,136 @@ async def test_ensure_dubtrack_playing(
         'track_id': 2,
         'start': dp.played,
     }, conn=conn)
+    refresh_playback_summary_mock.assert_awaited_once_with(3, conn=conn)
+    mark_activity_dirty_mock.assert_awaited_once_with([dp.played], conn=conn)
+    record_playing_mock.assert_called_once_with(dp)
+    record_playback_mock.assert_called_once_with(playback_id=3, start=dp.played, track_id=2, track_name=dp.song_name,
+                                                 user_id=1, username='dj')
 
 
+@pytest.mark.parametrize('ts', (None, 'ts'))
 @pytest.mark.asyncio
 async def test_ensure_dubtrack_skip(
         get_last_playback_mock,
         ensure_dubtrack_entity_mock,
         save_user_action_mock,
+        refresh_playback_summary_mock,
+        mark_activity_dirty_mock,
+        record_skip_mock,
         datetime_mock,
+        conn,
+        ts,
 ):
     get_last_playback_mock.return_value = {'id': 1}
     ensure_dubtrack_entity_mock.return_value = {'id': 2}
 
     ds = mock.Mock()
-    conn = mock.Mock()
-    await ensure_dubtrack_skip(event=ds, conn=conn)
+    await ensure_dubtrack_skip(event=ds, conn=conn, ts=ts)
 
+    conn.begin.assert_called_once_with()
     get_last_playback_mock.assert_awaited_once_with(conn=conn)
     ensure_dubtrack_entity_mock.assert_awaited_once_with(user=ds.sender, conn=conn)
     save_user_action_mock.assert_awaited_once_with(user_action_dict={
         'playback_id': 1,
         'user_id': 2,
         'action': Action.skip,
-        'ts': datetime_mock.datetime.utcnow.return_value,
+        'ts': ts or datetime_mock.datetime.utcnow.return_value,
     }, conn=conn)
+    refresh_playback_summary_mock.assert_awaited_once_with(1, conn=conn)
+    mark_activity_dirty_mock.assert_awaited_once_with([ts or datetime_mock.datetime.utcnow.return_value], conn=conn)
+    record_skip_mock.assert_called_once_with(1)
 
 
+@pytest.mark.parametrize('previous_action, expected_deltas', (
+    (None, {'updubs_given': 1}),
+    (Action.upvote, None),
+    (Action.downvote, {'updubs_given': 1, 'downdubs_given': -1}),
+))
+@pytest.mark.parametrize('ts', (None, 'ts'))
 @pytest.mark.parametrize('event_played', (1, False))
 @pytest.mark.asyncio
 async def test_ensure_dubtrack_dub(
         get_last_playback_mock,
         ensure_dubtrack_entity_mock,
         get_dub_action_mock,
+        lock_playback_mock,
+        get_user_last_dub_mock,
         save_user_action_mock,
+        refresh_playback_summary_mock,
+        store_stats_deltas_mock,
+        mark_activity_dirty_mock,
+        record_dub_mock,
         datetime_mock,
+        conn,
         event_played,
+        ts,
+        previous_action,
+        expected_deltas,
 ):
     dd = mock.Mock()
     dd.played = event_played
-    conn = mock.Mock()
     get_last_playback_mock.return_value = {'id': 1, 'start': 1}
     ensure_dubtrack_entity_mock.return_value = {'id': 2}
+    get_dub_action_mock.return_value = Action.upvote
+    get_user_last_dub_mock.return_value = previous_action
 
-    await ensure_dubtrack_dub(event=dd, conn=conn)
+    await ensure_dubtrack_dub(event=dd, conn=conn, ts=ts)
 
+    conn.begin.assert_called_once_with()
     if event_played:
         get_last_playback_mock.assert_awaited_once_with(conn=conn)
         ensure_dubtrack_entity_mock.assert_awaited_once_with(user=dd.sender, conn=conn)
         get_dub_action_mock.assert_called_once_with(dd.dubtype)
+        lock_playback_mock.assert_awaited_once_with(1, conn=conn)
         save_user_action_mock.assert_awaited_once_with(user_action_dict={
-            'ts': datetime_mock.datetime.utcnow.return_value,
+            'ts': ts or datetime_mock.datetime.utcnow.return_value,
             'playback_id': 1,
             'user_id': 2,
             'action': get_dub_action_mock.return_value,
         }, conn=conn)
+        stats, = store_stats_deltas_mock.await_args[0]
+        refresh_playback_summary_mock.assert_awaited_once_with(1, stats=stats, conn=conn)
+        store_stats_deltas_mock.assert_awaited_once_with(stats, conn=conn)
+        get_user_last_dub_mock.assert_awaited_once_with(1, 2, conn=conn)
+        if expected_deltas:
+            assert stats.users == {2: expected_deltas}
+            record_dub_mock.assert_called_once_with(1, 2, Action.upvote, previous_action)
+        else:
+            assert stats.users == {}
+            record_dub_mock.assert_not_called()
+        mark_activity_dirty_mock.assert_awaited_once_with(
+            [ts or datetime_mock.datetime.utcnow.return_value], conn=conn,
+        )
     else:
         get_last_playback_mock.assert_awaited_once_with(conn=conn)
         ensure_dubtrack_entity_mock.assert_not_awaited()
         get_dub_action_mock.assert_not_called()
+        lock_playback_mock.assert_not_awaited()
         save_user_action_mock.assert_not_awaited()
+        refresh_playback_summary_mock.assert_not_awaited()
+        store_stats_deltas_mock.assert_not_awaited()
+        mark_activity_dirty_mock.assert_not_awaited()
+        record_dub_mock.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_ensure_dubtrack_dub_concurrent(database):
+    # Each dub in its own connection, committed, as the handlers do
+    async with (await get_engine()).acquire() as conn:
+        dj = await save_user(user_dict={'dtid': 'dj', 'username': 'dj'}, conn=conn)
+        voter = await save_user(user_dict={'dtid': 'voter', 'username': 'voter'}, conn=conn)
+        track = await save_track(track_dict={'length': 120, 'origin': Origin.youtube, 'extid': 'a', 'name': 'a'},
+                                 conn=conn)
+        playback = await save_playback(playback_dict={'user_id': dj['id'], 'track_id': track['id'],
+                                                      'start': datetime.datetime.utcnow()}, conn=conn)
+    sender = mock.Mock(id='voter', username='voter')
+    dubs = [mock.Mock(played=playback['start'], dubtype=dubtype, sender=sender) for dubtype in ('updub', 'downdub')]
+
+    try:
+        await asyncio.gather(*(ensure_dubtrack_dub(event=dub) for dub in dubs))
+
+        # The second dub changes the first one, whichever it is
+        stats = await get_user_stats(voter['id'])
+        assert stats['updubs_given'] + stats['downdubs_given'] == 1
+    finally:
+        await close_engine()
@@ -7,7 +7,8 @@ from unittest import mock
 from mosbot.db import Action, Origin
 from mosbot.usecase import save_history_songs
 from mosbot.usecase.history_sync import persist_history, dubtrack_songs_since_ts, save_history_chunk, \
-    update_user_actions, get_or_create_playback, get_or_create_track, get_or_create_user, history_import_skip_action
+    update_user_actions, get_or_create_playback, get_or_create_track, get_or_create_user, history_import_skip_action, \
+    bulk_persist_history, history_rows, id_windows
 
 save_history_chunk = save_history_chunk.__wrapped__
 
@@ -38,6 +39,12 @@ def persist_history_mock():
         yield m
 
 
+@pytest.yield_fixture
+def bulk_persist_history_mock():
+    with am.patch('mosbot.usecase.history_sync.bulk_persist_history') as m:
+        yield m
+
+
 @pytest.yield_fixture
 def get_engine_mock():
     with am.patch('mosbot.usecase.history_sync.get_engine') as m:
@@ -87,6 +94,24 @@ def update_user_actions_mock():
         yield m
 
 
+@pytest.yield_fixture
+def mark_activity_dirty_mock():
+    with am.patch('mosbot.usecase.history_sync.mark_activity_dirty') as m:
+        yield m
+
+
+@pytest.yield_fixture
+def refresh_playback_summary_mock():
+    with am.patch('mosbot.usecase.history_sync.refresh_playback_summary') as m:
+        yield m
+
+
+@pytest.yield_fixture
+def store_stats_deltas_mock():
+    with am.patch('mosbot.usecase.history_sync.store_stats_deltas') as m:
+        yield m
+
+
 @pytest.yield_fixture
 def query_simplified_user_actions_mock():
     with am.patch('mosbot.usecase.history_sync.query_simplified_user_actions') as m:
@@ -146,6 +171,114 @@ async def test_save_history_songs(
         persist_history_mock.assert_awaited_once_with(dubtrack_songs_since_ts_mock.return_value)
 
 
+@pytest.mark.parametrize('since, bulk', ((0, True), (0, False), (None, True)))
+@pytest.mark.asyncio
+async def test_save_history_songs_since_or_bulk(
+        load_bot_data_mock,
+        dubtrack_songs_since_ts_mock,
+        persist_history_mock,
+        bulk_persist_history_mock,
+        since,
+        bulk,
+):
+    load_bot_data_mock.return_value = 'last_song'
+    result = await save_history_songs(since=since, bulk=bulk)
+
+    if since is None:
+        load_bot_data_mock.assert_awaited_once_with('last_saved_history')
+        dubtrack_songs_since_ts_mock.assert_awaited_once_with('last_song')
+    else:
+        load_bot_data_mock.assert_not_awaited()
+        dubtrack_songs_since_ts_mock.assert_awaited_once_with(since)
+    used_mock, unused_mock = (bulk_persist_history_mock, persist_history_mock) if bulk else \
+        (persist_history_mock, bulk_persist_history_mock)
+    used_mock.assert_awaited_once_with(dubtrack_songs_since_ts_mock.return_value)
+    unused_mock.assert_not_awaited()
+    assert result == used_mock.return_value
+
+
+def history_song(played, *, skipped=False):
+    return {
+        'played': played * 1000,
+        'skipped': skipped,
+        'userid': f'dtid {played}',
+        '_user': {'username': f'user {played}'},
+        '_song': {'type': 'youtube', 'fkid': f'fkid {played}', 'name': f'name {played}', 'songLength': 204500},
+        'updubs': 1,
+        'downdubs': 2,
+    }
+
+
+def test_history_rows():
+    songs = {played: history_song(played, skipped=played == 60) for played in (120, 0, 60)}
+
+    rows = history_rows(songs)
+
+    assert [row['played'] for row in rows] == [datetime.datetime(1970, 1, 1, 0, minute) for minute in range(3)]
+    assert [row['next_played'] for row in rows] == [rows[1]['played'], rows[2]['played'], None]
+    assert [row['skipped'] for row in rows] == [False, True, False]
+    assert rows[0] == {
+        'played': datetime.datetime(1970, 1, 1),
+        'next_played': datetime.datetime(1970, 1, 1, 0, 1),
+        'skipped': False,
+        'dtid': 'dtid 0',
+        'username': 'user 0',
+        'origin': Origin.youtube,
+        'extid': 'fkid 0',
+        'name': 'name 0',
+        'length': 204.5,
+        'updubs': 1,
+        'downdubs': 2,
+    }
+
+
+@pytest.mark.parametrize('ids, size, expected', (
+        ([], 10, []),
+        ([1, 2, 3], 10, [(1, 11)]),
+        ([1, 2, 3], 2, [(1, 3), (3, 5)]),
+        ([5, 6, 100, 109, 110], 10, [(5, 15), (100, 110), (110, 120)]),
+))
+def test_id_windows(ids, size, expected):
+    assert list(id_windows(ids, size)) == expected
+
+
+@pytest.mark.asyncio
+async def test_bulk_persist_history(mocker, save_bot_data_mock, mark_activity_dirty_mock):
+    create_partitions_mock = mocker.patch('mosbot.usecase.history_sync.create_missing_user_action_partitions',
+                                          new_callable=am.CoroutineMock)
+    engine_mock = mocker.patch('mosbot.usecase.history_sync.create_blocking_engine')
+    bulk_save_history_mock = mocker.patch('mosbot.usecase.history_sync.bulk_save_history',
+                                          return_value=[1, 2, 5])
+    refresh_mock = mocker.patch('mosbot.usecase.history_sync.refresh_playback_summaries',
+                                new_callable=am.CoroutineMock)
+    ensure_connection_mock = mocker.patch('mosbot.usecase.history_sync.ensure_connection')
+    ensure_connection_mock.return_value = am.MagicMock()
+    conn = ensure_connection_mock.return_value.__aenter__.return_value
+    songs = {played: history_song(played) for played in (0, 60, 120)}
+    rows = history_rows(songs)
+
+    assert await bulk_persist_history(songs, batch_size=2) == 120
+
+    create_partitions_mock.assert_awaited_once_with(rows[0]['played'], rows[-1]['played'])
+    bulk_save_history_mock.assert_called_once_with(
+        rows, conn=engine_mock.return_value.begin.return_value.__enter__.return_value,
+    )
+    engine_mock.return_value.dispose.assert_called_once_with()
+    assert refresh_mock.await_args_list == [am.call(1, 3, conn=conn), am.call(5, 7, conn=conn)]
+    mark_activity_dirty_mock.assert_awaited_once_with([row['played'] for row in rows], conn=conn)
+    save_bot_data_mock.assert_awaited_once_with('last_saved_history', 120)
+
+
+@pytest.mark.asyncio
+async def test_bulk_persist_history_empty(mocker, save_bot_data_mock):
+    bulk_save_history_mock = mocker.patch('mosbot.usecase.history_sync.bulk_save_history')
+
+    assert await bulk_persist_history({}) is None
+
+    bulk_save_history_mock.assert_not_called()
+    save_bot_data_mock.assert_not_awaited()
+
+
 @pytest.mark.parametrize('songs_input, songs_results, expected_last', (
         ({0: {'skipped': False}}, (None,), (True, 0),),
         ({0: {'skipped': False}, 1: {'skipped': False}, 2: {'skipped': False}}, (None, None, None,), (True, 2,),),
@@ -242,6 +375,9 @@ async def test_save_history_chunk(
         get_or_create_track_mock,
         get_or_create_playback_mock,
         update_user_actions_mock,
+        refresh_playback_summary_mock,
+        store_stats_deltas_mock,
+        mark_activity_dirty_mock,
         input_songs,
         history_import_skip_action_calls,
         whole_flow_calls,
@@ -276,6 +412,14 @@ async def test_save_history_chunk(
     assert get_or_create_track_mock.await_count == whole_flow_calls
     assert get_or_create_playback_mock.await_count == whole_flow_calls
     assert update_user_actions_mock.await_count == whole_flow_calls
+    assert refresh_playback_summary_mock.await_count == whole_flow_calls + len(history_import_skip_action_calls)
+    # The stats of all the songs are stored once, at the end of the chunk
+    stats, = store_stats_deltas_mock.await_args[0]
+    store_stats_deltas_mock.assert_awaited_once_with(stats, conn=conn)
+    assert all(call[1]['stats'] is stats for call in refresh_playback_summary_mock.await_args_list)
+    mark_activity_dirty_mock.assert_awaited_once_with([
+        datetime.datetime.utcfromtimestamp(song['played'] / 1000) for song in input_songs
+    ], conn=conn)
 
 
 @pytest.mark.parametrize('input_song,user_actions,expected_actions,save_user_action_returns,raises_exception', (
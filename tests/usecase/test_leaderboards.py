@@ -0,0 +1,147 @@
+import asyncio
+import datetime
+
+import asynctest as am
+import pytest
+
+from mosbot import config
+from mosbot.usecase.leaderboards import ResultCache, leaderboard_wait, refresh_leaderboards_forever, top_djs, \
+    top_tracks, user_stats
+
+
+class Counter:
+    """Compute function that returns how many times it was called."""
+
+    def __init__(self):
+        self.calls = 0
+
+    async def __call__(self):
+        self.calls += 1
+        await asyncio.sleep(0)
+        return self.calls
+
+
+@pytest.fixture
+def now():
+    return [0]
+
+
+@pytest.fixture
+def cache(now):
+    return ResultCache(ttl=10, maxsize=2, clock=lambda: now[0])
+
+
+@pytest.mark.asyncio
+async def test_result_cache_get(cache, now):
+    compute = Counter()
+
+    assert await cache.get('a', compute) == 1
+    assert await cache.get('a', compute) == 1
+    assert compute.calls == 1
+
+    # Once expired, it's computed again
+    now[0] = 10
+    assert await cache.get('a', compute) == 2
+    assert cache.metrics() == {'hits': 1, 'misses': 2, 'size': 1, 'requested': 1}
+
+
+@pytest.mark.asyncio
+async def test_result_cache_get_coalesced(cache):
+    compute = Counter()
+
+    assert await asyncio.gather(cache.get('a', compute), cache.get('a', compute)) == [1, 1]
+    assert compute.calls == 1
+
+
+@pytest.mark.asyncio
+async def test_result_cache_refresh(cache, now):
+    a, b = Counter(), Counter()
+    await cache.get('a', a)
+    now[0] = 5
+    await cache.get('b', b)
+
+    assert await cache.refresh() == 2
+    assert (a.calls, b.calls) == (2, 2)
+    assert await cache.get('a', a) == 2
+
+    # Both were last requested at 5, so they are forgotten once the ttl passes
+    now[0] = 16
+    assert await cache.refresh() == 0
+    assert cache.requested == {}
+    assert (a.calls, b.calls) == (2, 2)
+
+
+@pytest.mark.asyncio
+async def test_result_cache_requested_maxsize(cache):
+    for key in ('a', 'b', 'a', 'c'):
+        await cache.get(key, Counter())
+
+    # b is the least recently requested
+    assert list(cache.requested) == ['a', 'c']
+
+
+def test_leaderboard_wait(mocker):
+    mocker.patch('mosbot.usecase.leaderboards.RATE_LIMITER.buckets', {})
+    waits = [leaderboard_wait('dj') for _ in range(config.LEADERBOARD_RATE + 1)]
+
+    assert waits[:-1] == [0] * config.LEADERBOARD_RATE
+    assert waits[-1] > 0
+    assert leaderboard_wait('other') == 0
+
+
+@pytest.mark.asyncio
+async def test_top_djs(cache, mocker):
+    ranking = [{'username': f'dj{i}'} for i in range(config.LEADERBOARD_SIZE)]
+    get_dj_ranking_mock = mocker.patch('mosbot.usecase.leaderboards.get_dj_ranking', new_callable=am.CoroutineMock,
+                                       return_value=ranking)
+
+    assert await top_djs(3, order_by='updubs', cache=cache) == ranking[:3]
+    # The same leaderboard is used for any limit
+    assert await top_djs(5, order_by='updubs', cache=cache) == ranking[:5]
+
+    get_dj_ranking_mock.assert_awaited_once_with(since=None, order_by='updubs', limit=config.LEADERBOARD_SIZE)
+
+
+@pytest.mark.asyncio
+async def test_top_tracks_since(cache, mocker):
+    get_track_ranking_mock = mocker.patch('mosbot.usecase.leaderboards.get_track_ranking',
+                                          new_callable=am.CoroutineMock, return_value=[])
+    before = datetime.datetime.utcnow()
+
+    assert await top_tracks(3, since=datetime.timedelta(days=7), cache=cache) == []
+
+    since = get_track_ranking_mock.call_args[1]['since']
+    assert before - datetime.timedelta(days=7) <= since <= datetime.datetime.utcnow() - datetime.timedelta(days=7)
+    assert get_track_ranking_mock.call_args[1]['order_by'] == 'plays'
+
+
+@pytest.mark.asyncio
+async def test_user_stats(cache, mocker):
+    get_user_mock = mocker.patch('mosbot.usecase.leaderboards.get_user', new_callable=am.CoroutineMock,
+                                 side_effect=[{'id': 1, 'username': 'dj'}, None])
+    get_user_stats_mock = mocker.patch('mosbot.usecase.leaderboards.get_user_stats', new_callable=am.CoroutineMock,
+                                       return_value={'plays': 3})
+
+    assert await user_stats('dtid', cache=cache) == {'plays': 3, 'username': 'dj'}
+    assert await user_stats('dtid', cache=cache) == {'plays': 3, 'username': 'dj'}
+    assert await user_stats('unknown', cache=cache) is None
+
+    assert get_user_mock.await_args_list == [
+        am.call(user_dict={'dtid': 'dtid'}),
+        am.call(user_dict={'dtid': 'unknown'}),
+    ]
+    get_user_stats_mock.assert_awaited_once_with(1)
+
+
+@pytest.mark.asyncio
+async def test_refresh_leaderboards_forever():
+    with am.patch('mosbot.usecase.leaderboards.LEADERBOARDS') as leaderboards_mock, \
+            am.patch('mosbot.usecase.leaderboards.asyncio.sleep') as sleep_mock:
+        leaderboards_mock.refresh = am.CoroutineMock(side_effect=[ValueError(), 1])
+        sleep_mock.side_effect = [None, asyncio.CancelledError()]
+
+        with pytest.raises(asyncio.CancelledError):
+            await refresh_leaderboards_forever(30)
+
+    assert leaderboards_mock.refresh.await_count == 2
+    sleep_mock.assert_awaited_with(30)
@@ -0,0 +1,46 @@
+import asyncio
+import datetime
+
+import asynctest as am
+import pytest
+
+from mosbot.query import add_months, get_user_action_partitions, user_action_partition_name
+from mosbot.usecase.partitions import create_missing_user_action_partitions, ensure_user_action_partitions, \
+    ensure_user_action_partitions_forever
+
+
+@pytest.mark.asyncio
+async def test_ensure_user_action_partitions(db_conn):
+    now = datetime.datetime.utcnow()
+    # The migration creates them up to 3 months ahead
+    assert await ensure_user_action_partitions(months_ahead=3, conn=db_conn) == []
+
+    expected = [user_action_partition_name(add_months(now, months)) for months in (4, 5)]
+    assert await ensure_user_action_partitions(months_ahead=5, conn=db_conn) == expected
+    assert await ensure_user_action_partitions(months_ahead=5, conn=db_conn) == []
+    partitions = await get_user_action_partitions(conn=db_conn)
+    assert all(user_action_partition_name(add_months(now, months)) in partitions for months in range(6))
+
+
+@pytest.mark.asyncio
+async def test_create_missing_user_action_partitions(db_conn):
+    since, until = datetime.datetime(1999, 11, 20), datetime.datetime(2000, 2, 1)
+    expected = ['user_action_y1999m11', 'user_action_y1999m12', 'user_action_y2000m01', 'user_action_y2000m02']
+
+    assert await create_missing_user_action_partitions(since, until, conn=db_conn) == expected
+    assert await create_missing_user_action_partitions(since, until, conn=db_conn) == []
+    assert set(expected) <= set(await get_user_action_partitions(conn=db_conn))
+
+
+@pytest.mark.asyncio
+async def test_ensure_user_action_partitions_forever():
+    with am.patch('mosbot.usecase.partitions.ensure_user_action_partitions') as ensure_user_action_partitions_mock, \
+            am.patch('mosbot.usecase.partitions.asyncio.sleep') as sleep_mock:
+        ensure_user_action_partitions_mock.side_effect = [ValueError(), []]
+        sleep_mock.side_effect = [None, asyncio.CancelledError()]
+
+        with pytest.raises(asyncio.CancelledError):
+            await ensure_user_action_partitions_forever(10, months_ahead=2)
+
+    assert ensure_user_action_partitions_mock.await_args_list == [am.call(months_ahead=2)] * 2
+    sleep_mock.assert_awaited_with(10)
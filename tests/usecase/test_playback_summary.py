@@ -0,0 +1,37 @@
+import pytest
+
+from mosbot.query import get_playback_summary
+from mosbot.usecase.playback_summary import check_playback_summaries, rebuild_playback_summaries
+
+
+@pytest.mark.asyncio
+async def test_rebuild_and_check_playback_summaries_empty(db_conn):
+    assert await rebuild_playback_summaries(conn=db_conn) == 0
+    assert await check_playback_summaries(conn=db_conn) == (0, [])
+
+
+@pytest.mark.parametrize('batch_size', (1, 2, 1000))
+@pytest.mark.asyncio
+async def test_rebuild_and_check_playback_summaries(
+        db_conn,
+        track_generator,
+        user_generator,
+        playback_generator,
+        user_action_generator,
+        batch_size,
+):
+    track = await track_generator()
+    user = await user_generator()
+    playbacks = [await playback_generator(user=user, track=track) for _ in range(5)]
+    for playback in playbacks[::2]:
+        await user_action_generator(user=user, playback=playback, action='downvote')
+
+    checked, mismatches = await check_playback_summaries(batch_size=batch_size, conn=db_conn)
+    assert checked == 5
+    assert [mismatch['playback_id'] for mismatch in mismatches] == [playback['id'] for playback in playbacks]
+
+    assert await rebuild_playback_summaries(batch_size=batch_size, conn=db_conn) == 5
+
+    assert await check_playback_summaries(batch_size=batch_size, conn=db_conn) == (5, [])
+    summary = await get_playback_summary(playbacks[2]['id'], conn=db_conn)
+    assert (summary['downvotes'], summary['voters']) == (1, 1)
@@ -0,0 +1,110 @@
+import datetime
+
+import asynctest as am
+import pytest
+
+from mosbot.db import Action
+from mosbot.usecase.recent_playbacks import PlaybackRing, RecentPlayback, find_recent_playback, latest_playbacks, \
+    minutes_ago, record_dub, record_playback, record_skip, warm_up_recent_playbacks
+
+START = datetime.datetime(2000, 1, 1)
+
+
+def playback(id, name=None):
+    return RecentPlayback(id, START + datetime.timedelta(minutes=id), id, name or f'Track {id}', 1, 'dj')
+
+
+def test_recent_playback_slots():
+    with pytest.raises(AttributeError):
+        playback(1).other = 1
+    with pytest.raises(AttributeError):
+        PlaybackRing(1).other = 1
+
+
+def test_playback_ring():
+    ring = PlaybackRing(3)
+    assert ring.latest() == []
+
+    for id in range(1, 5):
+        ring.add(playback(id))
+
+    # The first one was replaced
+    assert [p.id for p in ring.latest()] == [4, 3, 2]
+    assert [p.id for p in ring.latest(2)] == [4, 3]
+    assert ring.get(1) is None
+    assert ring.get(3).track_name == 'Track 3'
+    assert len(ring) == 3
+
+    # Adding it again keeps the one there
+    existing = ring.get(4)
+    assert ring.add(playback(4)) is existing
+    assert [p.id for p in ring.latest()] == [4, 3, 2]
+
+
+def test_playback_ring_find():
+    ring = PlaybackRing(3)
+    ring.add(playback(1, 'Bohemian Rhapsody'))
+    ring.add(playback(2, 'Blue Monday'))
+    ring.add(playback(3, 'Bohemian Like You'))
+
+    assert ring.find('bohemian').id == 3
+    assert ring.find('RHAPSODY').id == 1
+    assert ring.find('queen') is None
+
+
+def test_playback_ring_votes():
+    ring = PlaybackRing(3)
+    ring.add(playback(1))
+
+    ring.dub(1, 'a', Action.upvote)
+    ring.dub(1, 'b', Action.upvote)
+    ring.dub(1, 'a', Action.downvote, Action.upvote)
+    ring.dub(1, 'c', Action.downvote, Action.downvote)
+    ring.dub(2, 'a', Action.upvote)
+    ring.skip(1)
+    ring.skip(2)
+
+    assert (ring.get(1).updubs, ring.get(1).downdubs, ring.get(1).skipped) == (1, 1, True)
+
+
+def test_playback_ring_updates_applied_again():
+    ring = PlaybackRing(3)
+    ring.add(playback(1))
+    ring.dub(1, 'a', Action.upvote)
+
+    # As if the transaction was rolled back and retried, the playback gets other id and the vote is counted again
+    again = RecentPlayback(5, playback(1).start, 1, 'Track 1', 1, 'dj')
+    assert ring.add(again) is ring.get(5)
+    assert ring.get(1) is None
+    ring.dub(5, 'a', Action.upvote)
+    ring.dub(5, 'a', Action.upvote, Action.downvote)
+
+    assert len(ring) == 1
+    assert (ring.get(5).updubs, ring.get(5).downdubs) == (1, 0)
+
+
+def test_record_playback():
+    ring = PlaybackRing(3)
+
+    with am.patch('mosbot.usecase.recent_playbacks.RECENT_PLAYBACKS', ring):
+        record_playback(playback_id=1, start=START, track_id=2, track_name='Track 2', user_id=3, username='dj')
+        record_dub(1, 4, Action.upvote)
+        record_skip(1)
+        recent, = latest_playbacks()
+        assert find_recent_playback('track') is recent
+
+    assert (recent.id, recent.track_id, recent.username, recent.updubs, recent.skipped) == (1, 2, 'dj', 1, True)
+    assert minutes_ago(recent, START + datetime.timedelta(minutes=5, seconds=30)) == 5
+
+
+@pytest.mark.asyncio
+async def test_warm_up_recent_playbacks(db_conn, track_generator, user_generator, playback_generator):
+    track = await track_generator()
+    user = await user_generator()
+    playbacks = [await playback_generator(user=user, track=track) for _ in range(3)]
+    ring = PlaybackRing(2)
+
+    assert await warm_up_recent_playbacks(ring=ring, conn=db_conn) == 2
+
+    assert [p.id for p in ring.latest()] == [playbacks[2]['id'], playbacks[1]['id']]
+    assert ring.latest(1)[0].username == user['username']
@@ -0,0 +1,137 @@
+import asyncio
+import datetime
+
+import asynctest as am
+import pytest
+
+from mosbot.db import Origin, Playback
+from mosbot.usecase.recommendations import TrackRecommender, refresh_recommendations, \
+    refresh_recommendations_forever, set_playing_track, suggest_tracks
+
+START = datetime.datetime(2000, 1, 1)
+
+
+def playback(id, minute, track_id, user_id=None):
+    return {
+        'id': id,
+        'start': START + datetime.timedelta(minutes=minute),
+        'track_id': track_id,
+        'user_id': user_id,
+        'track_name': f'Track {track_id}',
+        'origin': Origin.youtube,
+        'extid': f'extid {track_id}',
+    }
+
+
+def test_track_recommender():
+    recommender = TrackRecommender(window=600, top_k=2)
+
+    changed = recommender.add_playbacks([
+        playback(1, 0, 1, user_id=1),
+        playback(2, 4, 2, user_id=1),
+        playback(3, 8, 3, user_id=2),
+        # Out of the window of the first two, and by the same DJ as the third
+        playback(4, 16, 1, user_id=2),
+        # The same track again doesn't co-occur with itself
+        playback(5, 24, 1, user_id=2),
+    ])
+
+    assert changed == 3
+    assert recommender.cooccurrences == {
+        1: {2: 2, 3: 3},
+        2: {1: 2, 3: 1},
+        3: {1: 3, 2: 1},
+    }
+    assert recommender.recommend(1) == [(3, 3), (2, 2)]
+    assert recommender.recommend(3, 1) == [(1, 3)]
+    assert recommender.recommend(4) == []
+    assert recommender.latest_track_id == 1
+    assert [entry[1] for entry in recommender.recent] == [4, 5]
+
+    # Incrementally, only the changed tracks are ranked again
+    assert recommender.add_playbacks([playback(6, 30, 4)]) == 2
+    assert recommender.recommend(1) == [(3, 3), (2, 2)]
+    assert recommender.recommend(4) == [(1, 1)]
+    assert recommender.latest_track_id == 4
+
+
+def test_track_recommender_late_playback():
+    recommender = TrackRecommender(window=600, top_k=2)
+    recommender.add_playbacks([playback(1, 0, 1), playback(2, 4, 2)])
+
+    recommender.add_playbacks([playback(3, 2, 3)])
+
+    assert recommender.recommend(3) == [(1, 1), (2, 1)]
+    # It's not the one playing, it started before
+    assert recommender.latest_track_id == 2
+
+
+def test_suggest_tracks():
+    recommender = TrackRecommender(window=600, top_k=5)
+    assert suggest_tracks(3, recommender=recommender) == (None, [])
+
+    recommender.add_playbacks([playback(1, 0, 1), playback(2, 4, 2), playback(3, 8, 3), playback(4, 9, 1)])
+
+    # Ties go to the lowest track id
+    assert suggest_tracks(1, recommender=recommender) == ('Track 1', ['Track 2'])
+    assert suggest_tracks(5, recommender=recommender) == ('Track 1', ['Track 2', 'Track 3'])
+
+    # Once a track starts playing, it's the one playing, even before its playback is added
+    set_playing_track('youtube', 'extid 3', 'Track 3 upload', recommender=recommender)
+    assert suggest_tracks(1, recommender=recommender) == ('Track 3 upload', ['Track 1'])
+    set_playing_track('youtube', 'new', 'New track', recommender=recommender)
+    assert suggest_tracks(1, recommender=recommender) == ('New track', [])
+
+
+@pytest.mark.asyncio
+async def test_refresh_recommendations(db_conn, track_generator, user_generator, playback_generator):
+    tracks = [await track_generator() for _ in range(3)]
+    user = await user_generator()
+    for track in tracks:
+        await playback_generator(user=user, track=track)
+    recommender = TrackRecommender(window=600)
+
+    assert await refresh_recommendations(recommender, fetch_size=2, conn=db_conn) == 3
+    assert await refresh_recommendations(recommender, fetch_size=2, conn=db_conn) == 0
+    assert recommender.recommend(tracks[0]['id']) == [(tracks[1]['id'], 2), (tracks[2]['id'], 2)]
+
+    last = await playback_generator(user=await user_generator(), track=tracks[0])
+    assert await refresh_recommendations(recommender, conn=db_conn) == 1
+    assert recommender.watermark.last_id == last['id']
+    assert recommender.recommend(tracks[2]['id']) == [(tracks[0]['id'], 3), (tracks[1]['id'], 2)]
+    assert recommender.recommend(tracks[0]['id']) == [(tracks[1]['id'], 3), (tracks[2]['id'], 3)]
+    assert suggest_tracks(1, recommender=recommender) == (tracks[0]['name'], [tracks[1]['name']])
+
+
+@pytest.mark.asyncio
+async def test_refresh_recommendations_committed_out_of_order(db_conn, track_generator, user_generator,
+                                                              playback_generator):
+    tracks = [await track_generator() for _ in range(3)]
+    user = await user_generator()
+    first = await playback_generator(user=user, track=tracks[0])
+    # Saved before the last one, but committed after it was read
+    late = await playback_generator(user=user, track=tracks[1])
+    await playback_generator(user=user, track=tracks[2])
+    await db_conn.execute(Playback.delete().where(Playback.c.id == late['id']))
+    recommender = TrackRecommender(window=600, id_overlap=10)
+    assert await refresh_recommendations(recommender, conn=db_conn) == 2
+
+    await playback_generator(id=late['id'], user=user, track=tracks[1], start=late['start'])
+
+    assert await refresh_recommendations(recommender, conn=db_conn) == 1
+    assert recommender.recommend(tracks[1]['id']) == [(tracks[0]['id'], 2), (tracks[2]['id'], 2)]
+    assert recommender.recommend(first['track_id']) == [(tracks[1]['id'], 2), (tracks[2]['id'], 2)]
+
+
+@pytest.mark.asyncio
+async def test_refresh_recommendations_forever():
+    with am.patch('mosbot.usecase.recommendations.refresh_recommendations') as refresh_recommendations_mock, \
+            am.patch('mosbot.usecase.recommendations.asyncio.sleep') as sleep_mock:
+        refresh_recommendations_mock.side_effect = [ValueError(), 0]
+        sleep_mock.side_effect = [None, asyncio.CancelledError()]
+
+        with pytest.raises(asyncio.CancelledError):
+            await refresh_recommendations_forever(60)
+
+    assert refresh_recommendations_mock.await_count == 2
+    sleep_mock.assert_awaited_with(60)
@@ -0,0 +1,76 @@
+import datetime
+from unittest import mock
+
+import pytest
+
+from mosbot.db import Origin
+from mosbot.usecase.repeats import RecentPlays, playing_key, record_playing, warm_up_recent_plays
+
+START = datetime.datetime(2000, 1, 1)
+TRACK = (Origin.youtube, 'a')
+OTHER_TRACK = (Origin.soundcloud, 'a')
+
+
+def minutes(n):
+    return START + datetime.timedelta(minutes=n)
+
+
+def test_recent_plays():
+    recent = RecentPlays(window=3600)
+
+    assert recent.add(TRACK, minutes(0)) is None
+    assert recent.add(OTHER_TRACK, minutes(10)) is None
+    assert recent.add(TRACK, minutes(30)) == minutes(0)
+    # Adding it again is the same
+    assert recent.add(TRACK, minutes(30)) == minutes(0)
+    assert recent.last_played(TRACK, minutes(40)) == minutes(30)
+    assert recent.last_played(OTHER_TRACK, minutes(71)) is None
+
+    # Out of the window, the old plays are forgotten
+    assert recent.add(TRACK, minutes(100)) is None
+    assert recent.plays == {TRACK: (minutes(100), None)}
+    assert list(recent.expiry) == [(minutes(100), TRACK)]
+    assert recent.add(TRACK, minutes(130)) == minutes(100)
+    recent.expire(minutes(161))
+    assert recent.plays == {TRACK: (minutes(130), None)}
+    recent.expire(minutes(191))
+    assert recent.plays == {}
+    assert len(recent) == 0
+
+
+def test_recent_plays_out_of_order():
+    recent = RecentPlays(window=3600)
+    recent.add(TRACK, minutes(30))
+
+    # Added late, it's not a repeat of a later play
+    assert recent.add(TRACK, minutes(20)) is None
+    assert recent.plays == {TRACK: (minutes(30), minutes(20))}
+    assert recent.add(TRACK, minutes(10)) is None
+    assert recent.plays == {TRACK: (minutes(30), minutes(20))}
+    assert recent.add(TRACK, minutes(30)) == minutes(20)
+
+
+def test_record_playing():
+    event = mock.Mock(song_type='youtube', song_external_id='a', played=minutes(0))
+    recent = RecentPlays(window=3600)
+    assert playing_key(event) == TRACK
+
+    assert record_playing(event, recent=recent) is None
+    with mock.patch('mosbot.usecase.repeats.RECENT_PLAYS', recent):
+        event.played = minutes(5)
+        assert record_playing(event) == minutes(0)
+
+
+@pytest.mark.asyncio
+async def test_warm_up_recent_plays(db_conn, track_generator, user_generator, playback_generator):
+    tracks = [await track_generator(), await track_generator()]
+    user = await user_generator()
+    for track, start in ((tracks[0], minutes(0)), (tracks[0], minutes(70)), (tracks[1], minutes(80)),
+                         (tracks[0], minutes(90))):
+        await playback_generator(user=user, track=track, start=start)
+    recent = RecentPlays(window=3600)
+
+    assert await warm_up_recent_plays(minutes(120), recent=recent, conn=db_conn) == 2
+
+    keys = [(track['origin'], track['extid']) for track in tracks]
+    assert recent.plays == {keys[0]: (minutes(90), minutes(70)), keys[1]: (minutes(80), None)}
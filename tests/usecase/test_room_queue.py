@@ -0,0 +1,164 @@
+import asyncio
+
+import asynctest as am
+import pytest
+from abot.dubtrack import DubtrackPlaying, DubtrackRoomQueueReorder, DubtrackUserPauseQueue, \
+    DubtrackUserQueueUpdate, DubtrackUserUpdate
+
+from mosbot.usecase.room_queue import QueueItem, RoomQueue, apply_queue_event, parse_queue_details, \
+    reconcile_room_queue, reconcile_room_queue_forever, room_queue_fresh, upcoming_tracks
+
+
+def item(id, user_id='dj1'):
+    return QueueItem(id, user_id, 'youtube', f'ext{id}', f'Track {id}', 200)
+
+
+def details(*items):
+    return [
+        {
+            '_id': queue_item.id,
+            'userid': queue_item.user_id,
+            '_song': {
+                'type': queue_item.origin,
+                'fkid': queue_item.extid,
+                'name': queue_item.name,
+                'songLength': queue_item.length * 1000,
+            },
+        }
+        for queue_item in items
+    ]
+
+
+def event(cls, data):
+    return cls(data=data, dubtrack_backend=am.MagicMock())
+
+
+def test_parse_queue_details():
+    assert parse_queue_details(details(item('1'), item('2', user_id='dj2'))) == [item('1'), item('2', user_id='dj2')]
+
+
+def test_room_queue():
+    queue = RoomQueue()
+    assert not queue.fresh
+
+    drift = queue.reconcile([item('1'), item('2', 'dj2'), item('3'), item('4', 'dj3')])
+
+    # The first reconciliation isn't counted as drift, the model was empty
+    assert drift == {'missing': 4, 'unexpected': 0, 'misplaced': 0, 'stale': True}
+    assert queue.fresh
+    assert queue.upcoming(2) == [item('1'), item('2', 'dj2')]
+    assert queue.user_queue('dj1') == [item('1'), item('3')]
+
+    queue.playing('1', 'dj1')
+    assert queue.upcoming() == [item('2', 'dj2'), item('3'), item('4', 'dj3')]
+    assert queue.stale_users == {'dj1'}
+
+    queue.queue_paused('dj3', True)
+    assert queue.paused == {'dj3'}
+    assert queue.upcoming() == [item('2', 'dj2'), item('3')]
+    queue.user_updated('dj2', 0)
+    assert queue.upcoming() == [item('3')]
+    queue.reordered()
+    assert not queue.fresh
+
+    drift = queue.reconcile([item('5', 'dj2'), item('3')])
+
+    assert drift == {'missing': 1, 'unexpected': 0, 'misplaced': 0, 'stale': True}
+    assert queue.fresh
+    assert queue.stale_users == set()
+    assert queue.paused == {'dj3'}
+    assert queue.metrics() == {
+        'events': 4,
+        'reconciliations': 2,
+        'drifted': 1,
+        'missing': 5,
+        'unexpected': 0,
+        'misplaced': 0,
+        'size': 2,
+        'fresh': True,
+    }
+
+
+def test_room_queue_reconcile_drift():
+    queue = RoomQueue()
+    queue.reconcile([item('1'), item('2'), item('3'), item('4')])
+
+    drift = queue.reconcile([item('3'), item('2'), item('4'), item('5')])
+
+    assert drift == {'missing': 1, 'unexpected': 1, 'misplaced': 2, 'stale': False}
+    assert queue.upcoming() == [item('3'), item('2'), item('4'), item('5')]
+
+    queue.queue_paused('dj1', False)
+    assert queue.stale_users == {'dj1'}
+    assert queue.reconcile(queue.upcoming()) == {'missing': 0, 'unexpected': 0, 'misplaced': 0, 'stale': True}
+    assert queue.metrics()['drifted'] == 1
+
+
+def test_apply_queue_event():
+    queue = RoomQueue()
+    queue.reconcile([item('1'), item('2', 'dj2'), item('3', 'dj3'), item('4', 'dj4')])
+
+    apply_queue_event(event(DubtrackPlaying, {'song': {'_id': '1', 'userid': 'dj1'}}), queue=queue)
+    apply_queue_event(event(DubtrackUserQueueUpdate, {'user': {'_id': 'dj2'}}), queue=queue)
+    apply_queue_event(event(DubtrackUserPauseQueue, {
+        'user': {'_id': 'dj3'},
+        'user_queue': {'userid': 'dj3', 'queuePaused': 1, 'songsInQueue': 1},
+    }), queue=queue)
+    apply_queue_event(event(DubtrackUserUpdate, {'user': {'userid': 'dj4', 'songsInQueue': 0}}), queue=queue)
+    apply_queue_event(event(DubtrackRoomQueueReorder, {'user': {'_id': 'dj2'}}), queue=queue)
+
+    assert queue.upcoming() == [item('2', 'dj2')]
+    assert queue.stale_users == {'dj1', 'dj2'}
+    assert queue.paused == {'dj3'}
+    assert queue.order_stale
+    assert queue.metrics()['events'] == 5
+
+
+def test_upcoming_tracks():
+    queue = RoomQueue()
+    queue.reconcile([item('1'), item('2')])
+
+    with am.patch('mosbot.usecase.room_queue.ROOM_QUEUE', queue):
+        assert upcoming_tracks(1) == [item('1')]
+
+
+def test_room_queue_fresh():
+    queue = RoomQueue()
+    assert room_queue_fresh(queue=queue) is None
+
+    queue.reconcile([item('1')])
+    assert room_queue_fresh(queue=queue) is True
+
+    queue.queue_updated('dj1')
+    with am.patch('mosbot.usecase.room_queue.ROOM_QUEUE', queue):
+        assert room_queue_fresh() is False
+
+
+@pytest.mark.asyncio
+async def test_reconcile_room_queue():
+    queue = RoomQueue()
+    fetch = am.CoroutineMock(return_value=details(item('1')))
+
+    drift = await reconcile_room_queue(fetch, queue=queue)
+
+    assert drift['missing'] == 1
+    assert queue.upcoming() == [item('1')]
+    fetch.assert_awaited_once_with()
+
+
+@pytest.mark.asyncio
+async def test_reconcile_room_queue_forever():
+    fetch = am.CoroutineMock()
+    with am.patch('mosbot.usecase.room_queue.reconcile_room_queue') as reconcile_room_queue_mock, \
+            am.patch('mosbot.usecase.room_queue.asyncio.sleep') as sleep_mock:
+        reconcile_room_queue_mock.side_effect = [ValueError(), {}]
+        sleep_mock.side_effect = [None, None, None, asyncio.CancelledError()]
+        connected = am.MagicMock(side_effect=[False, True])
+
+        with pytest.raises(asyncio.CancelledError):
+            await reconcile_room_queue_forever(fetch, 300, connected=connected, connect_poll_interval=1)
+
+    assert reconcile_room_queue_mock.await_count == 2
+    reconcile_room_queue_mock.assert_awaited_with(fetch)
+    # It waits for the backend to connect, and reconciles right away
+    assert sleep_mock.await_args_list == [am.call(1), am.call(300), am.call(300), am.call(300)]
@@ -0,0 +1,30 @@
+import asynctest as am
+import pytest
+
+from mosbot.usecase.search import cached_search, normalize_search
+from mosbot.util import TTLCache
+
+
+def test_normalize_search():
+    assert normalize_search('  Bohemian\tRHAPSODY ') == 'bohemian rhapsody'
+
+
+@pytest.mark.asyncio
+async def test_cached_search():
+    cache = TTLCache(10, 60)
+    tracks = [{'id': 1, 'name': 'Bohemian Rhapsody'}]
+    users = [{'id': 2, 'username': 'Tom'}]
+    with am.patch('mosbot.usecase.search.search_tracks', return_value=tracks) as search_tracks_mock, \
+            am.patch('mosbot.usecase.search.search_users', return_value=users) as search_users_mock:
+        assert await cached_search('Rhapsody', cache=cache) == tracks
+        # Served from the cache
+        assert await cached_search(' rhapsody ', cache=cache) == tracks
+        assert await cached_search('rhapsody', limit=1, cache=cache) == tracks
+        assert await cached_search('tom', users=True, cache=cache) == users
+
+    assert search_tracks_mock.await_args_list == [
+        am.call('rhapsody', limit=5),
+        am.call('rhapsody', limit=1),
+    ]
+    search_users_mock.assert_awaited_once_with('tom', limit=5)
+    assert cache.metrics() == {'hits': 1, 'misses': 3, 'size': 3}
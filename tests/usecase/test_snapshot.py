@@ -0,0 +1,115 @@
+import datetime
+import json
+import tarfile
+
+import pytest
+
+from mosbot.db import Action, BotData, Origin, Playback, Track, User, UserAction, close_engine, \
+    create_blocking_engine, metadata
+from mosbot.query import get_user_action_partitions, truncate_tables
+from mosbot.usecase.snapshot import MANIFEST_NAME, SNAPSHOT_FORMAT, check_manifest, dependency_levels, \
+    export_snapshot, import_snapshot, parse_timestamp, read_manifest
+from mosbot.util import alembic_head_revision
+
+
+@pytest.mark.parametrize('ts', (
+        datetime.datetime(2000, 1, 1, 0, 1),
+        datetime.datetime(2000, 1, 1, 0, 1, 2, 345678),
+))
+def test_parse_timestamp(ts):
+    assert parse_timestamp(ts.isoformat()) == ts
+
+
+def test_dependency_levels():
+    levels = [sorted(table.name for table in level) for level in dependency_levels(metadata.sorted_tables)]
+    assert levels == [
+        ['activity_daily', 'activity_dirty', 'activity_hourly', 'bot_data', 'track', 'user'],
+        ['playback', 'track_canonical', 'track_stats', 'user_stats'],
+        ['playback_summary', 'user_action'],
+    ]
+    assert dependency_levels([]) == []
+
+
+def valid_manifest():
+    return {
+        'format': SNAPSHOT_FORMAT,
+        'revision': alembic_head_revision(),
+        'tables': {
+            table.name: {'rows': 0, 'columns': [column.name for column in table.c]} for table in metadata.sorted_tables
+        },
+    }
+
+
+@pytest.mark.parametrize('change, message', (
+        (lambda manifest: manifest.update(format=0), 'format 0 is not supported'),
+        (lambda manifest: manifest.update(revision='other'), 'revision other'),
+        (lambda manifest: manifest['tables'].pop('user'), 'tables are not the ones'),
+        (lambda manifest: manifest['tables']['user']['columns'].pop(), 'tables are not the ones'),
+))
+def test_check_manifest_fails(change, message):
+    manifest = valid_manifest()
+    check_manifest(manifest)
+    change(manifest)
+    with pytest.raises(ValueError) as e:
+        check_manifest(manifest)
+    assert message in str(e.value)
+
+
+@pytest.yield_fixture
+def blocking_engine(database):
+    engine = create_blocking_engine()
+    yield engine
+    with engine.begin() as conn:
+        truncate_tables(metadata.sorted_tables, conn=conn)
+    engine.dispose()
+
+
+def dump(engine):
+    with engine.connect() as conn:
+        return {
+            table.name: [tuple(row) for row in conn.execute(table.select().order_by(*table.primary_key.columns))]
+            for table in metadata.sorted_tables
+        }
+
+
+@pytest.mark.asyncio
+async def test_export_import_snapshot(blocking_engine, tmpdir):
+    with blocking_engine.begin() as conn:
+        user_id = conn.execute(User.insert().values(dtid='dtid', username='user').returning(User.c.id)).scalar()
+        track_id = conn.execute(Track.insert().values(
+            origin=Origin.youtube, extid='extid', name='name', length=100,
+        ).returning(Track.c.id)).scalar()
+        playback_id = conn.execute(Playback.insert().values(
+            track_id=track_id, user_id=user_id, start=datetime.datetime(2000, 1, 1),
+        ).returning(Playback.c.id)).scalar()
+        conn.execute(UserAction.insert().values(
+            playback_id=playback_id, user_id=user_id, action=Action.upvote, ts=datetime.datetime(2000, 1, 1, 0, 1),
+        ))
+    expected = dump(blocking_engine)
+    path = str(tmpdir.join('snapshot.tar'))
+
+    manifest = await export_snapshot(path, workers=2)
+
+    assert manifest == read_manifest(path)
+    assert manifest['revision'] == alembic_head_revision()
+    assert manifest['user_action_ts'] == ['2000-01-01T00:01:00', '2000-01-01T00:01:00']
+    assert manifest['tables']['user_action'] == {'rows': 1, 'columns': ['id', 'ts', 'playback_id', 'user_id', 'action']}
+    with tarfile.open(path) as archive:
+        assert archive.getnames()[0] == MANIFEST_NAME
+        assert json.load(archive.extractfile(MANIFEST_NAME)) == manifest
+
+    with pytest.raises(ValueError) as e:
+        await import_snapshot(path)
+    assert str(e.value) == 'Tables track, user, playback, user_action are not empty'
+
+    with blocking_engine.begin() as conn:
+        conn.execute(BotData.update().values(value=1))
+    assert await import_snapshot(path, workers=2, force=True) == {
+        name: table['rows'] for name, table in manifest['tables'].items()
+    }
+    assert dump(blocking_engine) == expected
+    assert 'user_action_y2000m01' in await get_user_action_partitions()
+    await close_engine()
+    with blocking_engine.begin() as conn:
+        assert conn.execute(User.insert().values(dtid='new', username='new').returning(User.c.id)).scalar() == \
+            user_id + 1
@@ -0,0 +1,58 @@
+import asynctest as am
+import pytest
+
+from mosbot.query import get_track_stats, get_user_stats
+from mosbot.usecase.stats import rebuild_stats
+
+
+@pytest.mark.asyncio
+async def test_rebuild_stats_empty(db_conn):
+    assert await rebuild_stats(conn=db_conn) == 0
+
+
+@pytest.mark.parametrize('batch_size', (1, 1000))
+@pytest.mark.asyncio
+async def test_rebuild_stats(
+        db_conn,
+        track_generator,
+        user_generator,
+        playback_generator,
+        batch_size,
+):
+    tracks = [await track_generator() for _ in range(2)]
+    users = [await user_generator() for _ in range(3)]
+    for user in users[:2]:
+        await playback_generator(user=user, track=tracks[0])
+    await db_conn.execute('INSERT INTO playback_summary (playback_id, upvotes, downvotes, voters, skipped) '
+                          'SELECT id, 0, 0, 0, false FROM playback')
+
+    batches = await rebuild_stats(batch_size=batch_size, conn=db_conn)
+
+    assert batches == (5 if batch_size == 1 else 2)
+    assert [(await get_user_stats(user['id'], conn=db_conn))['plays'] for user in users] == [1, 1, 0]
+    assert [(await get_track_stats(track['id'], conn=db_conn))['plays'] for track in tracks] == [2, 0]
+
+
+@pytest.mark.asyncio
+async def test_rebuild_stats_concurrent():
+    rebuild_user_stats_mock = am.CoroutineMock(__name__='rebuild_user_stats')
+    rebuild_track_stats_mock = am.CoroutineMock(__name__='rebuild_track_stats')
+    ranges = {'user': (1, 5), 'track': (3, 3)}
+
+    async def get_id_range(table, *, conn=None):
+        return ranges[table.name]
+
+    with am.patch('mosbot.usecase.stats.get_id_range', get_id_range), \
+            am.patch('mosbot.usecase.stats.ensure_connection') as ensure_connection_mock, \
+            am.patch('mosbot.usecase.stats.rebuild_user_stats', rebuild_user_stats_mock), \
+            am.patch('mosbot.usecase.stats.rebuild_track_stats', rebuild_track_stats_mock):
+        ensure_connection_mock.return_value = am.MagicMock()
+        assert await rebuild_stats(workers=2, batch_size=2) == 4
+
+    batch_conn = ensure_connection_mock.return_value.__aenter__.return_value
+    assert rebuild_user_stats_mock.await_args_list == [
+        am.call(1, 3, conn=batch_conn),
+        am.call(3, 5, conn=batch_conn),
+        am.call(5, 7, conn=batch_conn),
+    ]
+    rebuild_track_stats_mock.assert_awaited_once_with(3, 5, conn=batch_conn)